@@ -1,3 +1,25 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import Analysis, AnalysisCode, Job
+
+
+class AnalysisCodeInline(admin.TabularInline):
+    model = AnalysisCode
+    extra = 0
+    readonly_fields = ("position", "code", "modifiers", "created_at")
+
+
+@admin.register(Analysis)
+class AnalysisAdmin(admin.ModelAdmin):
+    list_display = ("id", "created_at", "final_cpt_code", "confidence", "mode", "source", "cached", "elapsed_ms")
+    list_filter = ("confidence", "mode", "source", "cached")
+    search_fields = ("final_cpt_code", "scenario_hash")
+    date_hierarchy = "created_at"
+    inlines = [AnalysisCodeInline]
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ("id", "status", "priority", "created_at", "started_at", "finished_at", "attempts", "worker")
+    list_filter = ("status", "priority")
+    search_fields = ("external_id",)
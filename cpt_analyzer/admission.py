@@ -0,0 +1,464 @@
+"""
+Admission control for the analysis endpoints.
+
+Every POST to an analysis path (settings.CPT_ADMISSION['PATHS']) passes
+three checks before the view runs:
+
+  rate limit   a token bucket per client (RATE requests per second, bursts of BURST);
+               over the limit -> 429 with Retry-After
+  quota        tokens spent by the client in the current QUOTA_WINDOW must be below its
+               quota (QUOTAS[client], else QUOTA_TOKENS; 0 = unlimited) -> 429 until the window ends
+  concurrency  at most MAX_CONCURRENT admitted requests run at once; up to MAX_QUEUE more
+               wait (first come, first served) for QUEUE_TIMEOUT seconds -> 503 with Retry-After
+
+A client is identified by its address (REMOTE_ADDR). Behind a proxy or API
+gateway that sets CLIENT_HEADER itself, enable TRUST_CLIENT_HEADER to use
+that header instead; never trust it when callers can reach the workers
+directly, since a new value per request would get a fresh bucket and quota. Streaming responses
+hold their slot until the stream is closed. The views charge each result's
+token usage to the client's quota (see charge()); queued jobs remember the
+submitting client and charge it when they run (see charge_client()).
+
+All state is local: buckets and the concurrency gate are per worker
+process, so the effective limits scale with the number of workers. Quotas
+use the in-process LocalQuotaStore, or SQLiteQuotaStore to share spend
+between the workers of a host.
+"""
+import asyncio
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+from django.utils.module_loading import import_string
+
+from .concurrency import ConcurrencyGate
+from .metrics import CallbackMetric, Counter, registry, timed
+
+DEFAULT_ADMISSION = {
+    "ENABLED": True,
+    "PATHS": ["/analyze/", "/jobs/"],
+    "CLIENT_HEADER": "X-Client-ID",
+    "TRUST_CLIENT_HEADER": False,
+    "RATE": 2.0,
+    "BURST": 20,
+    "MAX_CLIENTS": 10000,
+    "MAX_CONCURRENT": 32,
+    "MAX_QUEUE": 64,
+    "QUEUE_TIMEOUT": 10.0,
+    "RETRY_AFTER": 2,
+    "QUOTA_TOKENS": 0,
+    "QUOTAS": {},
+    "QUOTA_WINDOW": 86400,
+    "QUOTA_BACKEND": "cpt_analyzer.admission.LocalQuotaStore",
+    "QUOTA_OPTIONS": {},
+}
+
+# Error codes of rejected requests
+ERROR_RATE_LIMITED = "rate_limited"
+ERROR_QUOTA_EXCEEDED = "quota_exceeded"
+ERROR_OVERLOADED = "overloaded"
+
+ADMISSIONS = registry.register(Counter(
+    "cpt_admission_decisions_total",
+    "Admission decisions for analysis requests (admitted, queued, rate_limited, quota_exceeded, overloaded)",
+    ("decision",)))
+
+
+def admission_settings():
+    return {**DEFAULT_ADMISSION, **(getattr(settings, "CPT_ADMISSION", None) or {})}
+
+
+class TokenBucket:
+    """Holds up to `burst` tokens, refilled at `rate` per second; each request takes one"""
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic() if now is None else now
+
+    def take(self, now=None):
+        """Take a token; returns 0.0 when one was available, otherwise the seconds until there is one"""
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """A token bucket per client; the least recently seen clients are forgotten beyond `max_clients`"""
+
+    def __init__(self, rate, burst, max_clients=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, client, now=None):
+        """Seconds the client has to wait before its next request (0.0 = go ahead)"""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            bucket = self._buckets.pop(client, None) or TokenBucket(self.rate, self.burst, now)
+            self._buckets[client] = bucket
+            if len(self._buckets) > self.max_clients:
+                # Long idle, so its bucket would be full again anyway
+                self._buckets.popitem(last=False)
+            return bucket.take(now)
+
+
+class LocalQuotaStore:
+    """Tokens spent per client in fixed windows of `window` seconds, in this process only"""
+
+    def __init__(self, window=86400, **options):
+        self.window = window
+        self._spent = {}
+        self._lock = threading.Lock()
+
+    def window_of(self, now=None):
+        """(window number, seconds until the window ends)"""
+        now = time.time() if now is None else now
+        return int(now // self.window), self.window - now % self.window
+
+    def used(self, client, now=None):
+        current = self.window_of(now)[0]
+        with self._lock:
+            window, tokens = self._spent.get(client, (current, 0))
+        return tokens if window == current else 0
+
+    def spend(self, client, tokens, now=None):
+        current = self.window_of(now)[0]
+        with self._lock:
+            window, spent = self._spent.get(client, (current, 0))
+            self._spent[client] = (current, (spent if window == current else 0) + tokens)
+
+
+class SQLiteQuotaStore(LocalQuotaStore):
+    """Quota spend in an SQLite file, shared by the worker processes of a host"""
+
+    def __init__(self, path=None, window=86400, **options):
+        super().__init__(window)
+        self.path = str(path or os.path.join(settings.BASE_DIR, "cpt_quotas.sqlite3"))
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS quota_spend "
+                "(client TEXT NOT NULL, window INTEGER NOT NULL, tokens INTEGER NOT NULL, PRIMARY KEY (client, window))"
+            )
+            self._local.connection = connection
+        return connection
+
+    def used(self, client, now=None):
+        row = self._connection().execute(
+            "SELECT tokens FROM quota_spend WHERE client = ? AND window = ?", (client, self.window_of(now)[0])
+        ).fetchone()
+        return row[0] if row else 0
+
+    def spend(self, client, tokens, now=None):
+        window = self.window_of(now)[0]
+        connection = self._connection()
+        connection.execute(
+            "INSERT INTO quota_spend (client, window, tokens) VALUES (?, ?, ?) "
+            "ON CONFLICT (client, window) DO UPDATE SET tokens = tokens + excluded.tokens",
+            (client, window, tokens),
+        )
+        # Earlier windows are never read again
+        connection.execute("DELETE FROM quota_spend WHERE window < ?", (window - 1,))
+
+
+class Rejection:
+    """Why a request was not admitted, as an HTTP response"""
+
+    def __init__(self, status, code, message, retry_after):
+        self.status = status
+        self.code = code
+        self.message = message
+        self.retry_after = max(1, math.ceil(retry_after))
+
+    def response(self):
+        response = JsonResponse({"error": f"{self.message}. Retry in {self.retry_after}s.", "code": self.code,
+                                 "retry_after": self.retry_after}, status=self.status)
+        response["Retry-After"] = str(self.retry_after)
+        return response
+
+
+class AdmissionController:
+    """Rate limits, quotas and the concurrency gate of one worker process"""
+
+    def __init__(self, config):
+        self.config = config
+        self.paths = tuple(config["PATHS"])
+        self.limiter = RateLimiter(config["RATE"], config["BURST"], config["MAX_CLIENTS"])
+        self.gate = ConcurrencyGate(config["MAX_CONCURRENT"], config["MAX_QUEUE"])
+        self.quotas_enabled = bool(config["QUOTA_TOKENS"] or config["QUOTAS"])
+        options = {name.lower(): value for name, value in (config["QUOTA_OPTIONS"] or {}).items()}
+        self.quota = import_string(config["QUOTA_BACKEND"])(window=config["QUOTA_WINDOW"], **options)
+
+    def governs(self, request):
+        return request.method == "POST" and request.path.startswith(self.paths)
+
+    def client_id(self, request):
+        header = self.config["CLIENT_HEADER"] if self.config["TRUST_CLIENT_HEADER"] else ""
+        client = request.headers.get(header, "").strip() if header else ""
+        return client[:200] or request.META.get("REMOTE_ADDR") or "unknown"
+
+    def quota_for(self, client):
+        return self.config["QUOTAS"].get(client, self.config["QUOTA_TOKENS"])
+
+    def check_rate(self, client):
+        """A Rejection when the client is over its request rate, otherwise None"""
+        wait = self.limiter.take(client)
+        if not wait:
+            return None
+        return Rejection(429, ERROR_RATE_LIMITED,
+                         f"Too many requests: at most {self.config['RATE']:g} per second "
+                         f"(bursts of {self.config['BURST']}) per client", wait)
+
+    def check_quota(self, client):
+        """A Rejection when the client has spent its token quota for this window, otherwise None"""
+        quota = self.quota_for(client) if self.quotas_enabled else 0
+        if not quota or self.quota.used(client) < quota:
+            return None
+        return Rejection(429, ERROR_QUOTA_EXCEEDED,
+                         f"Token quota of {quota} per {self.config['QUOTA_WINDOW']}s exhausted",
+                         self.quota.window_of()[1])
+
+    def overloaded(self):
+        return Rejection(503, ERROR_OVERLOADED,
+                         f"Server busy: {self.gate.limit} analyses running and {self.gate.max_queue} waiting",
+                         self.config["RETRY_AFTER"])
+
+    def charge(self, client, usage):
+        if self.quotas_enabled:
+            tokens = usage.get("prompt_tokens", 0) + usage.get("completion_tokens", 0)
+            if tokens:
+                self.quota.spend(client, tokens)
+
+
+_admission = None
+_admission_lock = threading.Lock()
+
+
+def get_admission():
+    """Return the process-wide AdmissionController configured by settings.CPT_ADMISSION (None when disabled)"""
+    global _admission
+
+    if _admission is None:
+        with _admission_lock:
+            if _admission is None:
+                config = admission_settings()
+                if not config["ENABLED"]:
+                    return None
+                _admission = AdmissionController(config)
+    return _admission
+
+
+def reset_admission():
+    """Forget the configured controller so the next get_admission() call rebuilds it"""
+    global _admission
+    with _admission_lock:
+        _admission = None
+
+
+def charge_client(client, usage):
+    """Add token usage ({'prompt_tokens', 'completion_tokens'}) to a client's quota; queued jobs use this"""
+    admission = get_admission()
+    if client and admission is not None:
+        admission.charge(client, usage)
+
+
+def charge(request, usage):
+    """Add a finished analysis' token usage to the quota of the client that sent the request"""
+    charge_client(getattr(request, "admission_client", None), usage)
+
+
+async def acharge(request, usage):
+    """Async version of charge (the quota store may touch the disk)"""
+    if getattr(request, "admission_client", None) is not None:
+        await sync_to_async(charge)(request, usage)
+
+
+class ScenarioAdmission:
+    """
+    Admits each scenario of a batch request as if it were a request of its own
+
+    The request itself passed the middleware once; every scenario then takes
+    a rate-limit token (waiting for it rather than failing the rest of the
+    stream), passes the quota check and holds a concurrency slot while it
+    runs. BatchRunner(admit=...) charges each result as it completes, so a
+    large batch cannot run past the client's quota.
+    """
+
+    def __init__(self, admission, client):
+        self.admission = admission
+        self.client = client
+
+    @asynccontextmanager
+    async def __call__(self):
+        """Yields None while the scenario holds a slot, or the Rejection that stopped it"""
+        admission = self.admission
+        wait = admission.limiter.take(self.client)
+        while wait:
+            await asyncio.sleep(wait)
+            wait = admission.limiter.take(self.client)
+        rejection = None
+        if admission.quotas_enabled:
+            rejection = await sync_to_async(admission.check_quota)(self.client)
+        decision = None
+        if rejection is None:
+            decision = await admission.gate.aenter(admission.config["QUEUE_TIMEOUT"])
+            rejection = None if decision else admission.overloaded()
+        ADMISSIONS.inc(decision=rejection.code if rejection is not None else decision)
+        if rejection is not None:
+            yield rejection
+            return
+        try:
+            yield None
+        finally:
+            admission.gate.leave()
+
+    async def charge(self, usage):
+        await sync_to_async(self.admission.charge)(self.client, usage)
+
+
+def scenario_admission(request):
+    """A ScenarioAdmission for the client admitted for this request; None when admission is off"""
+    client = getattr(request, "admission_client", None)
+    admission = get_admission()
+    if client is None or admission is None:
+        return None
+    return ScenarioAdmission(admission, client)
+
+
+class _ReleasingStream:
+    """A streaming response's content that releases its slot once consumed or closed"""
+
+    def __init__(self, content, release):
+        self.content = content
+        self.release = release
+
+    def __iter__(self):
+        try:
+            yield from self.content
+        finally:
+            self.release()
+
+    def close(self):
+        # StreamingHttpResponse.close() closes its content, also when the client left before the first chunk
+        self.release()
+
+
+class _AsyncReleasingStream(_ReleasingStream):
+    __iter__ = None
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self.content:
+                yield chunk
+        finally:
+            self.release()
+
+
+def _hold_until_closed(response, gate):
+    """Release the slot now, or once a streaming response has been sent and closed"""
+    if not response.streaming:
+        gate.leave()
+        return response
+    released = threading.Lock()
+
+    def release():
+        if released.acquire(blocking=False):
+            gate.leave()
+
+    stream = _AsyncReleasingStream if response.is_async else _ReleasingStream
+    response.streaming_content = stream(response.streaming_content, release)
+    return response
+
+
+class AdmissionMiddleware:
+    """Apply the rate limit, quota and concurrency checks of AdmissionController to the analysis paths"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        admission = get_admission()
+        if admission is None or not admission.governs(request):
+            return self.get_response(request)
+        client = admission.client_id(request)
+        rejection = admission.check_rate(client) or admission.check_quota(client)
+        if rejection is None:
+            with timed("admission.wait"):
+                decision = admission.gate.enter(admission.config["QUEUE_TIMEOUT"])
+            rejection = None if decision else admission.overloaded()
+        if rejection is not None:
+            ADMISSIONS.inc(decision=rejection.code)
+            return rejection.response()
+        ADMISSIONS.inc(decision=decision)
+        request.admission_client = client
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            admission.gate.leave()
+            raise
+        return _hold_until_closed(response, admission.gate)
+
+    async def __acall__(self, request):
+        admission = get_admission()
+        if admission is None or not admission.governs(request):
+            return await self.get_response(request)
+        client = admission.client_id(request)
+        rejection = admission.check_rate(client)
+        if rejection is None and admission.quotas_enabled:
+            rejection = await sync_to_async(admission.check_quota)(client)
+        if rejection is None:
+            with timed("admission.wait"):
+                decision = await admission.gate.aenter(admission.config["QUEUE_TIMEOUT"])
+            rejection = None if decision else admission.overloaded()
+        if rejection is not None:
+            ADMISSIONS.inc(decision=rejection.code)
+            return rejection.response()
+        ADMISSIONS.inc(decision=decision)
+        request.admission_client = client
+        try:
+            response = await self.get_response(request)
+        except BaseException:
+            admission.gate.leave()
+            raise
+        return _hold_until_closed(response, admission.gate)
+
+
+def _gate_samples():
+    admission = _admission
+    if admission is None:
+        return {}
+    return {("active",): admission.gate.active, ("queued",): admission.gate.queued}
+
+
+registry.register(CallbackMetric(
+    "cpt_admission_requests", "Analysis requests holding a slot (active) or waiting for one (queued)", ("state",),
+    callback=_gate_samples))
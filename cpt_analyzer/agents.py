@@ -1,285 +1,351 @@
-import os
-import pandas as pd
-import openai
-import re
 from django.conf import settings
+from .catalog import get_catalog
+from .clients import achat_completion, chat_completion
+from .metrics import record_tokens, timed
+from .parsing import (
+    ANALYZER_FIELDS, VALIDATOR_FIELDS, find_code_tokens, format_codes, merge_responses, missing_fields,
+    parse_response, response_format,
+)
+from .prompts import ANALYZER_TEMPLATE, SECOND_OPINION_TEMPLATE, VALIDATOR_TEMPLATE
+from .retrieval import find_codes
 
-# Load the Excel file with CPT codes
-def load_cpt_data():
-    """Load CPT codes data from Excel file"""
-    try:
-        excel_path = os.path.join('data', 'Urinery.xlsx')
-        df = pd.read_excel(excel_path)
-        return df
-    except Exception as e:
-        print(f"Error loading CPT data: {e}")
-        return None
+def response_usage(response):
+    """Extract token usage from a chat completion response as a plain dict"""
+    usage = getattr(response, "usage", None)
+    details = getattr(usage, "prompt_tokens_details", None)
+    return {
+        "prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+        "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+        # Prompt tokens served from the provider's prompt cache (part of prompt_tokens)
+        "cached_tokens": getattr(details, "cached_tokens", 0) or 0,
+    }
 
-class CPTAnalyzerAgent:
+def add_usage(first, second):
+    return {name: first.get(name, 0) + second.get(name, 0) for name in first}
+
+# Per-stage completion options; settings.CPT_AGENT_MODELS overrides any of them
+DEFAULT_AGENT_MODELS = {
+    "analyzer": {"MODEL": "gpt-4o", "TEMPERATURE": 0.1, "MAX_TOKENS": 800},
+    "analyzer_fast": {"MODEL": "gpt-4o-mini", "TEMPERATURE": 0.1, "MAX_TOKENS": 800},
+    "validator": {"MODEL": "gpt-4o", "TEMPERATURE": 0.1, "MAX_TOKENS": 1000},
+    "second_opinion": {"MODEL": "gpt-4o", "TEMPERATURE": 0.1, "MAX_TOKENS": 600},
+}
+FAST_ANALYZER_STAGE = "analyzer_fast"
+
+def stage_options(stage):
+    """Completion options (model, temperature, max_tokens) for an agent stage"""
+    config = {**DEFAULT_AGENT_MODELS.get(stage, {}), **((getattr(settings, "CPT_AGENT_MODELS", None) or {}).get(stage) or {})}
+    return {"model": config["MODEL"], "temperature": config["TEMPERATURE"], "max_tokens": config["MAX_TOKENS"]}
+
+def tiering_settings():
+    return {
+        "ENABLED": False,
+        "ESCALATE_ON": ["check_failed", "low_confidence", "multi_procedure"],
+        "MIN_CONFIDENCE": "High",
+        "LOG_PATH": "",
+        **(getattr(settings, "CPT_MODEL_TIERING", None) or {}),
+    }
+
+def analyzer_stages():
+    """The analyzer stages a request may call, cheapest first"""
+    return (FAST_ANALYZER_STAGE, "analyzer") if tiering_settings()["ENABLED"] else ("analyzer",)
+
+FALLBACK_NOTE = "Note: Due to limited information in the scenario, a basic cystoscopy code (52000) has been provided as the most likely procedure. More specific coding would require additional procedural details."
+
+class StructuredResponseAgent:
+    """
+    Base class for agents that ask for a JSON response and parse it
+
+    Responses are requested with a json_schema response_format (when
+    settings.CPT_STRUCTURED_OUTPUT is on) and parsed by cpt_analyzer.parsing,
+    which also accepts the legacy labelled text format. If required fields
+    are still missing, one short follow-up asks for only those fields.
+    """
+    
+    fields = ()
+    stage = "agent"
+    schema_name = "cpt_response"
+    repair_max_tokens = 400
+    
+    @property
+    def completion_options(self):
+        """Model, temperature and max_tokens for this agent's stage (settings.CPT_AGENT_MODELS)"""
+        return stage_options(self.stage)
+    
+    def request_options(self, fields=None):
+        """Completion options for a request, including the response schema when enabled"""
+        options = dict(self.completion_options)
+        if settings.CPT_STRUCTURED_OUTPUT:
+            options["response_format"] = response_format(fields or self.fields, self.schema_name)
+        return options
+    
+    def repair_messages(self, messages, reply, missing):
+        """Follow-up conversation asking only for the fields missing from `reply`"""
+        return messages + [
+            {"role": "assistant", "content": reply},
+            {"role": "user", "content": f"Your answer did not include: {', '.join(missing)}. Reply with a JSON object containing only these fields."},
+        ]
+    
+    def repair_options(self, missing):
+        options = self.request_options(missing)
+        options["max_tokens"] = self.repair_max_tokens
+        return options
+    
+    def complete(self, messages):
+        """
+        Run the completion (and a repair call if fields are missing)
+        
+        Returns:
+            tuple: (parsed response dict, token usage dict)
+        """
+        with timed(f"{self.stage}.completion"):
+            response = chat_completion(messages=messages, **self.request_options())
+        reply = response.choices[0].message.content or ""
+        with timed(f"{self.stage}.parse"):
+            parsed, usage = parse_response(reply), response_usage(response)
+        missing = missing_fields(parsed, self.fields)
+        if missing and settings.CPT_REPAIR_MISSING_FIELDS:
+            with timed(f"{self.stage}.repair"):
+                repair = chat_completion(messages=self.repair_messages(messages, reply, missing), **self.repair_options(missing))
+            parsed = merge_responses(parsed, parse_response(repair.choices[0].message.content or ""))
+            usage = add_usage(usage, response_usage(repair))
+        record_tokens(self.stage, usage)
+        return parsed, usage
+    
+    async def acomplete(self, messages):
+        """Async version of complete"""
+        with timed(f"{self.stage}.completion"):
+            response = await achat_completion(messages=messages, **self.request_options())
+        reply = response.choices[0].message.content or ""
+        with timed(f"{self.stage}.parse"):
+            parsed, usage = parse_response(reply), response_usage(response)
+        missing = missing_fields(parsed, self.fields)
+        if missing and settings.CPT_REPAIR_MISSING_FIELDS:
+            with timed(f"{self.stage}.repair"):
+                repair = await achat_completion(messages=self.repair_messages(messages, reply, missing), **self.repair_options(missing))
+            parsed = merge_responses(parsed, parse_response(repair.choices[0].message.content or ""))
+            usage = add_usage(usage, response_usage(repair))
+        record_tokens(self.stage, usage)
+        return parsed, usage
+
+
+class CPTAnalyzerAgent(StructuredResponseAgent):
     """Agent that analyzes medical scenarios and provides CPT codes"""
     
-    def __init__(self):
-        self.cpt_data = load_cpt_data()
-        self.client = openai.OpenAI(api_key=settings.OPENAI_API_KEY)
+    fields = ANALYZER_FIELDS
+    stage = "analyzer"
+    schema_name = "cpt_analysis"
+    template = ANALYZER_TEMPLATE
+    
+    def __init__(self, catalog=None, stage="analyzer"):
+        # Model calls go through the shared, pooled clients in cpt_analyzer.clients.
+        # The catalog is the routed specialty shard(s); the default specialty otherwise.
+        # The stage picks the model: "analyzer", or "analyzer_fast" for the cheaper first tier.
+        self.catalog = catalog if catalog is not None else get_catalog()
+        self.stage = stage
     
-    def analyze_scenario(self, scenario_text):
+    def analyze_scenario(self, scenario_text, examples=(), guidance=()):
         """
         Analyze a medical scenario and return the appropriate CPT code(s)
         
         Args:
             scenario_text (str): The medical scenario to analyze
+            examples (list): Similar scenarios coded before, shown as few-shot context
+            guidance (list): Guideline passages retrieved for the scenario
             
         Returns:
             dict: Contains CPT code(s), description, and explanation
         """
-        # Convert DataFrame to a format that can be included in the prompt
-        if self.cpt_data is not None:
-            cpt_codes_context = self.cpt_data.to_string(index=False)
-        else:
+        with timed(f"{self.stage}.prompt"):
+            messages = self.build_messages(scenario_text, examples, guidance)
+        if messages is None:
             return {"error": "CPT data could not be loaded"}
         
-        # Create a prompt for the OpenAI model with enhanced modifier guidelines
-        prompt = f"""
-        You are a medical coding expert specializing in CPT codes for urinary system procedures.
-        
-        MEDICAL SCENARIO:
-        {scenario_text}
-        
-        AVAILABLE CPT CODES FROM DATABASE:
-        {cpt_codes_context}
-        
-        Based on the medical scenario and the available CPT codes, determine the most appropriate CPT code(s). 
-        You MUST provide a specific CPT code even if the scenario seems ambiguous - use your best judgment.
-        
-        IMPORTANT GUIDELINES FOR MULTIPLE PROCEDURES AND MODIFIERS:
-        
-        1. Identify all distinct procedures by looking for procedure terminology and action verbs (e.g., "performed", "underwent", "conducted").
-        
-        2. For multiple procedures performed during the same session/same day:
-           - Use modifier -51 (Multiple Procedure) for additional Category 1 CPT codes when the same provider performs multiple procedures
-           - Do NOT add the -51 modifier to the primary (most resource-intensive) procedure
-           - Only add the -51 modifier to secondary procedures
-        
-        3. Use modifier -59 (Distinct Procedural Service) when:
-           - A procedure would normally be bundled with another but is performed separately and independently
-           - The procedures are performed on different sites/organs
-           - The procedures are performed during different sessions on the same day
-        
-        4. Use modifier -50 (Bilateral Procedure) when:
-           - The same procedure is performed on both sides of the body
-           - The procedure is not already inherently bilateral
+        try:
+            parsed, usage = self.complete(messages)
+            result = self.finalize(parsed)
+            result["usage"] = usage
+            return result
+        except Exception as e:
+            return {"error": f"Error analyzing scenario: {str(e)}"}
+    
+    async def aanalyze_scenario(self, scenario_text, examples=(), guidance=()):
+        """Async version of analyze_scenario"""
+        with timed(f"{self.stage}.prompt"):
+            messages = self.build_messages(scenario_text, examples, guidance)
+        if messages is None:
+            return {"error": "CPT data could not be loaded"}
         
-        5. Sequence of codes:
-           - List the most resource-intensive or complex procedure FIRST without modifiers
-           - List additional procedures with appropriate modifiers afterward
+        try:
+            parsed, usage = await self.acomplete(messages)
+            result = self.finalize(parsed)
+            result["usage"] = usage
+            return result
+        except Exception as e:
+            return {"error": f"Error analyzing scenario: {str(e)}"}
+    
+    def build_messages(self, scenario_text, examples=(), guidance=()):
+        """
+        Build the chat messages for a scenario
         
-        FOR ALL SCENARIOS, you must provide a CPT code that best matches the description, even if some details are missing.
+        Returns:
+            list: Chat messages, or None if the CPT catalog is unavailable
+        """
+        if self.catalog is None:
+            return None
         
-        Provide your response in the following format:
-        CPT Code(s): [code(s) - if multiple codes, separate with commas, e.g., "51725, 51797-51"]
-        Description: [brief description of the code(s) - if multiple codes, separate descriptions with semicolons]
-        Explanation: [detailed explanation of why these code(s) are appropriate, including reasons for any modifiers used]
+        # The static system prefix is compiled once per catalog version; see cpt_analyzer.prompts
+        return self.template.compile(self.catalog, settings.CPT_PROMPT_TOP_K).messages(
+            scenario_text, examples=examples, guidance=guidance)
+    
+    def finalize(self, parsed):
         """
+        Turn a parsed response into the analyzer result, falling back when no code was given
+        """
+        codes = parsed["codes"]
+        explanation = parsed["explanation"]
         
-        try:
-            # Call OpenAI API with higher max tokens to allow for detailed response
-            response = self.client.chat.completions.create(
-                model="gpt-4o",  # Using GPT-4 for highest accuracy
-                messages=[
-                    {"role": "system", "content": "You are a medical coding expert specializing in CPT codes for urinary procedures. You ALWAYS provide a specific CPT code answer for any scenario."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.1,
-                max_tokens=800
-            )
-            
-            # Extract the response
-            result = response.choices[0].message.content
-            
-            # Parse the response to extract CPT code(s), description, and explanation
-            lines = result.strip().split('\n')
-            cpt_code = ""
-            description = ""
-            explanation = ""
-            
-            for line in lines:
-                if line.startswith("CPT Code") or line.startswith("CPT code"):
-                    cpt_code = line.replace("CPT Code(s):", "").replace("CPT Code:", "").replace("CPT code(s):", "").replace("CPT code:", "").strip()
-                elif line.startswith("Description"):
-                    description = line.replace("Description:", "").strip()
-                elif line.startswith("Explanation"):
-                    explanation = line.replace("Explanation:", "").strip()
-                    # Collect any additional lines as part of the explanation
-                    explanation_index = lines.index(line)
-                    if explanation_index < len(lines) - 1:
-                        additional_explanation = "\n".join(lines[explanation_index + 1:])
-                        explanation += " " + additional_explanation
-            
-            # Ensure we have a CPT code even if the model failed to provide one
-            if not cpt_code.strip():
-                # Attempt to extract any CPT-like codes from the explanation
-                pattern = r'\b\d{5}(?:-\d{1,2})?\b'
-                found_codes = re.findall(pattern, explanation)
-                if found_codes:
-                    cpt_code = ", ".join(found_codes)
-                else:
-                    # If no code was detected, provide a generic placeholder
-                    cpt_code = "52000"  # Basic cystoscopy as fallback
-                    explanation += " Note: Due to limited information in the scenario, a basic cystoscopy code (52000) has been provided as the most likely procedure. More specific coding would require additional procedural details."
-            
-            return {
-                "cpt_code": cpt_code,
-                "description": description,
-                "explanation": explanation
-            }
-            
-        except Exception as e:
-            return {"error": f"Error analyzing scenario: {str(e)}"}
+        # Ensure we have a CPT code even if the model failed to provide one
+        if not codes:
+            # Attempt to extract any CPT-like codes from the explanation
+            codes = find_code_tokens(explanation)
+            if not codes:
+                # If no code was detected, provide a generic placeholder
+                codes = [{"code": "52000", "modifiers": []}]  # Basic cystoscopy as fallback
+                explanation = f"{explanation} {FALLBACK_NOTE}".strip()
+        
+        return {
+            "cpt_code": format_codes(codes),
+            "codes": codes,
+            "description": parsed["description"],
+            "explanation": explanation
+        }
+
+
+class CPTSecondOpinionAgent(CPTAnalyzerAgent):
+    """
+    Agent that codes a scenario independently of the analyzer, with its own confidence
+
+    Used by the speculative pipeline mode, which runs it alongside the
+    analyzer and only calls the validator when the two disagree.
+    """
+    
+    fields = VALIDATOR_FIELDS
+    schema_name = "cpt_second_opinion"
+    template = SECOND_OPINION_TEMPLATE
+    
+    def __init__(self, catalog=None):
+        super().__init__(catalog, stage="second_opinion")
+    
+    def finalize(self, parsed):
+        result = super().finalize(parsed)
+        result["confidence"] = parsed["confidence"] or "Medium"
+        return result
 
 
-class CPTValidatorAgent:
-    """Agent that validates CPT codes using GPT-4"""
+class CPTValidatorAgent(StructuredResponseAgent):
+    """Agent that validates the analyzer's CPT codes"""
+    
+    fields = VALIDATOR_FIELDS
+    stage = "validator"
+    schema_name = "cpt_validation"
     
-    def __init__(self):
-        self.cpt_data = load_cpt_data()
-        self.client = openai.OpenAI(api_key=settings.OPENAI_API_KEY)
+    def __init__(self, catalog=None):
+        # Model calls go through the shared, pooled clients in cpt_analyzer.clients.
+        # The catalog is the routed specialty shard(s); the default specialty otherwise.
+        self.catalog = catalog if catalog is not None else get_catalog()
     
-    def validate_cpt_code(self, scenario_text, analyzer_result):
+    def validate_cpt_code(self, scenario_text, analyzer_result, guidance=()):
         """
         Validate the CPT code(s) provided by the analyzer agent
         
         Args:
             scenario_text (str): The original medical scenario
             analyzer_result (dict): The result from the analyzer agent
+            guidance (list): Guideline passages retrieved for the scenario
             
         Returns:
             dict: Contains validated CPT code(s), description, explanation, and confidence
         """
-        # Convert DataFrame to a format that can be included in the prompt
-        if self.cpt_data is not None:
-            cpt_codes_context = self.cpt_data.to_string(index=False)
-        else:
+        with timed("validator.prompt"):
+            messages = self.build_messages(scenario_text, analyzer_result, guidance)
+        if messages is None:
             return {"error": "CPT data could not be loaded"}
         
-        # Create a prompt for the OpenAI model with enhanced validation instructions
-        prompt = f"""
-        You are a senior medical coding expert specializing in CPT codes for urinary system procedures.
-        Your task is to validate the CPT code(s) provided by another agent.
-        
-        MEDICAL SCENARIO:
-        {scenario_text}
-        
-        FIRST AGENT'S ANALYSIS:
-        CPT Code(s): {analyzer_result.get('cpt_code', 'Not provided')}
-        Description: {analyzer_result.get('description', 'Not provided')}
-        Explanation: {analyzer_result.get('explanation', 'Not provided')}
-        
-        AVAILABLE CPT CODES FROM DATABASE:
-        {cpt_codes_context}
-        
-        Carefully review the scenario and the first agent's analysis. You MUST provide a specific CPT code even if the scenario seems ambiguous.
-        
-        IMPORTANT GUIDELINES FOR MULTIPLE PROCEDURES AND MODIFIERS:
-        
-        1. Identify all distinct procedures by looking for procedure terminology and action verbs (e.g., "performed", "underwent", "conducted").
-        
-        2. For multiple procedures performed during the same session/same day:
-           - Use modifier -51 (Multiple Procedure) for additional Category 1 CPT codes when the same provider performs multiple procedures
-           - Do NOT add the -51 modifier to the primary (most resource-intensive) procedure
-           - Only add the -51 modifier to secondary procedures
-        
-        3. Use modifier -59 (Distinct Procedural Service) when:
-           - A procedure would normally be bundled with another but is performed separately and independently
-           - The procedures are performed on different sites/organs
-           - The procedures are performed during different sessions on the same day
-        
-        4. Use modifier -50 (Bilateral Procedure) when:
-           - The same procedure is performed on both sides of the body
-           - The procedure is not already inherently bilateral
+        try:
+            parsed, usage = self.complete(messages)
+            result = self.finalize(parsed, analyzer_result)
+            result["usage"] = usage
+            return result
+        except Exception as e:
+            return {"error": f"Error validating CPT code: {str(e)}"}
+    
+    async def avalidate_cpt_code(self, scenario_text, analyzer_result, guidance=()):
+        """Async version of validate_cpt_code"""
+        with timed("validator.prompt"):
+            messages = self.build_messages(scenario_text, analyzer_result, guidance)
+        if messages is None:
+            return {"error": "CPT data could not be loaded"}
         
-        5. Sequence of codes:
-           - List the most resource-intensive or complex procedure FIRST without modifiers
-           - List additional procedures with appropriate modifiers afterward
+        try:
+            parsed, usage = await self.acomplete(messages)
+            result = self.finalize(parsed, analyzer_result)
+            result["usage"] = usage
+            return result
+        except Exception as e:
+            return {"error": f"Error validating CPT code: {str(e)}"}
+    
+    def build_messages(self, scenario_text, analyzer_result, guidance=()):
+        """
+        Build the chat messages for validating an analyzer result
         
-        You MUST provide a specific CPT code answer, even if you need to make reasonable assumptions based on the scenario.
+        Returns:
+            list: Chat messages, or None if the CPT catalog is unavailable
+        """
+        if self.catalog is None:
+            return None
         
-        Provide your response in the following format:
-        CPT Code(s): [code(s) - if multiple codes, separate with commas, e.g., "51725, 51797-51"]
-        Description: [brief description of the code(s) - if multiple codes, separate descriptions with semicolons]
-        Explanation: [detailed explanation of why these code(s) are appropriate]
-        Confidence: [High/Medium/Low] - your confidence in this/these code(s) being correct
+        # Keep the analyzer's own codes among the candidates shown to the validator
+        compiled = VALIDATOR_TEMPLATE.compile(self.catalog, settings.CPT_PROMPT_TOP_K)
+        return compiled.messages(
+            scenario_text,
+            extra_codes=find_codes(analyzer_result.get('cpt_code', '')),
+            guidance=guidance,
+            cpt_code=analyzer_result.get('cpt_code') or 'Not provided',
+            description=analyzer_result.get('description') or 'Not provided',
+            explanation=analyzer_result.get('explanation') or 'Not provided',
+        )
+    
+    def finalize(self, parsed, analyzer_result):
+        """
+        Turn a parsed response into the validator result, falling back to the analyzer's answer
         """
+        codes = parsed["codes"]
+        description = parsed["description"]
+        explanation = parsed["explanation"]
+        confidence = parsed["confidence"]
         
-        try:
-            # Call OpenAI API with higher max tokens to allow for detailed response
-            response = self.client.chat.completions.create(
-                model="gpt-4o",  # Using GPT-4 for maximum accuracy
-                messages=[
-                    {"role": "system", "content": "You are a senior medical coding expert specializing in CPT codes for urinary procedures. You ALWAYS provide a specific CPT code answer for any scenario."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.1,
-                max_tokens=1000
-            )
-            
-            # Extract the response
-            result = response.choices[0].message.content
-            
-            # Parse the response to extract CPT code(s), description, explanation, and confidence
-            lines = result.strip().split('\n')
-            cpt_code = ""
-            description = ""
-            explanation = ""
-            confidence = ""
-            
-            for line in lines:
-                if line.startswith("CPT Code") or line.startswith("CPT code"):
-                    cpt_code = line.replace("CPT Code(s):", "").replace("CPT Code:", "").replace("CPT code(s):", "").replace("CPT code:", "").strip()
-                elif line.startswith("Description"):
-                    description = line.replace("Description:", "").strip()
-                elif line.startswith("Explanation"):
-                    explanation = line.replace("Explanation:", "").strip()
-                    # Collect any additional lines as part of the explanation
-                    explanation_index = lines.index(line)
-                    if explanation_index < len(lines) - 1 and not lines[explanation_index + 1].startswith("Confidence:"):
-                        additional_explanation = "\n".join([l for l in lines[explanation_index + 1:] if not l.startswith("Confidence:")])
-                        explanation += " " + additional_explanation
-                elif line.startswith("Confidence:"):
-                    confidence = line.replace("Confidence:", "").strip()
-            
-            # Ensure we have a CPT code even if the model failed to provide one
-            if not cpt_code.strip():
-                # First try to use the analyzer's code if available
-                if analyzer_result.get('cpt_code') and analyzer_result.get('cpt_code').strip():
-                    cpt_code = analyzer_result.get('cpt_code')
-                    if not confidence:
-                        confidence = "Low"
-                    if not description:
-                        description = analyzer_result.get('description', "Description not available")
-                    explanation += "\n\nNo better alternative could be determined, so the original code has been retained."
-                else:
-                    # Attempt to extract any CPT-like codes from the explanation
-                    pattern = r'\b\d{5}(?:-\d{1,2})?\b'
-                    found_codes = re.findall(pattern, explanation)
-                    if found_codes:
-                        cpt_code = ", ".join(found_codes)
-                    else:
-                        # If no code was detected, provide a generic placeholder
-                        cpt_code = "52000"  # Basic cystoscopy as fallback
-                        explanation += "\n\nNote: Due to limited information in the scenario, a basic cystoscopy code (52000) has been provided as the most likely procedure. More specific coding would require additional procedural details."
-                        if not confidence:
-                            confidence = "Low"
-            
-            # Set a default confidence if none was provided
-            if not confidence:
-                confidence = "Medium"
-            
-            return {
-                "cpt_code": cpt_code,
-                "description": description,
-                "explanation": explanation,
-                "confidence": confidence
-            }
-            
-        except Exception as e:
-            return {"error": f"Error validating CPT code: {str(e)}"} 
\ No newline at end of file
+        # Ensure we have a CPT code even if the model failed to provide one
+        if not codes:
+            # First try to use the analyzer's code if available
+            if analyzer_result.get('cpt_code', '').strip():
+                codes = analyzer_result.get('codes') or find_code_tokens(analyzer_result['cpt_code'])
+                confidence = confidence or "Low"
+                description = description or analyzer_result.get('description', "Description not available")
+                explanation += "\n\nNo better alternative could be determined, so the original code has been retained."
+            else:
+                # Attempt to extract any CPT-like codes from the explanation
+                codes = find_code_tokens(explanation)
+                if not codes:
+                    # If no code was detected, provide a generic placeholder
+                    codes = [{"code": "52000", "modifiers": []}]  # Basic cystoscopy as fallback
+                    explanation += "\n\n" + FALLBACK_NOTE
+                    confidence = confidence or "Low"
+        
+        return {
+            "cpt_code": format_codes(codes),
+            "codes": codes,
+            "description": description,
+            "explanation": explanation,
+            "confidence": confidence or "Medium"
+        }
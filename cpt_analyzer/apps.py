@@ -4,3 +4,4 @@ from django.apps import AppConfig
 class CptAnalyzerConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "cpt_analyzer"
+
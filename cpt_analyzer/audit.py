@@ -0,0 +1,202 @@
+"""
+Persistence of pipeline results for audit, reuse and analytics.
+
+Results are written as an Analysis row plus one AnalysisCode row per final
+code. Web requests insert one analysis at a time; batch runs go through
+AuditBuffer, which bulk-inserts in chunks. Queries use keyset pagination
+(newest first, `before=<id>`), so page N costs the same as page 1 on large
+tables, and code/date filters go through the (code, created_at) index.
+"""
+import datetime
+import hashlib
+import logging
+import threading
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .cache import normalize_scenario
+from .models import Analysis, AnalysisCode
+from .parsing import find_code_tokens
+from .pipeline import result_usage
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def scenario_hash(scenario_text):
+    return hashlib.sha256(normalize_scenario(scenario_text).encode("utf-8")).hexdigest()
+
+
+def build_analysis(scenario_text, result, source=Analysis.SOURCE_WEB):
+    """
+    Unsaved Analysis and AnalysisCode objects for a pipeline result
+
+    Returns:
+        tuple: (Analysis, list of AnalysisCode without analysis set)
+    """
+    pipeline = result.get("pipeline") or {}
+    # Reused results (cache hits, coalesced, semantic matches) spent no tokens of their own
+    usage = result_usage(result)
+    trace = result.get("trace") or {}
+    created_at = timezone.now()
+    analysis = Analysis(
+        created_at=created_at,
+        source=source,
+        trace_id=trace.get("id", ""),
+        scenario_hash=scenario_hash(scenario_text),
+        scenario_text=scenario_text,
+        final_cpt_code=result.get("final_cpt_code", "")[:255],
+        final_description=result.get("final_description", ""),
+        confidence=result.get("confidence", "")[:32],
+        has_multiple_codes=bool(result.get("has_multiple_codes")),
+        mode=pipeline.get("mode", ""),
+        path=pipeline.get("path", ""),
+        specialties=",".join(pipeline.get("specialties") or []),
+        cached=bool(result.get("cached") or result.get("coalesced")),
+        catalog_version=pipeline.get("catalog_version", ""),
+        prompt_version=pipeline.get("prompt_version", ""),
+        elapsed_ms=pipeline.get("elapsed_ms"),
+        prompt_tokens=usage.get("prompt_tokens", 0),
+        completion_tokens=usage.get("completion_tokens", 0),
+        cached_tokens=usage.get("cached_tokens", 0),
+        analyzer_result=result.get("analyzer_result") or {},
+        validator_result=result.get("validator_result") or {},
+        rule_findings=result.get("rule_findings") or [],
+        stage_timings=trace.get("stages") or {},
+    )
+    final_codes = result.get("final_codes") or find_code_tokens(result.get("final_cpt_code", ""))
+    codes = [
+        AnalysisCode(position=position, code=code["code"], modifiers=",".join(code["modifiers"]), created_at=created_at)
+        for position, code in enumerate(final_codes)
+    ]
+    return analysis, codes
+
+
+def save_analyses(built, batch_size=500):
+    """Insert (Analysis, codes) pairs with two bulk inserts in one transaction"""
+    if not built:
+        return []
+    with transaction.atomic():
+        analyses = Analysis.objects.bulk_create([analysis for analysis, _ in built], batch_size=batch_size)
+        codes = []
+        for analysis, analysis_codes in zip(analyses, (codes for _, codes in built)):
+            for code in analysis_codes:
+                code.analysis = analysis
+                codes.append(code)
+        AnalysisCode.objects.bulk_create(codes, batch_size=batch_size)
+    return analyses
+
+
+def record_analysis(scenario_text, result, source=Analysis.SOURCE_WEB):
+    """
+    Store one result; returns the Analysis or None
+
+    A no-op when settings.CPT_AUDIT_ENABLED is off. Database errors are logged
+    rather than raised so auditing can never fail the request it records.
+    """
+    if not settings.CPT_AUDIT_ENABLED or "error" in result:
+        return None
+    try:
+        return save_analyses([build_analysis(scenario_text, result, source)])[0]
+    except Exception as e:
+        logger.error("Could not store analysis: %s", e)
+        return None
+
+
+arecord_analysis = sync_to_async(record_analysis)
+
+
+class AuditBuffer:
+    """Collects batch results and bulk-inserts them every `size` results (and on flush)"""
+
+    def __init__(self, size=None, source=Analysis.SOURCE_BATCH):
+        self.size = size or settings.CPT_AUDIT_BATCH_SIZE
+        self.source = source
+        self.saved = 0
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def add(self, scenario_text, result):
+        if not settings.CPT_AUDIT_ENABLED or "error" in result:
+            return
+        with self._lock:
+            self._pending.append(build_analysis(scenario_text, result, self.source))
+            full = len(self._pending) >= self.size
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        try:
+            self.saved += len(save_analyses(pending))
+        except Exception as e:
+            logger.error("Could not store %d batch analyses: %s", len(pending), e)
+
+
+def _parse_moment(value, end=False):
+    """ISO date or datetime -> aware datetime; a bare date covers the whole day when end=True"""
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(f"Invalid date '{value}' (expected YYYY-MM-DD or an ISO datetime)")
+        moment = datetime.datetime.combine(day, datetime.time.max if end else datetime.time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def query_analyses(params):
+    """
+    Filter and paginate stored analyses
+
+    Args:
+        params (dict): Optional filters: code, confidence, mode, source, specialty,
+            scenario (text, matched by hash), scenario_hash, since, until (ISO dates);
+            paging: limit, before (id of the last row of the previous page)
+
+    Returns:
+        dict: {"results": [...], "next": id to pass as `before`, or None}
+    """
+    queryset = Analysis.objects.all()
+    since = _parse_moment(params["since"]) if params.get("since") else None
+    until = _parse_moment(params["until"], end=True) if params.get("until") else None
+
+    if params.get("code"):
+        codes = AnalysisCode.objects.filter(code=params["code"])
+        if since:
+            codes = codes.filter(created_at__gte=since)
+        if until:
+            codes = codes.filter(created_at__lte=until)
+        queryset = queryset.filter(id__in=codes.values("analysis_id"))
+    if since:
+        queryset = queryset.filter(created_at__gte=since)
+    if until:
+        queryset = queryset.filter(created_at__lte=until)
+    if params.get("scenario"):
+        queryset = queryset.filter(scenario_hash=scenario_hash(params["scenario"]))
+    if params.get("scenario_hash"):
+        queryset = queryset.filter(scenario_hash=params["scenario_hash"])
+    for field in ("confidence", "mode", "source"):
+        if params.get(field):
+            queryset = queryset.filter(**{field: params[field]})
+    if params.get("specialty"):
+        queryset = queryset.filter(specialties__contains=params["specialty"])
+
+    limit = min(max(int(params.get("limit") or DEFAULT_PAGE_SIZE), 1), MAX_PAGE_SIZE)
+    if params.get("before"):
+        queryset = queryset.filter(id__lt=int(params["before"]))
+    rows = list(queryset.order_by("-id")[: limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "results": [row.as_dict() for row in rows],
+        "next": rows[-1].pk if has_more else None,
+    }
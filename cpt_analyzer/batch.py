@@ -0,0 +1,255 @@
+"""
+Bulk coding of scenario files.
+
+Used by the /analyze/batch/ view and the `code_scenarios` management
+command. Scenarios are read from CSV, JSONL or XLSX, run through the
+pipeline with bounded concurrency; rate-limit, connection and server
+errors are retried with jittered exponential backoff, other errors (an
+over-budget scenario, a missing catalog) fail at once. Results are yielded as they complete so callers can stream them.
+"""
+import asyncio
+import csv
+import io
+import json
+import os
+import random
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .audit import AuditBuffer
+from .pipeline import arun_pipeline, result_usage
+
+SUPPORTED_FORMATS = ("csv", "jsonl", "xlsx")
+RATE_LIMIT_MARKERS = ("429", "rate limit", "ratelimit", "too many requests")
+# Wording of the OpenAI client's connection, timeout and 5xx errors as the agents report them
+TRANSIENT_MARKERS = ("connection error", "timed out", "timeout", "error code: 5", "internal server error",
+                     "bad gateway", "service unavailable", "overloaded", "temporarily")
+
+
+def detect_format(filename):
+    """Guess the input format from a file name"""
+    extension = os.path.splitext(filename or "")[1].lower().lstrip(".")
+    if extension in ("json", "ndjson"):
+        return "jsonl"
+    if extension == "xls":
+        return "xlsx"
+    return extension
+
+
+def normalize_record(row, index):
+    """Normalize one input row to {'id': ..., 'scenario': ...}"""
+    if isinstance(row, str):
+        return {"id": str(index), "scenario": row}
+    scenario = row.get("scenario") or row.get("Scenario") or ""
+    identifier = row.get("id") or row.get("ID") or index
+    return {"id": str(identifier), "scenario": str(scenario).strip()}
+
+
+def read_scenarios(source, fmt):
+    """
+    Read scenarios from a path or binary file object
+
+    Args:
+        source: File path or binary file-like object
+        fmt (str): One of 'csv', 'jsonl' or 'xlsx'
+
+    Returns:
+        list: {'id': str, 'scenario': str} records; rows without a scenario are dropped
+    """
+    if fmt not in SUPPORTED_FORMATS:
+        raise ValueError(f"Unsupported batch format '{fmt}' (expected one of {', '.join(SUPPORTED_FORMATS)})")
+
+    if fmt == "xlsx":
+        import pandas as pd
+
+        rows = pd.read_excel(source).fillna("").to_dict("records")
+    else:
+        handle = open(source, "rb") if isinstance(source, (str, os.PathLike)) else source
+        try:
+            text = io.TextIOWrapper(handle, encoding="utf-8-sig")
+            if fmt == "csv":
+                rows = list(csv.DictReader(text))
+            else:
+                rows = [json.loads(line) for line in text if line.strip()]
+            text.detach()
+        finally:
+            if handle is not source:
+                handle.close()
+
+    records = [normalize_record(row, index) for index, row in enumerate(rows, start=1)]
+    return [record for record in records if record["scenario"]]
+
+
+def is_rate_limited(message):
+    message = (message or "").lower()
+    return any(marker in message for marker in RATE_LIMIT_MARKERS)
+
+
+def is_transient(message):
+    """Whether a pipeline error may go away on retry (rate limits, connection and server errors)"""
+    return is_rate_limited(message) or any(marker in (message or "").lower() for marker in TRANSIENT_MARKERS)
+
+
+class BatchStats:
+    """Running totals for a batch run"""
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.completed = 0
+        self.failed = 0
+        self.cached = 0
+        self.retries = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+
+    def add(self, record):
+        if record["status"] == "ok":
+            self.completed += 1
+            self.cached += bool(record["result"].get("cached"))
+            usage = result_usage(record["result"])
+            self.prompt_tokens += usage["prompt_tokens"]
+            self.completion_tokens += usage["completion_tokens"]
+            self.cached_tokens += usage["cached_tokens"]
+        else:
+            self.failed += 1
+        self.retries += max(0, record["attempts"] - 1)
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started_at
+        processed = self.completed + self.failed
+        return {
+            "processed": processed,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cached": self.cached,
+            "retries": self.retries,
+            "elapsed_seconds": round(elapsed, 2),
+            "scenarios_per_minute": round(processed / elapsed * 60, 2) if elapsed else 0.0,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.prompt_tokens + self.completion_tokens,
+            "cached_prompt_tokens": self.cached_tokens,
+        }
+
+
+class BatchRunner:
+    """
+    Run many scenarios through the pipeline with bounded concurrency
+
+    A rate-limit error from any scenario pauses every worker for the backoff
+    delay, so a burst of 429s does not turn into a burst of retries.
+    """
+
+    def __init__(self, concurrency=None, max_retries=None, backoff=None, use_cache=True, mode=None, audit=True,
+                 admit=None):
+        self.concurrency = max(1, concurrency or settings.CPT_BATCH_CONCURRENCY)
+        self.max_retries = settings.CPT_BATCH_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff = settings.CPT_BATCH_BACKOFF_SECONDS if backoff is None else backoff
+        self.use_cache = use_cache
+        self.mode = mode
+        self.stats = BatchStats()
+        # Successful results are bulk-inserted into the audit store (see cpt_analyzer.audit)
+        self.audit = AuditBuffer() if audit and settings.CPT_AUDIT_ENABLED else None
+        # Optional per-scenario admission (cpt_analyzer.admission.ScenarioAdmission) for web batches
+        self.admit = admit
+        self._resume_at = 0.0
+
+    def _delay(self, attempt):
+        return self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+    async def _wait_for_cooldown(self):
+        delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def run_one(self, item):
+        """Run one scenario with retries, returning its output record"""
+        attempt = 0
+        while True:
+            await self._wait_for_cooldown()
+            result = await arun_pipeline(item["scenario"], use_cache=self.use_cache, mode=self.mode)
+            if "error" not in result:
+                return {"id": item["id"], "status": "ok", "attempts": attempt + 1, "result": result}
+            if attempt >= self.max_retries or not is_transient(result["error"]):
+                return {"id": item["id"], "status": "error", "attempts": attempt + 1, "error": result["error"]}
+
+            delay = self._delay(attempt)
+            if is_rate_limited(result["error"]):
+                self._resume_at = max(self._resume_at, time.monotonic() + delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _admitted_run(self, item):
+        """
+        run_one() once the scenario is admitted; a rejected scenario fails without being attempted
+
+        Its tokens are charged before the next scenario is admitted, so the quota check sees them.
+        """
+        if self.admit is None:
+            return await self.run_one(item)
+        async with self.admit() as rejection:
+            if rejection is not None:
+                return {"id": item["id"], "status": "error", "attempts": 0, "error": rejection.message,
+                        "code": rejection.code}
+            record = await self.run_one(item)
+            if record["status"] == "ok":
+                await self.admit.charge(result_usage(record["result"]))
+            return record
+
+    async def run(self, items):
+        """
+        Process items, yielding output records in completion order
+
+        Args:
+            items (iterable): {'id': ..., 'scenario': ...} records
+        """
+        pending = iter(items)
+        results = asyncio.Queue()
+
+        async def worker():
+            for item in pending:
+                try:
+                    record = await self._admitted_run(item)
+                except Exception as e:
+                    record = {"id": item["id"], "status": "error", "attempts": 1, "error": str(e)}
+                if self.audit is not None and record["status"] == "ok":
+                    await sync_to_async(self.audit.add)(item["scenario"], record["result"])
+                await results.put(record)
+            await results.put(None)
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            remaining = len(workers)
+            while remaining:
+                record = await results.get()
+                if record is None:
+                    remaining -= 1
+                    continue
+                self.stats.add(record)
+                yield record
+        finally:
+            for task in workers:
+                task.cancel()
+            # Also when the consumer stops early or fails: completed results must not be lost
+            if self.audit is not None:
+                await sync_to_async(self.audit.flush)()
+
+
+def completed_ids(output_path):
+    """Ids already written to an output file, used to resume an interrupted run"""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, encoding="utf-8") as handle:
+        for line in handle:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A crash can leave a partial last line; that scenario is simply redone
+                continue
+            if record.get("status") == "ok":
+                done.add(str(record.get("id")))
+    return done
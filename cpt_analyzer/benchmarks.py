@@ -0,0 +1,155 @@
+"""
+Helpers for measuring the pipeline against the labeled scenario corpus.
+"""
+import asyncio
+import math
+import statistics
+import time
+
+from .pipeline import PATH_LOCAL, PATH_RECONCILED, arun_pipeline, result_usage
+from .prompts import prompt_version
+
+
+def normalize_code_set(codes):
+    """Comparable set of 'CODE-MOD' strings"""
+    return {code.strip().upper().replace(" ", "") for code in codes if code.strip()}
+
+
+def score_codes(predicted, gold):
+    """
+    Compare predicted codes with the labeled ones
+
+    Returns:
+        dict: exact (same codes and modifiers), partial (base codes overlap)
+    """
+    predicted, gold = normalize_code_set(predicted), normalize_code_set(gold)
+    base = lambda codes: {code.split("-")[0] for code in codes}
+    return {
+        "exact": predicted == gold,
+        "partial": bool(base(predicted) & base(gold)),
+    }
+
+
+def percentile(values, q):
+    """Nearest-rank percentile (q in 0-100) of a list of numbers; 0.0 when empty"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+async def run_benchmark(labeled, mode, concurrency=1, use_cache=False):
+    """
+    Run every labeled scenario through the pipeline with up to `concurrency` requests in flight
+
+    Returns:
+        dict: Latency percentiles, throughput, model calls, tokens and accuracy for the run
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def run_one(record):
+        async with semaphore:
+            started = time.monotonic()
+            result = await arun_pipeline(record["scenario"], use_cache=use_cache, mode=mode)
+            return record, result, time.monotonic() - started
+
+    started = time.monotonic()
+    outcomes = await asyncio.gather(*(run_one(record) for record in labeled))
+    wall_time = time.monotonic() - started
+
+    latencies = []
+    model_calls = 0
+    tokens = 0
+    cached_tokens = 0
+    exact = 0
+    partial = 0
+    errors = 0
+    validator_skipped = 0
+    tiered = escalated = 0
+    escalation_reasons = {}
+    speculated = agreed = 0
+    saved_ms = 0.0
+
+    for record, result, latency in outcomes:
+        latencies.append(latency)
+        if "error" in result:
+            errors += 1
+            continue
+        usage = result_usage(result)
+        tokens += usage["prompt_tokens"] + usage["completion_tokens"]
+        cached_tokens += usage["cached_tokens"]
+        model_calls += result["pipeline"]["model_calls"]
+        tiering = result["pipeline"].get("tiering")
+        validator_skipped += result["pipeline"]["path"] in (PATH_LOCAL, PATH_RECONCILED)
+        speculation = result["pipeline"].get("speculation")
+        if speculation:
+            speculated += 1
+            agreed += speculation["agreed"]
+            saved_ms += speculation["saved_ms"]
+        if tiering:
+            tiered += 1
+            escalated += tiering["decision"] == "escalated"
+            for reason in tiering["reasons"]:
+                escalation_reasons[reason] = escalation_reasons.get(reason, 0) + 1
+        score = score_codes(result["cpt_codes"], record["codes"])
+        exact += score["exact"]
+        partial += score["partial"]
+
+    count = len(labeled) or 1
+    return {
+        "mode": mode,
+        "prompt_version": prompt_version(),
+        "concurrency": concurrency,
+        "scenarios": len(labeled),
+        "errors": errors,
+        "mean_latency_s": round(statistics.fmean(latencies), 3) if latencies else 0.0,
+        "p50_latency_s": round(percentile(latencies, 50), 3),
+        "p95_latency_s": round(percentile(latencies, 95), 3),
+        "p99_latency_s": round(percentile(latencies, 99), 3),
+        "wall_time_s": round(wall_time, 3),
+        "throughput_per_s": round(len(labeled) / wall_time, 3) if wall_time else 0.0,
+        "model_calls": model_calls,
+        "validator_skipped": validator_skipped,
+        "tokens": tokens,
+        "tokens_per_scenario": round(tokens / count, 1),
+        "cached_tokens_per_scenario": round(cached_tokens / count, 1),
+        "exact_match": round(exact / count, 3),
+        "partial_match": round(partial / count, 3),
+        "escalation_rate": round(escalated / tiered, 3) if tiered else None,
+        "escalation_reasons": escalation_reasons,
+        "agreement_rate": round(agreed / speculated, 3) if speculated else None,
+        "saved_ms_per_scenario": round(saved_ms / speculated, 1) if speculated else None,
+    }
+
+
+async def run_mode_benchmark(labeled, mode):
+    """
+    Run every labeled scenario through the pipeline in one mode, one at a time (cache bypassed)
+
+    Returns:
+        dict: Latency, model-call, token and accuracy totals for the mode
+    """
+    return await run_benchmark(labeled, mode, concurrency=1)
+
+
+def compare_reports(current, baseline, keys=("p50_latency_s", "p95_latency_s", "throughput_per_s",
+                                             "tokens_per_scenario", "exact_match", "partial_match")):
+    """
+    Relative change of each metric between two runs with the same mode and concurrency
+
+    Returns:
+        list: One {mode, concurrency, changes: {metric: (baseline, current, ratio)}} per matched run
+    """
+    previous = {(run["mode"], run["concurrency"]): run for run in baseline}
+    comparisons = []
+    for run in current:
+        before = previous.get((run["mode"], run["concurrency"]))
+        if before is None:
+            continue
+        changes = {
+            key: (before[key], run[key], round(run[key] / before[key] - 1, 3) if before[key] else None)
+            for key in keys
+        }
+        comparisons.append({"mode": run["mode"], "concurrency": run["concurrency"], "changes": changes})
+    return comparisons
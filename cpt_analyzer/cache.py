@@ -0,0 +1,264 @@
+"""
+Scenario-level cache of final pipeline results.
+
+Keys combine the normalized scenario text with everything that can change
+the answer: catalog version, models and prompt version. Storage is
+pluggable through settings.CPT_RESULT_CACHE, using the same dotted-path
+BACKEND convention as Django's CACHES setting.
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .metrics import CallbackMetric, registry
+
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_scenario(text):
+    """Normalize scenario text so trivially different resubmissions share a key"""
+    text = unicodedata.normalize("NFKC", text or "")
+    return WHITESPACE_RE.sub(" ", text).strip().lower()
+
+
+def make_cache_key(scenario_text, catalog_version, models, prompt_version, mode="full"):
+    """
+    Build the cache key for a scenario
+
+    Args:
+        scenario_text (str): The raw scenario text
+        catalog_version (str): CPTCatalog.version the answer was produced with
+        models (iterable): Model names used by the pipeline stages
+        prompt_version (str): Version of the prompt templates
+        mode (str): Pipeline mode, since skipping the validator can change the answer
+
+    Returns:
+        str: Hex digest identifying the request
+    """
+    payload = json.dumps({
+        "scenario": normalize_scenario(scenario_text),
+        "catalog": catalog_version,
+        "models": list(models),
+        "prompt": prompt_version,
+        "mode": mode,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class BaseResultCacheBackend:
+    """Interface for result cache storage; values are JSON-serializable dicts"""
+
+    def __init__(self, ttl=None, max_entries=None, **options):
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def _expires_at(self):
+        return time.time() + self.ttl if self.ttl else None
+
+
+class LocalLRUBackend(BaseResultCacheBackend):
+    """In-process LRU with TTL; each worker process has its own copy"""
+
+    def __init__(self, ttl=None, max_entries=512, **options):
+        super().__init__(ttl=ttl, max_entries=max_entries)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at is not None and expires_at < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (self._expires_at(), value)
+            self._data.move_to_end(key)
+            while self.max_entries and len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class DjangoCacheBackend(BaseResultCacheBackend):
+    """Store results in a configured Django cache (size bounds come from its own OPTIONS)"""
+
+    def __init__(self, ttl=None, max_entries=None, alias="default", key_prefix="cpt-result:", **options):
+        super().__init__(ttl=ttl, max_entries=max_entries)
+        self.alias = alias
+        self.key_prefix = key_prefix
+
+    @property
+    def cache(self):
+        from django.core.cache import caches
+
+        return caches[self.alias]
+
+    def get(self, key):
+        return self.cache.get(self.key_prefix + key)
+
+    def set(self, key, value):
+        self.cache.set(self.key_prefix + key, value, timeout=self.ttl)
+
+    def clear(self):
+        self.cache.clear()
+
+
+class SQLiteBackend(BaseResultCacheBackend):
+    """On-disk cache shared by every worker on the host; evicts least recently used rows"""
+
+    def __init__(self, ttl=None, max_entries=10000, path=None, **options):
+        super().__init__(ttl=ttl, max_entries=max_entries)
+        self.path = str(path or os.path.join(settings.BASE_DIR, "cpt_result_cache.sqlite3"))
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS result_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL, accessed_at REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS result_cache_accessed ON result_cache (accessed_at)")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        connection = self._connection()
+        now = time.time()
+        row = connection.execute(
+            "SELECT value FROM result_cache WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (key, now),
+        ).fetchone()
+        if row is None:
+            return None
+        connection.execute("UPDATE result_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        connection = self._connection()
+        now = time.time()
+        connection.execute(
+            "INSERT OR REPLACE INTO result_cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value), self._expires_at(), now),
+        )
+        connection.execute("DELETE FROM result_cache WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+        if self.max_entries:
+            connection.execute(
+                "DELETE FROM result_cache WHERE key IN (SELECT key FROM result_cache ORDER BY accessed_at DESC "
+                "LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def clear(self):
+        self._connection().execute("DELETE FROM result_cache")
+
+
+class ResultCache:
+    """Backend wrapper that counts hits, misses and stores"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+
+    def get(self, key):
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value)
+        with self._lock:
+            self.sets += 1
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "sets": self.sets,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    """
+    Return the process-wide result cache configured by settings.CPT_RESULT_CACHE
+
+    Returns None when caching is disabled (no BACKEND configured).
+    """
+    global _result_cache
+
+    if _result_cache is None:
+        with _result_cache_lock:
+            if _result_cache is None:
+                config = dict(getattr(settings, "CPT_RESULT_CACHE", None) or {})
+                backend_path = config.pop("BACKEND", None)
+                if not backend_path:
+                    return None
+                options = {name.lower(): value for name, value in config.items()}
+                _result_cache = ResultCache(import_string(backend_path)(**options))
+    return _result_cache
+
+
+def reset_result_cache():
+    """Forget the configured cache so the next get_result_cache() call rebuilds it"""
+    global _result_cache
+    with _result_cache_lock:
+        _result_cache = None
+
+
+def _cache_lookup_samples():
+    cache = _result_cache
+    if cache is None:
+        return {}
+    stats = cache.stats()
+    return {("hit",): stats["hits"], ("miss",): stats["misses"]}
+
+
+registry.register(CallbackMetric(
+    "cpt_result_cache_lookups_total", "Result cache lookups by outcome", ("outcome",),
+    callback=_cache_lookup_samples, kind="counter"))
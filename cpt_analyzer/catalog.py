@@ -0,0 +1,369 @@
+"""
+In-memory CPT code catalog shared by every agent in the process.
+
+The catalog is parsed from the Excel workbook once, kept as a compact
+code-keyed index and only re-read when the workbook's mtime changes.
+A pickle snapshot, written the first time the workbook is parsed (or by
+`manage.py build_cpt_snapshot`), lets every later worker skip pandas and
+openpyxl entirely.
+
+Each specialty in settings.CPT_SPECIALTIES is a separate shard with its own
+workbook and snapshot, loaded the first time a scenario is routed to it
+(see cpt_analyzer.routing).
+"""
+import hashlib
+import logging
+import os
+import pickle
+import sys
+import threading
+from typing import NamedTuple
+
+from django.conf import settings
+
+from .metrics import CallbackMetric, registry as metrics_registry, timed
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT = 1
+
+# How prompts refer to a catalog's specialty unless settings.CPT_SPECIALTIES says otherwise
+DEFAULT_LABEL = "urinary system"
+
+
+class CPTEntry(NamedTuple):
+    """A single CPT code row from the workbook"""
+    code: str
+    description: str
+    topic: str
+    category: str
+
+
+class CPTSection(NamedTuple):
+    """A row from the section index sheet (e.g. 'Bladder - Endoscopy', '52000-52700')"""
+    name: str
+    code_range: str
+
+
+def _clean(value):
+    """Normalize a spreadsheet cell to a stripped string ('' for blanks/NaN)"""
+    if value is None or value != value:  # NaN check without importing numpy
+        return ""
+    return str(value).strip()
+
+
+def _normalize_code(value):
+    """Convert a cell such as 52000.0 or '52000' to the 5-character code string"""
+    text = _clean(value)
+    if text.endswith(".0"):
+        text = text[:-2]
+    return text
+
+
+class CPTCatalog:
+    """Code-keyed, read-only view of the CPT workbook"""
+
+    # Snapshots written before catalogs carried prompt examples unpickle without the attribute
+    prompt_examples = ""
+
+    def __init__(self, entries, sections, source_path="", source_mtime=0.0, label=DEFAULT_LABEL, prompt_examples=""):
+        self.label = label
+        # Worked examples for the prompt prefix (see cpt_analyzer.prompts.cacheable_prefix)
+        self.prompt_examples = prompt_examples
+        self.entries = {}
+        for entry in entries:
+            # The workbook has a few duplicated rows; the first occurrence wins
+            self.entries.setdefault(entry.code, entry)
+        self.codes = sorted(self.entries)
+        self.sections = list(sections)
+        self.source_path = str(source_path)
+        self.source_mtime = source_mtime
+        self.version = self._compute_version()
+        self.prompt_text = self._render_sections()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, code):
+        return code in self.entries
+
+    def __iter__(self):
+        return iter(self.entries.values())
+
+    def get(self, code, default=None):
+        return self.entries.get(code, default)
+
+    def _compute_version(self):
+        digest = hashlib.sha1()
+        for code in self.codes:
+            digest.update("|".join(self.entries[code]).encode("utf-8"))
+            digest.update(b"\n")
+        for section in self.sections:
+            digest.update("|".join(section).encode("utf-8"))
+            digest.update(b"\n")
+        return digest.hexdigest()[:12]
+
+    def _render_sections(self):
+        """Render the section index as a fixed-width table, rendered once per load"""
+        header = CPTSection("Section/Subsection", "CPT Code Range")
+        rows = [header] + self.sections
+        width = max(len(row.name) for row in rows)
+        return "\n".join(f"{row.name:<{width}}  {row.code_range}" for row in rows)
+
+    def to_snapshot(self):
+        return {
+            "format": SNAPSHOT_FORMAT,
+            "source_path": self.source_path,
+            "source_mtime": self.source_mtime,
+            "entries": [tuple(entry) for entry in self.entries.values()],
+            "sections": [tuple(section) for section in self.sections],
+        }
+
+    @classmethod
+    def from_snapshot(cls, data):
+        return cls(
+            [CPTEntry(*row) for row in data["entries"]],
+            [CPTSection(*row) for row in data["sections"]],
+            source_path=data.get("source_path", ""),
+            source_mtime=data.get("source_mtime", 0.0),
+        )
+
+
+def read_workbook(excel_path):
+    """Parse the CPT workbook into a CPTCatalog (the only place pandas is used)"""
+    import pandas as pd
+
+    sheets = pd.read_excel(excel_path, sheet_name=None)
+    entries = []
+    sections = []
+    for frame in sheets.values():
+        columns = set(frame.columns)
+        if {"CPT Code", "Description"} <= columns:
+            for row in frame.to_dict("records"):
+                code = _normalize_code(row.get("CPT Code"))
+                if not code:
+                    continue
+                # Topics and categories repeat across rows; intern them so a shard holds one copy each
+                entries.append(CPTEntry(
+                    code=code,
+                    description=_clean(row.get("Description")),
+                    topic=sys.intern(_clean(row.get("Topic"))),
+                    category=sys.intern(_clean(row.get("Category"))),
+                ))
+        elif {"Section/Subsection", "CPT Code Range"} <= columns:
+            for name, code_range in zip(frame["Section/Subsection"], frame["CPT Code Range"]):
+                name, code_range = _clean(name), _clean(code_range)
+                if name:
+                    sections.append(CPTSection(name, code_range))
+
+    return CPTCatalog(entries, sections, source_path=excel_path, source_mtime=os.path.getmtime(excel_path))
+
+
+def write_snapshot(catalog, snapshot_path):
+    """Write a precompiled pickle snapshot of the catalog"""
+    # Per-process temporary file: several workers may compile the same snapshot at once
+    tmp_path = f"{snapshot_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as handle:
+        pickle.dump(catalog.to_snapshot(), handle, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, snapshot_path)
+
+
+def read_snapshot(snapshot_path, source_mtime=None):
+    """
+    Load a snapshot, returning None if it is missing, unreadable or stale
+
+    A snapshot is stale when it was built from a workbook with a different mtime.
+    """
+    try:
+        with open(snapshot_path, "rb") as handle:
+            data = pickle.load(handle)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning("Ignoring unreadable CPT catalog snapshot %s: %s", snapshot_path, e)
+        return None
+
+    if data.get("format") != SNAPSHOT_FORMAT:
+        return None
+    if source_mtime is not None and data.get("source_mtime") != source_mtime:
+        return None
+    return CPTCatalog.from_snapshot(data)
+
+
+def _source_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def load_catalog(source_path=None, snapshot_path=None, label=None):
+    """
+    Load a catalog from its snapshot when it is fresh, otherwise from the workbook
+
+    Defaults to settings.CPT_DATA_PATH and settings.CPT_CATALOG_SNAPSHOT.
+    """
+    if source_path is None:
+        source_path, snapshot_path = settings.CPT_DATA_PATH, settings.CPT_CATALOG_SNAPSHOT
+    excel_path = str(source_path)
+    mtime = _source_mtime(excel_path)
+
+    catalog = None
+    if snapshot_path:
+        with timed("catalog.snapshot_load"):
+            catalog = read_snapshot(snapshot_path, source_mtime=mtime)
+        if catalog is not None:
+            logger.info("Loaded CPT catalog %s from snapshot %s", catalog.version, snapshot_path)
+
+    if catalog is None:
+        with timed("catalog.workbook_load"):
+            catalog = read_workbook(excel_path)
+        logger.info("Loaded CPT catalog %s (%d codes) from %s", catalog.version, len(catalog), excel_path)
+        if snapshot_path:
+            # The next process start (and every other worker) then loads the snapshot instead
+            try:
+                write_snapshot(catalog, snapshot_path)
+            except OSError as e:
+                logger.warning("Could not write CPT catalog snapshot %s: %s", snapshot_path, e)
+    if label:
+        catalog.label = label
+    return catalog
+
+
+def read_prompt_examples(path):
+    """A shard's worked prompt examples ('' without a file)"""
+    if not path:
+        return ""
+    try:
+        with open(path, encoding="utf-8") as handle:
+            return handle.read().strip()
+    except OSError as e:
+        logger.warning("Could not read prompt examples %s: %s", path, e)
+        return ""
+
+
+class CatalogShard:
+    """
+    One specialty's code set, loaded on first use and reloaded when its workbook changes
+
+    The name, label, keywords and code ranges are known without loading,
+    so scenarios can be routed before any shard is read.
+    """
+
+    def __init__(self, name, label, path, snapshot=None, keywords=(), code_ranges=(), prompt_examples=None):
+        self.name = name
+        self.label = label
+        self.prompt_examples = prompt_examples
+        self.path = str(path)
+        self.snapshot = snapshot
+        self.keywords = tuple(keywords)
+        self.code_ranges = tuple(code_ranges)
+        self._catalog = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._catalog is not None
+
+    def get(self):
+        """Return the shard's catalog, or None if it cannot be loaded and no previous copy exists"""
+        catalog = self._catalog
+        mtime = _source_mtime(self.path)
+        if catalog is not None and (mtime is None or mtime == catalog.source_mtime):
+            return catalog
+
+        with self._lock:
+            if self._catalog is not None and (mtime is None or mtime == self._catalog.source_mtime):
+                return self._catalog
+            try:
+                catalog = load_catalog(self.path, self.snapshot, self.label)
+                catalog.prompt_examples = read_prompt_examples(self.prompt_examples)
+                self._catalog = catalog
+            except Exception as e:
+                logger.error("Error loading CPT data for %s: %s", self.name, e)
+            return self._catalog
+
+
+class CatalogRegistry:
+    """The configured specialty shards, keyed by name"""
+
+    def __init__(self, shards, default):
+        self.shards = {shard.name: shard for shard in shards}
+        if default not in self.shards:
+            raise ValueError(f"CPT_DEFAULT_SPECIALTY '{default}' is not in CPT_SPECIALTIES")
+        self.default = default
+
+    def __iter__(self):
+        return iter(self.shards.values())
+
+    def __contains__(self, name):
+        return name in self.shards
+
+    def get(self, name=None):
+        """Catalog of one specialty (the default one when name is None)"""
+        return self.shards[name or self.default].get()
+
+    def loaded(self):
+        return [shard.name for shard in self if shard.loaded]
+
+
+def build_registry():
+    """
+    Build the registry from settings.CPT_SPECIALTIES
+
+    The default specialty's PATH and SNAPSHOT fall back to CPT_DATA_PATH and
+    CPT_CATALOG_SNAPSHOT.
+    """
+    default = settings.CPT_DEFAULT_SPECIALTY
+    shards = []
+    for name, config in settings.CPT_SPECIALTIES.items():
+        options = {key.lower(): value for key, value in config.items()}
+        if name == default:
+            options.setdefault("path", settings.CPT_DATA_PATH)
+            options.setdefault("snapshot", settings.CPT_CATALOG_SNAPSHOT)
+        shards.append(CatalogShard(name, options.pop("label", name), **options))
+    return CatalogRegistry(shards, default)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """Return the process-wide specialty registry (shards load lazily)"""
+    global _registry
+
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = build_registry()
+    return _registry
+
+
+def get_catalog(specialty=None):
+    """
+    Return the process-wide catalog of a specialty (default: settings.CPT_DEFAULT_SPECIALTY)
+
+    Reloads it if the workbook changed. Returns None if the catalog cannot
+    be loaded and no previous copy exists.
+    """
+    return get_registry().get(specialty)
+
+
+def _loaded_shard_samples():
+    registry = _registry
+    if registry is None:
+        return {}
+    return {(shard.name,): len(shard.get()) for shard in registry if shard.loaded}
+
+
+metrics_registry.register(CallbackMetric(
+    "cpt_catalog_shard_codes", "Codes held by each loaded specialty shard", ("specialty",),
+    callback=_loaded_shard_samples))
+
+
+def reset_catalog():
+    """Drop the registry and every loaded shard so the next get_catalog() call reloads"""
+    global _registry
+    with _registry_lock:
+        _registry = None
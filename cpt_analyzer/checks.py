@@ -0,0 +1,219 @@
+"""
+Deterministic checks of an analyzer result against the local CPT catalog.
+
+In the adaptive pipeline mode these decide whether the validator call can
+be skipped: a single code that exists in the catalog, whose description
+overlaps the scenario and whose modifiers are plausible, is accepted
+locally. Anything else (multiple codes, weak evidence) goes to the validator.
+
+In the speculative mode, reconcile() compares the analyzer's answer with an
+independent second opinion instead: the same codes and modifiers, all in
+the catalog, are accepted without the validator.
+"""
+from typing import NamedTuple
+
+from .parsing import CODE_TOKEN_RE
+from .retrieval import expand_query, tokenize
+
+# Modifiers the prompts tell the model to use, plus common surgical ones and the -59 subsets
+KNOWN_MODIFIERS = frozenset({"22", "50", "51", "52", "53", "58", "59", "76", "77", "78", "79", "RT", "LT",
+                             "XE", "XS", "XP", "XU"})
+BILATERAL_TERMS = ("bilateral", "both sides", "both kidneys", "both ureters", "left and right", "right and left")
+
+DEFAULT_MIN_OVERLAP = 0.3
+HIGH_CONFIDENCE_OVERLAP = 0.5
+
+
+class ParsedCode(NamedTuple):
+    code: str
+    modifiers: tuple
+
+
+def parse_code(text):
+    """Parse '51785-51' or '50590-LT' into ParsedCode('51785', ('51',)); returns None for anything else"""
+    text = text.strip().upper().replace(" ", "")
+    match = CODE_TOKEN_RE.fullmatch(text)
+    if match is None:
+        return None
+    modifiers = tuple(m for m in match.group(2).split("-") if m)
+    return ParsedCode(match.group(1), modifiers)
+
+
+def description_overlap(scenario_text, description):
+    """Fraction of a code description's terms that appear in the (synonym-expanded) scenario"""
+    description_terms = set(tokenize(description))
+    if not description_terms:
+        return 0.0
+    return len(description_terms & set(expand_query(scenario_text))) / len(description_terms)
+
+
+class CheckResult(NamedTuple):
+    passed: bool
+    codes: list
+    overlap: float
+    reasons: list
+
+    def as_dict(self):
+        return {
+            "passed": self.passed,
+            "codes": ["-".join((c.code,) + c.modifiers) for c in self.codes],
+            "overlap": round(self.overlap, 3),
+            "reasons": self.reasons,
+        }
+
+
+def check_analyzer_result(catalog, scenario_text, analyzer_result, min_overlap=DEFAULT_MIN_OVERLAP):
+    """
+    Check whether an analyzer result is safe to accept without the validator
+
+    Args:
+        catalog (CPTCatalog): The loaded catalog
+        scenario_text (str): The original scenario
+        analyzer_result (dict): Result from CPTAnalyzerAgent
+        min_overlap (float): Minimum description overlap to accept a code
+
+    Returns:
+        CheckResult: passed is True only when every check succeeds
+    """
+    reasons = []
+    tokens = [t for t in analyzer_result.get("cpt_code", "").split(",") if t.strip()]
+    codes = [parse_code(t) for t in tokens]
+
+    if any(code is None for code in codes):
+        reasons.append("unparseable code")
+    codes = [code for code in codes if code is not None]
+
+    if len(tokens) != 1:
+        reasons.append("multiple codes" if tokens else "no code")
+
+    overlap = 0.0
+    scenario_lower = scenario_text.lower()
+    for code in codes:
+        entry = catalog.get(code.code) if catalog is not None else None
+        if entry is None:
+            reasons.append(f"{code.code} not in catalog")
+            continue
+        overlap = max(overlap, description_overlap(scenario_text, entry.description))
+
+        unknown = [m for m in code.modifiers if m not in KNOWN_MODIFIERS]
+        if unknown:
+            reasons.append(f"unknown modifier(s) {', '.join(unknown)}")
+        if len(codes) == 1 and ("51" in code.modifiers or "59" in code.modifiers):
+            reasons.append("-51/-59 on a single procedure")
+        if "50" in code.modifiers and not any(term in scenario_lower for term in BILATERAL_TERMS):
+            reasons.append("-50 without a bilateral procedure in the scenario")
+
+    if codes and overlap < min_overlap:
+        reasons.append(f"low description overlap ({overlap:.2f})")
+
+    return CheckResult(not reasons, codes, overlap, reasons)
+
+
+def local_validation(analyzer_result, check, catalog):
+    """
+    Build a validator-shaped result from the analyzer result and local checks
+
+    Used when the validator call is skipped. Confidence reflects the checks:
+    High/Medium when they passed (by overlap strength), Low otherwise.
+    """
+    descriptions = [catalog.get(c.code).description for c in check.codes if catalog is not None and c.code in catalog]
+    if not check.passed:
+        confidence = "Low"
+        note = "Not validated by a second agent; local checks flagged: " + "; ".join(check.reasons) + "."
+    else:
+        confidence = "High" if check.overlap >= HIGH_CONFIDENCE_OVERLAP else "Medium"
+        note = "Validated locally against the CPT catalog (code exists, description matches, modifiers plausible)."
+
+    return {
+        "cpt_code": analyzer_result["cpt_code"],
+        "codes": analyzer_result.get("codes") or [{"code": c.code, "modifiers": list(c.modifiers)} for c in check.codes],
+        "description": analyzer_result.get("description") or "; ".join(descriptions),
+        "explanation": f"{analyzer_result.get('explanation', '')}\n\n{note}".strip(),
+        "confidence": confidence,
+    }
+
+
+def code_tokens(agent_result):
+    """The comma-separated code tokens of an agent result"""
+    return [token.strip() for token in agent_result.get("cpt_code", "").split(",") if token.strip()]
+
+
+def code_set(agent_result):
+    """An agent result's parseable codes as a set of ParsedCode with sorted modifiers"""
+    codes = (parse_code(token) for token in code_tokens(agent_result))
+    return {ParsedCode(c.code, tuple(sorted(c.modifiers))) for c in codes if c is not None}
+
+
+def base_codes(codes):
+    """Sorted code numbers of a code set, modifiers ignored"""
+    return sorted({c.code for c in codes})
+
+
+class Reconciliation(NamedTuple):
+    agreed: bool
+    codes: list
+    reasons: list
+
+    def as_dict(self):
+        return {
+            "agreed": self.agreed,
+            "codes": ["-".join((c.code,) + c.modifiers) for c in self.codes],
+            "reasons": self.reasons,
+        }
+
+
+def reconcile(catalog, analyzer_result, second_opinion):
+    """
+    Compare the analyzer's answer with an independent second opinion
+
+    They agree when both give the same codes with the same modifiers (in any
+    order), every code exists in the catalog with known modifiers, and the
+    second opinion is not of Low confidence. A token either answer gives
+    that does not parse as a code, or a different number of tokens, is a
+    disagreement.
+
+    Returns:
+        Reconciliation: agreed is True only when nothing calls for the validator
+    """
+    if "error" in second_opinion:
+        return Reconciliation(False, [], ["second opinion failed"])
+    first, second = code_set(analyzer_result), code_set(second_opinion)
+    first_tokens, second_tokens = code_tokens(analyzer_result), code_tokens(second_opinion)
+    reasons = []
+    if not first:
+        reasons.append("no code")
+    unparseable = [token for token in first_tokens + second_tokens if parse_code(token) is None]
+    if unparseable:
+        reasons.append(f"unparseable code(s) {', '.join(unparseable)}")
+    if len(first_tokens) != len(second_tokens):
+        reasons.append(f"different number of codes ({len(first_tokens)} vs {len(second_tokens)})")
+    if base_codes(first) != base_codes(second):
+        reasons.append(f"different codes ({', '.join(base_codes(first))} vs {', '.join(base_codes(second)) or 'none'})")
+    elif first != second:
+        reasons.append("different modifiers")
+    for code in sorted(first):
+        if catalog is None or code.code not in catalog:
+            reasons.append(f"{code.code} not in catalog")
+        unknown = [m for m in code.modifiers if m not in KNOWN_MODIFIERS]
+        if unknown:
+            reasons.append(f"unknown modifier(s) {', '.join(unknown)}")
+    if second_opinion.get("confidence") == "Low":
+        reasons.append("second opinion has low confidence")
+    return Reconciliation(not reasons, sorted(first), reasons)
+
+
+def reconciled_validation(analyzer_result, second_opinion):
+    """
+    Build a validator-shaped result for an analyzer answer the second opinion agrees with
+
+    The confidence is the second opinion's own.
+    """
+    note = "Confirmed by an independent second opinion (same codes and modifiers) and the CPT catalog."
+    return {
+        "cpt_code": analyzer_result["cpt_code"],
+        "codes": analyzer_result.get("codes") or [
+            {"code": c.code, "modifiers": list(c.modifiers)} for c in sorted(code_set(analyzer_result))],
+        "description": analyzer_result.get("description") or second_opinion.get("description", ""),
+        "explanation": f"{analyzer_result.get('explanation', '')}\n\n{note}".strip(),
+        "confidence": second_opinion.get("confidence") or "Medium",
+    }
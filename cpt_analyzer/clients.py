@@ -0,0 +1,287 @@
+"""
+Shared OpenAI clients for the agents.
+
+Instead of constructing a new client (and a new connection pool) per
+request, every agent goes through chat_completion()/achat_completion().
+They reuse one keep-alive pool per process, apply the timeouts from
+settings.OPENAI_CLIENT, retry 429/5xx responses with jittered exponential
+backoff and cap the number of calls a worker has in flight with one
+process-wide limiter shared by sync and async callers.
+
+An httpx async pool is bound to the event loop that created it, so the
+async client is only used on the long-lived loop of an ASGI server (the
+main thread's loop). Event loops that async_to_sync creates for a single
+call (runserver, WSGI workers, job threads) send their calls to the pooled
+sync client in a worker thread instead of building a pool per request.
+
+For benchmarks and tests, set_backend() routes every call through an
+object from cpt_analyzer.llm_backends (recording, replay or stub) instead.
+
+openai and httpx are imported with the first client, so pages that never
+call a model do not load them.
+"""
+import asyncio
+import logging
+import math
+import random
+import threading
+import time
+import weakref
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .concurrency import ConcurrencyGate
+from .metrics import CallbackMetric, registry
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CLIENT_SETTINGS = {
+    "CONNECT_TIMEOUT": 5.0,
+    "READ_TIMEOUT": 60.0,
+    "MAX_CONNECTIONS": 20,
+    "MAX_KEEPALIVE_CONNECTIONS": 10,
+    "KEEPALIVE_EXPIRY": 30.0,
+    "MAX_RETRIES": 3,
+    "BACKOFF_BASE": 0.5,
+    "BACKOFF_MAX": 8.0,
+    "MAX_CONCURRENCY": 8,
+}
+
+# Names of the openai exceptions worth retrying
+RETRYABLE_ERRORS = ("RateLimitError", "InternalServerError", "APIConnectionError", "APITimeoutError")
+
+
+def client_settings():
+    """settings.OPENAI_CLIENT merged over the defaults"""
+    return {**DEFAULT_CLIENT_SETTINGS, **getattr(settings, "OPENAI_CLIENT", {})}
+
+
+def _timeout(config):
+    import httpx
+
+    return httpx.Timeout(config["READ_TIMEOUT"], connect=config["CONNECT_TIMEOUT"])
+
+
+def _limits(config):
+    import httpx
+
+    return httpx.Limits(
+        max_connections=config["MAX_CONNECTIONS"],
+        max_keepalive_connections=config["MAX_KEEPALIVE_CONNECTIONS"],
+        keepalive_expiry=config["KEEPALIVE_EXPIRY"],
+    )
+
+
+def _client_kwargs(config):
+    # Retries are handled here (under the shared limiter) rather than inside the SDK
+    return {
+        "api_key": settings.OPENAI_API_KEY,
+        "base_url": getattr(settings, "OPENAI_BASE_URL", None) or None,
+        "timeout": _timeout(config),
+        "max_retries": 0,
+    }
+
+
+class RetryStats:
+    """Process-wide counters of upstream retries"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+
+    def record(self, retries):
+        with self._lock:
+            self.calls += 1
+            self.retries += retries
+
+    def snapshot(self):
+        with self._lock:
+            return {"calls": self.calls, "retries": self.retries}
+
+
+retry_stats = RetryStats()
+
+registry.register(CallbackMetric(
+    "cpt_upstream_calls_total", "Chat completion calls (after retries)", kind="counter",
+    callback=lambda: {(): retry_stats.snapshot()["calls"]}))
+registry.register(CallbackMetric(
+    "cpt_upstream_retries_total", "Chat completion retries after 429/5xx/connection errors", kind="counter",
+    callback=lambda: {(): retry_stats.snapshot()["retries"]}))
+
+_lock = threading.Lock()
+_backend = None
+_sync_client = None
+_limiter = None
+# The async client of the long-lived event loop; httpx async pools cannot be shared across loops
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_limiter():
+    """The process-wide cap on upstream calls in flight (OPENAI_CLIENT['MAX_CONCURRENCY'])"""
+    global _limiter
+
+    if _limiter is None:
+        with _lock:
+            if _limiter is None:
+                _limiter = ConcurrencyGate(client_settings()["MAX_CONCURRENCY"], max_queue=math.inf)
+    return _limiter
+
+
+def get_client():
+    """Return the process-wide pooled sync client"""
+    global _sync_client
+
+    if _sync_client is None:
+        with _lock:
+            if _sync_client is None:
+                import httpx
+                import openai
+
+                config = client_settings()
+                _sync_client = openai.OpenAI(
+                    http_client=httpx.Client(timeout=_timeout(config), limits=_limits(config)),
+                    **_client_kwargs(config),
+                )
+    return _sync_client
+
+
+def on_long_lived_loop():
+    """True on the ASGI server's event loop, False on a loop async_to_sync made for one call"""
+    return threading.current_thread() is threading.main_thread()
+
+
+def get_async_client():
+    """Return the pooled async client of the running (long-lived) event loop"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        import httpx
+        import openai
+
+        config = client_settings()
+        client = _async_clients[loop] = openai.AsyncOpenAI(
+            http_client=httpx.AsyncClient(timeout=_timeout(config), limits=_limits(config)),
+            **_client_kwargs(config),
+        )
+    return client
+
+
+def reset_clients():
+    """Drop the pooled clients and the limiter so they are rebuilt from current settings (used by tests)"""
+    global _sync_client, _limiter
+
+    with _lock:
+        if _sync_client is not None:
+            _sync_client.close()
+        _sync_client = None
+        _limiter = None
+        _async_clients.clear()
+
+
+def is_retryable(error):
+    import openai
+
+    if isinstance(error, tuple(getattr(openai, name) for name in RETRYABLE_ERRORS)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+def retry_delay(attempt, error=None, config=None):
+    """
+    Seconds to wait before retry number `attempt` (0-based)
+
+    Honors a Retry-After header when the server sends one, otherwise uses
+    full-jitter exponential backoff capped at BACKOFF_MAX.
+    """
+    config = config or client_settings()
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), config["BACKOFF_MAX"])
+        except ValueError:
+            pass
+    return random.uniform(0, min(config["BACKOFF_MAX"], config["BACKOFF_BASE"] * 2 ** attempt))
+
+
+def set_backend(backend):
+    """Route chat completions through a backend from cpt_analyzer.llm_backends; None restores the live API"""
+    global _backend
+    _backend = backend
+
+
+def get_backend():
+    return _backend
+
+
+def chat_completion(**kwargs):
+    """Call chat.completions.create through the configured backend (the live API by default)"""
+    if _backend is not None:
+        return _backend.complete(**kwargs)
+    return live_chat_completion(**kwargs)
+
+
+async def achat_completion(**kwargs):
+    """Async version of chat_completion"""
+    if _backend is not None:
+        return await _backend.acomplete(**kwargs)
+    return await live_achat_completion(**kwargs)
+
+
+def live_chat_completion(**kwargs):
+    """Call chat.completions.create on the shared sync client with retries"""
+    client = get_client()
+    limiter = get_limiter()
+    config = client_settings()
+    attempt = 0
+    while True:
+        try:
+            limiter.enter(None)
+            try:
+                response = client.chat.completions.create(**kwargs)
+            finally:
+                limiter.leave()
+            retry_stats.record(attempt)
+            return response
+        except Exception as e:
+            if attempt >= config["MAX_RETRIES"] or not is_retryable(e):
+                retry_stats.record(attempt)
+                raise
+            delay = retry_delay(attempt, e, config)
+            logger.warning("Retrying chat completion in %.2fs after %s", delay, e)
+            time.sleep(delay)
+            attempt += 1
+
+
+async def live_achat_completion(**kwargs):
+    """
+    Async version of live_chat_completion
+
+    Uses the async client on the long-lived loop, and the pooled sync client
+    in a worker thread on a loop that only lives for this request.
+    """
+    if not on_long_lived_loop():
+        return await sync_to_async(live_chat_completion, thread_sensitive=False)(**kwargs)
+    client = get_async_client()
+    limiter = get_limiter()
+    config = client_settings()
+    attempt = 0
+    while True:
+        try:
+            await limiter.aenter(None)
+            try:
+                response = await client.chat.completions.create(**kwargs)
+            finally:
+                limiter.leave()
+            retry_stats.record(attempt)
+            return response
+        except Exception as e:
+            if attempt >= config["MAX_RETRIES"] or not is_retryable(e):
+                retry_stats.record(attempt)
+                raise
+            delay = retry_delay(attempt, e, config)
+            logger.warning("Retrying chat completion in %.2fs after %s", delay, e)
+            await asyncio.sleep(delay)
+            attempt += 1
@@ -0,0 +1,264 @@
+"""
+Single-flight coalescing of identical in-flight scenarios.
+
+When the same scenario (same result cache key: normalized text, catalog,
+models, prompts and mode) is submitted while an analysis of it is already
+running, the later requests wait for that analysis and share its result
+instead of starting their own analyzer and validator calls.
+
+Within a process, followers wait on the leader's future. Across worker
+processes an optional lock backend (settings.CPT_COALESCE['LOCK_BACKEND'])
+lets only one worker compute a key at a time; the others wait for the lock
+and then read the answer from the result cache, so cross-worker sharing
+needs a shared cache backend (SQLiteBackend or a shared Django cache).
+"""
+import asyncio
+import concurrent.futures
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from .metrics import Counter, registry
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+COALESCED = registry.register(Counter(
+    "cpt_coalesced_requests_total", "Requests answered by another request's in-flight analysis", ("scope",)))
+COALESCE_LEADERS = registry.register(Counter(
+    "cpt_coalesce_leaders_total", "Analyses started while coalescing was enabled"))
+
+
+class Flight:
+    """One in-progress computation; followers wait on its future"""
+
+    def __init__(self, key):
+        self.key = key
+        # A thread-safe future: under WSGI each async view runs on its own event loop
+        self.future = concurrent.futures.Future()
+        self.followers = 0
+
+
+class BaseLockBackend:
+    """Interface for cross-process locks; acquire() must not block"""
+
+    def acquire(self, key):
+        """Return a handle if the lock was taken, otherwise None"""
+        raise NotImplementedError
+
+    def release(self, handle):
+        raise NotImplementedError
+
+
+class FileLockBackend(BaseLockBackend):
+    """flock()-based locks in a directory shared by the workers on a host; released if a worker dies"""
+
+    def __init__(self, path=None, **options):
+        if fcntl is None:
+            raise ImproperlyConfigured("FileLockBackend needs fcntl; use SQLiteLockBackend on this platform")
+        self.path = str(path or os.path.join(settings.BASE_DIR, "cpt_coalesce_locks"))
+        os.makedirs(self.path, exist_ok=True)
+
+    def _lock_path(self, key):
+        return os.path.join(self.path, hashlib.sha256(key.encode("utf-8")).hexdigest()[:32] + ".lock")
+
+    def acquire(self, key):
+        path = self._lock_path(key)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return None
+        try:
+            current = os.stat(path).st_ino
+        except FileNotFoundError:
+            current = None
+        if current != os.fstat(fd).st_ino:
+            # The previous holder unlinked the file between our open() and flock(); try again later
+            os.close(fd)
+            return None
+        return path, fd
+
+    def release(self, handle):
+        path, fd = handle
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+class SQLiteLockBackend(BaseLockBackend):
+    """Lock rows in an SQLite file; a lock left by a crashed worker expires after `ttl` seconds"""
+
+    def __init__(self, path=None, ttl=300, **options):
+        self.path = str(path or os.path.join(settings.BASE_DIR, "cpt_result_cache.sqlite3"))
+        self.ttl = ttl
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS coalesce_locks (key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._local.connection = connection
+        return connection
+
+    def acquire(self, key):
+        connection = self._connection()
+        owner = uuid.uuid4().hex
+        now = time.time()
+        connection.execute("DELETE FROM coalesce_locks WHERE key = ? AND expires_at <= ?", (key, now))
+        cursor = connection.execute(
+            "INSERT OR IGNORE INTO coalesce_locks (key, owner, expires_at) VALUES (?, ?, ?)",
+            (key, owner, now + self.ttl),
+        )
+        return (key, owner) if cursor.rowcount == 1 else None
+
+    def release(self, handle):
+        key, owner = handle
+        self._connection().execute("DELETE FROM coalesce_locks WHERE key = ? AND owner = ?", (key, owner))
+
+
+class SingleFlight:
+    """
+    Tracks in-flight analyses by key
+
+    Usage from the pipeline:
+        flight, leader = coalescer.begin(key)
+        if leader: compute, then coalescer.finish(flight, outcome)
+        else: outcome = await coalescer.wait(flight)
+    """
+
+    def __init__(self, lock_backend=None, wait_timeout=120.0, poll_interval=0.1):
+        self.lock_backend = lock_backend
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def begin(self, key):
+        """
+        Join the flight for `key`, starting one if none is running
+
+        Returns:
+            tuple: (Flight, True if the caller must compute the result)
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.followers += 1
+                return flight, False
+            flight = self._flights[key] = Flight(key)
+        COALESCE_LEADERS.inc()
+        return flight, True
+
+    def finish(self, flight, outcome):
+        """
+        Publish the leader's outcome and retire the flight
+
+        Args:
+            outcome: (event, payload) or None if the leader stopped without one
+        """
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+        if not flight.future.done():
+            flight.future.set_result(outcome)
+
+    async def wait(self, flight):
+        """The leader's (event, payload), or None if it gave up or took longer than wait_timeout"""
+        try:
+            # shield(): a follower timing out must not cancel the future the other followers share
+            outcome = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(flight.future)), self.wait_timeout)
+        except asyncio.TimeoutError:
+            return None
+        if outcome is not None:
+            COALESCED.inc(scope="local")
+        return outcome
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._flights)
+
+    async def acquire_remote(self, key):
+        """
+        Take the cross-process lock for `key`, waiting while another worker holds it
+
+        Returns:
+            tuple: (handle or None, waited). The handle is None when there is no
+            lock backend or the wait timed out; the caller then computes anyway.
+        """
+        if self.lock_backend is None:
+            return None, False
+        acquire = sync_to_async(self.lock_backend.acquire, thread_sensitive=False)
+        deadline = time.monotonic() + self.wait_timeout
+        waited = False
+        while True:
+            handle = await acquire(key)
+            if handle is not None or time.monotonic() >= deadline:
+                return handle, waited
+            waited = True
+            await asyncio.sleep(self.poll_interval)
+
+    def release_remote(self, handle):
+        if handle is not None:
+            self.lock_backend.release(handle)
+
+    async def arelease_remote(self, handle):
+        """release_remote() off the event loop: the lock backend may write to disk or the database"""
+        if handle is not None:
+            await sync_to_async(self.lock_backend.release, thread_sensitive=False)(handle)
+
+
+_coalescer = None
+_coalescer_lock = threading.Lock()
+
+
+def get_coalescer():
+    """
+    Return the process-wide SingleFlight configured by settings.CPT_COALESCE
+
+    Returns None when coalescing is disabled.
+    """
+    global _coalescer
+
+    if _coalescer is None:
+        with _coalescer_lock:
+            if _coalescer is None:
+                config = dict(getattr(settings, "CPT_COALESCE", None) or {})
+                if not config.get("ENABLED"):
+                    return None
+                lock_backend = None
+                backend_path = config.get("LOCK_BACKEND")
+                if backend_path:
+                    options = {name.lower(): value for name, value in (config.get("LOCK_OPTIONS") or {}).items()}
+                    lock_backend = import_string(backend_path)(**options)
+                _coalescer = SingleFlight(
+                    lock_backend,
+                    wait_timeout=config.get("WAIT_TIMEOUT", 120.0),
+                    poll_interval=config.get("POLL_INTERVAL", 0.1),
+                )
+    return _coalescer
+
+
+def reset_coalescer():
+    """Forget the configured coalescer so the next get_coalescer() call rebuilds it"""
+    global _coalescer
+    with _coalescer_lock:
+        _coalescer = None
@@ -0,0 +1,111 @@
+"""
+A concurrency gate shared by the admission middleware and the OpenAI clients.
+
+ConcurrencyGate admits at most `limit` holders at once and queues the rest
+first come, first served. Waiters may be threads (enter()) or coroutines on
+any event loop (aenter()), so one gate can bound work across the request
+threads, the per-request loops of async_to_sync and the server's own loop.
+"""
+import asyncio
+import threading
+from collections import deque
+
+
+class _LoopWaiter:
+    """A queued request on an event loop (under WSGI every async view has its own loop)"""
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+
+    def wake(self):
+        self.loop.call_soon_threadsafe(lambda: self.future.done() or self.future.set_result(True))
+
+
+class _ThreadWaiter:
+    """A queued request on a worker thread"""
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    def wake(self):
+        self.event.set()
+
+
+class ConcurrencyGate:
+    """
+    At most `limit` holders at once, with a bounded first-come first-served wait queue
+
+    leave() hands a freed slot straight to the oldest waiter, so a queued
+    request cannot be overtaken by one that arrives later.
+    """
+
+    def __init__(self, limit, max_queue):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.active = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def queued(self):
+        return len(self._waiters)
+
+    def _try_enter(self, make_waiter):
+        """True when a slot was taken, a waiter when queued, None when the queue is full"""
+        with self._lock:
+            if self.active < self.limit and not self._waiters:
+                self.active += 1
+                return True
+            if len(self._waiters) >= self.max_queue:
+                return None
+            waiter = make_waiter()
+            self._waiters.append(waiter)
+            return waiter
+
+    def _give_up(self, waiter):
+        """Leave the queue after a timeout; False if a slot was handed over in the meantime"""
+        with self._lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                return True
+        return False
+
+    def enter(self, timeout):
+        """
+        Take a slot, waiting up to `timeout` seconds in the queue
+
+        Returns:
+            str: 'admitted' or 'queued' once the caller holds a slot, None when rejected
+        """
+        waiter = self._try_enter(_ThreadWaiter)
+        if waiter is True or waiter is None:
+            return "admitted" if waiter else None
+        if not waiter.event.wait(timeout) and self._give_up(waiter):
+            return None
+        return "queued"
+
+    async def aenter(self, timeout):
+        """Async version of enter"""
+        waiter = self._try_enter(_LoopWaiter)
+        if waiter is True or waiter is None:
+            return "admitted" if waiter else None
+        try:
+            await asyncio.wait_for(waiter.future, timeout)
+        except asyncio.TimeoutError:
+            if self._give_up(waiter):
+                return None
+        except BaseException:
+            # Cancelled while queued: do not keep a slot nobody will release
+            if not self._give_up(waiter):
+                self.leave()
+            raise
+        return "queued"
+
+    def leave(self):
+        with self._lock:
+            if self._waiters:
+                # The slot passes to the oldest waiter; active stays the same
+                self._waiters.popleft().wake()
+            else:
+                self.active -= 1
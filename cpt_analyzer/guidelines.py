@@ -0,0 +1,468 @@
+"""
+Coding-guideline passages retrieved from a pre-built on-disk index.
+
+`manage.py ingest_guidelines` extracts the text of the guideline PDF
+(settings.CPT_GUIDELINES['SOURCE']), splits it into short passages and
+writes an index: a BM25 lexicon, memory-mapped postings and a memory-mapped
+chunk store. At request time the pipeline looks up the few passages that
+match the scenario and its likely codes and gives them to both agents. The
+result lists them under `guideline_citations`.
+
+Text comes from PyMuPDF (fitz) or pypdf, whichever is installed. Pages
+without a text layer are OCRed when PyMuPDF finds Tesseract. A text export
+with one form feed between pages (pdftotext, ocrmypdf --sidecar) can be
+ingested instead of the PDF. Re-ingesting a replaced PDF reuses the text of
+unchanged pages, so only new or edited pages are extracted again.
+
+Each build goes to its own directory and CURRENT is switched atomically, so
+workers keep reading a complete index while a new one is written; they pick
+the new one up within REFRESH_INTERVAL seconds.
+"""
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import shutil
+import threading
+import time
+from array import array
+from collections import Counter as TermCounter
+
+from django.conf import settings
+
+from .metrics import Counter, registry
+from .preprocess import count_tokens
+from .retrieval import expand_query, find_codes, get_retriever, tokenize
+
+logger = logging.getLogger(__name__)
+
+INDEX_FORMAT = 1
+CHUNK_WORDS = 120
+# Words repeated from the end of one chunk at the start of the next, so a rule split across chunks is still found
+CHUNK_OVERLAP = 20
+# Score added per candidate code a passage mentions
+CODE_BOOST = 2.0
+# Likely codes from catalog retrieval used to pick passages
+GUIDANCE_CANDIDATES = 10
+EXCERPT_CHARS = 200
+# Seconds between checks for a newer index
+REFRESH_INTERVAL = 5.0
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+PAGE_BREAK = "\f"
+PARAGRAPH_RE = re.compile(r"\n\s*\n")
+SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+GUIDELINE_LOOKUPS = registry.register(Counter(
+    "cpt_guideline_lookups_total", "Guideline passage lookups by outcome", ("outcome",)))
+
+DEFAULT_GUIDELINES = {
+    "ENABLED": True,
+    "SOURCE": "",
+    "INDEX_PATH": "",
+    "MAX_PASSAGES": 3,
+    "MAX_TOKENS": 450,
+    "MIN_SCORE": 1.0,
+}
+
+
+def guideline_settings():
+    return {**DEFAULT_GUIDELINES, **(getattr(settings, "CPT_GUIDELINES", None) or {})}
+
+
+class ExtractionError(RuntimeError):
+    """The guideline source has no extractable text, or no PDF reader is installed"""
+
+
+class PageText:
+    """Text of one source page and a fingerprint of its content, for incremental re-ingestion"""
+
+    def __init__(self, number, fingerprint, text, method):
+        self.number = number
+        self.fingerprint = fingerprint
+        self.text = text
+        self.method = method
+
+    def as_dict(self):
+        return {"page": self.number, "fingerprint": self.fingerprint, "method": self.method, "text": self.text}
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for block in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_text_export(path):
+    """Pages of a text export, split on form feeds"""
+    with open(path, encoding="utf-8") as handle:
+        pages = handle.read().split(PAGE_BREAK)
+    return [PageText(number, _sha256(text.encode("utf-8")), text, "text") for number, text in enumerate(pages, start=1)]
+
+
+def extract_pdf(path, cached=None):
+    """
+    Pages of a PDF, reusing `cached` {fingerprint: PageText} for pages whose content is unchanged
+
+    Raises:
+        ExtractionError: When neither PyMuPDF nor pypdf is installed
+    """
+    cached = cached or {}
+    try:
+        import fitz
+    except ImportError:
+        fitz = None
+    if fitz is not None:
+        return _extract_with_pymupdf(fitz, path, cached)
+    try:
+        import pypdf
+    except ImportError:
+        raise ExtractionError(
+            "Reading PDFs needs PyMuPDF or pypdf (pip install pymupdf); "
+            "alternatively pass a text export of the PDF with --text"
+        )
+    pages = []
+    for number, page in enumerate(pypdf.PdfReader(path).pages, start=1):
+        # pypdf cannot OCR, so the text itself is the fingerprint
+        text = page.extract_text() or ""
+        pages.append(PageText(number, _sha256(text.encode("utf-8")), text, "pypdf"))
+    return pages
+
+
+def _extract_with_pymupdf(fitz, path, cached):
+    pages = []
+    with fitz.open(path) as document:
+        for number, page in enumerate(document, start=1):
+            # Content stream plus raw image data: an unchanged scanned page is not OCRed again
+            content = page.read_contents() + b"".join(document.xref_stream_raw(image[0]) or b""
+                                                      for image in page.get_images(full=True))
+            fingerprint = _sha256(content)
+            if fingerprint in cached:
+                pages.append(PageText(number, fingerprint, cached[fingerprint].text, cached[fingerprint].method))
+                continue
+            text, method = page.get_text(), "pymupdf"
+            if not text.strip() and page.get_images():
+                try:
+                    text, method = page.get_text(textpage=page.get_textpage_ocr(full=True)), "ocr"
+                except Exception as e:
+                    logger.warning("OCR of page %d of %s failed (is Tesseract installed?): %s", number, path, e)
+            pages.append(PageText(number, fingerprint, text, method))
+    return pages
+
+
+def chunk_pages(pages, chunk_words=CHUNK_WORDS, overlap=CHUNK_OVERLAP):
+    """
+    Split page text into passages of about `chunk_words` words, never across pages
+
+    Returns:
+        list: {'page', 'text', 'codes'} dicts in document order
+    """
+    chunks = []
+    for page in pages:
+        passages, words = [], []
+        for paragraph in PARAGRAPH_RE.split(page.text):
+            for sentence in SENTENCE_RE.split(" ".join(paragraph.split())):
+                sentence_words = sentence.split()
+                if words and len(words) + len(sentence_words) > chunk_words:
+                    passages.append(words)
+                    words = words[-overlap:] if overlap else []
+                words.extend(sentence_words)
+                while len(words) > chunk_words * 2:
+                    # A run-on "sentence" (tables, OCR without punctuation)
+                    passages.append(words[:chunk_words])
+                    words = words[chunk_words - overlap:]
+        if words:
+            passages.append(words)
+        for passage in passages:
+            text = " ".join(passage)
+            chunks.append({"page": page.number, "text": text, "codes": find_codes(text)})
+    return chunks
+
+
+def build_index(chunks, directory, meta):
+    """Write the lexicon/metadata, postings and chunk store of `chunks` into `directory`; returns the term count"""
+    os.makedirs(directory, exist_ok=True)
+    postings, lengths, offsets, code_chunks = {}, [], [0], {}
+    with open(os.path.join(directory, "chunks.bin"), "wb") as store:
+        for chunk_id, chunk in enumerate(chunks):
+            terms = tokenize(chunk["text"])
+            lengths.append(len(terms))
+            for term, frequency in TermCounter(terms).items():
+                postings.setdefault(term, []).append((chunk_id, frequency))
+            for code in chunk["codes"]:
+                code_chunks.setdefault(code, []).append(chunk_id)
+            record = json.dumps(dict(chunk, id=chunk_id)).encode("utf-8")
+            store.write(record)
+            offsets.append(offsets[-1] + len(record))
+
+    lexicon, flat = {}, array("I")
+    for term in sorted(postings):
+        lexicon[term] = [len(flat) // 2, len(postings[term])]
+        for chunk_id, frequency in postings[term]:
+            flat.extend((chunk_id, frequency))
+    with open(os.path.join(directory, "postings.bin"), "wb") as handle:
+        flat.tofile(handle)
+    with open(os.path.join(directory, "meta.json"), "w") as handle:
+        json.dump(dict(meta, format=INDEX_FORMAT, chunks=len(chunks), terms=len(lexicon),
+                       avg_length=(sum(lengths) / len(lengths)) if lengths else 1.0, lengths=lengths,
+                       offsets=offsets, lexicon=lexicon, codes=code_chunks), handle)
+    return len(lexicon)
+
+
+def _read_cached_pages(index_path):
+    """{fingerprint: PageText} from the current build, for reuse by the next one"""
+    directory = current_directory(index_path)
+    path = os.path.join(directory, "pages.jsonl") if directory else None
+    if not path or not os.path.exists(path):
+        return {}
+    cached = {}
+    with open(path) as handle:
+        for line in handle:
+            page = json.loads(line)
+            cached[page["fingerprint"]] = PageText(page["page"], page["fingerprint"], page["text"], page["method"])
+    return cached
+
+
+def current_directory(index_path):
+    """The build directory CURRENT points at, or None before the first ingestion"""
+    try:
+        with open(os.path.join(index_path, "CURRENT")) as handle:
+            name = handle.read().strip()
+    except FileNotFoundError:
+        return None
+    return os.path.join(index_path, name) if name else None
+
+
+def current_meta(index_path):
+    directory = current_directory(index_path)
+    if directory is None:
+        return None
+    try:
+        with open(os.path.join(directory, "meta.json")) as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return None
+
+
+def ingest(source, index_path, text_export=None, chunk_words=CHUNK_WORDS, force=False):
+    """
+    Build the guideline index for `source` unless it is already indexed
+
+    Args:
+        source (str): The guideline PDF
+        index_path (str): Index directory
+        text_export (str): Optional text export of the PDF (form feeds between pages) to index instead
+        chunk_words (int): Target words per passage
+        force (bool): Rebuild even when the source has not changed
+
+    Returns:
+        dict: status ('unchanged' or 'built'), version, pages, pages_extracted, pages_reused, chunks, terms, seconds
+
+    Raises:
+        ExtractionError: When no text can be extracted
+    """
+    started = time.monotonic()
+    origin = text_export or source
+    source_hash = file_sha256(origin)
+    previous = current_meta(index_path)
+    if (not force and previous is not None and previous.get("source_sha256") == source_hash
+            and previous.get("chunk_words") == chunk_words and previous.get("format") == INDEX_FORMAT):
+        return {"status": "unchanged", "version": previous["version"], "pages": previous["pages"],
+                "chunks": previous["chunks"], "terms": previous["terms"],
+                "seconds": round(time.monotonic() - started, 3)}
+
+    cached = _read_cached_pages(index_path)
+    pages = read_text_export(text_export) if text_export else extract_pdf(source, cached)
+    if not any(page.text.strip() for page in pages):
+        raise ExtractionError(
+            f"No text found in {origin}: it looks like a scanned document. Install PyMuPDF with Tesseract to OCR it, "
+            f"or OCR it elsewhere (e.g. ocrmypdf --sidecar pages.txt) and pass that file with --text"
+        )
+    reused = sum(page.fingerprint in cached for page in pages)
+    chunks = chunk_pages(pages, chunk_words)
+
+    version = _sha256(f"{source_hash}:{chunk_words}:{INDEX_FORMAT}".encode("utf-8"))[:12]
+    directory = os.path.join(index_path, f"build-{version}")
+    shutil.rmtree(directory, ignore_errors=True)
+    meta = {
+        "version": version,
+        "source": os.path.basename(source),
+        "source_sha256": source_hash,
+        "chunk_words": chunk_words,
+        "pages": len(pages),
+        "built_at": time.time(),
+    }
+    terms = build_index(chunks, directory, meta)
+    with open(os.path.join(directory, "pages.jsonl"), "w") as handle:
+        for page in pages:
+            handle.write(json.dumps(page.as_dict()) + "\n")
+
+    # Readers follow CURRENT; switch it atomically, then drop builds other than the new and previous one
+    previous_directory = current_directory(index_path)
+    pointer = os.path.join(index_path, f"CURRENT.{os.getpid()}.tmp")
+    with open(pointer, "w") as handle:
+        handle.write(os.path.basename(directory))
+    os.replace(pointer, os.path.join(index_path, "CURRENT"))
+    keep = {os.path.basename(directory), os.path.basename(previous_directory or "")}
+    for name in os.listdir(index_path):
+        if name.startswith("build-") and name not in keep:
+            shutil.rmtree(os.path.join(index_path, name), ignore_errors=True)
+
+    return {"status": "built", "version": version, "pages": len(pages), "pages_extracted": len(pages) - reused,
+            "pages_reused": reused, "chunks": len(chunks), "terms": terms,
+            "seconds": round(time.monotonic() - started, 3)}
+
+
+def build_meta(directory):
+    with open(os.path.join(directory, "meta.json")) as handle:
+        return json.load(handle)
+
+
+class Passage:
+    """A retrieved guideline passage and where it came from"""
+
+    def __init__(self, chunk, score, source):
+        self.chunk_id = chunk["id"]
+        self.page = chunk["page"]
+        self.text = chunk["text"]
+        self.codes = chunk["codes"]
+        self.score = score
+        self.source = source
+
+    def citation(self, label):
+        excerpt = self.text if len(self.text) <= EXCERPT_CHARS else self.text[:EXCERPT_CHARS].rsplit(" ", 1)[0] + "..."
+        return {"id": label, "source": self.source, "page": self.page, "chunk": self.chunk_id,
+                "score": round(self.score, 3), "excerpt": excerpt}
+
+
+class GuidelineIndex:
+    """One ingested build, with its postings and chunk store memory-mapped"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        meta = build_meta(directory)
+        self.version = meta["version"]
+        self.source = meta["source"]
+        self.lexicon = meta["lexicon"]
+        self.lengths = meta["lengths"]
+        self.offsets = meta["offsets"]
+        self.code_chunks = meta["codes"]
+        self.avg_length = meta["avg_length"] or 1.0
+        self.count = meta["chunks"]
+        self._postings = self._map("postings.bin")
+        self._store = self._map("chunks.bin")
+        self._pairs = memoryview(self._postings).cast("I") if self._postings is not None else memoryview(array("I"))
+
+    def _map(self, name):
+        with open(os.path.join(self.directory, name), "rb") as handle:
+            if os.fstat(handle.fileno()).st_size == 0:
+                return None
+            return mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def chunk(self, chunk_id):
+        return json.loads(self._store[self.offsets[chunk_id]:self.offsets[chunk_id + 1]])
+
+    def search(self, text, codes=(), k=3, min_score=0.0):
+        """
+        Best passages for a scenario: BM25 over the text plus CODE_BOOST per candidate code mentioned
+
+        Returns:
+            list: Passage objects, best first
+        """
+        scores = {}
+        for term, weight in expand_query(text).items():
+            entry = self.lexicon.get(term)
+            if entry is None:
+                continue
+            start, frequency_count = entry
+            idf = math.log(1 + (self.count - frequency_count + 0.5) / (frequency_count + 0.5))
+            pairs = self._pairs[start * 2:(start + frequency_count) * 2]
+            for position in range(0, len(pairs), 2):
+                chunk_id, frequency = pairs[position], pairs[position + 1]
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[chunk_id] / self.avg_length)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + weight * idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+        for code in dict.fromkeys(codes):
+            for chunk_id in self.code_chunks.get(code, ()):
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + CODE_BOOST
+        ranked = sorted((item for item in scores.items() if item[1] >= min_score), key=lambda item: (-item[1], item[0]))
+        return [Passage(self.chunk(chunk_id), score, self.source) for chunk_id, score in ranked[:k]]
+
+
+def passages_for(index, catalog, scenario_text):
+    """
+    The passages to give the agents for a scenario, within MAX_PASSAGES and MAX_TOKENS
+
+    Candidate codes are the codes in the scenario plus the catalog's best matches.
+    """
+    config = guideline_settings()
+    codes = find_codes(scenario_text)
+    if catalog is not None:
+        codes += [code for code, _ in get_retriever(catalog).search(scenario_text, GUIDANCE_CANDIDATES)]
+    selected, used = [], 0
+    for passage in index.search(scenario_text, codes, k=config["MAX_PASSAGES"], min_score=config["MIN_SCORE"]):
+        tokens = count_tokens(passage.text)
+        if used + tokens > config["MAX_TOKENS"]:
+            break
+        selected.append(passage)
+        used += tokens
+    GUIDELINE_LOOKUPS.inc(outcome="hit" if selected else "miss")
+    return selected
+
+
+def citations(passages):
+    """The JSON citations for passages, labelled G1, G2, ... in the order the prompt shows them"""
+    return [passage.citation(f"G{number}") for number, passage in enumerate(passages, start=1)]
+
+
+_index = None
+_index_checked = 0.0
+_index_lock = threading.Lock()
+
+
+def get_guideline_index():
+    """
+    The current build under CPT_GUIDELINES['INDEX_PATH'], re-checked every REFRESH_INTERVAL seconds
+
+    Returns None when disabled or before the first ingestion.
+    """
+    global _index, _index_checked
+
+    now = time.monotonic()
+    if now - _index_checked < REFRESH_INTERVAL:
+        return _index
+    with _index_lock:
+        if now - _index_checked < REFRESH_INTERVAL:
+            return _index
+        config = guideline_settings()
+        directory = current_directory(config["INDEX_PATH"]) if config["ENABLED"] and config["INDEX_PATH"] else None
+        if directory is None:
+            _index = None
+        elif _index is None or _index.directory != directory:
+            try:
+                _index = GuidelineIndex(directory)
+                logger.info("Loaded guideline index %s (%d passages)", _index.version, len(_index))
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning("Ignoring unreadable guideline index %s: %s", directory, e)
+        _index_checked = now
+    return _index
+
+
+def reset_guideline_index():
+    """Forget the loaded index so the next get_guideline_index() call re-reads CURRENT"""
+    global _index, _index_checked
+    with _index_lock:
+        _index = None
+        _index_checked = 0.0
@@ -0,0 +1,341 @@
+"""
+Database-backed job queue for analyses that should not hold a request open.
+
+`/analyze/` with {"async": true} (or a `Prefer: respond-async` header) and
+POST /jobs/ store a Job row and return its id at once; clients poll
+/jobs/<id>/ or pass a callback_url that receives the finished job as JSON.
+No broker is needed: worker threads in each process (settings.CPT_JOBS
+WORKERS, started on first use) or a dedicated `manage.py run_jobs` process
+claim queued jobs by priority, then age, with a conditional UPDATE so two
+workers never run the same job.
+"""
+import datetime
+import ipaddress
+import json
+import logging
+import socket
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F
+from django.utils import timezone
+
+from .admission import charge_client
+from .audit import record_analysis
+from .metrics import Counter, registry
+from .models import Analysis, Job
+from .pipeline import resolve_mode, result_usage, run_pipeline
+
+logger = logging.getLogger(__name__)
+
+PRIORITIES = {
+    "interactive": Job.PRIORITY_INTERACTIVE,
+    "normal": Job.PRIORITY_NORMAL,
+    "batch": Job.PRIORITY_BATCH,
+}
+# Attempts at claiming a job before concluding other workers are draining the queue
+CLAIM_ATTEMPTS = 5
+
+JOBS = registry.register(Counter("cpt_jobs_total", "Queued analyses by outcome", ("outcome",)))
+
+DEFAULT_JOB_SETTINGS = {
+    "WORKERS": 2,
+    "POLL_INTERVAL": 1.0,
+    "STALE_AFTER": 600,
+    "MAX_ATTEMPTS": 3,
+    "CALLBACK_TIMEOUT": 10,
+    "CALLBACK_RETRIES": 3,
+    "CALLBACK_ALLOWED_HOSTS": [],
+}
+
+
+def job_settings():
+    return {**DEFAULT_JOB_SETTINGS, **(getattr(settings, "CPT_JOBS", None) or {})}
+
+
+# Set on enqueue so idle workers in this process pick the job up without waiting for the next poll
+_wakeup = threading.Event()
+
+
+def resolve_priority(value, default=Job.PRIORITY_NORMAL):
+    """'interactive', 'normal', 'batch' or an integer (lower runs first)"""
+    if value is None or value == "":
+        return default
+    if isinstance(value, str) and value.lower() in PRIORITIES:
+        return PRIORITIES[value.lower()]
+    try:
+        priority = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Unknown priority '{value}' (expected {', '.join(PRIORITIES)} or an integer)")
+    if not -1000 <= priority <= 1000:
+        raise ValueError("Priority must be between -1000 and 1000")
+    return priority
+
+
+def check_public_host(hostname, port):
+    """
+    Resolve a callback host and reject it unless every address is public
+
+    Loopback, private, link-local (cloud metadata), reserved, multicast and
+    unspecified addresses are refused, so callbacks cannot reach internal services.
+
+    Raises:
+        ValueError: When the host does not resolve or resolves to a non-public address
+    """
+    try:
+        infos = socket.getaddrinfo(hostname, port, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError):
+        raise ValueError(f"callback_url host '{hostname}' does not resolve")
+    for info in infos:
+        address = ipaddress.ip_address(info[4][0].split("%")[0])
+        if not address.is_global or address.is_multicast:
+            raise ValueError(f"callback_url host '{hostname}' resolves to a non-public address ({address})")
+
+
+def validate_callback_url(url):
+    """
+    Reject callback URLs that are not http(s), not on CALLBACK_ALLOWED_HOSTS or not public
+
+    Callbacks are off while the allow-list is empty; '*' allows any host with public addresses.
+    """
+    if not url:
+        return ""
+    parsed = urllib.parse.urlsplit(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        raise ValueError("callback_url must be an absolute http(s) URL")
+    allowed = job_settings()["CALLBACK_ALLOWED_HOSTS"]
+    if not allowed:
+        raise ValueError("callback_url is not enabled on this server (CPT_JOB_CALLBACK_HOSTS)")
+    if "*" not in allowed and parsed.hostname not in allowed:
+        raise ValueError(f"callback_url host '{parsed.hostname}' is not allowed")
+    check_public_host(parsed.hostname, parsed.port or (443 if parsed.scheme == "https" else 80))
+    return url
+
+
+class _NoRedirects(urllib.request.HTTPRedirectHandler):
+    """Refuse redirects: a callback must not be bounced to another (possibly internal) host"""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+_callback_opener = urllib.request.build_opener(_NoRedirects)
+
+
+def open_callback(request, timeout):
+    """POST a callback request without following redirects"""
+    return _callback_opener.open(request, timeout=timeout)
+
+
+def enqueue(scenario_text, mode=None, use_cache=True, priority=Job.PRIORITY_NORMAL, callback_url="", external_id="",
+            client=""):
+    """Queue one analysis and wake this process's workers; `client` is charged for its tokens"""
+    job = Job.objects.create(
+        scenario_text=scenario_text,
+        mode=mode or "",
+        use_cache=use_cache,
+        priority=priority,
+        callback_url=validate_callback_url(callback_url),
+        external_id=str(external_id or "")[:255],
+        client=str(client or "")[:255],
+    )
+    JOBS.inc(outcome="queued")
+    _wakeup.set()
+    return job
+
+
+def enqueue_many(items, mode=None, use_cache=True, priority=Job.PRIORITY_BATCH, batch_size=500):
+    """Queue {'id', 'scenario'} records with one bulk insert; returns the number queued"""
+    jobs = Job.objects.bulk_create([
+        Job(scenario_text=item["scenario"], mode=mode or "", use_cache=use_cache, priority=priority,
+            external_id=str(item.get("id") or "")[:255])
+        for item in items
+    ], batch_size=batch_size)
+    JOBS.inc(len(jobs), outcome="queued")
+    _wakeup.set()
+    return len(jobs)
+
+
+def submit_job(data, default_priority=Job.PRIORITY_NORMAL, client=""):
+    """
+    Queue a job from a request body
+
+    Args:
+        data (dict): scenario, and optionally mode, cache, priority, callback_url and id
+        client (str): The submitting request's admission client, charged for the job's tokens
+
+    Raises:
+        ValueError: On a missing scenario or an invalid mode, priority or callback URL
+    """
+    scenario_text = data.get("scenario", "")
+    if not scenario_text:
+        raise ValueError("No scenario provided")
+    job = enqueue(
+        scenario_text,
+        mode=resolve_mode(data.get("mode")),
+        use_cache=data.get("cache", True) is not False,
+        priority=resolve_priority(data.get("priority"), default_priority),
+        callback_url=data.get("callback_url") or "",
+        external_id=data.get("id") or "",
+        client=client,
+    )
+    ensure_workers()
+    return job
+
+
+def claim_next(worker_id):
+    """Move the next queued job to running for this worker; None when the queue is empty"""
+    for _ in range(CLAIM_ATTEMPTS):
+        candidate = (Job.objects.filter(status=Job.QUEUED).order_by("priority", "created_at")
+                     .values_list("pk", flat=True).first())
+        if candidate is None:
+            return None
+        # Only one worker's UPDATE can match status=queued; the others retry with the next job
+        claimed = Job.objects.filter(pk=candidate, status=Job.QUEUED).update(
+            status=Job.RUNNING, worker=worker_id, started_at=timezone.now(), attempts=F("attempts") + 1,
+        )
+        if claimed:
+            return Job.objects.get(pk=candidate)
+    return None
+
+
+def run_job(job):
+    """Run a claimed job, store its outcome and deliver its callback"""
+    try:
+        result = run_pipeline(job.scenario_text, use_cache=job.use_cache, mode=job.mode or None)
+    except Exception as e:
+        result = {"error": str(e)}
+    if "error" in result:
+        job.status, job.error = Job.FAILED, result["error"]
+    else:
+        job.status, job.result = Job.DONE, result
+        record_analysis(job.scenario_text, result, source=Analysis.SOURCE_JOB)
+        # Queued work counts against the submitter's quota like a direct request
+        charge_client(job.client, result_usage(result))
+    job.finished_at = timezone.now()
+    job.save(update_fields=["status", "error", "result", "finished_at"])
+    JOBS.inc(outcome=job.status)
+    if job.callback_url:
+        deliver_callback(job)
+    return job
+
+
+def deliver_callback(job):
+    """POST the finished job to its callback URL, retrying with backoff; the outcome is kept on the job"""
+    config = job_settings()
+    body = json.dumps(job.as_dict()).encode("utf-8")
+    status = ""
+    for attempt in range(config["CALLBACK_RETRIES"] + 1):
+        request = urllib.request.Request(
+            job.callback_url, data=body, method="POST",
+            headers={"Content-Type": "application/json", "X-Job-Id": str(job.pk)},
+        )
+        try:
+            # Checked again at delivery: the settings or the host's DNS may have changed since it was queued
+            validate_callback_url(job.callback_url)
+            with open_callback(request, config["CALLBACK_TIMEOUT"]) as response:
+                status = f"delivered ({response.status})"
+                break
+        except ValueError as e:
+            status = f"refused: {e}"[:64]
+            break
+        except urllib.error.HTTPError as e:
+            status = f"failed: HTTP {e.code}"
+            if 300 <= e.code < 400:
+                # Redirects are not followed; retrying would not change that
+                break
+            if attempt < config["CALLBACK_RETRIES"]:
+                time.sleep(min(2 ** attempt, 30))
+        except (urllib.error.URLError, OSError) as e:
+            status = f"failed: {e}"[:64]
+            if attempt < config["CALLBACK_RETRIES"]:
+                time.sleep(min(2 ** attempt, 30))
+    Job.objects.filter(pk=job.pk).update(callback_status=status)
+    job.callback_status = status
+    return status
+
+
+def process_next(worker_id):
+    """Claim and run one job; False when there was nothing to do"""
+    job = claim_next(worker_id)
+    if job is None:
+        return False
+    run_job(job)
+    return True
+
+
+def requeue_stale():
+    """
+    Return jobs left running by a crashed worker to the queue
+
+    Jobs that already used MAX_ATTEMPTS fail instead of being retried forever.
+    """
+    config = job_settings()
+    cutoff = timezone.now() - datetime.timedelta(seconds=config["STALE_AFTER"])
+    stale = Job.objects.filter(status=Job.RUNNING, started_at__lt=cutoff)
+    failed = stale.filter(attempts__gte=config["MAX_ATTEMPTS"]).update(
+        status=Job.FAILED, error="Worker stopped before finishing the job", finished_at=timezone.now(),
+    )
+    requeued = stale.update(status=Job.QUEUED, worker="")
+    return requeued, failed
+
+
+class JobWorkerPool:
+    """Worker threads that claim and run jobs until stopped"""
+
+    def __init__(self, workers, poll_interval=None):
+        self.workers = workers
+        self.poll_interval = job_settings()["POLL_INTERVAL"] if poll_interval is None else poll_interval
+        self.name = uuid.uuid4().hex[:8]
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        requeue_stale()
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._loop, args=(f"{self.name}-{index}",),
+                                      name=f"cpt-job-worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        _wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _loop(self, worker_id):
+        while not self._stopping.is_set():
+            try:
+                processed = process_next(worker_id)
+            except Exception:
+                logger.exception("Job worker %s failed", worker_id)
+                processed = False
+            finally:
+                close_old_connections()
+            if not processed:
+                _wakeup.wait(self.poll_interval)
+                _wakeup.clear()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def ensure_workers():
+    """Start this process's worker threads on first use (none when CPT_JOBS['WORKERS'] is 0)"""
+    global _pool
+
+    if _pool is None:
+        with _pool_lock:
+            workers = job_settings()["WORKERS"]
+            if _pool is None and workers > 0:
+                _pool = JobWorkerPool(workers).start()
+    return _pool
@@ -0,0 +1,178 @@
+"""
+Pluggable chat completion backends for benchmarks and offline runs.
+
+cpt_analyzer.clients.set_backend() routes every agent call through one of
+these instead of the live API:
+
+  LiveBackend       the live OpenAI API (the default path, as an object)
+  RecordingBackend  calls another backend and appends each exchange to a JSONL file
+  ReplayBackend     answers from a recording, keyed by the exact request
+  StubBackend       deterministic answers from the local retriever, with configurable latency
+
+Requests are keyed by a hash of everything sent to the model, so a replay
+only matches when prompts, models and options are unchanged.
+"""
+import asyncio
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+
+from openai.types.chat import ChatCompletion
+
+from . import clients
+from .routing import catalog_for_scenario
+from .retrieval import get_retriever
+
+BACKENDS = ("live", "record", "replay", "stub")
+
+SCENARIO_RE = re.compile(r"MEDICAL SCENARIO:\s*(.*?)\n\s*\n", re.DOTALL)
+
+
+def request_key(kwargs):
+    """Stable hash of a chat completion request"""
+    payload = json.dumps(kwargs, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def estimate_tokens(text):
+    """Rough token count (about four characters per token) for stubbed usage"""
+    return max(1, len(text) // 4)
+
+
+class ReplayMissError(LookupError):
+    """The recording has no response for a request"""
+
+
+class LiveBackend:
+    name = "live"
+
+    def complete(self, **kwargs):
+        return clients.live_chat_completion(**kwargs)
+
+    async def acomplete(self, **kwargs):
+        return await clients.live_achat_completion(**kwargs)
+
+
+class RecordingBackend:
+    """Pass requests to `inner` and append {key, model, response} lines to `path`"""
+
+    name = "record"
+
+    def __init__(self, path, inner=None):
+        self.path = path
+        self.inner = inner or LiveBackend()
+        self._lock = threading.Lock()
+
+    def _record(self, kwargs, response):
+        line = json.dumps({"key": request_key(kwargs), "model": kwargs.get("model"), "response": response.model_dump()})
+        with self._lock, open(self.path, "a", encoding="utf-8") as handle:
+            handle.write(line + "\n")
+
+    def complete(self, **kwargs):
+        response = self.inner.complete(**kwargs)
+        self._record(kwargs, response)
+        return response
+
+    async def acomplete(self, **kwargs):
+        response = await self.inner.acomplete(**kwargs)
+        self._record(kwargs, response)
+        return response
+
+
+class ReplayBackend:
+    """Answer from a recording made by RecordingBackend; raises ReplayMissError for unknown requests"""
+
+    name = "replay"
+
+    def __init__(self, path):
+        self.path = path
+        self.responses = {}
+        with open(path, encoding="utf-8") as handle:
+            for line in handle:
+                if line.strip():
+                    record = json.loads(line)
+                    self.responses[record["key"]] = record["response"]
+
+    def complete(self, **kwargs):
+        key = request_key(kwargs)
+        if key not in self.responses:
+            raise ReplayMissError(f"No recorded response for request {key[:12]} in {self.path}")
+        return ChatCompletion.model_validate(self.responses[key])
+
+    async def acomplete(self, **kwargs):
+        return self.complete(**kwargs)
+
+
+class StubBackend:
+    """
+    Deterministic stand-in for the model
+
+    Answers with the top retrieval hit for the scenario in the prompt, so
+    runs measure the pipeline's own overhead and a retrieval-only accuracy
+    baseline. Each call waits `latency` seconds plus up to `jitter` seconds,
+    derived from the request hash so repeated runs take the same time.
+    """
+
+    name = "stub"
+
+    def __init__(self, latency=0.0, jitter=0.0, model="stub"):
+        self.latency = latency
+        self.jitter = jitter
+        self.model = model
+
+    def delay(self, key):
+        return self.latency + random.Random(key).uniform(0, self.jitter) if self.jitter else self.latency
+
+    def response(self, kwargs):
+        prompt = "\n".join(message["content"] for message in kwargs.get("messages", []))
+        match = SCENARIO_RE.search(prompt)
+        scenario = match.group(1).strip() if match else prompt
+
+        catalog = catalog_for_scenario(scenario)[1]
+        hits = get_retriever(catalog).search(scenario, 1) if catalog is not None else []
+        code = hits[0][0] if hits else ""
+        entry = catalog.get(code) if code else None
+        answer = {
+            "codes": [{"code": code, "modifiers": []}] if code else [],
+            "description": entry.description if entry is not None else "",
+            "explanation": "Stub answer: highest ranked catalog code for the scenario.",
+            "confidence": "Medium",
+        }
+        # Honor a structured-output schema by returning exactly its fields
+        fields = ((kwargs.get("response_format") or {}).get("json_schema") or {}).get("schema", {}).get("required")
+        if fields:
+            answer = {field: answer.get(field, "") for field in fields}
+        content = json.dumps(answer)
+
+        prompt_tokens, completion_tokens = estimate_tokens(prompt), estimate_tokens(content)
+        return ChatCompletion.model_validate({
+            "id": "chatcmpl-stub", "object": "chat.completion", "created": 0,
+            "model": kwargs.get("model") or self.model,
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+    def complete(self, **kwargs):
+        time.sleep(self.delay(request_key(kwargs)))
+        return self.response(kwargs)
+
+    async def acomplete(self, **kwargs):
+        await asyncio.sleep(self.delay(request_key(kwargs)))
+        return self.response(kwargs)
+
+
+def make_backend(name, path=None, latency=0.0, jitter=0.0):
+    """Build a backend by name (one of BACKENDS); record/replay need a recording path"""
+    if name == "live":
+        return LiveBackend()
+    if name == "record":
+        return RecordingBackend(path)
+    if name == "replay":
+        return ReplayBackend(path)
+    if name == "stub":
+        return StubBackend(latency=latency, jitter=jitter)
+    raise ValueError(f"Unknown LLM backend '{name}' (expected one of {', '.join(BACKENDS)})")
@@ -0,0 +1,134 @@
+"""
+Local load generator for the HTTP endpoints.
+
+Drives the project's ASGI application in-process (middleware included, no
+network or server needed) with simulated clients. Each client sends its
+requests on a fixed schedule without waiting for earlier answers (an open
+loop), so bursts and slow upstream calls build up in-flight work the way
+real traffic does. Run it with the stub LLM backend (see
+cpt_analyzer.llm_backends) to measure admission control, rate limiting
+and load shedding without spending tokens; `manage.py bench_admission`
+does both.
+"""
+import asyncio
+import itertools
+import json
+import time
+
+from django.utils.crypto import get_random_string
+
+from .benchmarks import percentile
+
+
+class ClientProfile:
+    """One simulated client: `requests` POSTs, one every 1/`rate` seconds"""
+
+    def __init__(self, name, rate, requests):
+        self.name = name
+        self.rate = rate
+        self.requests = requests
+
+
+async def asgi_post(app, path, body, headers=(), host="localhost"):
+    """
+    POST a JSON body to an ASGI application
+
+    Sends a CSRF cookie and the matching X-CSRFToken header, as the web page does.
+
+    Returns:
+        tuple: (status, {header name: value}, response body bytes)
+    """
+    csrf_token = get_random_string(32)
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST", "scheme": "http",
+        "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+        "headers": [(b"host", host.encode()), (b"content-type", b"application/json"),
+                    (b"cookie", f"csrftoken={csrf_token}".encode()), (b"x-csrftoken", csrf_token.encode()),
+                    *((name.lower().encode(), value.encode()) for name, value in headers)],
+        "client": ("127.0.0.1", 50000), "server": (host, 80),
+    }
+    payload = json.dumps(body).encode()
+    sent = False
+    disconnected = asyncio.Event()
+    response = {"status": None, "headers": {}, "body": []}
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": payload, "more_body": False}
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = {name.decode().lower(): value.decode() for name, value in message.get("headers", [])}
+        elif message["type"] == "http.response.body":
+            response["body"].append(message.get("body", b""))
+            if not message.get("more_body"):
+                disconnected.set()
+
+    await app(scope, receive, send)
+    return response["status"], response["headers"], b"".join(response["body"])
+
+
+async def run_load(app, profiles, scenarios, mode="analyzer_only", path="/analyze/", host="localhost"):
+    """
+    Run every client profile concurrently against `app`
+
+    Args:
+        app: The ASGI application
+        profiles (list): ClientProfile per simulated client
+        scenarios (list): Scenario texts, used in turn (the result cache is bypassed)
+        mode (str): Pipeline mode of every request
+        host (str): Host header; must be in ALLOWED_HOSTS
+
+    Returns:
+        dict: Status counts, latency of admitted and rejected requests, and per-client outcomes
+    """
+    outcomes = []
+    counter = itertools.count()
+
+    async def send_one(profile):
+        scenario = scenarios[next(counter) % len(scenarios)]
+        started = time.monotonic()
+        status, headers, _ = await asgi_post(app, path, {"scenario": scenario, "mode": mode, "cache": False},
+                                             headers=[("X-Client-ID", profile.name)], host=host)
+        outcomes.append((profile.name, status, time.monotonic() - started, headers.get("retry-after")))
+
+    async def run_client(profile):
+        tasks = []
+        for _ in range(profile.requests):
+            tasks.append(asyncio.ensure_future(send_one(profile)))
+            await asyncio.sleep(1 / profile.rate)
+        await asyncio.gather(*tasks)
+
+    started = time.monotonic()
+    await asyncio.gather(*(run_client(profile) for profile in profiles))
+    wall_time = time.monotonic() - started
+
+    statuses, clients = {}, {}
+    admitted, rejected = [], []
+    missing_retry_after = 0
+    for name, status, latency, retry_after in outcomes:
+        statuses[status] = statuses.get(status, 0) + 1
+        client = clients.setdefault(name, {"sent": 0, "ok": 0, "rejected": 0})
+        client["sent"] += 1
+        if status in (429, 503):
+            client["rejected"] += 1
+            rejected.append(latency)
+            missing_retry_after += retry_after is None
+        else:
+            client["ok"] += status == 200
+            admitted.append(latency)
+    return {
+        "requests": len(outcomes),
+        "wall_time_s": round(wall_time, 3),
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "admitted_p50_s": round(percentile(admitted, 50), 3),
+        "admitted_p95_s": round(percentile(admitted, 95), 3),
+        "rejected_p95_s": round(percentile(rejected, 95), 4),
+        "rejections_without_retry_after": missing_retry_after,
+        "clients": clients,
+    }
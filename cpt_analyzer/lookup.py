@@ -0,0 +1,289 @@
+"""
+Instant CPT code lookup for the /codes/ API and the page's autocomplete.
+
+Everything is built once per catalog version, so a lookup never reads the
+workbook or calls a model:
+
+- the sorted code list, searched with bisect for code prefixes ('517');
+- a sorted vocabulary of description words with their postings, so every
+  query word also matches as a prefix ('cystour' finds
+  cystourethroscopy) and ranks by IDF, with the urology synonyms of
+  cpt_analyzer.retrieval;
+- the JSON of every entry, with the modifiers it may carry and its
+  bundling edits from the rule engine's edit table.
+
+That makes a lookup a few binary searches and set intersections (tens of
+microseconds), cheap enough to verify model-proposed codes and modifiers
+locally with verify().
+"""
+import bisect
+import math
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from .checks import KNOWN_MODIFIERS, parse_code
+from .metrics import Histogram, registry
+from .retrieval import STOPWORDS, SYNONYMS, TOKEN_RE
+from .rules import DISTINCT_MODIFIERS, format_code, get_rule_engine, is_add_on
+
+MODIFIER_DESCRIPTIONS = {
+    "22": "Increased procedural services",
+    "50": "Bilateral procedure",
+    "51": "Multiple procedures",
+    "52": "Reduced services",
+    "53": "Discontinued procedure",
+    "58": "Staged or related procedure during the postoperative period",
+    "59": "Distinct procedural service",
+    "76": "Repeat procedure by the same physician",
+    "77": "Repeat procedure by another physician",
+    "78": "Unplanned return to the operating room during the postoperative period",
+    "79": "Unrelated procedure during the postoperative period",
+    "RT": "Right side",
+    "LT": "Left side",
+    "XE": "Separate encounter",
+    "XS": "Separate structure",
+    "XP": "Separate practitioner",
+    "XU": "Unusual non-overlapping service",
+}
+# Description wording of codes that may not carry -50
+INHERENTLY_BILATERAL_TERMS = ("bilateral", "unilateral or bilateral")
+
+DESCRIPTION_WEIGHT = 1.0
+SECTION_WEIGHT = 0.5
+PREFIX_MATCH_WEIGHT = 0.8
+MAX_LIMIT = 50
+
+LOOKUP_SECONDS = registry.register(Histogram(
+    "cpt_code_lookup_seconds", "Latency of /codes/ lookups by kind", ("kind",),
+    buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01)))
+
+
+def modifier_rules(entry):
+    """
+    Which modifiers a catalog entry may carry
+
+    Returns:
+        dict: modifier -> {'description', 'allowed', 'note'}
+    """
+    description = entry.description.lower()
+    bilateral = any(term in description for term in INHERENTLY_BILATERAL_TERMS)
+    add_on = is_add_on(entry)
+    rules = {}
+    for modifier, text in MODIFIER_DESCRIPTIONS.items():
+        allowed, note = True, ""
+        if modifier == "50" and bilateral:
+            allowed, note = False, "Code is inherently bilateral"
+        elif modifier in ("RT", "LT") and bilateral:
+            allowed, note = False, "Code is inherently bilateral"
+        elif modifier == "51" and add_on:
+            allowed, note = False, "Add-on codes are exempt from -51"
+        elif modifier == "51":
+            note = "Secondary procedures only, never the primary code"
+        elif modifier in DISTINCT_MODIFIERS:
+            note = "Only to report a bundled pair at a distinct site or session"
+        rules[modifier] = {"description": text, "allowed": allowed, "note": note}
+    return rules
+
+
+class CodeIndex:
+    """Precomputed prefix and keyword index over one catalog version"""
+
+    def __init__(self, catalog, edits=None):
+        self.catalog = catalog
+        self.version = catalog.version
+        self.codes = list(catalog.codes)
+        self.rules = {}
+        self.entries = {}
+        self.details = {}
+        postings = defaultdict(dict)
+
+        bundles = defaultdict(lambda: {"includes": [], "bundled_into": [], "distinct_with": []})
+        for (column1, column2), pair in sorted((edits or {}).items()):
+            if pair.modifier_indicator == 0:
+                bundles[column1]["includes"].append(column2)
+                bundles[column2]["bundled_into"].append(column1)
+            else:
+                bundles[column2]["distinct_with"].append(column1)
+
+        for doc_id, code in enumerate(self.codes):
+            entry = catalog.get(code)
+            self.entries[code] = {
+                "code": code, "description": entry.description, "topic": entry.topic, "category": entry.category,
+            }
+            self.rules[code] = modifier_rules(entry)
+            self.details[code] = dict(
+                self.entries[code],
+                modifiers=[dict(rule, modifier=modifier) for modifier, rule in self.rules[code].items()],
+                bundling={key: list(value) for key, value in bundles[code].items()},
+            )
+            for weight, text in ((SECTION_WEIGHT, f"{entry.topic} {entry.category}"),
+                                 (DESCRIPTION_WEIGHT, entry.description)):
+                for word in TOKEN_RE.findall(text.lower()):
+                    if word not in STOPWORDS and not word.isdigit():
+                        postings[word][doc_id] = max(weight, postings[word].get(doc_id, 0.0))
+
+        count = len(self.codes) or 1
+        self.vocabulary = sorted(postings)
+        self.postings = [postings[word] for word in self.vocabulary]
+        self.idf = [math.log(1 + (count - len(docs) + 0.5) / (len(docs) + 0.5)) for docs in self.postings]
+
+    def _prefix_range(self, items, prefix):
+        start = bisect.bisect_left(items, prefix)
+        end = bisect.bisect_left(items, prefix + "\uffff", start)
+        return start, end
+
+    def by_prefix(self, prefix, limit=10):
+        """Codes starting with `prefix`, in code order"""
+        start, end = self._prefix_range(self.codes, prefix)
+        return [self.entries[code] for code in self.codes[start:min(end, start + limit)]]
+
+    def _word_scores(self, word):
+        """doc_id -> best score of any vocabulary word matching `word` (exactly, or as a prefix)"""
+        scores = {}
+        start, end = self._prefix_range(self.vocabulary, word)
+        for index in range(start, end):
+            factor = self.idf[index] * (1.0 if self.vocabulary[index] == word else PREFIX_MATCH_WEIGHT)
+            for doc_id, weight in self.postings[index].items():
+                score = weight * factor
+                if score > scores.get(doc_id, 0.0):
+                    scores[doc_id] = score
+        return scores
+
+    def search(self, text, limit=10):
+        """
+        Rank codes for a few typed words; every word matches as a prefix
+
+        Codes matching all words (or their synonyms) come first, then codes
+        matching fewer. Numbers restrict the results to codes with that prefix.
+
+        Returns:
+            list: Entry dicts, best first
+        """
+        words = [word for word in TOKEN_RE.findall(text.lower()) if word not in STOPWORDS]
+        code_prefixes = [word for word in words if word.isdigit()]
+        matched = defaultdict(int)
+        totals = defaultdict(float)
+        for word in words:
+            if word.isdigit():
+                continue
+            scores = self._word_scores(word)
+            for synonym in SYNONYMS.get(word, ()):
+                for doc_id, score in self._word_scores(synonym).items():
+                    if score > scores.get(doc_id, 0.0):
+                        scores[doc_id] = score
+            for doc_id, score in scores.items():
+                matched[doc_id] += 1
+                totals[doc_id] += score
+
+        if code_prefixes:
+            allowed = set()
+            for prefix in code_prefixes:
+                start, end = self._prefix_range(self.codes, prefix)
+                allowed.update(range(start, end))
+            if not matched:
+                return [self.entries[self.codes[doc_id]] for doc_id in sorted(allowed)[:limit]]
+            matched = {doc_id: hits for doc_id, hits in matched.items() if doc_id in allowed}
+
+        ranked = sorted(matched, key=lambda doc_id: (-matched[doc_id], -totals[doc_id], self.codes[doc_id]))
+        return [self.entries[self.codes[doc_id]] for doc_id in ranked[:limit]]
+
+    def complete(self, query, limit=10):
+        """
+        Autocomplete: a code prefix, a full code with modifiers, or description words
+
+        Returns:
+            tuple: (kind, entry dicts) where kind is 'code', 'prefix' or 'text'
+        """
+        query = query.strip()
+        parsed = parse_code(query)
+        if parsed is not None:
+            return "code", [self.entries[parsed.code]] if parsed.code in self.entries else []
+        if query.isdigit():
+            return "prefix", self.by_prefix(query, limit)
+        return "text", self.search(query, limit)
+
+    def detail(self, code):
+        """Entry, allowed modifiers and bundling edits of one catalog code; None when unknown"""
+        return self.details.get(code)
+
+    def check_modifiers(self, code, modifiers):
+        """Problems with a set of modifiers on one catalog code, as messages"""
+        issues = []
+        rules = self.rules.get(code, {})
+        for modifier in modifiers:
+            if modifier not in KNOWN_MODIFIERS and modifier not in MODIFIER_DESCRIPTIONS:
+                issues.append(f"Unknown modifier -{modifier}")
+            elif modifier in rules and not rules[modifier]["allowed"]:
+                issues.append(f"-{modifier} not allowed: {rules[modifier]['note']}")
+        if len(set(modifiers)) != len(modifiers):
+            issues.append("Modifier repeated")
+        if "50" in modifiers and ("RT" in modifiers or "LT" in modifiers):
+            issues.append("-50 together with -RT/-LT")
+        if "RT" in modifiers and "LT" in modifiers:
+            issues.append("-RT together with -LT; report -50 instead")
+        return issues
+
+    def verify(self, codes, scenario_text=""):
+        """
+        Check proposed codes without a model call: format, catalog presence,
+        modifiers and the rule engine's bundling and sequencing findings
+
+        Args:
+            codes (list): Code strings such as ['51729', '51785-51']
+
+        Returns:
+            dict: {'valid', 'codes': [per-code checks], 'findings', 'suggested'}
+        """
+        checked = []
+        for text in codes:
+            parsed = parse_code(text)
+            if parsed is None:
+                checked.append({"code": text, "valid": False, "issues": ["Not a CPT code"]})
+                continue
+            entry = self.entries.get(parsed.code)
+            issues = [] if entry else ["Code is not in the local CPT catalog"]
+            if entry:
+                issues += self.check_modifiers(parsed.code, parsed.modifiers)
+            checked.append({
+                "code": format_code(parsed),
+                "valid": not issues,
+                "description": entry["description"] if entry else None,
+                "issues": issues,
+            })
+        result = get_rule_engine(self.catalog).apply(codes, scenario_text)
+        return {
+            "valid": all(item["valid"] for item in checked) and not result.findings,
+            "codes": checked,
+            "findings": [finding.as_dict() for finding in result.findings],
+            "suggested": result.code_strings,
+        }
+
+
+def timed_lookup(kind, function, *args, **kwargs):
+    """Run one lookup into the latency histogram; returns (result, elapsed milliseconds)"""
+    started = time.perf_counter()
+    result = function(*args, **kwargs)
+    elapsed = time.perf_counter() - started
+    LOOKUP_SECONDS.observe(elapsed, kind=kind)
+    return result, round(elapsed * 1000, 3)
+
+
+# One index per catalog version and edit table, least recently used dropped first
+CODE_INDEX_CACHE_SIZE = 8
+_indexes = OrderedDict()
+_index_lock = threading.Lock()
+
+
+def get_code_index(catalog):
+    """Return the lookup index for this catalog version, rebuilt when the edit table changes"""
+    edits = get_rule_engine(catalog).edits
+    with _index_lock:
+        cached = _indexes.get(catalog.version)
+        if cached is None or cached[0] is not edits:
+            cached = _indexes[catalog.version] = (edits, CodeIndex(catalog, edits))
+            while len(_indexes) > CODE_INDEX_CACHE_SIZE:
+                _indexes.popitem(last=False)
+        else:
+            _indexes.move_to_end(catalog.version)
+        return cached[1]
@@ -0,0 +1,80 @@
+import json
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand
+
+from cpt_analyzer import clients
+from cpt_analyzer.admission import admission_settings, reset_admission
+from cpt_analyzer.llm_backends import StubBackend
+from cpt_analyzer.loadgen import ClientProfile, run_load
+from cpt_analyzer.pipeline import PIPELINE_MODES
+from cpt_analyzer.retrieval import load_labeled_scenarios
+
+
+class Command(BaseCommand):
+    help = ("Load-test /analyze/ in-process with the stub LLM: heavy and light clients against the admission "
+            "control (rate limits, quotas, concurrency cap), reporting statuses and latencies")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--labeled", default=settings.CPT_LABELED_SCENARIOS, help="JSONL file of labeled scenarios")
+        parser.add_argument("--mode", choices=PIPELINE_MODES, default="full", help="Pipeline mode")
+        parser.add_argument("--duration", type=float, default=5.0, help="Seconds each client keeps sending")
+        parser.add_argument("--heavy-clients", type=int, default=1)
+        parser.add_argument("--heavy-rate", type=float, default=40.0, help="Requests per second per heavy client")
+        parser.add_argument("--light-clients", type=int, default=4)
+        parser.add_argument("--light-rate", type=float, default=1.0, help="Requests per second per light client")
+        parser.add_argument("--stub-latency", type=float, default=0.5, help="Seconds per stubbed model call")
+        parser.add_argument("--rate", type=float, help="Override CPT_ADMISSION['RATE']")
+        parser.add_argument("--burst", type=int, help="Override CPT_ADMISSION['BURST']")
+        parser.add_argument("--max-concurrent", type=int, help="Override CPT_ADMISSION['MAX_CONCURRENT']")
+        parser.add_argument("--max-queue", type=int, help="Override CPT_ADMISSION['MAX_QUEUE']")
+        parser.add_argument("--queue-timeout", type=float, help="Override CPT_ADMISSION['QUEUE_TIMEOUT']")
+        parser.add_argument("--quota-tokens", type=int, help="Override CPT_ADMISSION['QUOTA_TOKENS']")
+        parser.add_argument("--host", default="localhost", help="Host header to send (must be in ALLOWED_HOSTS)")
+        parser.add_argument("--disabled", action="store_true", help="Run without admission control, for comparison")
+        parser.add_argument("--json", action="store_true", help="Print raw JSON instead of a summary")
+
+    def handle(self, *args, **options):
+        scenarios = [record["scenario"] for record in load_labeled_scenarios(options["labeled"])]
+        profiles = [ClientProfile(f"heavy-{n}", options["heavy_rate"], max(1, round(options["heavy_rate"] * options["duration"])))
+                    for n in range(options["heavy_clients"])]
+        profiles += [ClientProfile(f"light-{n}", options["light_rate"], max(1, round(options["light_rate"] * options["duration"])))
+                     for n in range(options["light_clients"])]
+
+        # The simulated clients share one address and are told apart by X-Client-ID
+        overrides = {"ENABLED": not options["disabled"], "TRUST_CLIENT_HEADER": True}
+        for name in ("rate", "burst", "max_concurrent", "max_queue", "queue_timeout", "quota_tokens"):
+            if options[name] is not None:
+                overrides[name.upper()] = options[name]
+        saved = {name: getattr(settings, name) for name in ("CPT_ADMISSION", "CPT_AUDIT_ENABLED")}
+        previous_backend = clients.get_backend()
+        # Stored analyses would only fill the audit log with load-test results
+        config = settings.CPT_ADMISSION = {**admission_settings(), **overrides}
+        settings.CPT_AUDIT_ENABLED = False
+        reset_admission()
+        clients.set_backend(StubBackend(latency=options["stub_latency"]))
+        try:
+            report = async_to_sync(run_load)(get_asgi_application(), profiles, scenarios, mode=options["mode"],
+                                             host=options["host"])
+        finally:
+            clients.set_backend(previous_backend)
+            for name, value in saved.items():
+                setattr(settings, name, value)
+            reset_admission()
+        report["admission"] = config if not options["disabled"] else None
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        state = "disabled" if options["disabled"] else "enabled"
+        self.stdout.write(f"{report['requests']} requests in {report['wall_time_s']}s, admission {state}, "
+                          f"stub latency {options['stub_latency']}s per model call")
+        self.stdout.write("statuses: " + ", ".join(f"{status} x{count}" for status, count in report["statuses"].items()))
+        self.stdout.write(f"admitted p50 {report['admitted_p50_s']}s, p95 {report['admitted_p95_s']}s; "
+                          f"rejections answered in {report['rejected_p95_s'] * 1000:.1f} ms (p95), "
+                          f"{report['rejections_without_retry_after']} without Retry-After")
+        self.stdout.write(f"{'client':<10}{'sent':>6}{'ok':>6}{'rejected':>10}")
+        for name, counts in sorted(report["clients"].items()):
+            self.stdout.write(f"{name:<10}{counts['sent']:>6}{counts['ok']:>6}{counts['rejected']:>10}")
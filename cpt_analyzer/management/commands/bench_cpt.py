@@ -0,0 +1,83 @@
+import json
+from datetime import datetime, timezone
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from cpt_analyzer import clients
+from cpt_analyzer.benchmarks import compare_reports, run_benchmark
+from cpt_analyzer.llm_backends import BACKENDS, make_backend
+from cpt_analyzer.pipeline import PIPELINE_MODES
+from cpt_analyzer.retrieval import load_labeled_scenarios
+
+
+class Command(BaseCommand):
+    help = ("Benchmark latency percentiles, throughput, tokens and accuracy of the pipeline on the labeled "
+            "scenarios, using the live API, a recording or a deterministic stub")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--labeled", default=settings.CPT_LABELED_SCENARIOS, help="JSONL file of labeled scenarios")
+        parser.add_argument("--limit", type=int, help="Only use the first N scenarios")
+        parser.add_argument("--mode", choices=PIPELINE_MODES, default=settings.CPT_PIPELINE_MODE, help="Pipeline mode")
+        parser.add_argument("--concurrency", type=int, nargs="+", default=[1],
+                            help="Concurrent requests; one run per value")
+        parser.add_argument("--backend", choices=BACKENDS, default="stub", help="LLM backend (default: stub)")
+        parser.add_argument("--recording", default=settings.CPT_BENCH_RECORDING,
+                            help="JSONL recording written by --backend record and read by --backend replay")
+        parser.add_argument("--stub-latency", type=float, default=0.05, help="Seconds per stubbed model call")
+        parser.add_argument("--stub-jitter", type=float, default=0.0, help="Extra random seconds per stubbed call")
+        parser.add_argument("--output", help="Write the report as JSON to this file")
+        parser.add_argument("--compare", help="Earlier JSON report to compare against")
+
+    def handle(self, *args, **options):
+        labeled = load_labeled_scenarios(options["labeled"])[: options["limit"]]
+        try:
+            backend = make_backend(options["backend"], options["recording"], options["stub_latency"],
+                                   options["stub_jitter"])
+        except OSError as e:
+            raise CommandError(f"Cannot open recording: {e}")
+
+        previous = clients.get_backend()
+        clients.set_backend(backend)
+        try:
+            runs = [async_to_sync(run_benchmark)(labeled, options["mode"], concurrency)
+                    for concurrency in options["concurrency"]]
+        finally:
+            clients.set_backend(previous)
+
+        report = {
+            "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "backend": backend.name,
+            "labeled": str(options["labeled"]),
+            "runs": runs,
+        }
+
+        self.stdout.write(f"{len(labeled)} scenarios, backend={backend.name}, mode={options['mode']}")
+        self.stdout.write(f"{'conc':>5}{'p50':>8}{'p95':>8}{'p99':>8}{'req/s':>8}{'tokens/scn':>12}"
+                          f"{'exact':>7}{'partial':>9}{'errors':>8}")
+        for run in runs:
+            self.stdout.write(
+                f"{run['concurrency']:>5}{run['p50_latency_s']:>7.2f}s{run['p95_latency_s']:>7.2f}s"
+                f"{run['p99_latency_s']:>7.2f}s{run['throughput_per_s']:>8.2f}{run['tokens_per_scenario']:>12}"
+                f"{run['exact_match']:>7.0%}{run['partial_match']:>9.0%}{run['errors']:>8}"
+            )
+        for run in runs:
+            if run["agreement_rate"] is not None:
+                self.stdout.write(f"concurrency {run['concurrency']}: second opinion agreed on {run['agreement_rate']:.0%}, "
+                                  f"saving an estimated {run['saved_ms_per_scenario']:.0f} ms per scenario")
+
+        if options["compare"]:
+            with open(options["compare"], encoding="utf-8") as handle:
+                baseline = json.load(handle)
+            for comparison in compare_reports(runs, baseline["runs"]):
+                changes = ", ".join(
+                    f"{key} {before} -> {after}" + (f" ({ratio:+.0%})" if ratio is not None else "")
+                    for key, (before, after, ratio) in comparison["changes"].items()
+                )
+                self.stdout.write(f"vs baseline ({comparison['mode']}, concurrency {comparison['concurrency']}): {changes}")
+
+        if options["output"]:
+            with open(options["output"], "w", encoding="utf-8") as handle:
+                json.dump(report, handle, indent=2)
+            self.stdout.write(f"Report written to {options['output']}")
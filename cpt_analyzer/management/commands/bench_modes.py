@@ -0,0 +1,53 @@
+import json
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from cpt_analyzer.benchmarks import run_mode_benchmark
+from cpt_analyzer.pipeline import PIPELINE_MODES
+from cpt_analyzer.retrieval import load_labeled_scenarios
+
+
+class Command(BaseCommand):
+    help = "Compare latency, model calls, tokens and accuracy of the pipeline modes on the labeled scenarios"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--labeled", default=settings.CPT_LABELED_SCENARIOS, help="JSONL file of labeled scenarios")
+        parser.add_argument("--modes", nargs="+", choices=PIPELINE_MODES, default=list(PIPELINE_MODES))
+        parser.add_argument("--limit", type=int, help="Only use the first N scenarios")
+        parser.add_argument("--json", action="store_true", help="Print raw JSON instead of a table")
+
+    def handle(self, *args, **options):
+        labeled = load_labeled_scenarios(options["labeled"])[: options["limit"]]
+        reports = [async_to_sync(run_mode_benchmark)(labeled, mode) for mode in options["modes"]]
+
+        if options["json"]:
+            self.stdout.write(json.dumps(reports, indent=2))
+            return
+
+        baseline = next((r for r in reports if r["mode"] == "full"), reports[0])
+        self.stdout.write(f"{'mode':<14}{'latency':>9}{'calls':>7}{'skipped':>9}{'tokens/scn':>12}{'exact':>7}{'partial':>9}{'errors':>8}")
+        for report in reports:
+            self.stdout.write(
+                f"{report['mode']:<14}{report['mean_latency_s']:>8.2f}s{report['model_calls']:>7}"
+                f"{report['validator_skipped']:>9}{report['tokens_per_scenario']:>12}"
+                f"{report['exact_match']:>7.0%}{report['partial_match']:>9.0%}{report['errors']:>8}"
+            )
+        for report in reports:
+            if report["escalation_rate"] is not None:
+                reasons = ", ".join(f"{reason} {count}" for reason, count in sorted(report["escalation_reasons"].items()))
+                self.stdout.write(f"{report['mode']}: {report['escalation_rate']:.0%} escalated to the full analyzer model"
+                                  + (f" ({reasons})" if reasons else ""))
+        for report in reports:
+            if report["agreement_rate"] is not None:
+                self.stdout.write(f"{report['mode']}: second opinion agreed on {report['agreement_rate']:.0%} of scenarios, "
+                                  f"saving an estimated {report['saved_ms_per_scenario']:.0f} ms per scenario")
+        for report in reports:
+            if report is baseline or not baseline["mean_latency_s"] or not baseline["tokens"]:
+                continue
+            self.stdout.write(
+                f"{report['mode']} vs {baseline['mode']}: "
+                f"{1 - report['mean_latency_s'] / baseline['mean_latency_s']:.0%} less latency, "
+                f"{1 - report['tokens'] / baseline['tokens']:.0%} fewer tokens"
+            )
@@ -0,0 +1,40 @@
+import json
+import subprocess
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cpt_analyzer.startup import run_probe, summarize
+
+
+class Command(BaseCommand):
+    help = ("Measure startup time, resident memory and imported heavy modules of a fresh worker, "
+            "and the per-worker memory of preloaded forked workers")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--runs", type=int, default=3, help="Fresh interpreters to start (the median is reported)")
+        parser.add_argument("--workers", type=int, default=2, help="Preloaded workers to fork in each run")
+        parser.add_argument("--no-warm", action="store_true", help="Skip the warm-up step")
+        parser.add_argument("--json", action="store_true", help="Print raw JSON instead of a table")
+
+    def handle(self, *args, **options):
+        try:
+            reports = [run_probe(warm=not options["no_warm"], workers=options["workers"]) for _ in range(options["runs"])]
+        except subprocess.CalledProcessError as e:
+            raise CommandError(f"Startup probe failed:\n{e.stderr}")
+        summary = summarize(reports)
+
+        if options["json"]:
+            self.stdout.write(json.dumps(summary, indent=2))
+            return
+
+        self.stdout.write(f"{'step':<16}{'seconds':>9}{'rss MB':>9}")
+        for step in summary["steps"]:
+            self.stdout.write(f"{step['step']:<16}{step['seconds']:>9.3f}{step['rss_kb'] / 1024:>9.1f}")
+        self.stdout.write(f"Heavy modules imported with the views: {', '.join(summary['heavy_modules_at_import']) or 'none'}")
+        if summary["worker_rss_kb"] is not None:
+            pss = summary["worker_pss_kb"]
+            self.stdout.write(
+                f"Per forked worker: {summary['worker_rss_kb'] / 1024:.1f} MB RSS"
+                + (f", {pss / 1024:.1f} MB PSS, {summary['worker_shared_kb'] / 1024:.1f} MB shared with the master"
+                   if pss is not None else "")
+            )
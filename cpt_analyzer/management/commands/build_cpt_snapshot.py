@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from cpt_analyzer.catalog import get_registry, read_workbook, write_snapshot
+
+
+class Command(BaseCommand):
+    help = "Precompile a CPT workbook into a snapshot so workers can skip Excel parsing"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--specialty", help="Build the configured shard of this specialty (see CPT_SPECIALTIES)")
+        parser.add_argument("--all", action="store_true", help="Build every configured specialty shard")
+        parser.add_argument("--source", default=str(settings.CPT_DATA_PATH), help="Path to the CPT workbook")
+        parser.add_argument("--output", default=settings.CPT_CATALOG_SNAPSHOT, help="Path of the snapshot to write")
+
+    def handle(self, *args, **options):
+        registry = get_registry()
+        if options["all"]:
+            jobs = [(shard.path, shard.snapshot) for shard in registry]
+        elif options["specialty"]:
+            if options["specialty"] not in registry:
+                raise CommandError(f"Unknown specialty '{options['specialty']}'")
+            shard = registry.shards[options["specialty"]]
+            jobs = [(shard.path, shard.snapshot)]
+        else:
+            jobs = [(options["source"], options["output"])]
+
+        for source, output in jobs:
+            if not output:
+                raise CommandError(f"No snapshot path configured for {source} (set SNAPSHOT or pass --output)")
+            try:
+                catalog = read_workbook(source)
+            except Exception as e:
+                raise CommandError(f"Could not read {source}: {e}")
+
+            write_snapshot(catalog, output)
+            self.stdout.write(self.style.SUCCESS(
+                f"Wrote {len(catalog)} codes (catalog {catalog.version}) to {output}"
+            ))
@@ -0,0 +1,80 @@
+import asyncio
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cpt_analyzer.batch import BatchRunner, completed_ids, detect_format, read_scenarios
+from cpt_analyzer.jobs import enqueue_many
+from cpt_analyzer.models import Job
+from cpt_analyzer.pipeline import PIPELINE_MODES
+
+
+class Command(BaseCommand):
+    help = "Code a CSV, JSONL or XLSX file of scenarios, writing JSONL results incrementally"
+
+    def add_arguments(self, parser):
+        parser.add_argument("input", help="File with a 'scenario' column/field and an optional 'id'")
+        parser.add_argument("--output", help="JSONL results file (default: <input>.results.jsonl)")
+        parser.add_argument("--format", choices=["csv", "jsonl", "xlsx"], help="Input format (default: from extension)")
+        parser.add_argument("--concurrency", type=int, help="Scenarios in flight at once")
+        parser.add_argument("--max-retries", type=int, help="Retries per scenario after an error")
+        parser.add_argument("--mode", choices=PIPELINE_MODES, help="Pipeline mode")
+        parser.add_argument("--no-cache", action="store_true", help="Bypass the result cache")
+        parser.add_argument("--restart", action="store_true", help="Ignore existing results instead of resuming")
+        parser.add_argument("--enqueue", action="store_true",
+                            help="Queue the scenarios as low-priority jobs (see run_jobs) instead of coding them now")
+
+    def handle(self, *args, **options):
+        input_path = options["input"]
+        output_path = options["output"] or f"{os.path.splitext(input_path)[0]}.results.jsonl"
+        fmt = options["format"] or detect_format(input_path)
+        try:
+            items = read_scenarios(input_path, fmt)
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+
+        if options["enqueue"]:
+            queued = enqueue_many(items, mode=options["mode"], use_cache=not options["no_cache"],
+                                  priority=Job.PRIORITY_BATCH)
+            self.stdout.write(self.style.SUCCESS(
+                f"Queued {queued} scenarios behind interactive jobs; results are stored in /analyses/ "
+                f"(source=job) and on each job"
+            ))
+            return
+
+        if options["restart"] and os.path.exists(output_path):
+            os.remove(output_path)
+        done = completed_ids(output_path)
+        todo = [item for item in items if item["id"] not in done]
+        self.stdout.write(f"{len(items)} scenarios in {input_path}; {len(done)} already done, {len(todo)} to code")
+
+        runner = BatchRunner(
+            concurrency=options["concurrency"],
+            max_retries=options["max_retries"],
+            use_cache=not options["no_cache"],
+            mode=options["mode"],
+        )
+        asyncio.run(self._run(runner, todo, output_path))
+
+        summary = runner.stats.summary()
+        self.stdout.write(json.dumps(summary, indent=2))
+        self.stdout.write(self.style.SUCCESS(
+            f"Coded {summary['completed']} scenarios ({summary['failed']} failed) at "
+            f"{summary['scenarios_per_minute']} scenarios/min using {summary['total_tokens']} tokens; "
+            f"results in {output_path}"
+        ))
+
+    async def _run(self, runner, items, output_path):
+        # Append and flush per record so a crash loses at most the scenarios in flight
+        with open(output_path, "a+", encoding="utf-8") as output:
+            if output.tell():
+                output.seek(output.tell() - 1)
+                if output.read(1) != "\n":
+                    # Terminate a line torn by a previous crash before appending
+                    output.write("\n")
+            async for record in runner.run(items):
+                output.write(json.dumps(record) + "\n")
+                output.flush()
+                if record["status"] != "ok":
+                    self.stderr.write(f"{record['id']}: {record['error']}")
@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from cpt_analyzer.catalog import get_catalog
+from cpt_analyzer.retrieval import load_labeled_scenarios, recall_at_k, render_candidates, select_candidates
+
+
+class Command(BaseCommand):
+    help = "Measure candidate retrieval recall@k and prompt size against a labeled scenario set"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--labeled", default=settings.CPT_LABELED_SCENARIOS, help="JSONL file of labeled scenarios")
+        parser.add_argument("-k", type=int, nargs="+", default=[5, 10, 25, 50], help="Retrieval depths to evaluate")
+
+    def handle(self, *args, **options):
+        catalog = get_catalog()
+        if catalog is None:
+            raise CommandError("CPT data could not be loaded")
+        labeled = load_labeled_scenarios(options["labeled"])
+
+        full_chars = len(render_candidates(list(catalog)))
+        self.stdout.write(f"{len(labeled)} scenarios, catalog {catalog.version} ({len(catalog)} codes, {full_chars} chars)")
+        for k in options["k"]:
+            recall = recall_at_k(catalog, labeled, k)
+            chars = [len(render_candidates(select_candidates(catalog, r["scenario"], k))) for r in labeled]
+            avg_chars = sum(chars) / len(chars) if chars else 0
+            self.stdout.write(f"recall@{k:<3} {recall:.3f}   avg context {avg_chars:,.0f} chars ({avg_chars / full_chars:.0%} of full)")
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from cpt_analyzer.guidelines import CHUNK_WORDS, ExtractionError, guideline_settings, ingest, reset_guideline_index
+
+
+class Command(BaseCommand):
+    help = "Extract, chunk and index the coding-guideline PDF for retrieval (skipped when it has not changed)"
+
+    def add_arguments(self, parser):
+        config = guideline_settings()
+        parser.add_argument("--source", default=config["SOURCE"], help="Guideline PDF")
+        parser.add_argument("--text", help="Text export of the PDF (pages separated by form feeds) to index instead")
+        parser.add_argument("--index", default=config["INDEX_PATH"], help="Index directory")
+        parser.add_argument("--chunk-words", type=int, default=CHUNK_WORDS, help="Target words per passage")
+        parser.add_argument("--force", action="store_true", help="Rebuild even if the source is unchanged")
+
+    def handle(self, *args, **options):
+        if not options["index"]:
+            raise CommandError("No index directory (set CPT_GUIDELINES['INDEX_PATH'] or pass --index)")
+        try:
+            report = ingest(options["source"], options["index"], text_export=options["text"],
+                            chunk_words=options["chunk_words"], force=options["force"])
+        except (ExtractionError, OSError) as e:
+            raise CommandError(str(e))
+        reset_guideline_index()
+
+        if report["status"] == "unchanged":
+            self.stdout.write(f"Index {report['version']} is up to date ({report['chunks']} passages); use --force to rebuild")
+            return
+        self.stdout.write(self.style.SUCCESS(
+            f"Indexed {report['pages']} pages ({report['pages_extracted']} extracted, {report['pages_reused']} reused) "
+            f"into {report['chunks']} passages and {report['terms']} terms (index {report['version']}) "
+            f"in {report['seconds']:.2f}s"
+        ))
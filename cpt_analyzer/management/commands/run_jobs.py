@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from cpt_analyzer.jobs import JobWorkerPool, job_settings, process_next, requeue_stale
+
+
+class Command(BaseCommand):
+    help = "Run queued analyses (/jobs/) in this process until interrupted"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, help="Worker threads (default: CPT_JOBS['WORKERS'] or 1)")
+        parser.add_argument("--drain", action="store_true", help="Exit once the queue is empty (one worker)")
+
+    def handle(self, *args, **options):
+        requeued, failed = requeue_stale()
+        if requeued or failed:
+            self.stdout.write(f"Requeued {requeued} stale jobs; {failed} failed after too many attempts")
+
+        if options["drain"]:
+            processed = 0
+            while process_next("drain"):
+                processed += 1
+            self.stdout.write(self.style.SUCCESS(f"Processed {processed} jobs"))
+            return
+
+        workers = options["workers"] or job_settings()["WORKERS"] or 1
+        pool = JobWorkerPool(workers).start()
+        self.stdout.write(f"Running {workers} job workers; press Ctrl+C to stop")
+        try:
+            while True:
+                time.sleep(60)
+                requeue_stale()
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping job workers after their current jobs")
+            pool.stop()
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from cpt_analyzer.catalog import get_registry
+from cpt_analyzer.warmup import warm_up
+
+
+class Command(BaseCommand):
+    help = "Load the CPT catalogs (writing their snapshots if missing), prompts and rule tables, and report the time"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--specialty", action="append", help="Warm up this specialty (repeatable; default: the default one)")
+        parser.add_argument("--all", action="store_true", help="Warm up every configured specialty")
+
+    def handle(self, *args, **options):
+        registry = get_registry()
+        specialties = "all" if options["all"] else options["specialty"]
+        for name in options["specialty"] or ():
+            if name not in registry:
+                raise CommandError(f"Unknown specialty '{name}'")
+
+        report = warm_up(specialties)
+        for name, shard in report["specialties"].items():
+            snapshot = registry.shards[name].snapshot or "no snapshot configured"
+            self.stdout.write(f"{name}: {shard['codes']} codes (catalog {shard['version']}) in {shard['seconds']:.3f}s; {snapshot}")
+        self.stdout.write(self.style.SUCCESS(f"Warmed up in {report['seconds']:.3f}s"))
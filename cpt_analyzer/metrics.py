@@ -0,0 +1,222 @@
+"""
+In-process metrics and per-request stage tracing.
+
+Counters and histograms live in this process only (each worker exposes its
+own) and are rendered in the Prometheus text format by the /metrics view.
+Stages are timed with timed(), which always feeds the stage histogram and,
+when a Trace is active for the current request, also records the span so
+the view can return it in the response and in a Server-Timing header.
+"""
+import bisect
+import contextvars
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TRACE_ID_RE = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """Monotonic counter, optionally split by labels"""
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in values
+        ]
+
+
+class Histogram(Metric):
+    """Cumulative-bucket histogram of observed values, optionally split by labels"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            series["counts"][bisect.bisect_left(self.buckets, value)] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def count(self, **labels):
+        with self._lock:
+            series = self._series.get(self._key(labels))
+            return series["count"] if series else 0
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            series_items = sorted((key, dict(s, counts=list(s["counts"]))) for key, s in self._series.items())
+        for key, series in series_items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series["counts"]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', le)])} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(series['sum'])}")
+            lines.append(f"{self.name}_count{labels} {series['count']}")
+        return lines
+
+
+class CallbackMetric(Metric):
+    """Metric whose samples are read from a function at scrape time ({label values tuple: value})"""
+
+    def __init__(self, name, documentation, labelnames=(), callback=None, kind="gauge"):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+        self.kind = kind
+
+    def render(self):
+        samples = self.callback() or {}
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in sorted(samples.items())
+        ]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.register(Histogram(
+    "cpt_stage_duration_seconds", "Wall time of each pipeline stage", ("stage",)))
+TOKENS = registry.register(Counter(
+    "cpt_tokens_total", "Model tokens used, by agent and kind", ("agent", "kind")))
+PIPELINE_REQUESTS = registry.register(Counter(
+    "cpt_pipeline_requests_total", "Pipeline runs by mode and outcome", ("mode", "outcome")))
+
+
+# The trace of the request being handled, if any
+current_trace = contextvars.ContextVar("cpt_trace", default=None)
+
+
+class Trace:
+    """Stage timings of one request, identified by a trace id"""
+
+    def __init__(self, trace_id=None):
+        self.trace_id = trace_id if trace_id and TRACE_ID_RE.match(trace_id) else uuid.uuid4().hex
+        self.spans = []
+        self.started = time.monotonic()
+
+    def add(self, stage, seconds):
+        self.spans.append((stage, seconds))
+
+    @contextmanager
+    def activate(self):
+        """Make this the current trace; do not hold across a yield of an async generator"""
+        token = current_trace.set(self)
+        try:
+            yield self
+        finally:
+            current_trace.reset(token)
+
+    def stages(self):
+        """{stage: total milliseconds}, summed over repeated stages"""
+        totals = {}
+        for stage, seconds in self.spans:
+            totals[stage] = totals.get(stage, 0.0) + seconds * 1000
+        return {stage: round(ms, 1) for stage, ms in totals.items()}
+
+    def as_dict(self):
+        return {"id": self.trace_id, "stages": self.stages()}
+
+    def server_timing(self):
+        """Value for a Server-Timing response header"""
+        return ", ".join(f"{stage};dur={ms}" for stage, ms in self.stages().items())
+
+
+@contextmanager
+def timed(stage):
+    """Time a block into the stage histogram and the current trace"""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - started
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.add(stage, elapsed)
+
+
+def record_tokens(agent, usage):
+    for kind in ("prompt_tokens", "completion_tokens", "cached_tokens"):
+        if usage.get(kind):
+            TOKENS.inc(usage[kind], agent=agent, kind=kind.split("_")[0])
@@ -0,0 +1,64 @@
+# Generated by Django 5.1.7 on 2026-10-17 07:44
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Analysis',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('source', models.CharField(choices=[('web', 'Web'), ('batch', 'Batch')], default='web', max_length=16)),
+                ('trace_id', models.CharField(blank=True, max_length=64)),
+                ('scenario_hash', models.CharField(max_length=64)),
+                ('scenario_text', models.TextField()),
+                ('final_cpt_code', models.CharField(blank=True, max_length=255)),
+                ('final_description', models.TextField(blank=True)),
+                ('confidence', models.CharField(blank=True, max_length=32)),
+                ('has_multiple_codes', models.BooleanField(default=False)),
+                ('mode', models.CharField(blank=True, max_length=32)),
+                ('path', models.CharField(blank=True, max_length=32)),
+                ('specialties', models.CharField(blank=True, max_length=255)),
+                ('cached', models.BooleanField(default=False)),
+                ('catalog_version', models.CharField(blank=True, max_length=32)),
+                ('prompt_version', models.CharField(blank=True, max_length=32)),
+                ('elapsed_ms', models.FloatField(blank=True, null=True)),
+                ('prompt_tokens', models.PositiveIntegerField(default=0)),
+                ('completion_tokens', models.PositiveIntegerField(default=0)),
+                ('cached_tokens', models.PositiveIntegerField(default=0)),
+                ('analyzer_result', models.JSONField(blank=True, default=dict)),
+                ('validator_result', models.JSONField(blank=True, default=dict)),
+                ('rule_findings', models.JSONField(blank=True, default=list)),
+                ('stage_timings', models.JSONField(blank=True, default=dict)),
+            ],
+            options={
+                'ordering': ['-id'],
+                'indexes': [models.Index(fields=['scenario_hash', 'created_at'], name='analysis_scenario_idx'), models.Index(fields=['created_at'], name='analysis_created_idx'), models.Index(fields=['confidence', 'created_at'], name='analysis_confidence_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='AnalysisCode',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveSmallIntegerField()),
+                ('code', models.CharField(max_length=5)),
+                ('modifiers', models.CharField(blank=True, max_length=32)),
+                ('created_at', models.DateTimeField()),
+                ('analysis', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='codes', to='cpt_analyzer.analysis')),
+            ],
+            options={
+                'ordering': ['analysis_id', 'position'],
+                'indexes': [models.Index(fields=['code', 'created_at'], name='analysis_code_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.1.7 on 2026-10-17 07:49
+
+import django.utils.timezone
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cpt_analyzer', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='analysis',
+            name='source',
+            field=models.CharField(choices=[('web', 'Web'), ('batch', 'Batch'), ('job', 'Job')], default='web', max_length=16),
+        ),
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=16)),
+                ('priority', models.SmallIntegerField(default=50)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('scenario_text', models.TextField()),
+                ('mode', models.CharField(blank=True, max_length=32)),
+                ('use_cache', models.BooleanField(default=True)),
+                ('external_id', models.CharField(blank=True, max_length=255)),
+                ('worker', models.CharField(blank=True, max_length=64)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('result', models.JSONField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+                ('callback_url', models.URLField(blank=True, max_length=1000)),
+                ('callback_status', models.CharField(blank=True, max_length=64)),
+            ],
+            options={
+                'ordering': ['priority', 'created_at'],
+                'indexes': [models.Index(fields=['status', 'priority', 'created_at'], name='job_queue_idx')],
+            },
+        ),
+    ]
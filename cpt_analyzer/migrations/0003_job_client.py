@@ -0,0 +1,18 @@
+# Generated by Django 5.1.7 on 2026-10-17 08:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cpt_analyzer', '0002_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='client',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
@@ -1,3 +1,181 @@
+import uuid
+
 from django.db import models
+from django.utils import timezone
+
+
+class Analysis(models.Model):
+    """One coded scenario: the agents' outputs, the final answer and what it cost"""
+
+    SOURCE_WEB = "web"
+    SOURCE_BATCH = "batch"
+    SOURCE_JOB = "job"
+    SOURCE_CHOICES = [(SOURCE_WEB, "Web"), (SOURCE_BATCH, "Batch"), (SOURCE_JOB, "Job")]
+
+    created_at = models.DateTimeField(default=timezone.now)
+    source = models.CharField(max_length=16, choices=SOURCE_CHOICES, default=SOURCE_WEB)
+    trace_id = models.CharField(max_length=64, blank=True)
+
+    # sha256 of the normalized scenario (cache.normalize_scenario), for "same scenario" lookups
+    scenario_hash = models.CharField(max_length=64)
+    scenario_text = models.TextField()
+
+    final_cpt_code = models.CharField(max_length=255, blank=True)
+    final_description = models.TextField(blank=True)
+    confidence = models.CharField(max_length=32, blank=True)
+    has_multiple_codes = models.BooleanField(default=False)
+
+    mode = models.CharField(max_length=32, blank=True)
+    path = models.CharField(max_length=32, blank=True)
+    specialties = models.CharField(max_length=255, blank=True)
+    cached = models.BooleanField(default=False)
+    catalog_version = models.CharField(max_length=32, blank=True)
+    prompt_version = models.CharField(max_length=32, blank=True)
+
+    elapsed_ms = models.FloatField(null=True, blank=True)
+    prompt_tokens = models.PositiveIntegerField(default=0)
+    completion_tokens = models.PositiveIntegerField(default=0)
+    cached_tokens = models.PositiveIntegerField(default=0)
+
+    analyzer_result = models.JSONField(default=dict, blank=True)
+    validator_result = models.JSONField(default=dict, blank=True)
+    rule_findings = models.JSONField(default=list, blank=True)
+    stage_timings = models.JSONField(default=dict, blank=True)
+
+    class Meta:
+        ordering = ["-id"]
+        indexes = [
+            models.Index(fields=["scenario_hash", "created_at"], name="analysis_scenario_idx"),
+            models.Index(fields=["created_at"], name="analysis_created_idx"),
+            models.Index(fields=["confidence", "created_at"], name="analysis_confidence_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.final_cpt_code or '-'} ({self.created_at:%Y-%m-%d %H:%M})"
+
+    def as_dict(self, detail=False):
+        data = {
+            "id": self.pk,
+            "created_at": self.created_at.isoformat(),
+            "source": self.source,
+            "trace_id": self.trace_id,
+            "scenario_hash": self.scenario_hash,
+            "scenario": self.scenario_text,
+            "final_cpt_code": self.final_cpt_code,
+            "confidence": self.confidence,
+            "mode": self.mode,
+            "path": self.path,
+            "specialties": [name for name in self.specialties.split(",") if name],
+            "cached": self.cached,
+            "elapsed_ms": self.elapsed_ms,
+            "usage": {
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "cached_tokens": self.cached_tokens,
+            },
+        }
+        if detail:
+            data.update({
+                "final_description": self.final_description,
+                "codes": [code.as_dict() for code in self.codes.all()],
+                "catalog_version": self.catalog_version,
+                "prompt_version": self.prompt_version,
+                "analyzer_result": self.analyzer_result,
+                "validator_result": self.validator_result,
+                "rule_findings": self.rule_findings,
+                "stage_timings": self.stage_timings,
+            })
+        return data
+
+
+class AnalysisCode(models.Model):
+    """One final code of an analysis; created_at is copied from it so code + date queries use one index"""
+
+    analysis = models.ForeignKey(Analysis, on_delete=models.CASCADE, related_name="codes")
+    position = models.PositiveSmallIntegerField()
+    code = models.CharField(max_length=5)
+    modifiers = models.CharField(max_length=32, blank=True)
+    created_at = models.DateTimeField()
+
+    class Meta:
+        ordering = ["analysis_id", "position"]
+        indexes = [
+            models.Index(fields=["code", "created_at"], name="analysis_code_idx"),
+        ]
+
+    def __str__(self):
+        return "-".join([self.code] + [m for m in self.modifiers.split(",") if m])
+
+    def as_dict(self):
+        return {"code": self.code, "modifiers": [m for m in self.modifiers.split(",") if m]}
+
+
+class Job(models.Model):
+    """A queued analysis; workers claim queued jobs by priority (lowest first), then age"""
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [(QUEUED, "Queued"), (RUNNING, "Running"), (DONE, "Done"), (FAILED, "Failed")]
+
+    # Interactive submissions jump ahead of batch backfills
+    PRIORITY_INTERACTIVE = 0
+    PRIORITY_NORMAL = 50
+    PRIORITY_BATCH = 100
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED)
+    priority = models.SmallIntegerField(default=PRIORITY_NORMAL)
+    created_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    scenario_text = models.TextField()
+    mode = models.CharField(max_length=32, blank=True)
+    use_cache = models.BooleanField(default=True)
+    external_id = models.CharField(max_length=255, blank=True)
+    # Admission client that submitted the job; its token quota is charged when the job runs
+    client = models.CharField(max_length=255, blank=True)
+
+    worker = models.CharField(max_length=64, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+
+    callback_url = models.URLField(max_length=1000, blank=True)
+    callback_status = models.CharField(max_length=64, blank=True)
+
+    class Meta:
+        ordering = ["priority", "created_at"]
+        indexes = [
+            models.Index(fields=["status", "priority", "created_at"], name="job_queue_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.pk} ({self.status})"
 
-# Create your models here.
+    def as_dict(self):
+        data = {
+            "id": str(self.pk),
+            "status": self.status,
+            "priority": self.priority,
+            "created_at": self.created_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "attempts": self.attempts,
+        }
+        if self.external_id:
+            data["external_id"] = self.external_id
+        if self.status == self.QUEUED:
+            data["queue_position"] = Job.objects.filter(status=self.QUEUED).filter(
+                models.Q(priority__lt=self.priority)
+                | models.Q(priority=self.priority, created_at__lt=self.created_at)
+            ).count() + 1
+        if self.status == self.DONE:
+            data["result"] = self.result
+        if self.status == self.FAILED:
+            data["error"] = self.error
+        if self.callback_url:
+            data["callback_status"] = self.callback_status
+        return data
@@ -0,0 +1,164 @@
+"""
+Parsing of agent responses into typed results.
+
+The agents ask for JSON matching a schema (OpenAI structured outputs). The
+parser accepts that JSON, JSON wrapped in prose or code fences, and the
+legacy "CPT Code(s): / Description: / Explanation: / Confidence:" text
+format, using one compiled pattern in a single pass. It reports which
+fields are missing so the agent can re-prompt for just those.
+"""
+import json
+import re
+
+CODES = "codes"
+DESCRIPTION = "description"
+EXPLANATION = "explanation"
+CONFIDENCE = "confidence"
+
+ANALYZER_FIELDS = (CODES, DESCRIPTION, EXPLANATION)
+VALIDATOR_FIELDS = (CODES, DESCRIPTION, EXPLANATION, CONFIDENCE)
+CONFIDENCE_LEVELS = ("High", "Medium", "Low")
+
+LEGACY_FIELD_RE = re.compile(
+    r"^[ \t>*#-]*(?P<label>CPT[ \t]+codes?(?:[ \t]*\(s\))?|Description|Explanation|Confidence)[ \t*]*:[ \t*]*",
+    re.IGNORECASE | re.MULTILINE,
+)
+CODE_TOKEN_RE = re.compile(r"\b(\d{5})((?:-(?:\d{2}|[A-Z]{2}))*)\b")
+JSON_OBJECT_RE = re.compile(r"\{.*\}", re.DOTALL)
+
+_LEGACY_LABELS = {"description": DESCRIPTION, "explanation": EXPLANATION, "confidence": CONFIDENCE}
+
+CODE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "code": {"type": "string", "description": "5-digit CPT code without modifiers"},
+        "modifiers": {"type": "array", "items": {"type": "string"}, "description": "Modifiers without the dash, e.g. ['51']"},
+    },
+    "required": ["code", "modifiers"],
+    "additionalProperties": False,
+}
+FIELD_SCHEMAS = {
+    CODES: {"type": "array", "items": CODE_SCHEMA},
+    DESCRIPTION: {"type": "string"},
+    EXPLANATION: {"type": "string"},
+    CONFIDENCE: {"type": "string", "enum": list(CONFIDENCE_LEVELS)},
+}
+
+
+def response_format(fields, name):
+    """Build an OpenAI json_schema response_format requiring exactly these fields"""
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": name,
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {field: FIELD_SCHEMAS[field] for field in fields},
+                "required": list(fields),
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
+def find_code_tokens(text):
+    """All CPT code tokens in free text as {'code', 'modifiers'} dicts, in order"""
+    return [
+        {"code": code, "modifiers": [m for m in modifiers.split("-") if m]}
+        for code, modifiers in CODE_TOKEN_RE.findall(text or "")
+    ]
+
+
+def format_codes(codes):
+    """[{'code': '51729', 'modifiers': []}, {'code': '51785', 'modifiers': ['51']}] -> '51729, 51785-51'"""
+    return ", ".join("-".join([c["code"]] + list(c["modifiers"])) for c in codes)
+
+
+def _normalize_codes(value):
+    """Accept schema objects, 'NNNNN-MM' strings or a comma string and return code dicts"""
+    if isinstance(value, str):
+        return find_code_tokens(value)
+    codes = []
+    for item in value or []:
+        if isinstance(item, str):
+            codes.extend(find_code_tokens(item))
+        elif isinstance(item, dict) and item.get("code"):
+            parsed = find_code_tokens(str(item["code"]))
+            if not parsed:
+                continue
+            modifiers = [str(m).strip().lstrip("-").upper() for m in item.get("modifiers") or [] if str(m).strip()]
+            modifiers = parsed[0]["modifiers"] + [m for m in modifiers if m not in parsed[0]["modifiers"]]
+            codes.append({"code": parsed[0]["code"], "modifiers": modifiers})
+    return codes
+
+
+def _normalize_confidence(value):
+    text = str(value or "").strip()
+    for level in CONFIDENCE_LEVELS:
+        if text.lower().startswith(level.lower()):
+            return level
+    return ""
+
+
+def empty_response():
+    return {CODES: [], DESCRIPTION: "", EXPLANATION: "", CONFIDENCE: ""}
+
+
+def parse_json(text):
+    """Parse a JSON response (optionally surrounded by prose or code fences); None if there is none"""
+    match = JSON_OBJECT_RE.search(text or "")
+    if match is None:
+        return None
+    try:
+        data = json.loads(match.group(0))
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+
+    parsed = empty_response()
+    parsed[CODES] = _normalize_codes(data.get(CODES, data.get("cpt_codes", data.get("cpt_code"))))
+    parsed[DESCRIPTION] = str(data.get(DESCRIPTION) or "").strip()
+    parsed[EXPLANATION] = str(data.get(EXPLANATION) or "").strip()
+    parsed[CONFIDENCE] = _normalize_confidence(data.get(CONFIDENCE))
+    return parsed
+
+
+def parse_legacy(text):
+    """Parse the labelled text format in one pass; each field runs until the next label"""
+    parsed = empty_response()
+    matches = list(LEGACY_FIELD_RE.finditer(text or ""))
+    for index, match in enumerate(matches):
+        end = matches[index + 1].start() if index + 1 < len(matches) else len(text)
+        value = text[match.end():end].strip()
+        label = match.group("label").lower()
+        if label.startswith("cpt"):
+            parsed[CODES] = find_code_tokens(value)
+        elif label == "confidence":
+            parsed[CONFIDENCE] = _normalize_confidence(value)
+        else:
+            parsed[_LEGACY_LABELS[label]] = value
+    return parsed
+
+
+def parse_response(text):
+    """Parse a model response in either JSON or the legacy text format"""
+    parsed = parse_json(text)
+    if parsed is None or not any(parsed.values()):
+        parsed = parse_legacy(text)
+    return parsed
+
+
+def missing_fields(parsed, fields):
+    """Fields that are empty in a parsed response"""
+    return [field for field in fields if not parsed.get(field)]
+
+
+def merge_responses(parsed, repair):
+    """Fill the empty fields of `parsed` from a repair response"""
+    merged = dict(parsed)
+    for field, value in repair.items():
+        if value and not merged.get(field):
+            merged[field] = value
+    return merged
@@ -0,0 +1,446 @@
+"""
+Analyzer -> validator orchestration shared by the web views and batch paths.
+
+The pipeline is written once as an async generator of (event, payload)
+pairs so the view can stream the analyzer result to the browser while the
+validator is still running. Synchronous callers use run_pipeline().
+
+Four modes are supported:
+  full           always run the validator after the analyzer
+  adaptive       skip the validator when local catalog checks accept the analyzer result
+  analyzer_only  never run the validator; confidence comes from the local checks
+  speculative    run an independent second opinion alongside the analyzer; the validator
+                 only runs when the two disagree (see cpt_analyzer.speculative)
+"""
+import hashlib
+import time
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+
+from .agents import CPTValidatorAgent, analyzer_stages, stage_options
+from .cache import get_result_cache, make_cache_key
+from .checks import check_analyzer_result, local_validation, reconciled_validation
+from .coalesce import COALESCED, get_coalescer
+from .guidelines import citations, get_guideline_index, passages_for
+from .metrics import PIPELINE_REQUESTS, Trace, timed
+from .parsing import find_code_tokens
+from .preprocess import (PreparedScenario, apply_budget, budget_settings, count_tokens, estimate_request,
+                         prepare_scenario)
+from .prompts import prompt_version
+from .routing import catalog_for_scenario
+from .rules import get_rule_engine
+from .semantic import get_semantic_index, lookup as semantic_lookup, stored_payload
+from .speculative import Speculation
+from .tiering import aanalyze_tiered
+
+EVENT_ANALYZER = "analyzer"
+EVENT_RESULT = "result"
+EVENT_ERROR = "error"
+EVENT_PREPROCESSED = "preprocessed"
+
+# Error code for scenarios rejected by the token budget (the views answer 413)
+ERROR_TOKEN_BUDGET = "token_budget_exceeded"
+
+MODE_FULL = "full"
+MODE_ADAPTIVE = "adaptive"
+MODE_ANALYZER_ONLY = "analyzer_only"
+MODE_SPECULATIVE = "speculative"
+PIPELINE_MODES = (MODE_FULL, MODE_ADAPTIVE, MODE_ANALYZER_ONLY, MODE_SPECULATIVE)
+
+PATH_VALIDATED = "analyzer+validator"
+PATH_LOCAL = "analyzer+local_checks"
+PATH_RECONCILED = "analyzer+second_opinion"
+PATH_SEMANTIC = "semantic_match"
+
+
+def split_codes(cpt_code):
+    """Split a comma separated code string such as '51729, 51785-51' into a list"""
+    return [code.strip() for code in cpt_code.split(',') if code.strip()]
+
+
+def typed_codes(agent_result):
+    """An agent result's codes as [{'code', 'modifiers'}] dicts, parsing cpt_code for older results"""
+    return agent_result.get('codes') or find_code_tokens(agent_result.get('cpt_code', ''))
+
+
+def partial_result(analyzer_result):
+    """Shape an analyzer-only result like the final response so the UI can render it early"""
+    cpt_codes = split_codes(analyzer_result['cpt_code'])
+    return {
+        'stage': EVENT_ANALYZER,
+        'analyzer_result': analyzer_result,
+        'final_cpt_code': analyzer_result['cpt_code'],
+        'final_description': analyzer_result['description'],
+        'final_explanation': analyzer_result['explanation'],
+        'confidence': 'Pending validation',
+        'has_multiple_codes': len(cpt_codes) > 1,
+        'cpt_codes': cpt_codes,
+        'final_codes': typed_codes(analyzer_result),
+    }
+
+
+def combine_results(analyzer_result, validator_result):
+    """Combine both agents' results into the /analyze/ response"""
+    cpt_codes = split_codes(validator_result['cpt_code'])
+    return {
+        'analyzer_result': analyzer_result,
+        'validator_result': validator_result,
+        'final_cpt_code': validator_result['cpt_code'],
+        'final_description': validator_result['description'],
+        'final_explanation': validator_result['explanation'],
+        'confidence': validator_result['confidence'],
+        'has_multiple_codes': len(cpt_codes) > 1,
+        'cpt_codes': cpt_codes,
+        'final_codes': typed_codes(validator_result),
+    }
+
+
+def apply_rules(result, scenario_text, catalog):
+    """
+    Run the deterministic rule engine over the final codes, correcting them in place
+
+    The validator's own answer is kept untouched in validator_result; the
+    final_* fields and cpt_codes reflect the corrected list.
+    """
+    rule_result = get_rule_engine(catalog).apply(result['cpt_codes'], scenario_text)
+    result['rule_findings'] = [finding.as_dict() for finding in rule_result.findings]
+    if rule_result.code_strings and rule_result.code_strings != result['cpt_codes']:
+        result['cpt_codes'] = rule_result.code_strings
+        result['final_cpt_code'] = ', '.join(rule_result.code_strings)
+        result['final_codes'] = ([{'code': c.code, 'modifiers': list(c.modifiers)} for c in rule_result.codes]
+                                 + [{'code': token, 'modifiers': []} for token in rule_result.unparsed])
+        result['has_multiple_codes'] = len(rule_result.code_strings) > 1
+    return result
+
+
+def result_usage(result):
+    """Total token usage of the agents (an escalated fast tier and a second opinion included) for a combined result
+
+    Zero for cache hits, reused answers and results shared from another request's analysis
+    (coalesced), whose tokens were already counted for that request.
+    """
+    totals = {'prompt_tokens': 0, 'completion_tokens': 0, 'cached_tokens': 0}
+    if result.get('cached') or result.get('semantic_match') or result.get('coalesced'):
+        return totals
+    analyzer_result = result.get('analyzer_result') or {}
+    usages = [analyzer_result.get('usage'), (analyzer_result.get('escalated_from') or {}).get('usage'),
+              (result.get('validator_result') or {}).get('usage'), (result.get('second_opinion_result') or {}).get('usage')]
+    for usage in usages:
+        for name in totals:
+            totals[name] += (usage or {}).get(name, 0)
+    return totals
+
+
+def resolve_mode(mode=None):
+    """Validate a requested pipeline mode, falling back to settings.CPT_PIPELINE_MODE"""
+    mode = mode or settings.CPT_PIPELINE_MODE
+    if mode not in PIPELINE_MODES:
+        raise ValueError(f"Unknown pipeline mode '{mode}' (expected one of {', '.join(PIPELINE_MODES)})")
+    return mode
+
+
+def result_cache_key(scenario_text, mode=MODE_FULL, catalog=None):
+    """Cache key for a scenario under its routed catalog, models and prompts (None if no catalog)"""
+    if catalog is None:
+        catalog = catalog_for_scenario(scenario_text)[1]
+    if catalog is None:
+        return None
+    stages = (*analyzer_stages(), 'validator') + (('second_opinion',) if mode == MODE_SPECULATIVE else ())
+    models = [stage_options(stage)['model'] for stage in stages]
+    version = prompt_version()
+    if catalog.prompt_examples:
+        # The shard's worked examples may be part of the prompt prefix
+        version = f"{version}+examples-{hashlib.sha1(catalog.prompt_examples.encode('utf-8')).hexdigest()[:8]}"
+    guidelines = get_guideline_index()
+    if guidelines is not None:
+        # The guideline passages are part of the prompt
+        version = f"{version}+guidelines-{guidelines.version}"
+    return make_cache_key(scenario_text, catalog.version, models, version, mode=mode)
+
+
+async def astream_pipeline(scenario_text, use_cache=True, mode=None, trace=None):
+    """
+    Run both agents, yielding progress as soon as each stage finishes
+
+    The scenario is first cleaned and fitted into the token budget (see
+    cpt_analyzer.preprocess); the 'preprocessed' event reports what was
+    removed and the estimated tokens and cost before any model call. A
+    scenario that is already being analyzed under the same key is not
+    analyzed twice: the request waits for the running analysis and yields
+    its result with `coalesced: true` (see cpt_analyzer.coalesce).
+
+    Args:
+        scenario_text (str): The medical scenario to analyze
+        use_cache (bool): Set False to bypass the result cache for this request
+        mode (str): One of PIPELINE_MODES; defaults to settings.CPT_PIPELINE_MODE
+        trace (Trace): Collects stage timings for this request; a new one is created if omitted
+
+    Yields:
+        tuple: (event, payload) where event is 'preprocessed', 'analyzer', 'result' or 'error'
+    """
+    mode = resolve_mode(mode)
+    trace = trace or Trace()
+    started = time.monotonic()
+    # The trace is only activated between yields: a generator must not hold a context variable across them
+    with trace.activate():
+        # Loading a shard, the tokenizer or the guideline index reads from disk: keep it off the event loop
+        specialties, catalog, prepared = await sync_to_async(prepare_request)(scenario_text, mode)
+    if prepared is None:
+        async for event, payload in _astream(scenario_text, use_cache, mode, trace, started, specialties, catalog):
+            yield event, payload
+        return
+
+    preprocessing = prepared.as_dict()
+    if prepared.error:
+        PIPELINE_REQUESTS.inc(mode=mode, outcome="rejected")
+        yield EVENT_ERROR, {'error': prepared.error, 'code': ERROR_TOKEN_BUDGET,
+                            'preprocessing': preprocessing, 'trace': trace.as_dict()}
+        return
+    yield EVENT_PREPROCESSED, preprocessing
+    async for event, payload in _astream(prepared.text, use_cache, mode, trace, started, specialties, catalog):
+        if event in (EVENT_RESULT, EVENT_ERROR):
+            payload = dict(payload, preprocessing=preprocessing)
+        yield event, payload
+
+
+def prepare_request(scenario_text, mode):
+    """
+    Clean the scenario, route it and apply the token budget
+
+    Returns:
+        tuple: (specialties, catalog, PreparedScenario or None when budgeting is disabled)
+    """
+    if not budget_settings()['ENABLED']:
+        return (*catalog_for_scenario(scenario_text), None)
+    with timed("preprocess"):
+        prepared = prepare_scenario(scenario_text)
+    # Route on the cleaned text: the catalog is part of the cache key, the prompts and the budget
+    specialties, catalog = catalog_for_scenario(prepared.text)
+    if catalog is not None:
+        with timed("budget"):
+            apply_budget(prepared, catalog, mode)
+    return specialties, catalog, prepared
+
+
+def preview_pipeline(scenario_text, mode=None):
+    """What astream_pipeline would send and spend for a scenario, without calling the models"""
+    mode = resolve_mode(mode)
+    specialties, catalog, prepared = prepare_request(scenario_text, mode)
+    if prepared is None:
+        prepared = PreparedScenario(scenario_text, count_tokens(scenario_text))
+        if catalog is not None:
+            prepared.estimate = estimate_request(prepared.tokens, catalog, mode)
+    return dict(prepared.as_dict(), mode=mode, specialties=specialties, scenario=prepared.text)
+
+
+async def _astream(scenario_text, use_cache, mode, trace, started, specialties, catalog):
+    """Cache lookup, coalescing and analysis of a prepared scenario"""
+    cache = get_result_cache() if use_cache else None
+    coalescer = get_coalescer()
+    with trace.activate():
+        # The key also identifies in-flight analyses, so it is needed even when the cache is bypassed
+        needs_key = cache is not None or coalescer is not None
+        cache_key = await sync_to_async(result_cache_key)(scenario_text, mode, catalog) if needs_key else None
+        cached = None
+        if cache is not None and cache_key is not None:
+            with timed("cache.lookup"):
+                # Backends may touch the database or disk, so keep them off the event loop
+                cached = await sync_to_async(cache.get)(cache_key)
+    if cached is not None:
+        PIPELINE_REQUESTS.inc(mode=mode, outcome="cached")
+        yield EVENT_RESULT, dict(cached, cached=True, trace=trace.as_dict())
+        return
+
+    flight = remote = None
+    if coalescer is not None and cache_key is not None:
+        flight, leader = coalescer.begin(cache_key)
+        if not leader:
+            with trace.activate(), timed("coalesce.wait"):
+                outcome = await coalescer.wait(flight)
+            if outcome is not None:
+                event, payload = outcome
+                PIPELINE_REQUESTS.inc(mode=mode, outcome="coalesced")
+                yield event, dict(payload, coalesced=True, trace=trace.as_dict())
+                return
+            # The running analysis gave up or is taking too long: analyze independently
+            flight = None
+        elif cache is not None:
+            # Another worker may be analyzing the same scenario; wait for it and reuse its cached result
+            with trace.activate(), timed("coalesce.lock"):
+                remote, waited = await coalescer.acquire_remote(cache_key)
+                cached = await sync_to_async(cache.get)(cache_key) if waited else None
+            if cached is not None:
+                COALESCED.inc(scope="remote")
+                PIPELINE_REQUESTS.inc(mode=mode, outcome="coalesced")
+                result = dict(cached, cached=True, coalesced=True, trace=trace.as_dict())
+                await _settle(coalescer, flight, remote, (EVENT_RESULT, result))
+                yield EVENT_RESULT, result
+                return
+
+    try:
+        analysis = _analyze(scenario_text, mode, trace, started, specialties, catalog, cache, cache_key, use_cache)
+        async for event, payload in analysis:
+            if event in (EVENT_RESULT, EVENT_ERROR):
+                # Release waiting requests now: callers stop iterating once they have the result
+                await _settle(coalescer, flight, remote, (event, payload))
+                flight = remote = None
+            yield event, payload
+    finally:
+        await _settle(coalescer, flight, remote, None)
+
+
+async def _settle(coalescer, flight, remote, outcome):
+    """Hand the outcome to requests waiting on this flight and release the cross-worker lock"""
+    if flight is not None:
+        coalescer.finish(flight, outcome)
+    if remote is not None:
+        await coalescer.arelease_remote(remote)
+
+
+async def _analyze(scenario_text, mode, trace, started, specialties, catalog, cache, cache_key, use_cache):
+    """The semantic lookup -> analyzer -> checks/validator -> rules stages of astream_pipeline"""
+    # The first call loads the index from disk
+    index = await sync_to_async(get_semantic_index)() if catalog is not None else None
+    examples = ()
+    if index is not None:
+        with trace.activate(), timed("semantic.lookup"):
+            # A forced fresh analysis may still learn from similar scenarios, but never reuses one
+            match = await sync_to_async(semantic_lookup)(index, scenario_text, catalog.version, allow_reuse=use_cache)
+        if match.reuse is not None:
+            result = reused_result(match, mode, specialties, started)
+            if cache is not None and cache_key is not None:
+                with trace.activate(), timed("cache.store"):
+                    await sync_to_async(cache.set)(cache_key, result)
+            PIPELINE_REQUESTS.inc(mode=mode, outcome=PATH_SEMANTIC)
+            yield EVENT_RESULT, dict(result, cached=False, trace=trace.as_dict())
+            return
+        examples = match.examples
+
+    guidelines = await sync_to_async(get_guideline_index)()
+    guidance = []
+    if guidelines is not None:
+        with trace.activate(), timed("guidelines.lookup"):
+            guidance = await sync_to_async(passages_for)(guidelines, catalog, scenario_text)
+
+    speculation = None
+    with trace.activate():
+        if mode == MODE_SPECULATIVE:
+            # Started first so the second opinion runs while the analyzer does
+            speculation = Speculation(catalog, scenario_text, examples=examples, guidance=guidance)
+        try:
+            # The fast model answers first when model tiering is enabled (see cpt_analyzer.tiering)
+            analyzer_result, tiering = await aanalyze_tiered(catalog, scenario_text, examples=examples, guidance=guidance)
+        except BaseException:
+            if speculation is not None:
+                speculation.cancel()
+            raise
+        if speculation is not None:
+            speculation.analyzer_done()
+    if 'error' in analyzer_result:
+        if speculation is not None:
+            speculation.cancel()
+        PIPELINE_REQUESTS.inc(mode=mode, outcome="error")
+        yield EVENT_ERROR, {'error': analyzer_result['error'], 'trace': trace.as_dict()}
+        return
+    try:
+        yield EVENT_ANALYZER, partial_result(analyzer_result)
+    except GeneratorExit:
+        # The caller stopped listening after the analyzer's answer
+        if speculation is not None:
+            speculation.cancel()
+        raise
+
+    with trace.activate():
+        check = None
+        if mode in (MODE_ADAPTIVE, MODE_ANALYZER_ONLY):
+            with timed("checks"):
+                check = check_analyzer_result(catalog, scenario_text, analyzer_result)
+        elif speculation is not None:
+            await speculation.reconcile(analyzer_result)
+            speculation.record()
+
+        if mode == MODE_ANALYZER_ONLY or (mode == MODE_ADAPTIVE and check.passed):
+            path = PATH_LOCAL
+            validator_result = local_validation(analyzer_result, check, catalog)
+        elif speculation is not None and speculation.agreed:
+            path = PATH_RECONCILED
+            validator_result = reconciled_validation(analyzer_result, speculation.second_opinion)
+        else:
+            path = PATH_VALIDATED
+            validator_agent = CPTValidatorAgent(catalog)
+            validator_result = await validator_agent.avalidate_cpt_code(scenario_text, analyzer_result, guidance=guidance)
+    if 'error' in validator_result:
+        PIPELINE_REQUESTS.inc(mode=mode, outcome="error")
+        yield EVENT_ERROR, {'error': validator_result['error'], 'trace': trace.as_dict()}
+        return
+
+    with trace.activate():
+        result = combine_results(analyzer_result, validator_result)
+        if speculation is not None:
+            result['second_opinion_result'] = speculation.second_opinion
+        result['guideline_citations'] = citations(guidance)
+        if settings.CPT_RULES_ENABLED:
+            with timed("rules"):
+                apply_rules(result, scenario_text, catalog)
+        result['pipeline'] = {
+            'mode': mode,
+            'path': path,
+            'specialties': specialties,
+            'catalog_version': catalog.version,
+            'prompt_version': prompt_version(),
+            'model_calls': ((2 if path == PATH_VALIDATED else 1) + bool(tiering and tiering.escalated)
+                            + (speculation is not None)),
+            'checks': check.as_dict() if check is not None else None,
+            'tiering': tiering.as_dict() if tiering is not None else None,
+            'speculation': speculation.as_dict() if speculation is not None else None,
+            'elapsed_ms': round((time.monotonic() - started) * 1000, 1),
+            'usage': result_usage(result),
+        }
+        if cache is not None and cache_key is not None:
+            with timed("cache.store"):
+                await sync_to_async(cache.set)(cache_key, result)
+        # Only validated (or independently confirmed), high-confidence answers are offered to later scenarios
+        if index is not None and path in (PATH_VALIDATED, PATH_RECONCILED) and result['confidence'] == 'High':
+            with timed("semantic.insert"):
+                await sync_to_async(index.add)(scenario_text, stored_payload(scenario_text, result))
+    PIPELINE_REQUESTS.inc(mode=mode, outcome=path)
+    yield EVENT_RESULT, dict(result, cached=False, trace=trace.as_dict())
+
+
+def reused_result(match, mode, specialties, started):
+    """A prior validated result served for a near-identical scenario, flagged with the match"""
+    result = dict(match.reuse['result'])
+    result['semantic_match'] = {
+        'similarity': round(match.similarity, 4),
+        'scenario': match.reuse['scenario'],
+    }
+    result['pipeline'] = dict(
+        result.get('pipeline') or {},
+        mode=mode,
+        path=PATH_SEMANTIC,
+        specialties=specialties,
+        model_calls=0,
+        checks=None,
+        elapsed_ms=round((time.monotonic() - started) * 1000, 1),
+        usage=result_usage(result),
+    )
+    return result
+
+
+async def arun_pipeline(scenario_text, use_cache=True, mode=None, trace=None):
+    """
+    Run both agents and return only the final result
+
+    Returns:
+        dict: The combined result, or {'error': ...} if either agent failed
+    """
+    async for event, payload in astream_pipeline(scenario_text, use_cache=use_cache, mode=mode, trace=trace):
+        if event in (EVENT_RESULT, EVENT_ERROR):
+            return payload
+    return {'error': 'Pipeline finished without a result'}
+
+
+def run_pipeline(scenario_text, use_cache=True, mode=None):
+    """Synchronous wrapper around arun_pipeline for management commands and other sync callers"""
+    return async_to_sync(arun_pipeline)(scenario_text, use_cache=use_cache, mode=mode)
@@ -0,0 +1,299 @@
+"""
+Scenario preprocessing and token budgeting.
+
+Runs before the agents. Pasted notes often carry history, medications,
+vitals and other sections that never change the procedure code, and
+copy-paste repeats. This stage drops those sections and repeated
+sentences, counts tokens locally and estimates the whole request: scenario,
+prompt prefix and catalog context for each agent call, plus completions.
+A scenario that does not fit settings.CPT_TOKEN_BUDGET is truncated or
+rejected with a message saying by how much, and the estimate (tokens and
+USD, from settings.CPT_MODEL_PRICES) is reported before any model call.
+
+Token counts use tiktoken when it is installed and a close local
+approximation otherwise.
+"""
+import math
+import re
+import threading
+
+from django.conf import settings
+
+from .agents import analyzer_stages, stage_options
+from .prompts import ANALYZER_TEMPLATE, SECOND_OPINION_TEMPLATE, VALIDATOR_TEMPLATE
+from .retrieval import render_candidates, select_candidates
+
+DEFAULT_BUDGET = {
+    "ENABLED": True,
+    "MAX_SCENARIO_TOKENS": 2000,
+    "MAX_REQUEST_TOKENS": 32000,
+    "ON_OVERFLOW": "truncate",
+    "MIN_SCENARIO_TOKENS": 50,
+    "STRIP_SECTIONS": [],
+}
+OVERFLOW_ACTIONS = ("truncate", "reject")
+
+# Note sections that do not describe the procedure performed
+BOILERPLATE_SECTIONS = (
+    "past medical history", "pmh", "past surgical history", "psh", "medical history", "surgical history",
+    "social history", "family history", "medications", "current medications", "home medications", "meds",
+    "allergies", "vitals", "vital signs", "review of systems", "ros", "labs", "laboratory", "lab results",
+    "immunizations", "insurance", "billing", "disclaimer", "signature", "electronically signed",
+    "attestation", "follow up", "follow-up", "discharge instructions", "patient education",
+)
+# Lines that describe a procedure are never dropped as part of a boilerplate section
+PROCEDURE_RE = re.compile(
+    r"\b(underwent|performed|procedure|operation|\d{5}|\w*(?:scopy|otomy|ostomy|ectomy|plasty|tripsy|metrogram|graphy)"
+    r"|biops\w*|catheter\w*|stent\w*|insert\w*|remov\w*|place[dm]\w*|resect\w*|incision|excision|dilat\w*)\b",
+    re.IGNORECASE,
+)
+HEADING_RE = re.compile(r"^\s*([A-Za-z][A-Za-z /&-]{1,40}?)\s*:\s*(.*)$")
+SENTENCE_RE = re.compile(r"[^.!?\n]+(?:[.!?]+|$)")
+TOKEN_PIECE_RE = re.compile(r"[A-Za-z]+|\d+|[^\sA-Za-z\d]")
+TRUNCATION_MARK = " [truncated]"
+# Role markers and formatting around each chat message
+MESSAGE_OVERHEAD = 4
+# The validator prompt repeats the analyzer's answer: code(s), description and explanation
+ANALYZER_ECHO_TOKENS = 250
+
+_encoding = None
+_encoding_checked = False
+_context_tokens = {}
+_context_lock = threading.Lock()
+
+
+def budget_settings():
+    config = {**DEFAULT_BUDGET, **(getattr(settings, "CPT_TOKEN_BUDGET", None) or {})}
+    if config["ON_OVERFLOW"] not in OVERFLOW_ACTIONS:
+        raise ValueError(f"CPT_TOKEN_BUDGET['ON_OVERFLOW'] must be one of {', '.join(OVERFLOW_ACTIONS)}")
+    return config
+
+
+def _get_encoding():
+    global _encoding, _encoding_checked
+
+    if not _encoding_checked:
+        try:
+            import tiktoken
+
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            # Not installed, or the encoding file cannot be downloaded
+            _encoding = None
+        _encoding_checked = True
+    return _encoding
+
+
+def count_tokens(text):
+    """Tokens in `text`: exact with tiktoken, otherwise ~1 per short word/number/symbol and 1 per 4 letters"""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return sum(max(1, math.ceil(len(piece) / 4)) if piece.isalpha() else max(1, math.ceil(len(piece) / 3))
+               for piece in TOKEN_PIECE_RE.findall(text))
+
+
+def clean_scenario(text, strip_sections=()):
+    """
+    Drop boilerplate sections and repeated sentences
+
+    A section starts at a 'Heading:' line and runs to the next heading or
+    blank line; a heading with text on the same line ('Allergies: NKDA') is
+    a section of that line only. Lines that mention a procedure are kept
+    even inside a boilerplate section. Sentences are compared case- and
+    whitespace-insensitively.
+
+    Returns:
+        tuple: (cleaned text, removed section headings, number of repeated sentences dropped)
+    """
+    boilerplate = set(BOILERPLATE_SECTIONS) | {name.lower() for name in strip_sections}
+    kept_lines, removed = [], []
+    skipping = False
+    for line in (text or "").splitlines():
+        heading = HEADING_RE.match(line)
+        if heading:
+            name = heading.group(1).strip().lower()
+            skipping = name in boilerplate
+            if skipping:
+                removed.append(heading.group(1).strip())
+                # Inline content makes the heading line the whole section
+                skipping = not heading.group(2).strip()
+                if not PROCEDURE_RE.search(heading.group(2)):
+                    continue
+                line = heading.group(2)
+        elif not line.strip():
+            skipping = False
+        elif skipping and PROCEDURE_RE.search(line):
+            skipping = False
+        if not skipping:
+            kept_lines.append(line)
+
+    seen, paragraphs, duplicates = set(), [], 0
+    for paragraph in "\n".join(kept_lines).split("\n\n"):
+        sentences = []
+        for sentence in SENTENCE_RE.findall(paragraph):
+            # Compare without any 'Heading:' prefix so a labelled copy still counts as a repeat
+            heading = HEADING_RE.match(sentence)
+            key = " ".join((heading.group(2) if heading else sentence).lower().split()).rstrip(".!? ")
+            if not key:
+                continue
+            if key in seen and len(key) > 20:
+                duplicates += 1
+                continue
+            seen.add(key)
+            sentences.append(" ".join(sentence.split()))
+        if sentences:
+            paragraphs.append(" ".join(sentences))
+    return "\n\n".join(paragraphs), removed, duplicates
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Keep whole sentences from the start of `text` up to `max_tokens` (cutting words if the first is too long)"""
+    budget = max_tokens - count_tokens(TRUNCATION_MARK)
+    kept, used = [], 0
+    for sentence in SENTENCE_RE.findall(text):
+        tokens = count_tokens(sentence)
+        if used + tokens > budget:
+            if not kept:
+                words = sentence.split()
+                while words and count_tokens(" ".join(words)) > budget:
+                    words = words[: max(1, len(words) * 3 // 4)] if len(words) > 1 else []
+                kept.append(" ".join(words))
+            break
+        kept.append(sentence.strip())
+        used += tokens
+    return " ".join(part for part in kept if part) + TRUNCATION_MARK
+
+
+def _context_tokens_for(template, catalog, top_k):
+    """Tokens of the static system prefix plus, with retrieval, a typical candidate list (cached per catalog)"""
+    key = (template.name, catalog.version, top_k)
+    cached = _context_tokens.get(key)
+    if cached is None:
+        compiled = template.compile(catalog, top_k)
+        cached = count_tokens(compiled.system_message["content"]) + MESSAGE_OVERHEAD
+        if not compiled.static_catalog and len(catalog):
+            per_code = count_tokens(render_candidates(select_candidates(catalog, "", 0))) / len(catalog)
+            cached += math.ceil(per_code * min(top_k, len(catalog))) + count_tokens(compiled.user) + MESSAGE_OVERHEAD
+        with _context_lock:
+            if len(_context_tokens) > 64:
+                _context_tokens.clear()
+            _context_tokens[key] = cached
+    return cached
+
+
+def estimate_request(scenario_tokens, catalog, mode, top_k=None):
+    """
+    Upper-bound token and cost estimate for one pipeline run
+
+    The analyzer always runs (both tiers, when model tiering may escalate);
+    the validator is counted unless the mode never calls it, and the
+    speculative mode's second opinion is counted too. Guideline
+    passages are counted at their CPT_GUIDELINES['MAX_TOKENS'] cap.
+    """
+    top_k = settings.CPT_PROMPT_TOP_K if top_k is None else top_k
+    guidelines = getattr(settings, "CPT_GUIDELINES", None) or {}
+    guidance = guidelines.get("MAX_TOKENS", 0) if guidelines.get("ENABLED") else 0
+    calls = [(stage, ANALYZER_TEMPLATE, 0) for stage in analyzer_stages()]
+    if mode == "speculative":
+        calls.append(("second_opinion", SECOND_OPINION_TEMPLATE, 0))
+    if mode != "analyzer_only":
+        calls.append(("validator", VALIDATOR_TEMPLATE, ANALYZER_ECHO_TOKENS))
+    stages, prompt_total, completion_total, cost = {}, 0, 0, 0.0
+    for stage, template, extra in calls:
+        options = stage_options(stage)
+        prompt = _context_tokens_for(template, catalog, top_k) + scenario_tokens + guidance + extra
+        completion = options["max_tokens"]
+        stage_cost = estimate_cost(options["model"], prompt, completion)
+        stages[stage] = {"prompt_tokens": prompt, "max_completion_tokens": completion, "cost_usd": stage_cost}
+        prompt_total += prompt
+        completion_total += completion
+        cost += stage_cost or 0.0
+    return {
+        "prompt_tokens": prompt_total,
+        "max_completion_tokens": completion_total,
+        "total_tokens": prompt_total + completion_total,
+        "cost_usd": round(cost, 6),
+        "stages": stages,
+    }
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens, cached_tokens=0):
+    """USD cost from settings.CPT_MODEL_PRICES (per million tokens); None for an unpriced model"""
+    prices = (getattr(settings, "CPT_MODEL_PRICES", None) or {}).get(model)
+    if not prices:
+        return None
+    cached_price = prices.get("cached_input", prices["input"])
+    cost = ((prompt_tokens - cached_tokens) * prices["input"] + cached_tokens * cached_price
+            + completion_tokens * prices["output"]) / 1_000_000
+    return round(cost, 6)
+
+
+class PreparedScenario:
+    """The scenario the agents will see, what was removed, and the request's token estimate"""
+
+    def __init__(self, text, original_tokens, removed_sections=(), duplicates_removed=0):
+        self.text = text
+        self.original_tokens = original_tokens
+        self.removed_sections = list(removed_sections)
+        self.duplicates_removed = duplicates_removed
+        self.truncated = False
+        self.estimate = None
+        self.error = None
+
+    @property
+    def tokens(self):
+        return count_tokens(self.text)
+
+    def as_dict(self):
+        data = {
+            "original_tokens": self.original_tokens,
+            "tokens": self.tokens,
+            "removed_sections": self.removed_sections,
+            "duplicates_removed": self.duplicates_removed,
+            "truncated": self.truncated,
+            "estimate": self.estimate,
+        }
+        if self.error:
+            data["error"] = self.error
+        return data
+
+
+def prepare_scenario(text):
+    """Clean a scenario (the budget is applied once its catalog is known; see apply_budget)"""
+    config = budget_settings()
+    cleaned, removed, duplicates = clean_scenario(text, config["STRIP_SECTIONS"])
+    # Never clean a scenario away entirely; fall back to the text as given
+    if not cleaned.strip():
+        cleaned, removed, duplicates = " ".join((text or "").split()), [], 0
+    return PreparedScenario(cleaned, count_tokens(text), removed, duplicates)
+
+
+def apply_budget(prepared, catalog, mode):
+    """
+    Fit the scenario into the per-scenario and per-request budgets
+
+    Sets prepared.estimate, and either truncates prepared.text or sets
+    prepared.error, depending on CPT_TOKEN_BUDGET['ON_OVERFLOW'].
+    """
+    config = budget_settings()
+    tokens = prepared.tokens
+    fixed = estimate_request(0, catalog, mode)
+    # Scenario tokens appear once per agent call
+    calls = len(fixed["stages"])
+    allowed = min(config["MAX_SCENARIO_TOKENS"], (config["MAX_REQUEST_TOKENS"] - fixed["total_tokens"]) // calls)
+    if tokens > allowed:
+        message = (
+            f"Scenario is about {tokens} tokens after removing boilerplate; the budget allows {max(allowed, 0)} "
+            f"(CPT_TOKEN_BUDGET: {config['MAX_SCENARIO_TOKENS']} per scenario, {config['MAX_REQUEST_TOKENS']} per "
+            f"request including {fixed['total_tokens']} for prompts, catalog context and completions)"
+        )
+        if config["ON_OVERFLOW"] == "reject" or allowed < config["MIN_SCENARIO_TOKENS"]:
+            prepared.error = f"{message}. Shorten the scenario to the procedure details."
+        else:
+            prepared.text = truncate_to_tokens(prepared.text, allowed)
+            prepared.truncated = True
+    prepared.estimate = estimate_request(prepared.tokens, catalog, mode)
+    return prepared
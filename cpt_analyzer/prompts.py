@@ -0,0 +1,282 @@
+"""
+Versioned prompt templates for the agents.
+
+Each template is split into a static system message (role, coding
+guidelines, response format and, when the whole catalog is sent, the CPT
+table) and a short per-request user message. Keeping the static part first
+and byte-identical across requests lets provider-side prompt caching reuse
+it; it is rendered once per catalog version (specialty shard) and top-k
+setting rather than on every call. Providers only cache prefixes of at
+least PROMPT_CACHE_MIN_TOKENS; while a compiled prefix is shorter, the
+shard's own worked examples (settings.CPT_SPECIALTIES PROMPT_EXAMPLES) and
+then the modifier reference are added to it. Prefixes that already carry
+the whole catalog are left as they are.
+
+Bump PROMPT_VERSION when the wording changes on purpose. The cache keys
+and benchmark reports use prompt_version(), which also includes a hash of
+the template text, so a change to the text cannot reuse stale results.
+"""
+import hashlib
+import threading
+from textwrap import dedent
+
+from .retrieval import find_codes, render_candidates, select_candidates
+
+PROMPT_VERSION = "9"
+
+COMPILED_CACHE_SIZE = 16
+# Shortest prefix OpenAI's prompt caching applies to
+PROMPT_CACHE_MIN_TOKENS = 1024
+
+GUIDELINES = dedent("""
+    IMPORTANT GUIDELINES FOR MULTIPLE PROCEDURES AND MODIFIERS:
+
+    1. Identify all distinct procedures by looking for procedure terminology and action verbs (e.g., "performed", "underwent", "conducted").
+
+    2. For multiple procedures performed during the same session/same day:
+       - Use modifier -51 (Multiple Procedure) for additional Category 1 CPT codes when the same provider performs multiple procedures
+       - Do NOT add the -51 modifier to the primary (most resource-intensive) procedure
+       - Only add the -51 modifier to secondary procedures
+
+    3. Use modifier -59 (Distinct Procedural Service) when:
+       - A procedure would normally be bundled with another but is performed separately and independently
+       - The procedures are performed on different sites/organs
+       - The procedures are performed during different sessions on the same day
+
+    4. Use modifier -50 (Bilateral Procedure) when:
+       - The same procedure is performed on both sides of the body
+       - The procedure is not already inherently bilateral
+
+    5. Sequence of codes:
+       - List the most resource-intensive or complex procedure FIRST without modifiers
+       - List additional procedures with appropriate modifiers afterward
+
+    6. Bundled procedures:
+       - Do not report a diagnostic endoscopy separately when a surgical endoscopy is performed through it in the same session
+       - Do not report a procedure separately when its description makes it part of another procedure that was performed
+       - Report a bundled pair with -59 (or -XE, -XS, -XP, -XU) only when the documentation shows a separate site, session or practitioner
+
+    7. Add-on codes (descriptions containing "list separately in addition to code for primary procedure"):
+       - Always report them together with their primary procedure
+       - Never add -51 to an add-on code; add-on codes are exempt from the multiple procedure reduction
+""").strip()
+
+MODIFIER_REFERENCE = dedent("""
+    MODIFIER REFERENCE (written without the dash):
+    - 22 Increased procedural services: substantially greater work than usually required, documented in the scenario
+    - 50 Bilateral procedure: the same procedure on both sides in the same session; not for inherently bilateral codes
+    - 51 Multiple procedures: secondary procedures in the same session, never the primary code or an add-on code
+    - 52 Reduced services: a procedure partially reduced or eliminated at the physician's discretion
+    - 53 Discontinued procedure: started but stopped because of risk to the patient's well-being
+    - 58 Staged or related procedure by the same physician during the postoperative period
+    - 59 Distinct procedural service: a procedure not normally reported together with another, performed at a separate site or session
+    - 76 Repeat procedure by the same physician on the same day
+    - 77 Repeat procedure by another physician on the same day
+    - 78 Unplanned return to the operating room for a related procedure during the postoperative period
+    - 79 Unrelated procedure by the same physician during the postoperative period
+    - RT / LT Right side / left side: for unilateral procedures on paired organs; never together with 50, and never both on one code (use 50)
+    - XE Separate encounter, XS separate structure or organ, XP separate practitioner, XU unusual non-overlapping service: more specific alternatives to 59; use one of them or 59, not both
+
+    General rules:
+    - Report each procedure once per session unless the code descriptor counts units (e.g., "each additional")
+    - Choose the code that describes the complete procedure rather than reporting its component steps
+    - When the scenario gives a size, count or approach (open, laparoscopic, endoscopic, percutaneous), choose the code for that size, count or approach
+    - "With" and "without" in a code description are significant: pick the code whose description matches what was done
+""").strip()
+
+EXAMPLES_HEADING = "WORKED EXAMPLES (illustrating the rules above; code each scenario on its own details):"
+
+CODES_FIELD = ('"codes": the code(s) in sequence, each as {"code": "5-digit CPT code", "modifiers": '
+               '["modifier without the dash"]}, e.g. 51725 and 51785-51 are [{"code": "51725", "modifiers": []}, '
+               '{"code": "51785", "modifiers": ["51"]}]')
+
+ANALYZER_SYSTEM = dedent("""
+    You are a medical coding expert specializing in CPT codes for {specialty} procedures. You ALWAYS provide a specific CPT code answer for any scenario.
+
+    Given a medical scenario and CPT codes from the database, determine the most appropriate CPT code(s).
+    You MUST provide a specific CPT code even if the scenario seems ambiguous - use your best judgment.
+
+    {guidelines}
+
+    FOR ALL SCENARIOS, you must provide a CPT code that best matches the description, even if some details are missing.
+
+    Respond with a JSON object with these fields:
+    {codes_field}
+    "description": brief description of the code(s) - if multiple codes, separate descriptions with semicolons
+    "explanation": detailed explanation of why these code(s) are appropriate, including reasons for any modifiers used
+""").strip()
+
+VALIDATOR_SYSTEM = dedent("""
+    You are a senior medical coding expert specializing in CPT codes for {specialty} procedures. You ALWAYS provide a specific CPT code answer for any scenario.
+    Your task is to validate the CPT code(s) provided by another agent.
+
+    Carefully review the scenario and the first agent's analysis. You MUST provide a specific CPT code even if the scenario seems ambiguous.
+
+    {guidelines}
+
+    You MUST provide a specific CPT code answer, even if you need to make reasonable assumptions based on the scenario.
+
+    Respond with a JSON object with these fields:
+    {codes_field}
+    "description": brief description of the code(s) - if multiple codes, separate descriptions with semicolons
+    "explanation": detailed explanation of why these code(s) are appropriate
+    "confidence": "High", "Medium" or "Low" - your confidence in this/these code(s) being correct
+""").strip()
+
+SECOND_OPINION_SYSTEM = dedent("""
+    You are a senior medical coding expert specializing in CPT codes for {specialty} procedures. You ALWAYS provide a specific CPT code answer for any scenario.
+    Your task is to code the scenario independently, as a second opinion; you will not see any other coder's answer.
+
+    Given a medical scenario and CPT codes from the database, determine the most appropriate CPT code(s).
+
+    {guidelines}
+
+    You MUST provide a specific CPT code answer, even if you need to make reasonable assumptions based on the scenario.
+
+    Respond with a JSON object with these fields:
+    {codes_field}
+    "description": brief description of the code(s) - if multiple codes, separate descriptions with semicolons
+    "explanation": brief explanation of why these code(s) are appropriate
+    "confidence": "High", "Medium" or "Low" - your confidence in this/these code(s) being correct
+""").strip()
+
+ANALYZER_USER = dedent("""
+    MEDICAL SCENARIO:
+    {scenario}
+
+    {examples}{guidance}{candidates}Based on the medical scenario and the CPT codes from the database, determine the most appropriate CPT code(s).
+""").strip()
+
+VALIDATOR_USER = dedent("""
+    MEDICAL SCENARIO:
+    {scenario}
+
+    FIRST AGENT'S ANALYSIS:
+    CPT Code(s): {cpt_code}
+    Description: {description}
+    Explanation: {explanation}
+
+    {guidance}{candidates}Validate the first agent's code(s) against the scenario and the CPT codes from the database.
+""").strip()
+
+
+def render_worked_examples(text):
+    """A shard's worked examples under their heading ('' when it has none)"""
+    return f"{EXAMPLES_HEADING}\n{text.strip()}" if text and text.strip() else ""
+
+
+def cacheable_prefix(system, catalog):
+    """
+    Lengthen a system prefix that is too short for provider-side prompt caching
+
+    The catalog's worked examples, then the modifier reference, are appended
+    only while the prefix is below PROMPT_CACHE_MIN_TOKENS.
+    """
+    # preprocess imports this module for its templates
+    from .preprocess import count_tokens
+
+    for block in (render_worked_examples(catalog.prompt_examples), MODIFIER_REFERENCE):
+        if block and count_tokens(system) < PROMPT_CACHE_MIN_TOKENS:
+            system += "\n\n" + block
+    return system
+
+
+def render_examples(examples):
+    """Few-shot block of similar scenarios coded before ('' when there are none)"""
+    if not examples:
+        return ""
+    lines = ["SIMILAR SCENARIOS CODED BEFORE (for reference only; code this scenario on its own details):"]
+    for number, example in enumerate(examples, start=1):
+        lines.append(f"{number}. {' '.join(example['scenario'].split())}")
+        lines.append(f"   CPT Code(s): {example['cpt_code']} ({example['description']})")
+    return "\n".join(lines) + "\n\n"
+
+
+def render_guidance(passages):
+    """Guideline passages retrieved for the scenario, labelled like their citations ('' when there are none)"""
+    if not passages:
+        return ""
+    lines = ["CODING GUIDELINE EXCERPTS (apply them where relevant):"]
+    for number, passage in enumerate(passages, start=1):
+        lines.append(f"[G{number}] ({passage.source}, p. {passage.page}) {passage.text}")
+    return "\n".join(lines) + "\n\n"
+
+
+class CompiledPrompt:
+    """A template rendered for one catalog and top-k; only the user message varies per request"""
+
+    def __init__(self, template, catalog, top_k):
+        self.catalog = catalog
+        self.top_k = top_k
+        # With top_k <= 0 the whole catalog is sent, so it can live in the cacheable prefix
+        self.static_catalog = top_k <= 0
+        system = template.system.replace("{specialty}", catalog.label)
+        if self.static_catalog:
+            system += "\n\nCPT CODES FROM DATABASE:\n" + render_candidates(select_candidates(catalog, "", 0))
+        system = cacheable_prefix(system, catalog)
+        self.system_message = {"role": "system", "content": system}
+        self.user = template.user
+        self.prefix_hash = hashlib.sha1(system.encode("utf-8")).hexdigest()[:12]
+
+    def messages(self, scenario_text, extra_codes=(), examples=(), guidance=(), **fields):
+        """
+        Chat messages for a request: the shared system prefix, then the request-specific part
+
+        `examples` are similar, previously coded scenarios ({'scenario', 'cpt_code',
+        'description'}); their codes are added to the candidates. `guidance` are
+        guideline passages (see cpt_analyzer.guidelines).
+        """
+        if self.static_catalog:
+            candidates = ""
+        else:
+            extra_codes = list(extra_codes) + [c for example in examples for c in find_codes(example["cpt_code"])]
+            entries = select_candidates(self.catalog, scenario_text, self.top_k, extra_codes=extra_codes)
+            candidates = f"CANDIDATE CPT CODES FROM DATABASE:\n{render_candidates(entries)}\n\n"
+        fields.setdefault("examples", render_examples(examples))
+        fields.setdefault("guidance", render_guidance(guidance))
+        user = self.user.format(scenario=scenario_text.strip(), candidates=candidates, **fields)
+        return [self.system_message, {"role": "user", "content": user}]
+
+
+class PromptTemplate:
+    """A named template whose compiled forms are cached per catalog version, specialty label and top-k"""
+
+    def __init__(self, name, system, user):
+        self.name = name
+        # {specialty} is filled in per catalog at compile time
+        self.system = system.format(guidelines=GUIDELINES, codes_field=CODES_FIELD, specialty="{specialty}")
+        self.user = user
+        self._compiled = {}
+        self._lock = threading.Lock()
+
+    @property
+    def fingerprint(self):
+        return hashlib.sha1((self.system + self.user).encode("utf-8")).hexdigest()[:8]
+
+    def compile(self, catalog, top_k):
+        key = (catalog.version, catalog.label, catalog.prompt_examples, top_k)
+        compiled = self._compiled.get(key)
+        if compiled is None:
+            with self._lock:
+                compiled = self._compiled.get(key)
+                if compiled is None:
+                    compiled = CompiledPrompt(self, catalog, top_k)
+                    # Bounded: a few shards (and their merges) are live at once; old versions age out
+                    if len(self._compiled) >= COMPILED_CACHE_SIZE:
+                        self._compiled.pop(next(iter(self._compiled)))
+                    self._compiled[key] = compiled
+        return compiled
+
+
+ANALYZER_TEMPLATE = PromptTemplate("analyzer", ANALYZER_SYSTEM, ANALYZER_USER)
+VALIDATOR_TEMPLATE = PromptTemplate("validator", VALIDATOR_SYSTEM, VALIDATOR_USER)
+# Same request part as the analyzer: the second opinion must not see the analyzer's answer
+SECOND_OPINION_TEMPLATE = PromptTemplate("second_opinion", SECOND_OPINION_SYSTEM, ANALYZER_USER)
+TEMPLATES = (ANALYZER_TEMPLATE, VALIDATOR_TEMPLATE, SECOND_OPINION_TEMPLATE)
+
+
+def prompt_version():
+    """PROMPT_VERSION plus a hash of the template text, for cache keys and benchmark reports"""
+    text = "".join(t.fingerprint for t in TEMPLATES) + MODIFIER_REFERENCE + EXAMPLES_HEADING
+    digest = hashlib.sha1(text.encode("utf-8")).hexdigest()[:8]
+    return f"{PROMPT_VERSION}-{digest}"
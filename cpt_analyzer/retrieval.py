@@ -0,0 +1,225 @@
+"""
+Local candidate retrieval over the CPT catalog.
+
+Instead of inlining the whole catalog into every prompt, the agents ask this
+module for the top-k codes that plausibly match a scenario. Ranking is BM25
+over code descriptions with urology synonym expansion, and any CPT code that
+appears verbatim in the scenario is always included.
+"""
+import json
+import math
+import re
+import threading
+from collections import Counter, OrderedDict, defaultdict
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+CODE_RE = re.compile(r"\b(\d{5})(?:-\d{2})?\b")
+
+STOPWORDS = frozenset("""
+    a an and any are as at be by for from in into is it of on or the this to was were with without
+    patient underwent performed procedure procedures separate including eg e g via using each all
+    """.split())
+
+# Scenario wording -> catalog wording. Keys and values are raw (unstemmed) words.
+SYNONYMS = {
+    "cystoscopy": ["cystourethroscopy", "endoscopy"],
+    "ureteroscopy": ["ureteral", "endoscopy"],
+    "scope": ["endoscopy"],
+    "stone": ["calculus"],
+    "stones": ["calculus"],
+    "calculi": ["calculus"],
+    "kidney": ["renal"],
+    "renal": ["kidney"],
+    "bladder": ["vesical", "cystotomy"],
+    "foley": ["indwelling", "bladder", "catheter"],
+    "catheterization": ["catheter"],
+    "cmg": ["cystometrogram"],
+    "uroflow": ["uroflowmetry"],
+    "emg": ["electromyography"],
+    "pcnl": ["percutaneous", "nephrolithotomy"],
+    "eswl": ["lithotripsy", "extracorporeal", "shock", "wave"],
+    "swl": ["lithotripsy", "extracorporeal", "shock", "wave"],
+    "turp": ["transurethral", "prostate"],
+    "suprapubic": ["cystostomy"],
+    "incontinence": ["sling", "continence"],
+    "pvr": ["residual", "urine", "voiding"],
+    "transplant": ["allotransplantation", "allograft"],
+    "nephrostomy": ["nephrostomy", "catheter"],
+}
+SYNONYM_WEIGHT = 0.6
+EXACT_CODE_SCORE = 1000.0
+
+_SUFFIXES = ("ations", "ation", "ings", "ing", "ed", "es", "al", "e", "s")
+
+
+def _stem(token):
+    """Very small suffix stripper; good enough to match removal/removed/remove"""
+    for suffix in _SUFFIXES:
+        if token.endswith(suffix) and len(token) - len(suffix) >= 4:
+            return token[: -len(suffix)]
+    return token
+
+
+def tokenize(text):
+    """Lowercase, drop stopwords and stem"""
+    return [_stem(t) for t in TOKEN_RE.findall(text.lower()) if t not in STOPWORDS and not t.isdigit()]
+
+
+def expand_query(text):
+    """
+    Tokenize a scenario and add synonym expansions
+
+    Returns:
+        dict: stemmed term -> query weight
+    """
+    weights = defaultdict(float)
+    for raw in TOKEN_RE.findall(text.lower()):
+        if raw in STOPWORDS or raw.isdigit():
+            continue
+        weights[_stem(raw)] += 1.0
+        for synonym in SYNONYMS.get(raw, ()):
+            weights[_stem(synonym)] += SYNONYM_WEIGHT
+    return weights
+
+
+class CPTRetriever:
+    """BM25 index over the descriptions of one catalog version"""
+
+    def __init__(self, catalog, k1=1.2, b=0.75):
+        self.catalog = catalog
+        self.version = catalog.version
+        self.k1 = k1
+        self.b = b
+        self.codes = list(catalog.codes)
+        self.postings = defaultdict(list)
+        self.doc_lengths = []
+
+        for doc_id, code in enumerate(self.codes):
+            entry = catalog.get(code)
+            terms = tokenize(f"{entry.description} {entry.topic} {entry.category}")
+            self.doc_lengths.append(len(terms))
+            for term, freq in Counter(terms).items():
+                self.postings[term].append((doc_id, freq))
+
+        count = len(self.codes) or 1
+        self.avg_length = (sum(self.doc_lengths) / count) or 1.0
+        self.idf = {
+            term: math.log(1 + (count - len(docs) + 0.5) / (len(docs) + 0.5))
+            for term, docs in self.postings.items()
+        }
+
+    def search(self, text, k):
+        """
+        Rank catalog codes for a scenario
+
+        Args:
+            text (str): The scenario text
+            k (int): Maximum number of codes to return
+
+        Returns:
+            list: (code, score) pairs, best first
+        """
+        scores = defaultdict(float)
+        for term, weight in expand_query(text).items():
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for doc_id, freq in self.postings[term]:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / self.avg_length)
+                scores[doc_id] += weight * idf * freq * (self.k1 + 1) / (freq + norm)
+
+        ranked = {self.codes[doc_id]: score for doc_id, score in scores.items()}
+        for code in find_codes(text):
+            if code in self.catalog:
+                ranked[code] = ranked.get(code, 0.0) + EXACT_CODE_SCORE
+
+        return sorted(ranked.items(), key=lambda item: (-item[1], item[0]))[:k]
+
+
+def find_codes(text):
+    """Return the 5-digit CPT codes mentioned in free text, in order of appearance"""
+    return list(dict.fromkeys(CODE_RE.findall(text or "")))
+
+
+# One retriever per catalog version (specialty shards and their merges), least recently used dropped first
+RETRIEVER_CACHE_SIZE = 8
+_retrievers = OrderedDict()
+_retriever_lock = threading.Lock()
+
+
+def get_retriever(catalog):
+    """Return the retriever for this catalog version, building it on first use"""
+    with _retriever_lock:
+        retriever = _retrievers.get(catalog.version)
+        if retriever is None:
+            retriever = _retrievers[catalog.version] = CPTRetriever(catalog)
+            while len(_retrievers) > RETRIEVER_CACHE_SIZE:
+                _retrievers.popitem(last=False)
+        else:
+            _retrievers.move_to_end(catalog.version)
+        return retriever
+
+
+def select_candidates(catalog, text, k, extra_codes=()):
+    """
+    Pick the catalog entries to show the model for a scenario
+
+    Args:
+        catalog (CPTCatalog): The loaded catalog
+        text (str): The scenario text
+        k (int): Number of retrieved codes; 0 or less means the whole catalog
+        extra_codes (iterable): Codes that must be included (e.g. the analyzer's answer)
+
+    Returns:
+        list: CPTEntry objects in rank order
+    """
+    if k <= 0:
+        codes = list(catalog.codes)
+    else:
+        codes = [code for code, _ in get_retriever(catalog).search(text, k)]
+        if not codes:
+            # Nothing matched at all; let the model see everything rather than nothing
+            codes = list(catalog.codes)
+
+    for code in extra_codes:
+        if code in catalog and code not in codes:
+            codes.append(code)
+    return [catalog.get(code) for code in codes]
+
+
+def render_candidates(entries):
+    """Render candidate entries as a compact prompt table"""
+    lines = ["CPT Code | Section | Description"]
+    for entry in entries:
+        section = f"{entry.topic} - {entry.category}" if entry.category else entry.topic
+        lines.append(f"{entry.code} | {section} | {entry.description}")
+    return "\n".join(lines)
+
+
+def load_labeled_scenarios(path):
+    """Read a JSONL file of {"scenario": ..., "codes": [...]} records"""
+    with open(path, encoding="utf-8") as handle:
+        return [json.loads(line) for line in handle if line.strip()]
+
+
+def recall_at_k(catalog, labeled, k):
+    """
+    Average fraction of gold codes found in the top-k candidates
+
+    Args:
+        catalog (CPTCatalog): The loaded catalog
+        labeled (list): Records with "scenario" and "codes" keys
+        k (int): Retrieval depth
+
+    Returns:
+        float: Mean recall over the labeled set (0.0 for an empty set)
+    """
+    if not labeled:
+        return 0.0
+    retriever = get_retriever(catalog)
+    total = 0.0
+    for record in labeled:
+        gold = {code.split("-")[0] for code in record["codes"]}
+        found = {code for code, _ in retriever.search(record["scenario"], k)}
+        total += len(gold & found) / len(gold)
+    return total / len(labeled)
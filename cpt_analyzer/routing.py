@@ -0,0 +1,123 @@
+"""
+Routing of scenarios to specialty catalog shards.
+
+A small keyword classifier scores each configured specialty from the
+scenario text (stemmed, synonym-expanded terms) and from any CPT codes the
+scenario quotes. Only the winning shards are loaded and shown to the
+model, so memory and prompt size follow the specialties a scenario
+touches rather than the size of the whole catalog.
+"""
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .catalog import CPTCatalog, get_registry
+from .metrics import timed
+from .retrieval import expand_query, find_codes, tokenize
+
+# Shards scoring at least this fraction of the best shard's score are included
+RELATIVE_CUTOFF = 0.5
+# A quoted code inside a shard's range outweighs a handful of keyword hits
+CODE_WEIGHT = 3.0
+MERGED_CACHE_SIZE = 8
+
+
+def parse_code_range(text):
+    """'50010-53899' -> ('50010', '53899'); a single code is a one-code range"""
+    low, _, high = text.partition("-")
+    return low.strip(), (high or low).strip()
+
+
+class SpecialtyClassifier:
+    """Scores specialties for a scenario without loading any catalog"""
+
+    def __init__(self, shards):
+        self.vocabulary = {shard.name: frozenset(tokenize(" ".join(shard.keywords))) for shard in shards}
+        self.ranges = {shard.name: [parse_code_range(r) for r in shard.code_ranges] for shard in shards}
+
+    def scores(self, text):
+        terms = expand_query(text)
+        codes = find_codes(text)
+        scores = {}
+        for name, vocabulary in self.vocabulary.items():
+            score = sum(weight for term, weight in terms.items() if term in vocabulary)
+            score += CODE_WEIGHT * sum(
+                1 for code in codes if any(low <= code <= high for low, high in self.ranges[name])
+            )
+            scores[name] = score
+        return scores
+
+    def route(self, text, default, limit=2):
+        """
+        Pick the specialties for a scenario, best first
+
+        Returns:
+            list: Up to `limit` specialty names; [default] when nothing scores
+        """
+        ranked = sorted(self.scores(text).items(), key=lambda item: (-item[1], item[0]))
+        if not ranked or ranked[0][1] <= 0:
+            return [default]
+        best = ranked[0][1]
+        return [name for name, score in ranked if score >= best * RELATIVE_CUTOFF][: max(1, limit)]
+
+
+def merge_catalogs(catalogs):
+    """One catalog holding the codes of several shards (first shard wins on duplicate codes)"""
+    entries = [entry for catalog in catalogs for entry in catalog]
+    sections = [section for catalog in catalogs for section in catalog.sections]
+    return CPTCatalog(
+        entries, sections,
+        source_path=";".join(catalog.source_path for catalog in catalogs),
+        source_mtime=max(catalog.source_mtime for catalog in catalogs),
+        label=" and ".join(catalog.label for catalog in catalogs),
+        prompt_examples="\n".join(catalog.prompt_examples for catalog in catalogs if catalog.prompt_examples),
+    )
+
+
+_classifier = None
+_classifier_registry = None
+_merged = OrderedDict()
+_lock = threading.Lock()
+
+
+def get_classifier():
+    """Classifier for the current registry, rebuilt when the registry is reset"""
+    global _classifier, _classifier_registry
+
+    registry = get_registry()
+    if _classifier_registry is not registry:
+        with _lock:
+            if _classifier_registry is not registry:
+                _classifier = SpecialtyClassifier(registry)
+                _classifier_registry = registry
+    return _classifier
+
+
+def catalog_for_scenario(scenario_text):
+    """
+    Route a scenario and return the catalog to code it against
+
+    Returns:
+        tuple: (specialty names, CPTCatalog or None). Several specialties
+        share one merged catalog, cached per combination of shard versions.
+    """
+    registry = get_registry()
+    with timed("routing"):
+        names = get_classifier().route(scenario_text, registry.default, settings.CPT_MAX_SPECIALTIES)
+    catalogs = [catalog for catalog in (registry.get(name) for name in names) if catalog is not None]
+    if not catalogs:
+        return names, None
+    if len(catalogs) == 1:
+        return names, catalogs[0]
+
+    key = tuple(catalog.version for catalog in catalogs)
+    with _lock:
+        merged = _merged.get(key)
+        if merged is None:
+            merged = _merged[key] = merge_catalogs(catalogs)
+            while len(_merged) > MERGED_CACHE_SIZE:
+                _merged.popitem(last=False)
+        else:
+            _merged.move_to_end(key)
+    return names, merged
@@ -0,0 +1,287 @@
+"""
+Deterministic modifier, bundling and sequencing rules.
+
+The modifier guidelines in the agent prompts (-51 only on secondary
+procedures, -50 for bilateral procedures, -59 for distinct services,
+most resource-intensive code first) are enforced here in code so model
+output can be corrected without another round-trip.
+
+Bundling uses an NCCI procedure-to-procedure style edit table read from a
+local CSV (columns: column1, column2, modifier_indicator, rationale). The
+shipped data/ncci_edits.csv is a small sample; the CMS PTP file can be
+converted to the same columns and dropped in its place. A modifier
+indicator of 0 means the column 2 code is never reported with column 1;
+1 means it may be reported with a distinct-service modifier (-59).
+Bundled codes are only removed with settings.CPT_NCCI_EDITS_ENFORCE on,
+which should wait until the real CMS file is loaded; otherwise every edit
+is reported as a warning and the codes are kept.
+
+Add-on codes ("List separately in addition to...") are exempt from -51.
+A secondary procedure without -51 is only reported as a warning, because
+many payers apply the multiple procedure reduction themselves and reject
+-51; settings.CPT_RULES_ADD_MODIFIER_51 adds it instead.
+
+Sequencing weights come from an optional per-code CSV (code, weight; e.g.
+RVUs) and fall back to settings.CPT_CATEGORY_WEIGHTS by catalog category.
+"""
+import csv
+import os
+import threading
+from typing import NamedTuple
+
+from django.conf import settings
+
+from .checks import BILATERAL_TERMS, ParsedCode, parse_code
+
+DISTINCT_MODIFIERS = frozenset({"59", "XE", "XS", "XP", "XU"})
+# Description wording of add-on codes, which never take -51
+ADD_ON_TERMS = ("list separately in addition", "each additional")
+
+FIXED = "fixed"
+WARNING = "warning"
+
+
+class EditPair(NamedTuple):
+    column1: str
+    column2: str
+    modifier_indicator: int
+    rationale: str
+
+
+class Finding(NamedTuple):
+    rule: str
+    severity: str
+    code: str
+    message: str
+
+    def as_dict(self):
+        return self._asdict()
+
+
+class RuleResult(NamedTuple):
+    codes: list
+    findings: list
+    # Tokens that are not CPT codes, passed through unchanged after the checked codes
+    unparsed: list = []
+
+    @property
+    def code_strings(self):
+        return [format_code(code) for code in self.codes] + list(self.unparsed)
+
+
+def format_code(code):
+    return "-".join((code.code,) + code.modifiers)
+
+
+def load_edit_table(path):
+    """Read an edit table CSV into {(column1, column2): EditPair}"""
+    edits = {}
+    with open(path, newline="", encoding="utf-8") as handle:
+        for row in csv.DictReader(handle):
+            pair = EditPair(
+                row["column1"].strip(),
+                row["column2"].strip(),
+                int(row.get("modifier_indicator") or 0),
+                (row.get("rationale") or "").strip(),
+            )
+            edits[(pair.column1, pair.column2)] = pair
+    return edits
+
+
+def load_code_weights(path):
+    """Read an optional code,weight CSV (e.g. work RVUs) into {code: float}"""
+    weights = {}
+    with open(path, newline="", encoding="utf-8") as handle:
+        for row in csv.DictReader(handle):
+            weights[row["code"].strip()] = float(row["weight"])
+    return weights
+
+
+def is_add_on(entry):
+    """Whether a catalog entry is an add-on code"""
+    description = entry.description.lower()
+    return any(term in description for term in ADD_ON_TERMS)
+
+
+def _with_modifiers(code, add=(), remove=()):
+    modifiers = [m for m in code.modifiers if m not in remove]
+    modifiers += [m for m in add if m not in modifiers]
+    return ParsedCode(code.code, tuple(modifiers))
+
+
+class RuleEngine:
+    """Applies bundling, duplicate, sequencing and modifier rules to a code list"""
+
+    def __init__(self, catalog, edits, code_weights=None, category_weights=None, enforce_bundling=False,
+                 add_modifier_51=False):
+        self.catalog = catalog
+        self.edits = edits
+        self.enforce_bundling = enforce_bundling
+        self.add_modifier_51 = add_modifier_51
+        self.code_weights = code_weights or {}
+        self.category_weights = category_weights or {}
+
+    def weight(self, code):
+        """Sequencing weight: explicit per-code weight, else the catalog category's weight"""
+        if code in self.code_weights:
+            return self.code_weights[code]
+        entry = self.catalog.get(code) if self.catalog is not None else None
+        if entry is None:
+            return 0.0
+        for category, weight in self.category_weights.items():
+            if entry.category.startswith(category):
+                return weight
+        return 0.0
+
+    def apply(self, codes, scenario_text=""):
+        """
+        Apply every rule to a list of codes
+
+        Args:
+            codes (list): Code strings such as ['51729', '51785-51'] or ParsedCode objects
+            scenario_text (str): The scenario, used to decide on bilateral modifiers
+
+        Returns:
+            RuleResult: Corrected codes (primary first) and the findings explaining each change.
+            Tokens that do not parse as codes are kept unchanged in `unparsed`.
+        """
+        findings = []
+        parsed = []
+        unparsed = []
+        for code in codes:
+            item = code if isinstance(code, ParsedCode) else parse_code(code)
+            if item is None:
+                findings.append(Finding("format", WARNING, str(code), "Not a CPT code; kept unchanged without rule checks"))
+                unparsed.append(str(code))
+                continue
+            if self.catalog is not None and item.code not in self.catalog:
+                findings.append(Finding("catalog", WARNING, item.code, "Code is not in the local CPT catalog"))
+            parsed.append(item)
+
+        bilateral = any(term in scenario_text.lower() for term in BILATERAL_TERMS)
+        parsed = self._merge_duplicates(parsed, bilateral, findings)
+        parsed = self._apply_bundling(parsed, findings)
+        parsed = self._sequence(parsed, findings)
+        parsed = self._apply_multiple_procedure_modifiers(parsed, findings)
+        self._check_bilateral(parsed, bilateral, findings)
+        return RuleResult(parsed, findings, unparsed)
+
+    def _merge_duplicates(self, codes, bilateral, findings):
+        merged = []
+        seen = {}
+        for code in codes:
+            if code.code not in seen:
+                seen[code.code] = len(merged)
+                merged.append(code)
+                continue
+            index = seen[code.code]
+            if bilateral:
+                # -50 replaces the side modifiers: -RT/-LT together with -50 is invalid
+                merged[index] = _with_modifiers(merged[index], add=("50",), remove=("RT", "LT"))
+                findings.append(Finding("bilateral", FIXED, code.code,
+                                        "Same procedure on both sides reported once with modifier -50"))
+            else:
+                findings.append(Finding("duplicate", FIXED, code.code, "Duplicate code removed"))
+        return merged
+
+    def _apply_bundling(self, codes, findings):
+        dropped = set()
+        result = []
+        for code in codes:
+            # In code order, so the column 1 code a finding names does not depend on set ordering
+            for other in (item.code for item in codes if item.code != code.code):
+                pair = self.edits.get((other, code.code))
+                if pair is None or other in dropped:
+                    continue
+                if pair.modifier_indicator == 0 and self.enforce_bundling:
+                    dropped.add(code.code)
+                    findings.append(Finding("bundling", FIXED, code.code,
+                                            f"Bundled into {other} and removed: {pair.rationale}"))
+                    break
+                if pair.modifier_indicator == 0:
+                    findings.append(Finding("bundling", WARNING, code.code,
+                                            f"Bundled into {other}; not reported separately ({pair.rationale})"))
+                    break
+                if not DISTINCT_MODIFIERS & set(code.modifiers):
+                    findings.append(Finding("bundling", WARNING, code.code,
+                                            f"Normally bundled into {other}; report with -59 only if performed "
+                                            f"at a distinct site or session ({pair.rationale})"))
+            if code.code not in dropped:
+                result.append(code)
+        return result
+
+    def _sequence(self, codes, findings):
+        ordered = sorted(codes, key=lambda code: -self.weight(code.code))
+        if [c.code for c in ordered] != [c.code for c in codes]:
+            findings.append(Finding("sequencing", FIXED, ordered[0].code,
+                                    "Codes re-sequenced with the most resource-intensive procedure first"))
+        return ordered
+
+    def _is_add_on(self, code):
+        entry = self.catalog.get(code) if self.catalog is not None else None
+        return entry is not None and is_add_on(entry)
+
+    def _apply_multiple_procedure_modifiers(self, codes, findings):
+        result = []
+        for index, code in enumerate(codes):
+            if self._is_add_on(code.code):
+                if "51" in code.modifiers:
+                    code = _with_modifiers(code, remove=("51",))
+                    findings.append(Finding("modifier_51", FIXED, code.code,
+                                            "Removed -51 from an add-on code, which is exempt from it"))
+            elif index == 0 and "51" in code.modifiers:
+                code = _with_modifiers(code, remove=("51",))
+                findings.append(Finding("modifier_51", FIXED, code.code,
+                                        "Removed -51 from the primary procedure"))
+            elif index > 0 and "51" not in code.modifiers and "50" not in code.modifiers and self.add_modifier_51:
+                code = _with_modifiers(code, add=("51",))
+                findings.append(Finding("modifier_51", FIXED, code.code,
+                                        "Added -51 to a secondary procedure in the same session"))
+            elif index > 0 and "51" not in code.modifiers and "50" not in code.modifiers:
+                findings.append(Finding("modifier_51", WARNING, code.code,
+                                        "Secondary procedure in the same session without -51; add it unless "
+                                        "the payer applies the multiple procedure reduction itself"))
+            result.append(code)
+        return result
+
+    def _check_bilateral(self, codes, bilateral, findings):
+        for code in codes:
+            if "50" in code.modifiers and not bilateral:
+                findings.append(Finding("bilateral", WARNING, code.code,
+                                        "Modifier -50 used but the scenario does not describe a bilateral procedure"))
+        if bilateral and len(codes) == 1 and "50" not in codes[0].modifiers:
+            findings.append(Finding("bilateral", WARNING, codes[0].code,
+                                    "Scenario describes a bilateral procedure; add -50 unless the code is "
+                                    "inherently bilateral"))
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path) if path else None
+    except OSError:
+        return None
+
+
+_engines = {}
+_engine_lock = threading.Lock()
+
+
+def get_rule_engine(catalog):
+    """Return a RuleEngine for this catalog, rebuilt when the catalog or rule files change"""
+    edits_path = settings.CPT_NCCI_EDITS_PATH
+    weights_path = settings.CPT_CODE_WEIGHTS_PATH
+    version = catalog.version if catalog is not None else None
+    key = (_mtime(edits_path), _mtime(weights_path), settings.CPT_NCCI_EDITS_ENFORCE, settings.CPT_RULES_ADD_MODIFIER_51)
+
+    with _engine_lock:
+        cached = _engines.get(version)
+        if cached is None or cached[0] != key:
+            edits = load_edit_table(edits_path) if key[0] is not None else {}
+            weights = load_code_weights(weights_path) if key[1] is not None else {}
+            # Engines are kept per catalog version so alternating specialty shards don't rebuild them
+            if cached is None and len(_engines) >= 8:
+                _engines.pop(next(iter(_engines)))
+            cached = _engines[version] = (key, RuleEngine(catalog, edits, weights, settings.CPT_CATEGORY_WEIGHTS,
+                                                          enforce_bundling=settings.CPT_NCCI_EDITS_ENFORCE,
+                                                          add_modifier_51=settings.CPT_RULES_ADD_MODIFIER_51))
+        return cached[1]
@@ -0,0 +1,385 @@
+"""
+Nearest-neighbor index over previously coded scenarios.
+
+Operative notes that differ only in patient details usually map to the same
+codes. Each validated, high-confidence result is embedded with a CPU-only
+hashed n-gram vector (stemmed words, numbers and word pairs, with ages and
+patient-detail words dropped) and appended to an on-disk index. The
+features keep what changes the code: "with"/"without", laterality and
+measurements or counts ("2 cm", "3 stones"). Before the
+analyzer runs, the pipeline looks up the closest prior scenarios: above
+REUSE_THRESHOLD the prior answer is returned with a `semantic_match` flag,
+above FEW_SHOT_THRESHOLD the matches are shown to the analyzer as examples.
+
+Vectors live in a flat float32 file opened with numpy.memmap, so a worker
+only pages in what it reads and other workers' inserts are picked up by
+re-mapping the grown file. Small indexes are scanned exactly; larger ones
+use random-hyperplane LSH tables to pick candidates first. numpy comes with
+pandas; it is imported with the first embedding, so workers running with
+the index disabled never load it.
+"""
+import json
+import logging
+import math
+import os
+import re
+import sys
+import threading
+import time
+import zlib
+from collections import Counter as TermCounter
+
+from django.conf import settings
+
+from .metrics import CallbackMetric, Counter, registry
+from .retrieval import STOPWORDS, TOKEN_RE, _stem, tokenize
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process appends only
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Bump when features() changes; an index built with other features is discarded
+FEATURES_VERSION = 2
+# Words that describe the patient rather than the procedure
+PATIENT_TERMS = frozenset(tokenize(
+    "year years old month months male female man woman boy girl patient pt yo gentleman lady "
+    "mr mrs ms his her he she history presents presented"
+))
+# Stopwords that change the procedure ("with" vs "without" stent insertion), kept as features
+KEPT_STOPWORDS = frozenset({"with", "without"})
+# A number followed by one of these words (or after 'age') is the patient's age, not a measurement
+AGE_UNITS = frozenset({"year", "years", "yr", "yrs", "yo", "month", "months", "week", "weeks", "day", "days"})
+AGE_TOKEN_RE = re.compile(r"^\d+(?:yo|y|yr|yrs|mo)$")
+# Up to this many rows every lookup is an exact scan; above it LSH picks the candidates
+EXACT_SCAN_LIMIT = 5000
+LSH_TABLES = 8
+LSH_BITS = 12
+LSH_SEED = 1729
+# Seconds between checks for rows appended by other processes
+REFRESH_INTERVAL = 5.0
+
+# numpy, once _numpy() has imported it
+np = None
+
+SEMANTIC_LOOKUPS = registry.register(Counter(
+    "cpt_semantic_lookups_total", "Semantic index lookups by outcome", ("outcome",)))
+
+
+def feature_tokens(text):
+    """
+    Stemmed words and numbers of a scenario, without ages and patient details
+
+    Unlike retrieval.tokenize this keeps "with"/"without" and numbers, so
+    scenarios that differ in them do not embed as the same one.
+    """
+    words = TOKEN_RE.findall(text.lower())
+    terms = []
+    for index, word in enumerate(words):
+        if word.isdigit():
+            following = words[index + 1] if index + 1 < len(words) else ""
+            if following in AGE_UNITS or (index and words[index - 1] in ("age", "aged")):
+                continue
+            terms.append(word)
+        elif AGE_TOKEN_RE.match(word) or (word in STOPWORDS and word not in KEPT_STOPWORDS):
+            continue
+        else:
+            term = _stem(word)
+            if term not in PATIENT_TERMS:
+                terms.append(term)
+    return terms
+
+
+def features(text):
+    """Feature tokens and adjacent token pairs"""
+    terms = feature_tokens(text)
+    return terms + [f"{a} {b}" for a, b in zip(terms, terms[1:])]
+
+
+def _numpy():
+    global np
+
+    if np is None:
+        import numpy
+
+        np = numpy
+    return np
+
+
+def embed(text, dimensions):
+    """Unit-length signed feature-hashing vector (log-scaled term counts)"""
+    np = _numpy()
+    vector = np.zeros(dimensions, dtype=np.float32)
+    for feature, count in TermCounter(features(text)).items():
+        digest = zlib.crc32(feature.encode("utf-8"))
+        vector[digest % dimensions] += (1.0 + math.log(count)) * (1.0 if digest & 0x80000000 else -1.0)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class SemanticIndex:
+    """
+    Append-only vector index with JSONL payloads
+
+    Files in `path`: meta.json (dimensions, features version), vectors.f32
+    (row-major float32) and entries.jsonl (one payload per row). Only row
+    offsets and catalog versions are kept in memory; payloads are read from
+    disk for the few rows a lookup returns.
+    """
+
+    def __init__(self, path, dimensions=1024):
+        # Every method below uses the module-level np imported here
+        _numpy()
+        self.path = str(path)
+        self.dimensions = dimensions
+        self.vectors_path = os.path.join(self.path, "vectors.f32")
+        self.entries_path = os.path.join(self.path, "entries.jsonl")
+        self._lock = threading.RLock()
+        rng = np.random.default_rng(LSH_SEED)
+        self._planes = rng.standard_normal((LSH_TABLES * LSH_BITS, dimensions)).astype(np.float32)
+        self._powers = (1 << np.arange(LSH_BITS)).astype(np.int64)
+        os.makedirs(self.path, exist_ok=True)
+        self._check_meta()
+        self._load()
+
+    def _check_meta(self):
+        meta_path = os.path.join(self.path, "meta.json")
+        meta = {"dimensions": self.dimensions, "features_version": FEATURES_VERSION}
+        try:
+            with open(meta_path, encoding="utf-8") as handle:
+                stored = json.load(handle)
+        except (OSError, ValueError):
+            stored = None
+        if stored != meta:
+            if stored is not None:
+                logger.warning("Discarding semantic index %s built with %s (now %s)", self.path, stored, meta)
+            for name in (self.vectors_path, self.entries_path):
+                if os.path.exists(name):
+                    os.remove(name)
+            with open(meta_path, "w", encoding="utf-8") as handle:
+                json.dump(meta, handle)
+
+    def _load(self):
+        """(Re)map the vectors file and index the rows that have both a vector and a payload"""
+        row_bytes = self.dimensions * 4
+        offsets, catalogs = [], []
+        with open(self.entries_path, "a+b") as handle:
+            if fcntl is not None:
+                fcntl.flock(handle, fcntl.LOCK_EX)
+            try:
+                handle.seek(0)
+                offset = 0
+                for line in handle:
+                    if not line.endswith(b"\n"):
+                        break  # a torn last line from a crashed writer
+                    try:
+                        catalogs.append(sys.intern(json.loads(line).get("catalog_version", "")))
+                    except ValueError:
+                        break
+                    offsets.append(offset)
+                    offset += len(line)
+                vector_rows = os.path.getsize(self.vectors_path) // row_bytes if os.path.exists(self.vectors_path) else 0
+                rows = min(len(offsets), vector_rows)
+                # A writer that crashed between the two appends leaves the files out of step; cut both back
+                entries_end = offsets[rows] if rows < len(offsets) else offset
+                if entries_end != handle.seek(0, os.SEEK_END):
+                    handle.truncate(entries_end)
+                if vector_rows != rows or (os.path.exists(self.vectors_path)
+                                           and os.path.getsize(self.vectors_path) != rows * row_bytes):
+                    os.truncate(self.vectors_path, rows * row_bytes)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(handle, fcntl.LOCK_UN)
+        self._mapped = (np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(rows, self.dimensions))
+                        if rows else np.zeros((0, self.dimensions), dtype=np.float32))
+        self._fresh = np.zeros((16, self.dimensions), dtype=np.float32)
+        self._fresh_rows = 0
+        self._offsets = offsets[:rows]
+        self._catalogs = catalogs[:rows]
+        self._buckets = [dict() for _ in range(LSH_TABLES)]
+        for start in range(0, rows, 4096):
+            self._add_to_buckets(start, self._mapped[start:start + 4096])
+        self._vectors_size = rows * row_bytes
+        self._checked_at = time.monotonic()
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def _signatures(self, vectors):
+        bits = (np.asarray(vectors) @ self._planes.T) > 0
+        return bits.reshape(len(bits), LSH_TABLES, LSH_BITS).astype(np.int64) @ self._powers
+
+    def _add_to_buckets(self, first_row, vectors):
+        for row, signature in enumerate(self._signatures(vectors), start=first_row):
+            for table, key in enumerate(signature):
+                self._buckets[table].setdefault(int(key), []).append(row)
+
+    def _vectors(self, rows):
+        mapped = len(self._mapped)
+        return np.stack([self._mapped[row] if row < mapped else self._fresh[row - mapped] for row in rows])
+
+    def refresh(self):
+        """Pick up rows appended by other processes since the last check"""
+        if time.monotonic() - self._checked_at < REFRESH_INTERVAL:
+            return
+        with self._lock:
+            self._checked_at = time.monotonic()
+            if os.path.exists(self.vectors_path) and os.path.getsize(self.vectors_path) != self._vectors_size:
+                self._load()
+
+    def add(self, text, payload):
+        """Embed `text` and append it with its JSON payload; returns the new row number"""
+        vector = embed(text, self.dimensions)
+        line = (json.dumps(payload) + "\n").encode("utf-8")
+        with self._lock:
+            with open(self.entries_path, "ab") as entries, open(self.vectors_path, "ab") as vectors:
+                if fcntl is not None:
+                    fcntl.flock(entries, fcntl.LOCK_EX)
+                try:
+                    offset = entries.seek(0, os.SEEK_END)
+                    entries.write(line)
+                    entries.flush()
+                    vectors.write(vector.tobytes())
+                    vectors.flush()
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(entries, fcntl.LOCK_UN)
+            self._vectors_size += vector.nbytes
+            if self._fresh_rows == len(self._fresh):
+                self._fresh = np.concatenate([self._fresh, np.zeros_like(self._fresh)])
+            self._fresh[self._fresh_rows] = vector
+            self._fresh_rows += 1
+            row = len(self._offsets)
+            self._offsets.append(offset)
+            self._catalogs.append(sys.intern(payload.get("catalog_version", "")))
+            self._add_to_buckets(row, vector[None, :])
+        return row
+
+    def _candidates(self, vector):
+        if len(self) <= EXACT_SCAN_LIMIT:
+            return None
+        rows = set()
+        for table, key in enumerate(self._signatures(vector[None, :])[0]):
+            rows.update(self._buckets[table].get(int(key), ()))
+        return sorted(rows)
+
+    def search(self, text, k=3, min_similarity=0.0):
+        """
+        Closest stored scenarios by cosine similarity
+
+        Returns:
+            list: (similarity, row) pairs, best first
+        """
+        self.refresh()
+        vector = embed(text, self.dimensions)
+        with self._lock:
+            if not len(self) or not vector.any():
+                return []
+            rows = self._candidates(vector)
+            if rows is None:
+                similarities = np.concatenate([self._mapped @ vector, self._fresh[:self._fresh_rows] @ vector])
+                rows = np.arange(len(similarities))
+            elif rows:
+                similarities = self._vectors(rows) @ vector
+                rows = np.asarray(rows)
+            else:
+                return []
+        best = np.argsort(-similarities)[:k]
+        return [(float(similarities[i]), int(rows[i])) for i in best if similarities[i] >= min_similarity]
+
+    def entry(self, row):
+        """The payload stored for a row"""
+        with open(self.entries_path, "rb") as handle:
+            handle.seek(self._offsets[row])
+            return json.loads(handle.readline())
+
+    def catalog_version(self, row):
+        return self._catalogs[row]
+
+
+def stored_payload(scenario_text, result):
+    """What the index keeps for a result: the scenario for few-shot prompts and the result for reuse"""
+    pipeline = result.get("pipeline") or {}
+    return {
+        "scenario": scenario_text.strip()[:2000],
+        "final_cpt_code": result.get("final_cpt_code", ""),
+        "final_description": result.get("final_description", ""),
+        "catalog_version": pipeline.get("catalog_version", ""),
+        "result": {name: value for name, value in result.items() if name not in ("trace", "cached", "coalesced")},
+    }
+
+
+class SemanticLookup:
+    """Outcome of a lookup: a prior result to reuse, or examples for the analyzer prompt"""
+
+    def __init__(self, reuse=None, similarity=0.0, examples=()):
+        self.reuse = reuse
+        self.similarity = similarity
+        self.examples = list(examples)
+
+    @property
+    def outcome(self):
+        if self.reuse is not None:
+            return "reuse"
+        return "few_shot" if self.examples else "miss"
+
+
+def semantic_settings():
+    return dict(getattr(settings, "CPT_SEMANTIC_CACHE", None) or {})
+
+
+def lookup(index, scenario_text, catalog_version, allow_reuse=True):
+    """
+    Find prior answers for a scenario
+
+    A prior result is only reused when it was produced with the same catalog
+    version; older matches can still serve as few-shot examples.
+    """
+    config = semantic_settings()
+    few_shot_threshold = config.get("FEW_SHOT_THRESHOLD", 0.6)
+    reuse_threshold = config.get("REUSE_THRESHOLD")
+    matches = index.search(scenario_text, k=max(1, config.get("FEW_SHOT_EXAMPLES", 2)),
+                           min_similarity=few_shot_threshold)
+    result = SemanticLookup()
+    if matches and allow_reuse and reuse_threshold is not None:
+        similarity, row = matches[0]
+        if similarity >= reuse_threshold and index.catalog_version(row) == catalog_version:
+            result = SemanticLookup(reuse=index.entry(row), similarity=similarity)
+    if result.reuse is None and matches:
+        entries = [index.entry(row) for _, row in matches]
+        result = SemanticLookup(similarity=matches[0][0], examples=[
+            {"scenario": entry["scenario"], "cpt_code": entry["final_cpt_code"],
+             "description": entry["final_description"]}
+            for entry in entries
+        ])
+    SEMANTIC_LOOKUPS.inc(outcome=result.outcome)
+    return result
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_semantic_index():
+    """Process-wide index configured by settings.CPT_SEMANTIC_CACHE; None when disabled"""
+    global _index
+
+    if _index is None:
+        with _index_lock:
+            config = semantic_settings()
+            if _index is None and config.get("ENABLED"):
+                _index = SemanticIndex(config["PATH"], dimensions=config.get("DIMENSIONS", 1024))
+    return _index
+
+
+def reset_semantic_index():
+    global _index
+    with _index_lock:
+        _index = None
+
+
+registry.register(CallbackMetric(
+    "cpt_semantic_index_rows", "Scenarios in this worker's semantic index",
+    callback=lambda: {(): len(_index)} if _index is not None else {}))
@@ -0,0 +1,113 @@
+"""
+Speculative second opinion for the 'speculative' pipeline mode.
+
+The second-opinion agent (cpt_analyzer.agents.CPTSecondOpinionAgent) codes
+the scenario on its own, started alongside the analyzer instead of after
+it. Once both have answered, cpt_analyzer.checks.reconcile compares them
+locally: when they agree the answer is accepted without the validator, so
+the request takes about as long as the slower of the two calls rather than
+analyzer plus validator. Only disagreements pay for the sequential
+validator call.
+
+saved_ms estimates the time saved against the full mode, with the second
+opinion's latency standing in for the validator call it replaces: on
+agreement it is the shorter of the two calls; on disagreement it is minus
+the time spent waiting for the second opinion after the analyzer finished.
+"""
+import asyncio
+import logging
+import time
+
+from .agents import CPTSecondOpinionAgent, stage_options
+from .checks import reconcile
+from .metrics import Counter, registry, timed
+
+logger = logging.getLogger(__name__)
+
+SPECULATIONS = registry.register(Counter(
+    "cpt_speculative_total", "Speculative second opinions by outcome (agreed, disagreed, error)", ("outcome",)))
+SPECULATION_SAVED = registry.register(Counter(
+    "cpt_speculative_saved_seconds_total", "Estimated seconds saved by second opinions that agreed"))
+
+
+def _elapsed_ms(started):
+    return round((time.monotonic() - started) * 1000, 1)
+
+
+class Speculation:
+    """A second opinion running alongside the analyzer, and how it compared"""
+
+    def __init__(self, catalog, scenario_text, examples=(), guidance=()):
+        self.catalog = catalog
+        self.model = stage_options("second_opinion")["model"]
+        self.started = time.monotonic()
+        self.analyzer_ms = None
+        self.second_opinion_ms = None
+        self.second_opinion = None
+        self.reconciliation = None
+        # The task copies the current context, so its stage timings land in the active trace
+        self._task = asyncio.ensure_future(self._run(scenario_text, examples, guidance))
+
+    async def _run(self, scenario_text, examples, guidance):
+        try:
+            agent = CPTSecondOpinionAgent(self.catalog)
+            return await agent.aanalyze_scenario(scenario_text, examples=examples, guidance=guidance)
+        finally:
+            self.second_opinion_ms = _elapsed_ms(self.started)
+
+    def analyzer_done(self):
+        self.analyzer_ms = _elapsed_ms(self.started)
+
+    def cancel(self):
+        """Stop the second opinion when the request ends before it is needed"""
+        if not self._task.done():
+            self._task.cancel()
+
+    async def reconcile(self, analyzer_result):
+        """Wait for the second opinion and compare it with the analyzer's answer"""
+        with timed("second_opinion.wait"):
+            self.second_opinion = await self._task
+        with timed("reconcile"):
+            self.reconciliation = reconcile(self.catalog, analyzer_result, self.second_opinion)
+        return self.reconciliation
+
+    @property
+    def agreed(self):
+        return self.reconciliation is not None and self.reconciliation.agreed
+
+    @property
+    def outcome(self):
+        if self.second_opinion is None or "error" in self.second_opinion:
+            return "error"
+        return "agreed" if self.agreed else "disagreed"
+
+    @property
+    def saved_ms(self):
+        if self.analyzer_ms is None or self.second_opinion_ms is None:
+            return 0.0
+        if self.agreed:
+            return min(self.analyzer_ms, self.second_opinion_ms)
+        return -max(0.0, round(self.second_opinion_ms - self.analyzer_ms, 1))
+
+    def record(self):
+        """Count the outcome and the time saved"""
+        SPECULATIONS.inc(outcome=self.outcome)
+        if self.saved_ms > 0:
+            SPECULATION_SAVED.inc(self.saved_ms / 1000)
+        logger.debug("Second opinion %s (%s): analyzer %s ms, second opinion %s ms, saved %s ms",
+                     self.outcome, "; ".join(self.reconciliation.reasons) if self.reconciliation else "not run",
+                     self.analyzer_ms, self.second_opinion_ms, self.saved_ms)
+
+    def as_dict(self):
+        second_opinion = self.second_opinion or {}
+        return {
+            "outcome": self.outcome,
+            "agreed": self.agreed,
+            "reasons": self.reconciliation.reasons if self.reconciliation else [],
+            "model": self.model,
+            "second_opinion_code": second_opinion.get("cpt_code"),
+            "second_opinion_confidence": second_opinion.get("confidence"),
+            "analyzer_ms": self.analyzer_ms,
+            "second_opinion_ms": self.second_opinion_ms,
+            "saved_ms": self.saved_ms,
+        }
@@ -0,0 +1,150 @@
+"""
+Startup time and per-worker memory measurements.
+
+`python -m cpt_analyzer.startup` runs in a fresh interpreter: it times
+django.setup(), importing the views and warming up, records the resident set
+size after each step and which heavy modules got imported, and writes the
+result as JSON to the --output file. With --workers N it then forks N workers the way gunicorn
+--preload does and reports each worker's RSS, proportional set size (PSS)
+and the part shared with the master. `manage.py bench_startup` runs it
+several times and summarizes.
+
+Memory figures come from /proc and are None on platforms without it.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Modules the request path should only import when it needs them
+HEAVY_MODULES = ("pandas", "openpyxl", "numpy", "openai", "httpx")
+
+
+def memory_usage(pid="self"):
+    """{'rss_kb', 'pss_kb', 'shared_kb'} of a process from /proc (None values where unavailable)"""
+    usage = {"rss_kb": None, "pss_kb": None, "shared_kb": None}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as handle:
+            fields = dict(line.split(":", 1) for line in handle if ":" in line and not line.startswith(" "))
+    except OSError:
+        fields = {}
+    kb = lambda name: int(fields[name].split()[0]) if name in fields else None
+    usage["rss_kb"], usage["pss_kb"] = kb("Rss"), kb("Pss")
+    if "Shared_Clean" in fields:
+        usage["shared_kb"] = kb("Shared_Clean") + kb("Shared_Dirty")
+    if usage["rss_kb"] is None:
+        try:
+            with open(f"/proc/{pid}/status") as handle:
+                usage["rss_kb"] = next(int(line.split()[1]) for line in handle if line.startswith("VmRSS:"))
+        except (OSError, StopIteration):
+            pass
+    return usage
+
+
+def probe(warm=True, workers=0):
+    """Measure this (fresh) interpreter's startup; fork `workers` preloaded workers afterwards"""
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "medical_coding.settings")
+    steps = []
+    started = time.perf_counter()
+
+    def step(name):
+        steps.append({"step": name, "seconds": round(time.perf_counter() - started, 4), **memory_usage()})
+
+    import django
+
+    django.setup()
+    step("django.setup")
+    import cpt_analyzer.views  # noqa: F401
+
+    step("import views")
+    heavy = [name for name in HEAVY_MODULES if name in sys.modules]
+    if warm:
+        from cpt_analyzer.warmup import warm_up
+
+        warm_up(freeze=bool(workers))
+        step("warm up")
+    report = {"steps": steps, "heavy_modules_at_import": heavy, "workers": []}
+    if workers:
+        report["workers"] = _fork_workers(workers)
+    return report
+
+
+def _fork_workers(count):
+    """Fork preloaded workers that handle one retrieval each, then measure and stop them"""
+    from cpt_analyzer.catalog import get_catalog
+    from cpt_analyzer.retrieval import select_candidates
+
+    ready_read, ready_write = os.pipe()
+    pids = []
+    for _ in range(count):
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_read)
+            select_candidates(get_catalog(), "Cystourethroscopy with fulguration of a small bladder tumor", 20)
+            os.write(ready_write, b".")
+            time.sleep(60)
+            os._exit(0)
+        pids.append(pid)
+    os.close(ready_write)
+    received = 0
+    while received < count:
+        chunk = os.read(ready_read, count)
+        if not chunk:
+            break
+        received += len(chunk)
+    measured = [dict(memory_usage(pid), pid=pid) for pid in pids]
+    for pid in pids:
+        os.kill(pid, 15)
+        os.waitpid(pid, 0)
+    return measured
+
+
+def run_probe(warm=True, workers=0, env=None):
+    """Run probe() in a fresh interpreter and return its report"""
+    # The report goes to a file, so nothing the probed code writes to stdout can corrupt it
+    with tempfile.TemporaryDirectory() as directory:
+        output = os.path.join(directory, "report.json")
+        args = ([sys.executable, "-m", "cpt_analyzer.startup", "--output", output]
+                + ([] if warm else ["--no-warm"]) + ["--workers", str(workers)])
+        subprocess.run(args, capture_output=True, text=True, check=True, env=env,
+                       cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        with open(output) as handle:
+            return json.load(handle)
+
+
+def summarize(reports):
+    """Median seconds and RSS per step, and mean per-worker memory, over several probe reports"""
+    steps = {}
+    for report in reports:
+        for entry in report["steps"]:
+            steps.setdefault(entry["step"], []).append(entry)
+    workers = [worker for report in reports for worker in report["workers"]]
+    mean = lambda name: round(statistics.fmean(w[name] for w in workers)) if workers and workers[0][name] is not None else None
+    return {
+        "runs": len(reports),
+        "steps": [
+            {"step": name, "seconds": statistics.median(e["seconds"] for e in entries),
+             "rss_kb": statistics.median(e["rss_kb"] or 0 for e in entries)}
+            for name, entries in steps.items()
+        ],
+        "heavy_modules_at_import": reports[0]["heavy_modules_at_import"] if reports else [],
+        "worker_rss_kb": mean("rss_kb"),
+        "worker_pss_kb": mean("pss_kb"),
+        "worker_shared_kb": mean("shared_kb"),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--no-warm", action="store_true", help="Skip the warm-up step")
+    parser.add_argument("--workers", type=int, default=0, help="Fork this many preloaded workers and measure them")
+    parser.add_argument("--output", required=True, help="File to write the JSON report to")
+    options = parser.parse_args()
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    report = probe(warm=not options.no_warm, workers=options.workers)
+    with open(options.output, "w") as handle:
+        json.dump(report, handle)
@@ -1,3 +1,1768 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+from django.test import AsyncClient, TestCase, override_settings
+
+from . import catalog as catalog_module
+from .cache import LocalLRUBackend, ResultCache, SQLiteBackend, make_cache_key, reset_result_cache
+from .catalog import CPTCatalog, CPTEntry, CPTSection, get_catalog, read_snapshot, read_workbook, write_snapshot
+from .retrieval import CPTRetriever, load_labeled_scenarios, recall_at_k, select_candidates
+
+
+class CPTCatalogTests(TestCase):
+    def setUp(self):
+        catalog_module.reset_catalog()
+
+    def tearDown(self):
+        catalog_module.reset_catalog()
+
+    def test_workbook_is_indexed_by_code(self):
+        from django.conf import settings
+
+        catalog = read_workbook(settings.CPT_DATA_PATH)
+        self.assertIn("51725", catalog)
+        self.assertEqual(catalog.get("51725").topic, "Bladder")
+        self.assertTrue(any(section.name == "Bladder - Endoscopy" for section in catalog.sections))
+        self.assertIn("Section/Subsection", catalog.prompt_text)
+
+    def test_get_catalog_is_shared_until_source_changes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "codes.xlsx")
+            with open(source, "w") as handle:
+                handle.write("placeholder")
+            calls = []
+
+            def fake_read(path):
+                calls.append(path)
+                return CPTCatalog([CPTEntry("52000", "Cystourethroscopy", "Bladder", "Endoscopy")], [],
+                                  source_path=path, source_mtime=os.path.getmtime(path))
+
+            with override_settings(CPT_DATA_PATH=source, CPT_CATALOG_SNAPSHOT=None), \
+                    mock.patch.object(catalog_module, "read_workbook", fake_read):
+                first = get_catalog()
+                self.assertIs(get_catalog(), first)
+                os.utime(source, (0, os.path.getmtime(source) + 10))
+                self.assertIsNot(get_catalog(), first)
+            self.assertEqual(len(calls), 2)
+
+    def test_snapshot_round_trip_and_staleness(self):
+        catalog = CPTCatalog([CPTEntry("52000", "Cystourethroscopy", "Bladder", "Endoscopy")],
+                             [CPTSection("Bladder", "51020-51999")], source_mtime=123.0)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "catalog.pickle")
+            write_snapshot(catalog, path)
+            loaded = read_snapshot(path, source_mtime=123.0)
+            self.assertEqual(loaded.version, catalog.version)
+            self.assertIsNone(read_snapshot(path, source_mtime=456.0))
+
+    def test_workbook_load_compiles_the_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source, snapshot = os.path.join(tmp, "codes.xlsx"), os.path.join(tmp, "codes.pickle")
+            with open(source, "w") as handle:
+                handle.write("placeholder")
+            catalog = CPTCatalog([CPTEntry("52000", "Cystourethroscopy", "Bladder", "Endoscopy")], [],
+                                 source_path=source, source_mtime=os.path.getmtime(source))
+            with mock.patch.object(catalog_module, "read_workbook", return_value=catalog) as read:
+                catalog_module.load_catalog(source, snapshot)
+                self.assertEqual(catalog_module.load_catalog(source, snapshot).version, catalog.version)
+            self.assertEqual(read.call_count, 1)
+
+
+
+def make_catalog():
+    """Small in-memory catalog used by tests that don't need the workbook"""
+    return CPTCatalog([
+        CPTEntry("51725", "Simple cystometrogram (CMG) (e.g., spinal manometer).", "Bladder", "Urodynamics"),
+        CPTEntry("51702", "Insertion of temporary indwelling bladder catheter, simple (e.g., Foley).", "Bladder", "Introduction"),
+        CPTEntry("50590", "Lithotripsy, extracorporeal shock wave", "Kidney", "Endoscopy"),
+        CPTEntry("50080", "Percutaneous nephrolithotomy or pyelolithotomy, endoscopic, stones <= 2 cm.", "Kidney", "Incision"),
+        CPTEntry("53200", "Biopsy of urethra", "Urethra", "Excision"),
+    ], [CPTSection("Bladder", "51020-51999")])
+
+
+class CPTRetrievalTests(TestCase):
+    def test_ranks_matching_description_first(self):
+        retriever = CPTRetriever(make_catalog())
+        self.assertEqual(retriever.search("Foley catheter placed", 1)[0][0], "51702")
+        self.assertEqual(retriever.search("ESWL for a kidney stone", 1)[0][0], "50590")
+
+    def test_exact_code_mentions_are_always_included(self):
+        retriever = CPTRetriever(make_catalog())
+        self.assertEqual(retriever.search("Coded previously as 53200, now a cystometrogram", 1)[0][0], "53200")
+
+    def test_select_candidates_keeps_extra_codes_and_falls_back(self):
+        catalog = make_catalog()
+        codes = [e.code for e in select_candidates(catalog, "simple cystometrogram", 1, extra_codes=["50080"])]
+        self.assertEqual(codes, ["51725", "50080"])
+        self.assertEqual(len(select_candidates(catalog, "zzz", 3)), len(catalog))
+
+    def test_recall_on_labeled_scenarios(self):
+        from django.conf import settings
+
+        catalog = read_workbook(settings.CPT_DATA_PATH)
+        labeled = load_labeled_scenarios(settings.CPT_LABELED_SCENARIOS)
+        self.assertGreaterEqual(recall_at_k(catalog, labeled, settings.CPT_PROMPT_TOP_K), 0.9)
+
+
+ANALYZER_RESULT = {"cpt_code": "51729, 51785-51", "description": "Complex CMG; needle EMG", "explanation": "Two procedures."}
+VALIDATOR_RESULT = dict(ANALYZER_RESULT, confidence="High")
+
+
+@override_settings(OPENAI_API_KEY="test-key")
+class AnalyzeViewTests(TestCase):
+    def setUp(self):
+        reset_result_cache()
+        self.addCleanup(reset_result_cache)
+        patches = [
+            mock.patch("cpt_analyzer.agents.CPTAnalyzerAgent.aanalyze_scenario", return_value=ANALYZER_RESULT),
+            mock.patch("cpt_analyzer.agents.CPTValidatorAgent.avalidate_cpt_code", return_value=VALIDATOR_RESULT),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    async def test_json_response(self):
+        response = await AsyncClient().post("/analyze/", {"scenario": "CMG with EMG"}, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["cpt_codes"], ["51729", "51785-51"])
+        self.assertTrue(data["has_multiple_codes"])
+        self.assertEqual(data["confidence"], "High")
+
+    async def test_ndjson_stream_sends_analyzer_result_first(self):
+        response = await AsyncClient().post(
+            "/analyze/", {"scenario": "CMG with EMG"}, content_type="application/json",
+            headers={"Accept": "application/x-ndjson"},
+        )
+        body = b"".join([chunk async for chunk in response.streaming_content]).decode()
+        events = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual([e["event"] for e in events], ["preprocessed", "analyzer", "result"])
+        self.assertGreater(events[0]["data"]["estimate"]["total_tokens"], 0)
+        self.assertEqual(events[1]["data"]["confidence"], "Pending validation")
+        self.assertEqual(events[2]["data"]["final_cpt_code"], "51729, 51785-51")
+
+    async def test_missing_scenario(self):
+        response = await AsyncClient().post("/analyze/", {}, content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+    async def test_trace_id_and_server_timing(self):
+        response = await AsyncClient().post("/analyze/", {"scenario": "CMG with EMG"}, content_type="application/json",
+                                            headers={"X-Request-ID": "req-123"})
+        self.assertEqual(response["X-Trace-Id"], "req-123")
+        self.assertEqual(response.json()["trace"]["id"], "req-123")
+        self.assertIn("rules;dur=", response["Server-Timing"])
+
+
+class ResultCacheTests(TestCase):
+    def test_key_ignores_whitespace_and_case_but_not_catalog(self):
+        key = make_cache_key("Simple  CMG\n performed", "v1", ["gpt-4o"], "2")
+        self.assertEqual(key, make_cache_key("simple cmg performed ", "v1", ["gpt-4o"], "2"))
+        self.assertNotEqual(key, make_cache_key("simple cmg performed", "v2", ["gpt-4o"], "2"))
+
+    def test_lru_evicts_least_recently_used_and_expires(self):
+        backend = LocalLRUBackend(max_entries=2)
+        backend.set("a", {"n": 1})
+        backend.set("b", {"n": 2})
+        backend.get("a")
+        backend.set("c", {"n": 3})
+        self.assertIsNone(backend.get("b"))
+        self.assertEqual(backend.get("a"), {"n": 1})
+
+        expiring = LocalLRUBackend(ttl=10)
+        expiring.set("a", {"n": 1})
+        with mock.patch("cpt_analyzer.cache.time.time", return_value=10 ** 12):
+            self.assertIsNone(expiring.get("a"))
+
+    def test_sqlite_backend_bounds_size(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            backend = SQLiteBackend(max_entries=2, path=os.path.join(tmp, "cache.sqlite3"))
+            for name in "abc":
+                backend.set(name, {"code": name})
+            self.assertIsNone(backend.get("a"))
+            self.assertEqual(backend.get("c"), {"code": "c"})
+
+    def test_counts_hits_and_misses(self):
+        cache = ResultCache(LocalLRUBackend())
+        cache.get("missing")
+        cache.set("key", {"x": 1})
+        cache.get("key")
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+
+@override_settings(OPENAI_API_KEY="test-key")
+class PipelineCacheTests(TestCase):
+    def setUp(self):
+        reset_result_cache()
+        self.addCleanup(reset_result_cache)
+
+    def test_resubmission_is_served_from_cache_unless_bypassed(self):
+        from .pipeline import run_pipeline
+
+        with mock.patch("cpt_analyzer.agents.CPTAnalyzerAgent.aanalyze_scenario", return_value=ANALYZER_RESULT) as analyze, \
+                mock.patch("cpt_analyzer.agents.CPTValidatorAgent.avalidate_cpt_code", return_value=VALIDATOR_RESULT):
+            self.assertFalse(run_pipeline("CMG with EMG")["cached"])
+            self.assertTrue(run_pipeline("  cmg WITH emg ")["cached"])
+            self.assertFalse(run_pipeline("CMG with EMG", use_cache=False)["cached"])
+        self.assertEqual(analyze.call_count, 2)
+
+
+class BatchTests(TestCase):
+    def test_reads_csv_and_jsonl(self):
+        from .batch import read_scenarios
+
+        with tempfile.TemporaryDirectory() as tmp:
+            csv_path = os.path.join(tmp, "in.csv")
+            with open(csv_path, "w") as handle:
+                handle.write("id,scenario\nenc-1,Simple CMG\nenc-2,\n")
+            jsonl_path = os.path.join(tmp, "in.jsonl")
+            with open(jsonl_path, "w") as handle:
+                handle.write('{"scenario": "Foley placed"}\n')
+            self.assertEqual(read_scenarios(csv_path, "csv"), [{"id": "enc-1", "scenario": "Simple CMG"}])
+            self.assertEqual(read_scenarios(jsonl_path, "jsonl"), [{"id": "1", "scenario": "Foley placed"}])
+
+    def test_retries_rate_limited_scenarios(self):
+        from asgiref.sync import async_to_sync
+        from .batch import BatchRunner
+
+        results = [{"error": "Error analyzing scenario: 429 rate limit"}, dict(ANALYZER_RESULT, cached=False)]
+        runner = BatchRunner(concurrency=2, max_retries=2, backoff=0)
+
+        async def collect():
+            return [record async for record in runner.run([{"id": "1", "scenario": "x"}])]
+
+        with mock.patch("cpt_analyzer.batch.arun_pipeline", side_effect=results):
+            records = async_to_sync(collect)()
+        self.assertEqual(records[0]["status"], "ok")
+        self.assertEqual(records[0]["attempts"], 2)
+        self.assertEqual(runner.stats.summary()["retries"], 1)
+
+    def test_deterministic_errors_are_not_retried(self):
+        from asgiref.sync import async_to_sync
+        from .batch import BatchRunner
+
+        runner = BatchRunner(concurrency=1, max_retries=3, backoff=0)
+
+        async def collect():
+            return [record async for record in runner.run([{"id": "1", "scenario": "x"}])]
+
+        with mock.patch("cpt_analyzer.batch.arun_pipeline",
+                        return_value={"error": "Scenario exceeds the token budget", "code": "token_budget_exceeded"}) as run:
+            records = async_to_sync(collect)()
+        self.assertEqual((records[0]["status"], records[0]["attempts"], run.call_count), ("error", 1, 1))
+
+    def test_audit_is_flushed_when_the_consumer_stops_early(self):
+        from asgiref.sync import async_to_sync
+        from .batch import BatchRunner
+        from .models import Analysis
+
+        runner = BatchRunner(concurrency=1, max_retries=0, backoff=0)
+        items = [{"id": "1", "scenario": "one"}, {"id": "2", "scenario": "two"}]
+
+        async def first():
+            records = runner.run(items)
+            try:
+                return await records.__anext__()
+            finally:
+                await records.aclose()
+
+        with override_settings(CPT_AUDIT_BATCH_SIZE=100), \
+                mock.patch("cpt_analyzer.batch.arun_pipeline", return_value=dict(VALIDATOR_RESULT, cached=False)):
+            self.assertEqual(async_to_sync(first)()["status"], "ok")
+        self.assertGreaterEqual(Analysis.objects.count(), 1)
+
+    def test_command_resumes_from_existing_output(self):
+        from django.core.management import call_command
+
+        with tempfile.TemporaryDirectory() as tmp:
+            input_path = os.path.join(tmp, "in.jsonl")
+            output_path = os.path.join(tmp, "out.jsonl")
+            with open(input_path, "w") as handle:
+                handle.write('{"id": "a", "scenario": "one"}\n{"id": "b", "scenario": "two"}\n')
+            with open(output_path, "w") as handle:
+                handle.write('{"id": "a", "status": "ok", "attempts": 1, "result": {}}\n{"id": "b", "sta')
+
+            result = dict(VALIDATOR_RESULT, cached=False)
+            with mock.patch("cpt_analyzer.batch.arun_pipeline", return_value=result) as run:
+                call_command("code_scenarios", input_path, output=output_path, stdout=io.StringIO())
+            run.assert_called_once_with("two", use_cache=True, mode=None)
+            with open(output_path) as handle:
+                self.assertTrue(handle.read().splitlines()[-1].startswith('{"id": "b", "status": "ok"'))
+
+
+def chat_completion_body(content, prompt_tokens=100, completion_tokens=20, cached_tokens=0):
+    """A minimal chat completions API response"""
+    return {
+        "id": "chatcmpl-test", "object": "chat.completion", "created": 0, "model": "gpt-4o",
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens,
+                  "prompt_tokens_details": {"cached_tokens": cached_tokens}},
+    }
+
+
+class StubChatServer:
+    """Local HTTP server mimicking POST /v1/chat/completions with scripted (status, body) replies"""
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.requests = []
+        self.client_ports = set()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                stub.requests.append(json.loads(self.rfile.read(length)))
+                stub.client_ports.add(self.client_address[1])
+                status, body = stub.replies.pop(0) if len(stub.replies) > 1 else stub.replies[0]
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                if status == 429:
+                    self.send_header("Retry-After", "0")
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class OpenAIClientTests(TestCase):
+    def setUp(self):
+        from .clients import reset_clients
+
+        reset_clients()
+        self.addCleanup(reset_clients)
+
+    def test_retries_rate_limits_and_reuses_connections(self):
+        from .clients import chat_completion
+
+        ok = (200, chat_completion_body("CPT Code(s): 51725"))
+        limited = (429, {"error": {"message": "Rate limit reached", "type": "rate_limit"}})
+        with StubChatServer([limited, ok]) as stub, \
+                override_settings(OPENAI_API_KEY="test-key", OPENAI_BASE_URL=stub.url), \
+                self.assertLogs("cpt_analyzer.clients", "WARNING"):
+            first = chat_completion(model="gpt-4o", messages=[{"role": "user", "content": "hi"}])
+            chat_completion(model="gpt-4o", messages=[{"role": "user", "content": "again"}])
+
+        self.assertEqual(first.choices[0].message.content, "CPT Code(s): 51725")
+        self.assertEqual(len(stub.requests), 3)
+        self.assertEqual(len(stub.client_ports), 1)
+
+    def test_gives_up_after_max_retries(self):
+        import openai
+        from .clients import chat_completion
+
+        failing = (500, {"error": {"message": "boom"}})
+        client_settings = {"MAX_RETRIES": 1, "BACKOFF_BASE": 0}
+        with StubChatServer([failing]) as stub, \
+                override_settings(OPENAI_API_KEY="test-key", OPENAI_BASE_URL=stub.url, OPENAI_CLIENT=client_settings):
+            with self.assertRaises(openai.InternalServerError), self.assertLogs("cpt_analyzer.clients", "WARNING"):
+                chat_completion(model="gpt-4o", messages=[{"role": "user", "content": "hi"}])
+        self.assertEqual(len(stub.requests), 2)
+
+    def test_agent_calls_from_async_to_sync_share_the_pool_and_limiter(self):
+        from asgiref.sync import async_to_sync
+        from .clients import get_limiter
+
+        reply = (200, chat_completion_body("CPT Code(s): 51725\nDescription: Simple CMG\nExplanation: Basic study.",
+                                           cached_tokens=64))
+        with StubChatServer([reply]) as stub, \
+                override_settings(OPENAI_API_KEY="test-key", OPENAI_BASE_URL=stub.url):
+            from .agents import CPTAnalyzerAgent
+
+            limiter = get_limiter()
+            # Each async_to_sync call runs on a new event loop, as under WSGI and in job threads
+            result = async_to_sync(CPTAnalyzerAgent().aanalyze_scenario)("Simple cystometrogram")
+            async_to_sync(CPTAnalyzerAgent().aanalyze_scenario)("Simple cystometrogram")
+        self.assertEqual(result["cpt_code"], "51725")
+        self.assertEqual(result["usage"], {"prompt_tokens": 100, "completion_tokens": 20, "cached_tokens": 64})
+        self.assertEqual(len(stub.requests), 2)
+        self.assertEqual(len(stub.client_ports), 1)
+        self.assertIs(get_limiter(), limiter)
+        self.assertEqual(limiter.active, 0)
+
+
+class AnalyzerChecksTests(TestCase):
+    def test_single_matching_code_passes(self):
+        from .checks import check_analyzer_result
+
+        check = check_analyzer_result(make_catalog(), "Simple cystometrogram performed", {"cpt_code": "51725"})
+        self.assertTrue(check.passed, check.reasons)
+
+    def test_multi_code_unknown_code_and_modifiers_fail(self):
+        from .checks import check_analyzer_result
+
+        catalog = make_catalog()
+        scenario = "Simple cystometrogram performed"
+        self.assertIn("multiple codes", check_analyzer_result(catalog, scenario, {"cpt_code": "51725, 53200-51"}).reasons)
+        self.assertIn("52000 not in catalog", check_analyzer_result(catalog, scenario, {"cpt_code": "52000"}).reasons)
+        self.assertFalse(check_analyzer_result(catalog, scenario, {"cpt_code": "51725-50"}).passed)
+        self.assertFalse(check_analyzer_result(catalog, "Urethral biopsy", {"cpt_code": "51725"}).passed)
+
+    def test_letter_modifiers_parse(self):
+        from .checks import ParsedCode, check_analyzer_result, parse_code
+
+        self.assertEqual(parse_code("50590-lt"), ParsedCode("50590", ("LT",)))
+        self.assertEqual(parse_code("51785-51-XS"), ParsedCode("51785", ("51", "XS")))
+        self.assertIsNone(parse_code("50590-L"))
+        check = check_analyzer_result(make_catalog(), "Lithotripsy, extracorporeal shock wave, left kidney", {"cpt_code": "50590-LT"})
+        self.assertTrue(check.passed, check.reasons)
+
+
+@override_settings(OPENAI_API_KEY="test-key")
+class PipelineModeTests(TestCase):
+    def run_mode(self, mode, analyzer_result):
+        from .pipeline import run_pipeline
+
+        with mock.patch("cpt_analyzer.agents.CPTAnalyzerAgent.aanalyze_scenario", return_value=analyzer_result), \
+                mock.patch("cpt_analyzer.agents.CPTValidatorAgent.avalidate_cpt_code", return_value=VALIDATOR_RESULT) as validate:
+            result = run_pipeline("Simple cystometrogram (CMG) to evaluate the bladder", use_cache=False, mode=mode)
+        return result, validate.call_count
+
+    def test_adaptive_skips_validator_when_checks_pass(self):
+        simple = {"cpt_code": "51725", "description": "Simple CMG", "explanation": "Basic study."}
+        result, calls = self.run_mode("adaptive", simple)
+        self.assertEqual(calls, 0)
+        self.assertEqual(result["pipeline"]["path"], "analyzer+local_checks")
+        self.assertEqual(result["final_cpt_code"], "51725")
+
+    def test_adaptive_validates_multi_code_results(self):
+        result, calls = self.run_mode("adaptive", ANALYZER_RESULT)
+        self.assertEqual(calls, 1)
+        self.assertEqual(result["pipeline"]["path"], "analyzer+validator")
+
+    def test_analyzer_only_never_validates(self):
+        result, calls = self.run_mode("analyzer_only", ANALYZER_RESULT)
+        self.assertEqual(calls, 0)
+        self.assertEqual(result["confidence"], "Low")
+
+    def test_unknown_mode_is_rejected_by_view(self):
+        response = self.client.post("/analyze/", {"scenario": "x", "mode": "fast"}, content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+
+class RuleEngineTests(TestCase):
+    def engine(self):
+        from .rules import EditPair, RuleEngine
+
+        catalog = CPTCatalog([
+            CPTEntry("51725", "Simple cystometrogram (CMG)", "Bladder", "Urodynamics"),
+            CPTEntry("51729", "Cystometrogram with voiding pressure and urethral pressure profile", "Bladder", "Urodynamics"),
+            CPTEntry("51570", "Complete cystectomy", "Bladder", "Excision"),
+            CPTEntry("51702", "Insertion of temporary indwelling bladder catheter", "Bladder", "Introduction"),
+            CPTEntry("52310", "Cystourethroscopy with removal of ureteral stent", "Bladder", "Endoscopy"),
+            CPTEntry("51797", "Voiding pressure studies (List separately in addition to code for primary procedure)", "Bladder", "Urodynamics"),
+        ], [])
+        edits = {
+            ("51729", "51725"): EditPair("51729", "51725", 0, "Comprehensive CMG includes simple CMG"),
+            ("51570", "51702"): EditPair("51570", "51702", 1, "Catheter integral to cystectomy"),
+        }
+        return RuleEngine(catalog, edits, category_weights={"Excision": 8, "Endoscopy": 5, "Introduction": 3},
+                          enforce_bundling=True, add_modifier_51=True)
+
+    def test_removes_bundled_codes(self):
+        result = self.engine().apply(["51729", "51725-51"])
+        self.assertEqual(result.code_strings, ["51729"])
+        self.assertEqual(result.findings[0].rule, "bundling")
+        # The first column 1 code in the answer is named, whatever the set ordering
+        from .rules import EditPair
+
+        engine = self.engine()
+        engine.edits[("51570", "51725")] = EditPair("51570", "51725", 0, "Included in cystectomy")
+        for codes in (["51729", "51570", "51725"], ["51570", "51729", "51725"]):
+            finding = next(f for f in engine.apply(codes).findings if f.rule == "bundling")
+            self.assertIn(f"Bundled into {codes[0]} ", finding.message)
+
+    def test_bundling_only_warns_unless_enforced(self):
+        engine = self.engine()
+        engine.enforce_bundling = False
+        result = engine.apply(["51729", "51725"])
+        self.assertEqual(result.code_strings, ["51729", "51725-51"])
+        self.assertEqual((result.findings[0].rule, result.findings[0].severity), ("bundling", "warning"))
+
+    def test_add_on_codes_are_exempt_from_modifier_51(self):
+        self.assertEqual(self.engine().apply(["51729", "51797"]).code_strings, ["51729", "51797"])
+        result = self.engine().apply(["51729", "51797-51"])
+        self.assertEqual(result.code_strings, ["51729", "51797"])
+        self.assertEqual(result.findings[0].rule, "modifier_51")
+
+    def test_resequences_and_fixes_multiple_procedure_modifiers(self):
+        result = self.engine().apply(["52310-51", "51570"])
+        self.assertEqual(result.code_strings, ["51570", "52310-51"])
+        result = self.engine().apply(["51570-51", "52310"])
+        self.assertEqual(result.code_strings, ["51570", "52310-51"])
+
+    def test_modifier_51_is_only_suggested_unless_enabled(self):
+        engine = self.engine()
+        engine.add_modifier_51 = False
+        result = engine.apply(["51570", "52310"])
+        self.assertEqual(result.code_strings, ["51570", "52310"])
+        self.assertEqual([(f.rule, f.severity) for f in result.findings], [("modifier_51", "warning")])
+
+    def test_warns_on_modifier_indicator_one_pairs(self):
+        result = self.engine().apply(["51570", "51702-51"])
+        self.assertEqual(result.code_strings, ["51570", "51702-51"])
+        self.assertTrue(any(f.rule == "bundling" and f.severity == "warning" for f in result.findings))
+
+    def test_duplicate_bilateral_procedure_becomes_modifier_50(self):
+        result = self.engine().apply(["52310", "52310"], "Bilateral ureteral stent removal via cystoscopy")
+        self.assertEqual(result.code_strings, ["52310-50"])
+        self.assertEqual(self.engine().apply(["52310", "52310"], "Left stent removal").code_strings, ["52310"])
+        result = self.engine().apply(["52310-RT", "52310-LT"], "Bilateral ureteral stent removal via cystoscopy")
+        self.assertEqual(result.code_strings, ["52310-50"])
+
+    def test_letter_modifiers_go_through_the_rules(self):
+        from .rules import EditPair
+
+        engine = self.engine()
+        self.assertEqual(engine.apply(["51729", "51725-XS"]).code_strings, ["51729"])
+        engine.edits[("51729", "51725")] = EditPair("51729", "51725", 1, "Distinct site allowed")
+        result = engine.apply(["51729", "51725-XS"])
+        self.assertEqual(result.code_strings, ["51729", "51725-XS-51"])
+        self.assertFalse(any(f.rule == "bundling" for f in result.findings))
+        result = engine.apply(["52310-LT", "51570-RT"], "Left stent removal and right-sided cystectomy")
+        self.assertEqual(result.code_strings, ["51570-RT", "52310-LT-51"])
+
+    def test_unparseable_codes_are_kept(self):
+        from .pipeline import apply_rules
+
+        result = self.engine().apply(["51729", "5172X", "51725"])
+        self.assertEqual(result.code_strings, ["51729", "5172X"])
+        self.assertEqual(result.findings[0].rule, "format")
+        final = apply_rules({"cpt_codes": ["51729", "5172X", "51725"]}, "", self.engine().catalog)
+        self.assertEqual(final["cpt_codes"], ["51729", "51725", "5172X"])
+        self.assertEqual(final["final_codes"][2], {"code": "5172X", "modifiers": []})
+
+    def test_loads_shipped_edit_table(self):
+        from django.conf import settings
+        from .rules import load_edit_table
+
+        edits = load_edit_table(settings.CPT_NCCI_EDITS_PATH)
+        self.assertEqual(edits[("51729", "51725")].modifier_indicator, 0)
+
+
+class ResponseParsingTests(TestCase):
+    def test_parses_schema_json(self):
+        from .parsing import format_codes, parse_response
+
+        reply = json.dumps({"codes": [{"code": "51725", "modifiers": []}, {"code": "51797", "modifiers": ["-51"]}],
+                            "description": "Simple CMG; Voiding pressure studies", "explanation": "Both done.",
+                            "confidence": "high"})
+        parsed = parse_response(f"```json\n{reply}\n```")
+        self.assertEqual(format_codes(parsed["codes"]), "51725, 51797-51")
+        self.assertEqual(parsed["confidence"], "High")
+
+    def test_parses_legacy_text_in_one_pass(self):
+        from .parsing import parse_response
+
+        parsed = parse_response("**CPT Code(s):** 51729, 51785-51\nDescription: Complex CMG\n"
+                                "Explanation: Line one.\nLine two.\nConfidence: Medium - likely")
+        self.assertEqual(parsed["codes"], [{"code": "51729", "modifiers": []}, {"code": "51785", "modifiers": ["51"]}])
+        self.assertEqual(parsed["explanation"], "Line one.\nLine two.")
+        self.assertEqual(parsed["confidence"], "Medium")
+
+    def test_repeated_explanation_lines_do_not_confuse_parser(self):
+        from .parsing import parse_response
+
+        parsed = parse_response("Explanation: same\nExplanation: same\nCPT Code: 51725")
+        self.assertEqual(parsed["codes"][0]["code"], "51725")
+
+    def test_reprompts_only_for_missing_fields(self):
+        from asgiref.sync import async_to_sync
+
+        first = (200, chat_completion_body(json.dumps({"codes": [{"code": "51725", "modifiers": []}]})))
+        repair = (200, chat_completion_body(json.dumps({"description": "Simple CMG", "explanation": "Basic study."}),
+                                            prompt_tokens=50, completion_tokens=10))
+        with StubChatServer([first, repair]) as stub, \
+                override_settings(OPENAI_API_KEY="test-key", OPENAI_BASE_URL=stub.url):
+            from .agents import CPTAnalyzerAgent
+
+            result = async_to_sync(CPTAnalyzerAgent().aanalyze_scenario)("Simple cystometrogram")
+
+        self.assertEqual(len(stub.requests), 2)
+        schema = stub.requests[1]["response_format"]["json_schema"]["schema"]
+        self.assertEqual(schema["required"], ["description", "explanation"])
+        self.assertEqual(result["codes"], [{"code": "51725", "modifiers": []}])
+        self.assertEqual(result["description"], "Simple CMG")
+        self.assertEqual(result["usage"], {"prompt_tokens": 150, "completion_tokens": 30, "cached_tokens": 0})
+
+
+class MetricsTests(TestCase):
+    def test_histogram_renders_cumulative_buckets(self):
+        from .metrics import Histogram
+
+        histogram = Histogram("test_seconds", "Test", ("stage",), buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 5.0):
+            histogram.observe(value, stage="analyzer")
+        lines = histogram.render()
+        self.assertIn('test_seconds_bucket{stage="analyzer",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{stage="analyzer",le="1.0"} 2', lines)
+        self.assertIn('test_seconds_bucket{stage="analyzer",le="+Inf"} 3', lines)
+        self.assertIn('test_seconds_count{stage="analyzer"} 3', lines)
+
+    def test_timed_records_into_active_trace(self):
+        from .metrics import STAGE_SECONDS, Trace, timed
+
+        before = STAGE_SECONDS.count(stage="test.stage")
+        trace = Trace("not a valid id!")
+        with trace.activate(), timed("test.stage"):
+            pass
+        with timed("test.stage"):
+            pass
+        self.assertEqual(STAGE_SECONDS.count(stage="test.stage"), before + 2)
+        self.assertEqual(list(trace.stages()), ["test.stage"])
+        self.assertEqual(len(trace.trace_id), 32)
+
+    def test_metrics_endpoint(self):
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"# TYPE cpt_stage_duration_seconds histogram", response.content)
+        self.assertIn(b"cpt_upstream_retries_total", response.content)
+        with override_settings(CPT_METRICS_ENABLED=False):
+            self.assertEqual(self.client.get("/metrics").status_code, 404)
+
+
+class BenchmarkHarnessTests(TestCase):
+    def setUp(self):
+        from .clients import set_backend
+
+        self.addCleanup(set_backend, None)
+
+    def test_percentile_nearest_rank(self):
+        from .benchmarks import percentile
+
+        values = [float(v) for v in range(1, 101)]
+        self.assertEqual(percentile(values, 50), 50.0)
+        self.assertEqual(percentile(values, 99), 99.0)
+        self.assertEqual(percentile([], 95), 0.0)
+
+    def test_record_then_replay(self):
+        from asgiref.sync import async_to_sync
+        from .agents import CPTAnalyzerAgent
+        from .clients import set_backend
+        from .llm_backends import RecordingBackend, ReplayBackend, ReplayMissError, StubBackend
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "recording.jsonl")
+            set_backend(RecordingBackend(path, inner=StubBackend()))
+            recorded = async_to_sync(CPTAnalyzerAgent().aanalyze_scenario)("Simple cystometrogram")
+
+            set_backend(ReplayBackend(path))
+            replayed = CPTAnalyzerAgent().analyze_scenario("Simple cystometrogram")
+            self.assertEqual(replayed, recorded)
+            with self.assertRaises(ReplayMissError):
+                ReplayBackend(path).complete(model="gpt-4o", messages=[{"role": "user", "content": "other"}])
+
+    def test_bench_cpt_writes_json_report(self):
+        from django.core.management import call_command
+
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, "bench.json")
+            call_command("bench_cpt", "--limit", "3", "--concurrency", "1", "2", "--stub-latency", "0",
+                         "--output", output, stdout=io.StringIO())
+            with open(output) as handle:
+                report = json.load(handle)
+        self.assertEqual(report["backend"], "stub")
+        self.assertEqual([run["concurrency"] for run in report["runs"]], [1, 2])
+        self.assertEqual(report["runs"][0]["errors"], 0)
+        self.assertGreater(report["runs"][0]["tokens_per_scenario"], 0)
+
+
+class PromptTemplateTests(TestCase):
+    def test_static_prefix_is_shared_and_compiled_once(self):
+        from .prompts import ANALYZER_TEMPLATE
+
+        catalog = make_catalog()
+        compiled = ANALYZER_TEMPLATE.compile(catalog, 3)
+        self.assertIs(ANALYZER_TEMPLATE.compile(catalog, 3), compiled)
+        first = compiled.messages("Simple cystometrogram")
+        second = compiled.messages("Cystoscopy with stent removal")
+        self.assertEqual(first[0], second[0])
+        self.assertNotIn("Simple cystometrogram", first[0]["content"])
+        self.assertTrue(first[1]["content"].startswith("MEDICAL SCENARIO:\nSimple cystometrogram"))
+
+    def test_whole_catalog_moves_into_prefix(self):
+        from .prompts import VALIDATOR_TEMPLATE
+
+        catalog = make_catalog()
+        messages = VALIDATOR_TEMPLATE.compile(catalog, 0).messages(
+            "Simple {braces} cystometrogram", cpt_code="51725", description="CMG", explanation="Why")
+        for entry in catalog:
+            self.assertIn(entry.code, messages[0]["content"])
+        self.assertNotIn("CANDIDATE CPT CODES", messages[1]["content"])
+        self.assertIn("Simple {braces} cystometrogram", messages[1]["content"])
+
+    def test_prefix_is_long_enough_for_provider_caching(self):
+        from django.conf import settings
+
+        from .catalog import read_prompt_examples
+        from .preprocess import count_tokens
+        from .prompts import MODIFIER_REFERENCE, PROMPT_CACHE_MIN_TOKENS, TEMPLATES
+
+        urinary = make_catalog()
+        urinary.prompt_examples = read_prompt_examples(settings.CPT_SPECIALTIES["urinary"]["PROMPT_EXAMPLES"])
+        skin = CPTCatalog([CPTEntry("12001", "Simple repair of superficial wounds", "Skin", "Repair")], [],
+                          label="integumentary system")
+        for template in TEMPLATES:
+            # Even with only the top-k candidates in the user message
+            prefixes = {catalog.label: template.compile(catalog, 3).system_message["content"]
+                        for catalog in (urinary, skin)}
+            for label, system in prefixes.items():
+                self.assertGreaterEqual(count_tokens(system), PROMPT_CACHE_MIN_TOKENS, (template.name, label))
+            self.assertIn("52332-50", prefixes["urinary system"])
+            # Another specialty never gets the urology examples
+            self.assertNotIn("WORKED EXAMPLES", prefixes["integumentary system"])
+            self.assertIn(MODIFIER_REFERENCE, prefixes["integumentary system"])
+
+        # Nothing is added to a prefix that is long enough on its own
+        long_examples = make_catalog()
+        long_examples.prompt_examples = "\n".join(f"{n}. Example scenario number {n} with a long description of "
+                                                   f"the procedure performed" for n in range(1, 120))
+        system = TEMPLATES[0].compile(long_examples, 3).system_message["content"]
+        self.assertIn("119. Example", system)
+        self.assertNotIn(MODIFIER_REFERENCE, system)
+
+    def test_prompt_version_tracks_template_text(self):
+        from .prompts import PROMPT_VERSION, prompt_version
+
+        self.assertTrue(prompt_version().startswith(PROMPT_VERSION + "-"))
+
+
+SPECIALTIES = {
+    "urinary": {"LABEL": "urinary system", "CODE_RANGES": ["50010-53899"],
+                "KEYWORDS": ["bladder", "cystoscopy", "kidney", "ureter"]},
+    "integumentary": {"LABEL": "integumentary system", "PATH": "/nonexistent/integumentary.xlsx",
+                      "CODE_RANGES": ["10030-19499"], "KEYWORDS": ["skin", "laceration", "wound", "debridement"]},
+}
+
+
+@override_settings(CPT_SPECIALTIES=SPECIALTIES, CPT_DEFAULT_SPECIALTY="urinary", CPT_MAX_SPECIALTIES=2)
+class SpecialtyRoutingTests(TestCase):
+    def setUp(self):
+        catalog_module.reset_catalog()
+        self.addCleanup(catalog_module.reset_catalog)
+        self.loads = []
+
+        def fake_load(path, snapshot=None, label=None):
+            self.loads.append(label)
+            if label == "integumentary system":
+                entries = [CPTEntry("12001", "Simple repair of superficial wounds", "Skin", "Repair")]
+            else:
+                entries = list(make_catalog())
+            return CPTCatalog(entries, [], source_path=path, label=label)
+
+        patch = mock.patch.object(catalog_module, "load_catalog", fake_load)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_classifier_routes_by_keywords_and_codes(self):
+        from .routing import get_classifier
+
+        classifier = get_classifier()
+        self.assertEqual(classifier.route("Repair of a 3 cm skin laceration", "urinary"), ["integumentary"])
+        self.assertEqual(classifier.route("Cystoscopy of the bladder", "urinary"), ["urinary"])
+        self.assertEqual(classifier.route("Reported 12001 and 52000", "urinary"), ["integumentary", "urinary"])
+        self.assertEqual(classifier.route("Office visit", "urinary"), ["urinary"])
+
+    def test_shards_load_lazily(self):
+        from .routing import catalog_for_scenario
+
+        names, catalog = catalog_for_scenario("Debridement of a skin wound")
+        self.assertEqual(names, ["integumentary"])
+        self.assertEqual(catalog.codes, ["12001"])
+        self.assertEqual(self.loads, ["integumentary system"])
+        self.assertEqual(catalog_module.get_registry().loaded(), ["integumentary"])
+
+    def test_multiple_specialties_share_a_merged_catalog(self):
+        from .prompts import ANALYZER_TEMPLATE
+        from .routing import catalog_for_scenario
+
+        names, catalog = catalog_for_scenario("Skin laceration repair and cystoscopy of the bladder")
+        self.assertEqual(set(names), {"integumentary", "urinary"})
+        self.assertIn("12001", catalog)
+        self.assertIn("51725", catalog)
+        self.assertIs(catalog_for_scenario("Skin laceration repair and cystoscopy of the bladder")[1], catalog)
+        system = ANALYZER_TEMPLATE.compile(catalog, 3).messages("x")[0]["content"]
+        self.assertIn("system and ", system.split("procedures.")[0])
+
+
+@override_settings(OPENAI_API_KEY="test-key", CPT_AUDIT_ENABLED=True)
+class AuditStoreTests(TestCase):
+    def result(self, codes, confidence="High"):
+        return {
+            "final_cpt_code": ", ".join(codes), "final_description": "", "confidence": confidence,
+            "has_multiple_codes": len(codes) > 1, "cached": False,
+            "pipeline": {"mode": "full", "path": "analyzer+validator", "specialties": ["urinary"],
+                         "usage": {"prompt_tokens": 10, "completion_tokens": 2, "cached_tokens": 0}},
+        }
+
+    def test_buffer_bulk_inserts_in_chunks(self):
+        from .audit import AuditBuffer
+        from .models import Analysis, AnalysisCode
+
+        buffer = AuditBuffer(size=2)
+        with self.assertNumQueries(0):
+            buffer.add("one", self.result(["51725"]))
+        # A full chunk is one transaction: two bulk inserts plus savepoint bookkeeping
+        with self.assertNumQueries(4):
+            buffer.add("two", self.result(["51729", "51785-51"]))
+        buffer.add("three", {"error": "failed"})
+        buffer.flush()
+        self.assertEqual(buffer.saved, 2)
+        self.assertEqual(Analysis.objects.count(), 2)
+        self.assertEqual(
+            [str(code) for code in AnalysisCode.objects.filter(analysis__scenario_text="two")],
+            ["51729", "51785-51"],
+        )
+
+    def test_query_by_code_date_range_and_pages(self):
+        import datetime
+        from django.utils import timezone
+        from .audit import query_analyses, record_analysis
+        from .models import Analysis, AnalysisCode
+
+        for index in range(5):
+            record_analysis(f"scenario {index}", self.result(["51725"] if index % 2 else ["51729"]))
+        old = timezone.now() - datetime.timedelta(days=10)
+        Analysis.objects.filter(scenario_text="scenario 1").update(created_at=old)
+        AnalysisCode.objects.filter(analysis__scenario_text="scenario 1").update(created_at=old)
+
+        recent = query_analyses({"code": "51725", "since": (timezone.now() - datetime.timedelta(days=1)).date().isoformat()})
+        self.assertEqual([row["scenario"] for row in recent["results"]], ["scenario 3"])
+        self.assertEqual(len(query_analyses({"code": "51725"})["results"]), 2)
+        self.assertEqual(query_analyses({"scenario": "  SCENARIO 4"})["results"][0]["scenario"], "scenario 4")
+
+        first = query_analyses({"limit": 2})
+        second = query_analyses({"limit": 2, "before": first["next"]})
+        last = query_analyses({"limit": 2, "before": second["next"]})
+        ids = [row["id"] for page in (first, second, last) for row in page["results"]]
+        self.assertEqual(ids, sorted(ids, reverse=True))
+        self.assertEqual(len(set(ids)), 5)
+        self.assertIsNone(last["next"])
+        with self.assertRaises(ValueError):
+            query_analyses({"since": "last week"})
+
+    def test_analyze_view_records_and_api_returns_it(self):
+        with mock.patch("cpt_analyzer.agents.CPTAnalyzerAgent.aanalyze_scenario", return_value=ANALYZER_RESULT), \
+                mock.patch("cpt_analyzer.agents.CPTValidatorAgent.avalidate_cpt_code", return_value=VALIDATOR_RESULT):
+            self.client.post("/analyze/", {"scenario": "CMG with EMG", "cache": False}, content_type="application/json")
+
+        listing = self.client.get("/analyses/", {"code": "51785"}).json()
+        self.assertEqual(len(listing["results"]), 1)
+        detail = self.client.get(f"/analyses/{listing['results'][0]['id']}/").json()
+        self.assertEqual(detail["codes"], [{"code": "51729", "modifiers": []}, {"code": "51785", "modifiers": ["51"]}])
+        self.assertEqual(detail["validator_result"]["confidence"], "High")
+        self.assertEqual(self.client.get("/analyses/", {"until": "soon"}).status_code, 400)
+        self.assertEqual(self.client.get("/analyses/999999/").status_code, 404)
+
+
+@override_settings(OPENAI_API_KEY="test-key", CPT_AUDIT_ENABLED=False)
+class CoalescingTests(TestCase):
+    def setUp(self):
+        from .coalesce import reset_coalescer
+
+        reset_coalescer()
+        reset_result_cache()
+        self.addCleanup(reset_coalescer)
+        self.addCleanup(reset_result_cache)
+
+    def test_concurrent_identical_requests_share_one_analysis(self):
+        import asyncio
+        from asgiref.sync import async_to_sync
+        from .coalesce import COALESCED
+        from .pipeline import arun_pipeline
+
+        async def slow_analysis(*args, **kwargs):
+            await asyncio.sleep(0.05)
+            return ANALYZER_RESULT
+
+        async def submit():
+            return await asyncio.gather(
+                arun_pipeline("CMG with EMG", use_cache=False),
+                arun_pipeline("  cmg WITH emg", use_cache=False),
+                arun_pipeline("CMG with EMG", use_cache=False),
+                arun_pipeline("Foley catheter placed", use_cache=False),
+            )
+
+        before = COALESCED.value(scope="local")
+        with mock.patch("cpt_analyzer.agents.CPTAnalyzerAgent.aanalyze_scenario", side_effect=slow_analysis) as analyze, \
+                mock.patch("cpt_analyzer.agents.CPTValidatorAgent.avalidate_cpt_code", return_value=VALIDATOR_RESULT):
+            results = async_to_sync(submit)()
+        self.assertEqual(analyze.call_count, 2)
+        self.assertEqual([bool(r.get("coalesced")) for r in results], [False, True, True, False])
+        self.assertEqual(results[1]["final_cpt_code"], results[0]["final_cpt_code"])
+        self.assertNotEqual(results[1]["trace"]["id"], results[0]["trace"]["id"])
+        self.assertEqual(COALESCED.value(scope="local") - before, 2)
+
+        # Followers spent nothing themselves: they are neither charged nor stored with the leader's tokens
+        from .audit import build_analysis
+        from .pipeline import result_usage
+
+        self.assertEqual(result_usage(results[1]), {"prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0})
+        follower, _ = build_analysis("CMG with EMG", dict(results[1], pipeline=dict(results[1]["pipeline"],
+                                                                                      usage={"prompt_tokens": 900})))
+        self.assertEqual((follower.prompt_tokens, follower.cached), (0, True))
+        self.assertEqual(result_usage(results[0])["prompt_tokens"],
+                         results[0]["pipeline"]["usage"].get("prompt_tokens", 0))
+
+    def test_followers_analyze_on_their_own_if_the_leader_gives_up(self):
+        from asgiref.sync import async_to_sync
+        from .coalesce import SingleFlight
+
+        coalescer = SingleFlight(wait_timeout=1)
+        flight, leader = coalescer.begin("key")
+        same, follower_leads = coalescer.begin("key")
+        self.assertTrue(leader)
+        self.assertIs(same, flight)
+        self.assertFalse(follower_leads)
+        coalescer.finish(flight, None)
+        self.assertIsNone(async_to_sync(coalescer.wait)(flight))
+        self.assertEqual(coalescer.in_flight(), 0)
+        self.assertTrue(coalescer.begin("key")[1])
+
+    def test_lock_backends_exclude_other_holders(self):
+        from .coalesce import FileLockBackend, SQLiteLockBackend
+
+        with tempfile.TemporaryDirectory() as tmp:
+            for backend_class, path in ((FileLockBackend, os.path.join(tmp, "locks")),
+                                        (SQLiteLockBackend, os.path.join(tmp, "locks.sqlite3"))):
+                first, second = backend_class(path=path), backend_class(path=path)
+                handle = first.acquire("key")
+                self.assertIsNotNone(handle)
+                self.assertIsNone(second.acquire("key"))
+                self.assertIsNotNone(second.acquire("other"))
+                first.release(handle)
+                self.assertIsNotNone(second.acquire("key"))
+
+    def test_waits_for_another_worker_and_reuses_its_cached_result(self):
+        import asyncio
+        from asgiref.sync import async_to_sync
+        from .cache import get_result_cache
+        from .coalesce import SQLiteLockBackend
+        from .pipeline import arun_pipeline, result_cache_key
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "locks.sqlite3")
+            config = {"ENABLED": True, "LOCK_BACKEND": "cpt_analyzer.coalesce.SQLiteLockBackend",
+                      "LOCK_OPTIONS": {"PATH": path}, "WAIT_TIMEOUT": 5, "POLL_INTERVAL": 0.01}
+            other_worker = SQLiteLockBackend(path=path)
+            key = result_cache_key("CMG with EMG", "full")
+            handle = other_worker.acquire(key)
+
+            async def finish_elsewhere():
+                await asyncio.sleep(0.05)
+                get_result_cache().set(key, {"final_cpt_code": "51729"})
+                other_worker.release(handle)
+
+            async def submit():
+                result, _ = await asyncio.gather(arun_pipeline("CMG with EMG"), finish_elsewhere())
+                return result
+
+            with override_settings(CPT_COALESCE=config), \
+                    mock.patch("cpt_analyzer.agents.CPTAnalyzerAgent.aanalyze_scenario") as analyze:
+                result = async_to_sync(submit)()
+            analyze.assert_not_called()
+            self.assertEqual(result["final_cpt_code"], "51729")
+            self.assertTrue(result["coalesced"])
+            self.assertIn("coalesce.lock", result["trace"]["stages"])
+
+
+@override_settings(OPENAI_API_KEY="test-key", CPT_JOBS={"WORKERS": 0, "CALLBACK_RETRIES": 0})
+class JobQueueTests(TestCase):
+    def setUp(self):
+        reset_result_cache()
+        self.addCleanup(reset_result_cache)
+        patches = [
+            mock.patch("cpt_analyzer.agents.CPTAnalyzerAgent.aanalyze_scenario", return_value=ANALYZER_RESULT),
+            mock.patch("cpt_analyzer.agents.CPTValidatorAgent.avalidate_cpt_code", return_value=VALIDATOR_RESULT),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_interactive_jobs_are_claimed_before_batch_backfill(self):
+        from .jobs import claim_next, enqueue, enqueue_many
+        from .models import Job
+
+        enqueue_many([{"id": "b1", "scenario": "one"}, {"id": "b2", "scenario": "two"}])
+        normal = enqueue("three")
+        interactive = enqueue("four", priority=Job.PRIORITY_INTERACTIVE)
+        claimed = [claim_next("w1"), claim_next("w2"), claim_next("w1")]
+        self.assertEqual([job.pk for job in claimed[:2]], [interactive.pk, normal.pk])
+        self.assertEqual(claimed[2].external_id, "b1")
+        self.assertEqual(claimed[0].status, Job.RUNNING)
+        self.assertEqual(claimed[1].worker, "w2")
+        self.assertEqual(Job.objects.filter(status=Job.QUEUED).count(), 1)
+
+    def test_async_analyze_returns_job_to_poll(self):
+        from .jobs import process_next
+
+        response = self.client.post("/analyze/", {"scenario": "CMG with EMG", "async": True},
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 202)
+        job = response.json()
+        self.assertEqual((job["status"], job["priority"], job["queue_position"]), ("queued", 0, 1))
+        self.assertEqual(response["Location"], job["status_url"])
+
+        self.assertTrue(process_next("test"))
+        done = self.client.get(job["status_url"]).json()
+        self.assertEqual(done["status"], "done")
+        self.assertEqual(done["result"]["final_cpt_code"], "51729, 51785-51")
+        self.assertEqual(len(self.client.get("/analyses/", {"source": "job"}).json()["results"]), 1)
+        self.assertFalse(process_next("test"))
+
+    def test_callback_receives_finished_job(self):
+        from .jobs import process_next
+        from .models import Job
+
+        public = [(2, 1, 6, "", ("93.184.216.34", 443))]
+        with override_settings(CPT_JOBS={"WORKERS": 0, "CALLBACK_ALLOWED_HOSTS": ["example.test"]}), \
+                mock.patch("cpt_analyzer.jobs.socket.getaddrinfo", return_value=public):
+            response = self.client.post("/jobs/", {"scenario": "CMG with EMG", "priority": "batch",
+                                                   "callback_url": "https://example.test/hook"},
+                                        content_type="application/json")
+            self.assertEqual(response.json()["priority"], Job.PRIORITY_BATCH)
+            with mock.patch("cpt_analyzer.jobs.open_callback") as open_callback:
+                open_callback.return_value.__enter__.return_value.status = 204
+                process_next("test")
+        request = open_callback.call_args[0][0]
+        self.assertEqual(request.full_url, "https://example.test/hook")
+        self.assertEqual(json.loads(request.data)["status"], "done")
+        self.assertEqual(Job.objects.get().callback_status, "delivered (204)")
+
+        invalid = self.client.post("/jobs/", {"scenario": "x", "callback_url": "file:///etc/passwd"},
+                                   content_type="application/json")
+        self.assertEqual(invalid.status_code, 400)
+        self.assertEqual(self.client.get("/jobs/00000000-0000-0000-0000-000000000000/").status_code, 404)
+
+    def test_callback_urls_are_denied_by_default_and_must_be_public(self):
+        import urllib.error
+        import urllib.request
+        from .jobs import _callback_opener, validate_callback_url
+
+        with override_settings(CPT_JOBS={"CALLBACK_ALLOWED_HOSTS": []}):
+            with self.assertRaisesRegex(ValueError, "not enabled"):
+                validate_callback_url("https://example.test/hook")
+        with override_settings(CPT_JOBS={"CALLBACK_ALLOWED_HOSTS": ["*"]}):
+            for url in ("http://127.0.0.1:8000/admin/", "http://169.254.169.254/latest/meta-data/",
+                        "http://10.0.0.5/", "http://[::1]/", "http://localhost/"):
+                with self.assertRaisesRegex(ValueError, "non-public"):
+                    validate_callback_url(url)
+
+        class Redirect(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.send_response(302)
+                self.send_header("Location", "http://169.254.169.254/")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Redirect)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+        request = urllib.request.Request(f"http://127.0.0.1:{server.server_port}/", data=b"{}", method="POST")
+        with self.assertRaises(urllib.error.HTTPError) as raised:
+            _callback_opener.open(request, timeout=5)
+        self.assertEqual(raised.exception.code, 302)
+
+    def test_stale_running_jobs_are_requeued_then_failed(self):
+        import datetime
+        from django.utils import timezone
+        from .jobs import claim_next, enqueue, requeue_stale
+        from .models import Job
+
+        job = enqueue("CMG with EMG")
+        long_ago = timezone.now() - datetime.timedelta(hours=1)
+        for attempt in range(3):
+            claim_next("crashed")
+            Job.objects.filter(pk=job.pk).update(started_at=long_ago)
+            requeue_stale()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.FAILED, 3))
+
+
+class SemanticIndexTests(TestCase):
+    FIRST = "A 65-year-old male underwent complex cystometrogram with needle electromyography of the sphincter."
+    SECOND = "72 year old female patient underwent complex cystometrogram with needle electromyography of the sphincter."
+
+    def setUp(self):
+        from .semantic import reset_semantic_index
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        reset_semantic_index()
+        self.addCleanup(reset_semantic_index)
+        reset_result_cache()
+        self.addCleanup(reset_result_cache)
+
+    def test_patient_details_do_not_change_the_match(self):
+        from .semantic import SemanticIndex
+
+        index = SemanticIndex(self.tmp.name, dimensions=256)
+        index.add(self.FIRST, {"catalog_version": "v1", "code": "51729"})
+        index.add("Cystourethroscopy with removal of a ureteral stent", {"catalog_version": "v1", "code": "52310"})
+        (similarity, row), = index.search(self.SECOND, k=1)
+        self.assertGreater(similarity, 0.99)
+        self.assertEqual(index.entry(row)["code"], "51729")
+
+        with mock.patch("cpt_analyzer.semantic.EXACT_SCAN_LIMIT", 0):
+            self.assertEqual(index.search(self.SECOND, k=1)[0][1], row)
+
+    def test_near_duplicates_that_change_the_code_are_not_reused(self):
+        from .semantic import embed
+
+        def similarity(first, second):
+            return float(embed(first, 1024) @ embed(second, 1024))
+
+        self.assertGreater(similarity(self.FIRST, self.SECOND), 0.97)
+        self.assertLess(similarity("Cystourethroscopy with ureteral stent insertion",
+                                   "Cystourethroscopy without ureteral stent insertion"), 0.97)
+        self.assertLess(similarity("Percutaneous nephrolithotomy for a 2 cm renal stone",
+                                   "Percutaneous nephrolithotomy for a 3 cm renal stone"), 0.97)
+        self.assertLess(similarity("Left ureteroscopy with laser lithotripsy",
+                                   "Right ureteroscopy with laser lithotripsy"), 0.97)
+        self.assertGreater(similarity("Age 40: cystoscopy with biopsy", "Age 81: cystoscopy with biopsy"), 0.97)
+
+    def test_persists_and_repairs_a_torn_append(self):
+        from .semantic import SemanticIndex
+
+        index = SemanticIndex(self.tmp.name, dimensions=256)
+        index.add(self.FIRST, {"catalog_version": "v1"})
+        with open(index.entries_path, "ab") as handle:
+            handle.write(b'{"catalog_version": "v1"}\n{"torn')
+
+        reopened = SemanticIndex(self.tmp.name, dimensions=256)
+        self.assertEqual(len(reopened), 1)
+        reopened.add("Cystourethroscopy with removal of a ureteral stent", {"catalog_version": "v2"})
+        self.assertEqual(len(SemanticIndex(self.tmp.name, dimensions=256)), 2)
+        with self.assertLogs("cpt_analyzer.semantic", "WARNING"):
+            self.assertEqual(len(SemanticIndex(self.tmp.name, dimensions=128)), 0)
+
+    def test_pipeline_reuses_validated_answers_and_adds_examples(self):
+        from .pipeline import run_pipeline
+
+        config = {"ENABLED": True, "PATH": self.tmp.name, "DIMENSIONS": 256, "REUSE_THRESHOLD": 0.97,
+                  "FEW_SHOT_THRESHOLD": 0.5, "FEW_SHOT_EXAMPLES": 2}
+        with override_settings(OPENAI_API_KEY="test-key", CPT_SEMANTIC_CACHE=config), \
+                mock.patch("cpt_analyzer.agents.CPTAnalyzerAgent.aanalyze_scenario", return_value=ANALYZER_RESULT) as analyze, \
+                mock.patch("cpt_analyzer.agents.CPTValidatorAgent.avalidate_cpt_code", return_value=VALIDATOR_RESULT):
+            first = run_pipeline(self.FIRST)
+            reused = run_pipeline(self.SECOND)
+            fresh = run_pipeline(self.SECOND, use_cache=False)
+        self.assertNotIn("semantic_match", first)
+        self.assertEqual(analyze.call_count, 2)
+        self.assertEqual(reused["final_cpt_code"], first["final_cpt_code"])
+        self.assertEqual(reused["pipeline"]["path"], "semantic_match")
+        self.assertEqual(reused["pipeline"]["usage"]["prompt_tokens"], 0)
+        self.assertGreater(reused["semantic_match"]["similarity"], 0.97)
+        self.assertNotIn("semantic_match", fresh)
+        examples = analyze.call_args.kwargs["examples"]
+        self.assertEqual(examples[0]["cpt_code"], first["final_cpt_code"])
+
+    def test_examples_are_rendered_into_the_user_message(self):
+        from .prompts import ANALYZER_TEMPLATE
+
+        examples = [{"scenario": "Complex CMG\nwith EMG", "cpt_code": "51729, 51785-51", "description": "CMG; EMG"}]
+        messages = ANALYZER_TEMPLATE.compile(get_catalog(), 5).messages("Simple CMG", examples=examples)
+        self.assertIn("SIMILAR SCENARIOS CODED BEFORE", messages[1]["content"])
+        self.assertIn("1. Complex CMG with EMG\n   CPT Code(s): 51729, 51785-51", messages[1]["content"])
+        self.assertIn("51785", messages[1]["content"].split("CANDIDATE CPT CODES")[1])
+        self.assertNotIn("SIMILAR", ANALYZER_TEMPLATE.compile(get_catalog(), 5).messages("Simple CMG")[1]["content"])
+
+
+@override_settings(OPENAI_API_KEY="test-key")
+class PreprocessingTests(TestCase):
+    NOTE = (
+        "Past Medical History:\n"
+        "hypertension, diabetes\n"
+        "BPH on tamsulosin\n"
+        "\n"
+        "Procedure: Complex cystometrogram with urethral pressure profile was performed.\n"
+        "Medications: tamsulosin 0.4 mg daily\n"
+        "Vitals: BP 128/82, HR 71\n"
+        "\n"
+        "Needle EMG of the urethral sphincter was performed. "
+        "Complex cystometrogram with urethral pressure profile was performed."
+    )
+
+    def test_strips_boilerplate_sections_and_repeats(self):
+        from .preprocess import clean_scenario
+
+        cleaned, removed, duplicates = clean_scenario(self.NOTE)
+        self.assertEqual(removed, ["Past Medical History", "Medications", "Vitals"])
+        self.assertEqual(duplicates, 1)
+        self.assertNotIn("tamsulosin", cleaned)
+        self.assertIn("Needle EMG", cleaned)
+        self.assertEqual(cleaned.count("Complex cystometrogram"), 1)
+
+    def test_keeps_procedure_lines_after_inline_boilerplate_headings(self):
+        from .preprocess import clean_scenario
+
+        cleaned, removed, _ = clean_scenario(
+            "Allergies: NKDA\nPatient underwent complex cystometrogram with urethral pressure profile.\n"
+            "Findings: normal capacity")
+        self.assertEqual(removed, ["Allergies"])
+        self.assertIn("complex cystometrogram", cleaned)
+        self.assertNotIn("NKDA", cleaned)
+
+        cleaned, _, _ = clean_scenario("Medications:\ntamsulosin 0.4 mg\nFoley catheter placed at bedside.\n"
+                                       "Follow up: cystoscopy performed to remove the stent")
+        self.assertNotIn("tamsulosin", cleaned)
+        self.assertIn("Foley catheter placed", cleaned)
+        self.assertIn("cystoscopy performed", cleaned)
+
+    def test_counts_tokens_locally(self):
+        from .preprocess import count_tokens
+
+        self.assertEqual(count_tokens(""), 0)
+        self.assertLess(abs(count_tokens("Complex cystometrogram with needle EMG of the sphincter.") - 12), 5)
+
+    def test_truncates_or_rejects_over_budget(self):
+        from .preprocess import apply_budget, estimate_request, prepare_scenario
+
+        long_note = " ".join(f"Step {n}: the bladder was irrigated and inspected again." for n in range(400))
+        fixed = estimate_request(0, get_catalog(), "full")["total_tokens"]
+        budget = {"MAX_SCENARIO_TOKENS": 300, "MAX_REQUEST_TOKENS": fixed + 10000}
+        with override_settings(CPT_TOKEN_BUDGET=budget):
+            prepared = apply_budget(prepare_scenario(long_note), get_catalog(), "full")
+        self.assertTrue(prepared.truncated)
+        self.assertLessEqual(prepared.tokens, 300)
+        self.assertTrue(prepared.text.endswith("[truncated]"))
+        self.assertGreater(prepared.estimate["cost_usd"], 0)
+        self.assertEqual(set(prepared.estimate["stages"]), {"analyzer", "validator"})
+
+        with override_settings(CPT_TOKEN_BUDGET=dict(budget, ON_OVERFLOW="reject")):
+            rejected = apply_budget(prepare_scenario(long_note), get_catalog(), "analyzer_only")
+        self.assertIn("the budget allows 300", rejected.error)
+        self.assertEqual(set(rejected.estimate["stages"]), {"analyzer"})
+
+    def test_view_rejects_with_413_and_previews_cost(self):
+        with override_settings(CPT_TOKEN_BUDGET={"MAX_SCENARIO_TOKENS": 60, "ON_OVERFLOW": "reject"}), \
+                mock.patch("cpt_analyzer.agents.CPTAnalyzerAgent.aanalyze_scenario") as analyze:
+            response = self.client.post("/analyze/", {"scenario": "Cystoscopy performed. " * 80},
+                                        content_type="application/json")
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(response.json()["code"], "token_budget_exceeded")
+        analyze.assert_not_called()
+
+        preview = self.client.post("/analyze/", {"scenario": self.NOTE, "dry_run": True},
+                                   content_type="application/json").json()
+        self.assertEqual(preview["removed_sections"], ["Past Medical History", "Medications", "Vitals"])
+        self.assertNotIn("tamsulosin", preview["scenario"])
+        self.assertGreater(preview["estimate"]["prompt_tokens"], preview["tokens"])
+
+
+@override_settings(OPENAI_API_KEY="test-key", CPT_MODEL_TIERING={"ENABLED": True, "MIN_CONFIDENCE": "Medium"})
+class ModelTieringTests(TestCase):
+    SCENARIO = "Simple cystometrogram (CMG) to evaluate the bladder"
+    SIMPLE = {"cpt_code": "51725", "description": "Simple CMG", "explanation": "Basic study."}
+
+    def run_tiered(self, answers, scenario=SCENARIO, log_path=""):
+        from .agents import CPTAnalyzerAgent
+        from .pipeline import run_pipeline
+
+        stages = []
+
+        def analyze(agent, scenario_text, examples=(), guidance=()):
+            stages.append(agent.stage)
+            return dict(answers[agent.stage], usage={"prompt_tokens": 1000, "completion_tokens": 100, "cached_tokens": 0})
+
+        config = {"ENABLED": True, "MIN_CONFIDENCE": "Medium", "LOG_PATH": log_path}
+        with override_settings(CPT_MODEL_TIERING=config), \
+                mock.patch.object(CPTAnalyzerAgent, "aanalyze_scenario", autospec=True, side_effect=analyze):
+            result = run_pipeline(scenario, use_cache=False, mode="analyzer_only")
+        return result, stages
+
+    def test_keeps_fast_answer_that_passes_checks(self):
+        result, stages = self.run_tiered({"analyzer_fast": self.SIMPLE})
+        self.assertEqual(stages, ["analyzer_fast"])
+        tiering = result["pipeline"]["tiering"]
+        self.assertEqual(tiering["decision"], "fast")
+        self.assertEqual(tiering["model"], "gpt-4o-mini")
+        self.assertEqual(result["pipeline"]["model_calls"], 1)
+        self.assertEqual(result["final_cpt_code"], "51725")
+
+    def test_escalates_multi_procedure_answers_and_counts_both_tiers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            log_path = os.path.join(directory, "tiering.jsonl")
+            result, stages = self.run_tiered({"analyzer_fast": ANALYZER_RESULT, "analyzer": self.SIMPLE},
+                                             log_path=log_path)
+            with open(log_path) as handle:
+                logged = [json.loads(line) for line in handle]
+        self.assertEqual(stages, ["analyzer_fast", "analyzer"])
+        tiering = result["pipeline"]["tiering"]
+        self.assertEqual(tiering["decision"], "escalated")
+        self.assertIn("multi_procedure", tiering["reasons"])
+        self.assertEqual(tiering["model"], "gpt-4o")
+        self.assertGreater(tiering["escalation_cost_usd"], tiering["fast_cost_usd"])
+        self.assertEqual(result["analyzer_result"]["escalated_from"]["cpt_code"], ANALYZER_RESULT["cpt_code"])
+        self.assertEqual(result["pipeline"]["model_calls"], 2)
+        self.assertEqual(result["pipeline"]["usage"]["prompt_tokens"], 2000)
+        self.assertEqual(logged[0]["fast_codes"], ANALYZER_RESULT["cpt_code"])
+        self.assertEqual(logged[0]["codes"], "51725")
+
+    def test_escalation_triggers(self):
+        from .agents import tiering_settings
+        from .checks import check_analyzer_result
+        from .tiering import escalation_reasons
+
+        catalog = make_catalog()
+        config = tiering_settings()
+        unknown = check_analyzer_result(catalog, self.SCENARIO, {"cpt_code": "52000"})
+        self.assertEqual(escalation_reasons(self.SCENARIO, unknown, "Low", config), ["check_failed", "low_confidence"])
+        passed = check_analyzer_result(catalog, "Simple cystometrogram performed", {"cpt_code": "51725"})
+        self.assertEqual(escalation_reasons("Simple cystometrogram performed", passed, "High", config), [])
+        followed = "Simple cystometrogram performed, followed by urethral dilation"
+        self.assertEqual(escalation_reasons(followed, passed, "High", config), ["multi_procedure"])
+        self.assertEqual(escalation_reasons(followed, passed, "High", dict(config, ESCALATE_ON=[])), [])
+
+    def test_stage_models_come_from_settings(self):
+        from .agents import CPTValidatorAgent
+        from .pipeline import result_cache_key
+        from .preprocess import estimate_request
+
+        catalog = get_catalog()
+        key = result_cache_key(self.SCENARIO, "full", catalog)
+        self.assertIn("analyzer_fast", estimate_request(100, catalog, "full")["stages"])
+        models = {"validator": {"MODEL": "gpt-4o-mini", "TEMPERATURE": 0.0, "MAX_TOKENS": 300}}
+        with override_settings(CPT_AGENT_MODELS=models):
+            self.assertEqual(CPTValidatorAgent(catalog).request_options()["max_tokens"], 300)
+            self.assertNotEqual(result_cache_key(self.SCENARIO, "full", catalog), key)
+        with override_settings(CPT_MODEL_TIERING={"ENABLED": False}):
+            self.assertNotIn("analyzer_fast", estimate_request(100, catalog, "full")["stages"])
+
+
+class SpeculativeModeTests(TestCase):
+    SCENARIO = "Simple cystometrogram (CMG) to evaluate the bladder"
+    SIMPLE = {"cpt_code": "51725", "description": "Simple CMG", "explanation": "Basic study."}
+    USAGE = {"prompt_tokens": 1000, "completion_tokens": 100, "cached_tokens": 0}
+
+    def run_speculative(self, second_opinion, latency=0.0):
+        from .agents import CPTAnalyzerAgent, CPTValidatorAgent
+        from .pipeline import run_pipeline
+
+        stages = []
+
+        async def analyze(agent, scenario_text, examples=(), guidance=()):
+            stages.append(agent.stage)
+            await asyncio.sleep(latency)
+            answer = second_opinion if agent.stage == "second_opinion" else self.SIMPLE
+            return dict(answer, usage=self.USAGE)
+
+        async def validate(agent, scenario_text, analyzer_result, guidance=()):
+            stages.append("validator")
+            return dict(VALIDATOR_RESULT, usage=self.USAGE)
+
+        with mock.patch.object(CPTAnalyzerAgent, "aanalyze_scenario", autospec=True, side_effect=analyze), \
+                mock.patch.object(CPTValidatorAgent, "avalidate_cpt_code", autospec=True, side_effect=validate):
+            result = run_pipeline(self.SCENARIO, use_cache=False, mode="speculative")
+        return result, stages
+
+    def test_agreement_skips_the_validator_and_runs_both_calls_concurrently(self):
+        result, stages = self.run_speculative(dict(self.SIMPLE, confidence="High"), latency=0.2)
+        self.assertEqual(sorted(stages), ["analyzer", "second_opinion"])
+        pipeline = result["pipeline"]
+        self.assertEqual(pipeline["path"], "analyzer+second_opinion")
+        self.assertEqual(pipeline["model_calls"], 2)
+        self.assertEqual(pipeline["usage"]["prompt_tokens"], 2000)
+        self.assertTrue(pipeline["speculation"]["agreed"])
+        self.assertGreater(pipeline["speculation"]["saved_ms"], 100)
+        # About max() of the two calls, not their sum
+        self.assertLess(pipeline["elapsed_ms"], 350)
+        self.assertEqual(result["confidence"], "High")
+        self.assertEqual(result["final_cpt_code"], "51725")
+
+    def test_disagreement_falls_back_to_the_validator(self):
+        result, stages = self.run_speculative({"cpt_code": "51702", "description": "Foley", "explanation": "",
+                                               "confidence": "High"})
+        self.assertEqual(stages[-1], "validator")
+        pipeline = result["pipeline"]
+        self.assertEqual(pipeline["path"], "analyzer+validator")
+        self.assertEqual(pipeline["model_calls"], 3)
+        self.assertFalse(pipeline["speculation"]["agreed"])
+        self.assertEqual(pipeline["speculation"]["reasons"], ["different codes (51725 vs 51702)"])
+        self.assertEqual(result["final_cpt_code"], VALIDATOR_RESULT["cpt_code"])
+
+    def test_reconcile(self):
+        from .checks import reconcile
+
+        catalog = make_catalog()
+        answer = {"cpt_code": "51725, 51702-59-51"}
+        self.assertTrue(reconcile(catalog, answer, {"cpt_code": "51702-51-59, 51725", "confidence": "Medium"}).agreed)
+        self.assertEqual(reconcile(catalog, answer, {"cpt_code": "51725, 51702-51"}).reasons, ["different modifiers"])
+        self.assertEqual(reconcile(catalog, {"cpt_code": "52000"}, {"cpt_code": "52000"}).reasons,
+                         ["52000 not in catalog"])
+        self.assertEqual(reconcile(catalog, answer, dict(answer, confidence="Low")).reasons,
+                         ["second opinion has low confidence"])
+        self.assertEqual(reconcile(catalog, answer, {"error": "timeout"}).reasons, ["second opinion failed"])
+        # A token that doesn't parse, or an extra one, is never silently ignored
+        odd = reconcile(catalog, {"cpt_code": "51725, 5170X"}, {"cpt_code": "51725", "confidence": "High"})
+        self.assertFalse(odd.agreed)
+        self.assertEqual(odd.reasons[:2], ["unparseable code(s) 5170X", "different number of codes (2 vs 1)"])
+        self.assertFalse(reconcile(catalog, {"cpt_code": "51725, 51725"}, {"cpt_code": "51725"}).agreed)
+        self.assertTrue(reconcile(catalog, {"cpt_code": "50590-LT"}, {"cpt_code": "50590-LT"}).agreed)
+
+    def test_estimate_counts_the_second_opinion(self):
+        from .pipeline import result_cache_key
+        from .preprocess import estimate_request
+
+        catalog = get_catalog()
+        self.assertIn("second_opinion", estimate_request(100, catalog, "speculative")["stages"])
+        self.assertNotIn("second_opinion", estimate_request(100, catalog, "full")["stages"])
+        self.assertNotEqual(result_cache_key(self.SCENARIO, "speculative", catalog),
+                            result_cache_key(self.SCENARIO, "full", catalog))
+
+
+class AdmissionTests(TestCase):
+    LIMITS = {"RATE": 1.0, "BURST": 1, "MAX_CONCURRENT": 4, "MAX_QUEUE": 4, "QUEUE_TIMEOUT": 1.0,
+              "TRUST_CLIENT_HEADER": True}
+
+    def setUp(self):
+        from .admission import reset_admission
+
+        reset_admission()
+        self.addCleanup(reset_admission)
+        reset_result_cache()
+        self.addCleanup(reset_result_cache)
+
+    def post(self, client_id, client=None):
+        return (client or AsyncClient()).post("/analyze/", {"scenario": "CMG with EMG", "cache": False},
+                                              content_type="application/json",
+                                              headers={"X-Client-ID": client_id})
+
+    def test_token_bucket(self):
+        from .admission import TokenBucket
+
+        bucket = TokenBucket(rate=2.0, burst=2, now=0.0)
+        self.assertEqual([bucket.take(0.0), bucket.take(0.0)], [0.0, 0.0])
+        self.assertAlmostEqual(bucket.take(0.0), 0.5)
+        self.assertAlmostEqual(bucket.take(0.25), 0.25)
+        self.assertEqual(bucket.take(0.5), 0.0)
+
+    def test_concurrency_gate_queues_in_order_and_sheds_beyond_the_queue(self):
+        from asgiref.sync import async_to_sync
+
+        from .concurrency import ConcurrencyGate
+
+        async def scenario():
+            gate = ConcurrencyGate(limit=1, max_queue=1)
+            self.assertEqual(await gate.aenter(1.0), "admitted")
+            waiting = asyncio.ensure_future(gate.aenter(1.0))
+            await asyncio.sleep(0)
+            self.assertIsNone(await gate.aenter(1.0))
+            gate.leave()
+            self.assertEqual(await waiting, "queued")
+            self.assertIsNone(await asyncio.ensure_future(gate.aenter(0.01)))
+            gate.leave()
+            self.assertEqual((gate.active, gate.queued), (0, 0))
+
+        async_to_sync(scenario)()
+
+    def test_streaming_responses_hold_their_slot_until_closed(self):
+        from asgiref.sync import async_to_sync
+        from django.http import StreamingHttpResponse
+
+        from .admission import _hold_until_closed
+        from .concurrency import ConcurrencyGate
+
+        async def chunks():
+            yield b"a"
+            yield b"b"
+
+        async def consume(response):
+            return [chunk async for chunk in response]
+
+        gate = ConcurrencyGate(limit=2, max_queue=0)
+        gate.enter(0)
+        response = _hold_until_closed(StreamingHttpResponse(iter([b"a", b"b"])), gate)
+        self.assertEqual(gate.active, 1)
+        self.assertEqual(b"".join(response), b"ab")
+        response.close()
+        self.assertEqual(gate.active, 0)
+
+        gate.enter(0)
+        response = _hold_until_closed(StreamingHttpResponse(chunks()), gate)
+        self.assertEqual(async_to_sync(consume)(response), [b"a", b"b"])
+        self.assertEqual(gate.active, 0)
+
+        # A client that leaves before the first chunk still gives the slot back, once
+        gate.enter(0)
+        _hold_until_closed(StreamingHttpResponse(chunks()), gate).close()
+        self.assertEqual(gate.active, 0)
+
+    def test_quota_stores(self):
+        from .admission import LocalQuotaStore, SQLiteQuotaStore
+
+        with tempfile.TemporaryDirectory() as directory:
+            for store in (LocalQuotaStore(window=60), SQLiteQuotaStore(os.path.join(directory, "q.sqlite3"), window=60)):
+                store.spend("a", 100, now=10)
+                store.spend("a", 50, now=20)
+                self.assertEqual(store.used("a", now=30), 150)
+                self.assertEqual(store.used("b", now=30), 0)
+                self.assertEqual(store.used("a", now=70), 0)
+
+    @mock.patch("cpt_analyzer.agents.CPTValidatorAgent.avalidate_cpt_code", return_value=VALIDATOR_RESULT)
+    @mock.patch("cpt_analyzer.agents.CPTAnalyzerAgent.aanalyze_scenario", return_value=ANALYZER_RESULT)
+    async def test_rate_limit_is_per_client(self, *mocks):
+        with override_settings(CPT_ADMISSION=self.LIMITS):
+            self.assertEqual((await self.post("a")).status_code, 200)
+            limited = await self.post("a")
+            self.assertEqual((await self.post("b")).status_code, 200)
+        self.assertEqual(limited.status_code, 429)
+        self.assertEqual(limited.json()["code"], "rate_limited")
+        self.assertEqual(limited["Retry-After"], "1")
+
+    @mock.patch("cpt_analyzer.agents.CPTValidatorAgent.avalidate_cpt_code", return_value=VALIDATOR_RESULT)
+    @mock.patch("cpt_analyzer.agents.CPTAnalyzerAgent.aanalyze_scenario", return_value=ANALYZER_RESULT)
+    async def test_client_header_is_ignored_unless_trusted(self, *mocks):
+        with override_settings(CPT_ADMISSION=dict(self.LIMITS, TRUST_CLIENT_HEADER=False)):
+            self.assertEqual((await self.post("a")).status_code, 200)
+            # A fresh header value does not buy a fresh bucket
+            self.assertEqual((await self.post("b")).status_code, 429)
+
+    @mock.patch("cpt_analyzer.agents.CPTValidatorAgent.avalidate_cpt_code", return_value=VALIDATOR_RESULT)
+    @mock.patch("cpt_analyzer.agents.CPTAnalyzerAgent.aanalyze_scenario", return_value=ANALYZER_RESULT)
+    def test_quota_is_charged_with_the_tokens_spent(self, *mocks):
+        from django.test import Client
+
+        usage = {"prompt_tokens": 600, "completion_tokens": 100, "cached_tokens": 0}
+        mocks[0].return_value = dict(ANALYZER_RESULT, usage=usage)
+        limits = dict(self.LIMITS, RATE=100.0, BURST=10, QUOTA_TOKENS=1000, QUOTAS={"vip": 10 ** 6})
+        with override_settings(CPT_ADMISSION=limits):
+            responses = [self.post("a", Client()) for _ in range(3)] + [self.post("vip", Client())]
+        self.assertEqual([r.status_code for r in responses], [200, 200, 429, 200])
+        self.assertEqual(responses[2].json()["code"], "quota_exceeded")
+        self.assertGreater(int(responses[2]["Retry-After"]), 0)
+
+    @mock.patch("cpt_analyzer.agents.CPTValidatorAgent.avalidate_cpt_code", return_value=VALIDATOR_RESULT)
+    @mock.patch("cpt_analyzer.agents.CPTAnalyzerAgent.aanalyze_scenario", return_value=ANALYZER_RESULT)
+    def test_queued_jobs_are_charged_to_the_submitting_client(self, *mocks):
+        from django.test import Client
+
+        from .jobs import process_next
+        from .models import Job
+
+        mocks[0].return_value = dict(ANALYZER_RESULT, usage={"prompt_tokens": 600, "completion_tokens": 100})
+        limits = dict(self.LIMITS, RATE=100.0, BURST=10, QUOTA_TOKENS=1000)
+        statuses = []
+        with override_settings(CPT_ADMISSION=limits, CPT_JOBS={"WORKERS": 0}):
+            for _ in range(3):
+                response = Client().post("/analyze/", {"scenario": "CMG with EMG", "cache": False, "async": True},
+                                         content_type="application/json", headers={"X-Client-ID": "a"})
+                statuses.append(response.status_code)
+                process_next("test")
+        self.assertEqual(statuses, [202, 202, 429])
+        self.assertEqual(set(Job.objects.values_list("client", flat=True)), {"a"})
+
+    @mock.patch("cpt_analyzer.agents.CPTValidatorAgent.avalidate_cpt_code", return_value=VALIDATOR_RESULT)
+    @mock.patch("cpt_analyzer.agents.CPTAnalyzerAgent.aanalyze_scenario", return_value=ANALYZER_RESULT)
+    async def test_batch_scenarios_are_admitted_and_charged_one_by_one(self, *mocks):
+        from .admission import get_admission
+
+        mocks[0].return_value = dict(ANALYZER_RESULT, usage={"prompt_tokens": 600, "completion_tokens": 100})
+        limits = dict(self.LIMITS, RATE=100.0, BURST=10, QUOTA_TOKENS=1000)
+        with override_settings(CPT_ADMISSION=limits, CPT_BATCH_CONCURRENCY=1):
+            response = await AsyncClient().post("/analyze/batch/", {"scenarios": ["CMG one", "CMG two", "CMG three"],
+                                                                    "cache": False},
+                                                content_type="application/json", headers={"X-Client-ID": "a"})
+            body = b"".join([chunk async for chunk in response.streaming_content])
+            events = [json.loads(line) for line in body.decode().splitlines()]
+            self.assertEqual(get_admission().gate.active, 0)
+        records = [event["data"] for event in events if event["event"] == "result"]
+        self.assertEqual([record["status"] for record in records], ["ok", "ok", "error"])
+        self.assertEqual(records[2]["code"], "quota_exceeded")
+        self.assertEqual(events[-1]["data"]["failed"], 1)
+
+    def test_load_shedding_under_a_local_load_generator(self):
+        from asgiref.sync import async_to_sync
+        from django.core.asgi import get_asgi_application
+
+        from .clients import set_backend
+        from .llm_backends import StubBackend
+        from .loadgen import ClientProfile, run_load
+
+        set_backend(StubBackend(latency=0.05))
+        self.addCleanup(set_backend, None)
+        limits = {"RATE": 50.0, "BURST": 50, "MAX_CONCURRENT": 2, "MAX_QUEUE": 2, "QUEUE_TIMEOUT": 0.05,
+                  "TRUST_CLIENT_HEADER": True}
+        profiles = [ClientProfile("heavy", 200.0, 20), ClientProfile("light", 2.0, 1)]
+        with override_settings(CPT_ADMISSION=limits, CPT_AUDIT_ENABLED=False):
+            report = async_to_sync(run_load)(get_asgi_application(), profiles, ["Simple cystometrogram"],
+                                             mode="analyzer_only", host="testserver")
+        self.assertEqual(report["requests"], 21, report)
+        self.assertGreater(report["statuses"].get("503", 0), 0, report)
+        self.assertGreater(report["statuses"].get("200", 0), 0)
+        self.assertEqual(report["rejections_without_retry_after"], 0)
+        self.assertLess(report["rejected_p95_s"], 0.5)
+
+
+class StartupTests(TestCase):
+    def test_warm_up_compiles_the_default_specialty(self):
+        from .warmup import warm_up
+
+        report = warm_up(import_clients=False)
+        self.assertEqual(list(report["specialties"]), ["urinary"])
+        self.assertGreater(report["specialties"]["urinary"]["codes"], 0)
+
+    def test_views_import_without_heavy_modules(self):
+        from .startup import run_probe, summarize
+
+        summary = summarize([run_probe(warm=False)])
+        self.assertEqual(summary["heavy_modules_at_import"], [])
+        self.assertEqual([step["step"] for step in summary["steps"]], ["django.setup", "import views"])
+
+
+class GuidelineIndexTests(TestCase):
+    PAGES = [
+        "Cystourethroscopy\n\nCode 52000 reports a diagnostic cystourethroscopy. It is included in every "
+        "therapeutic cystourethroscopy and is not reported separately when 52224 or 52234 is performed.",
+        "Urodynamics\n\nA complex cystometrogram (51728, 51729) includes the simple study 51725. Report needle "
+        "electromyography 51785 in addition when the sphincter is studied in the same session.",
+    ]
+
+    def setUp(self):
+        from .guidelines import reset_guideline_index
+
+        reset_guideline_index()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.index_path = os.path.join(self.tmp.name, "index")
+        self.export = os.path.join(self.tmp.name, "guidelines.txt")
+        self.write_export(self.PAGES)
+        self.addCleanup(self.tmp.cleanup)
+        self.addCleanup(reset_guideline_index)
+
+    def write_export(self, pages):
+        with open(self.export, "w") as handle:
+            handle.write("\f".join(pages))
+
+    def ingest(self):
+        from .guidelines import ingest
+
+        return ingest("guidelines.pdf", self.index_path, text_export=self.export)
+
+    def test_ingest_is_incremental(self):
+        built = self.ingest()
+        self.assertEqual((built["status"], built["pages"], built["pages_reused"]), ("built", 2, 0))
+        self.assertEqual(self.ingest()["status"], "unchanged")
+
+        self.write_export([self.PAGES[0], self.PAGES[1] + " Uroflowmetry 51741 is reported separately."])
+        rebuilt = self.ingest()
+        self.assertEqual((rebuilt["pages_extracted"], rebuilt["pages_reused"]), (1, 1))
+        self.assertNotEqual(rebuilt["version"], built["version"])
+
+    def test_search_ranks_by_text_and_candidate_codes(self):
+        from .guidelines import GuidelineIndex, citations, current_directory
+
+        self.ingest()
+        index = GuidelineIndex(current_directory(self.index_path))
+        passages = index.search("complex cystometrogram with needle EMG of the sphincter", k=2)
+        self.assertEqual(passages[0].page, 2)
+        boosted = index.search("bladder", codes=["52000"], k=1)
+        self.assertEqual(boosted[0].page, 1)
+        cited = citations(passages)
+        self.assertEqual((cited[0]["id"], cited[0]["source"], cited[0]["page"]), ("G1", "guidelines.pdf", 2))
+
+    def test_pipeline_injects_passages_and_returns_citations(self):
+        from .pipeline import run_pipeline
+
+        self.ingest()
+        config = {"ENABLED": True, "INDEX_PATH": self.index_path, "MAX_PASSAGES": 2, "MAX_TOKENS": 450, "MIN_SCORE": 0.5}
+        with override_settings(OPENAI_API_KEY="test-key", CPT_GUIDELINES=config), \
+                mock.patch("cpt_analyzer.agents.CPTAnalyzerAgent.aanalyze_scenario", return_value=ANALYZER_RESULT) as analyze, \
+                mock.patch("cpt_analyzer.agents.CPTValidatorAgent.avalidate_cpt_code", return_value=VALIDATOR_RESULT) as validate:
+            result = run_pipeline("Complex cystometrogram with needle EMG of the urethral sphincter", use_cache=False)
+        guidance = analyze.call_args.kwargs["guidance"]
+        self.assertEqual(guidance[0].page, 2)
+        self.assertIs(validate.call_args.kwargs["guidance"], guidance)
+        self.assertEqual(result["guideline_citations"][0]["page"], 2)
+
+    def test_prompt_renders_labelled_passages(self):
+        from .guidelines import GuidelineIndex, current_directory
+        from .prompts import ANALYZER_TEMPLATE
+
+        self.ingest()
+        passages = GuidelineIndex(current_directory(self.index_path)).search("complex cystometrogram", k=1)
+        messages = ANALYZER_TEMPLATE.compile(make_catalog(), 5).messages("Complex CMG", guidance=passages)
+        self.assertIn("[G1] (guidelines.pdf, p. 2)", messages[1]["content"])
+        self.assertNotIn("GUIDELINE EXCERPTS", ANALYZER_TEMPLATE.compile(make_catalog(), 5).messages("Complex CMG")[1]["content"])
+
+
+class CodeLookupTests(TestCase):
+    def make_index(self):
+        from .lookup import CodeIndex
+        from .rules import EditPair
+
+        catalog = CPTCatalog(list(make_catalog()) + [
+            CPTEntry("51729", "Complex cystometrogram with voiding pressure and urethral pressure profile studies.", "Bladder", "Urodynamics"),
+            CPTEntry("51797", "Voiding pressure studies, intra-abdominal (List separately in addition to code for primary procedure)", "Bladder", "Urodynamics"),
+            CPTEntry("50436", "Dilation of existing tract, percutaneous, for an endourologic procedure, unilateral or bilateral", "Kidney", "Introduction"),
+        ], [CPTSection("Bladder", "51020-51999")])
+        edits = {("51729", "51725"): EditPair("51729", "51725", 0, "Complex CMG includes the simple study")}
+        return CodeIndex(catalog, edits)
+
+    def test_prefix_and_keyword_lookup(self):
+        index = self.make_index()
+        self.assertEqual([e["code"] for e in index.by_prefix("517")], ["51702", "51725", "51729", "51797"])
+        self.assertEqual(index.by_prefix("517", limit=1)[0]["code"], "51702")
+        self.assertEqual(index.complete("51785-51"), ("code", []))
+        self.assertEqual(index.complete("50590-50")[1][0]["code"], "50590")
+        # Every word matches as a prefix; codes matching all of them rank first, synonyms included
+        self.assertEqual(index.search("complex cysto")[0]["code"], "51729")
+        self.assertEqual(index.search("kidney stone")[0]["code"], "50080")
+        self.assertEqual(index.complete("foley")[1][0]["code"], "51702")
+        self.assertEqual([e["code"] for e in index.search("cystometrogram 5172")], ["51725", "51729"])
+
+    def test_modifier_validity_and_verify(self):
+        index = self.make_index()
+        self.assertEqual(index.check_modifiers("51725", ("51",)), [])
+        self.assertIn("-51 not allowed: Add-on codes are exempt from -51", index.check_modifiers("51797", ("51",)))
+        self.assertIn("-50 not allowed: Code is inherently bilateral", index.check_modifiers("50436", ("50",)))
+        self.assertEqual(index.check_modifiers("50590", ("ZZ",)), ["Unknown modifier -ZZ"])
+        self.assertEqual(index.detail("51725")["bundling"]["bundled_into"], ["51729"])
+
+        with override_settings(CPT_NCCI_EDITS_PATH=""):
+            verified = index.verify(["51725", "99999", "5172"])
+        self.assertFalse(verified["valid"])
+        self.assertEqual([item["valid"] for item in verified["codes"]], [True, False, False])
+
+    def test_views_serve_from_the_index(self):
+        response = self.client.get("/codes/", {"q": "517", "limit": 3})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["match"], "prefix")
+        self.assertEqual(len(data["results"]), 3)
+        self.assertTrue(all(entry["code"].startswith("517") for entry in data["results"]))
+        self.assertLess(data["elapsed_ms"], 1.0)
+
+        detail = self.client.get("/codes/51729-51-51/").json()
+        self.assertEqual((detail["code"], detail["valid"]), ("51729", False))
+        self.assertEqual(self.client.get("/codes/00000/").status_code, 404)
+        self.assertEqual(self.client.get("/codes/", {"q": "x", "specialty": "nope"}).status_code, 400)
+
+        verified = self.client.get("/codes/verify/", {"codes": "51729,51725"}).json()
+        self.assertIn("bundling", [finding["rule"] for finding in verified["findings"]])
+        self.assertFalse(verified["valid"])
+        self.assertEqual(verified["suggested"], ["51729", "51725"])
@@ -0,0 +1,187 @@
+"""
+Model tiering for the analyzer.
+
+With settings.CPT_MODEL_TIERING enabled, the analyzer first runs on the
+cheaper 'analyzer_fast' model (settings.CPT_AGENT_MODELS). Its answer is kept
+unless one of the ESCALATE_ON triggers fires, in which case the scenario is
+analyzed again on the 'analyzer' model:
+
+  check_failed     local catalog checks reject the answer (see cpt_analyzer.checks)
+  low_confidence   the checks' confidence is below MIN_CONFIDENCE
+  multi_procedure  the answer has several codes or the scenario reads as several procedures
+  error            the fast call failed (always escalated)
+
+Every decision is counted, logged with the fast call's latency and cost and,
+when LOG_PATH is set, appended to a JSON-lines file so the triggers can be
+tuned against the benchmark corpus.
+"""
+import datetime
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+
+from .agents import FAST_ANALYZER_STAGE, CPTAnalyzerAgent, stage_options, tiering_settings
+from .checks import check_analyzer_result, local_validation
+from .metrics import Counter, registry, timed
+from .preprocess import estimate_cost
+
+logger = logging.getLogger(__name__)
+
+ESCALATION_TRIGGERS = ("check_failed", "low_confidence", "multi_procedure")
+CONFIDENCE_LEVELS = {"Low": 0, "Medium": 1, "High": 2}
+# Phrases that introduce a second procedure in the same encounter
+MULTI_PROCEDURE_RE = re.compile(
+    r"\b(additionally|in addition|followed by|as well as|subsequently|same (?:session|setting|sitting)"
+    r"|also (?:performed|placed|removed|inserted|underwent|had))\b",
+    re.IGNORECASE,
+)
+
+TIER_DECISIONS = registry.register(Counter(
+    "cpt_model_tier_decisions_total", "Analyzer tiering decisions by outcome and escalation reason",
+    ("decision", "reason")))
+
+_log_lock = threading.Lock()
+
+
+def escalation_reasons(scenario_text, check, confidence, config):
+    """
+    Which enabled triggers fire for a fast analyzer answer
+
+    Args:
+        scenario_text (str): The scenario that was analyzed
+        check (CheckResult): Local checks of the fast answer
+        confidence (str): Confidence the local checks give the answer
+        config (dict): CPT_MODEL_TIERING settings
+
+    Returns:
+        list: Trigger names, empty when the fast answer can be kept
+    """
+    escalate_on = config["ESCALATE_ON"]
+    reasons = []
+    # Several codes fail the checks too; that case is reported as multi_procedure only
+    if "check_failed" in escalate_on and any(reason != "multiple codes" for reason in check.reasons):
+        reasons.append("check_failed")
+    if "low_confidence" in escalate_on and (
+            CONFIDENCE_LEVELS.get(confidence, 0) < CONFIDENCE_LEVELS.get(config["MIN_CONFIDENCE"], 0)):
+        reasons.append("low_confidence")
+    if "multi_procedure" in escalate_on and (
+            len(check.codes) > 1 or "multiple codes" in check.reasons or MULTI_PROCEDURE_RE.search(scenario_text)):
+        reasons.append("multi_procedure")
+    return reasons
+
+
+def usage_cost(model, usage):
+    """USD cost of one call's token usage; None for an unpriced model"""
+    usage = usage or {}
+    return estimate_cost(model, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0),
+                         usage.get("cached_tokens", 0))
+
+
+class TierDecision:
+    """Which analyzer tier answered a scenario, why, and what each tier cost"""
+
+    def __init__(self, fast_model, model):
+        self.fast_model = fast_model
+        self.model = model
+        self.escalated = False
+        self.reasons = []
+        self.fast_ms = 0.0
+        self.fast_cost_usd = None
+        self.escalation_ms = 0.0
+        self.escalation_cost_usd = None
+
+    @property
+    def decision(self):
+        return "escalated" if self.escalated else "fast"
+
+    def as_dict(self):
+        return {
+            "decision": self.decision,
+            "fast_model": self.fast_model,
+            "model": self.model if self.escalated else self.fast_model,
+            "reasons": self.reasons,
+            "fast_ms": self.fast_ms,
+            "fast_cost_usd": self.fast_cost_usd,
+            "escalation_ms": self.escalation_ms,
+            "escalation_cost_usd": self.escalation_cost_usd,
+        }
+
+    def record(self, scenario_text, fast_result, result, log_path=""):
+        """Count and log the decision; append it to `log_path` as one JSON line when set"""
+        for reason in self.reasons or ("none",):
+            TIER_DECISIONS.inc(decision=self.decision, reason=reason)
+        logger.info(
+            "Analyzer tier %s (%s): fast %s %.0f ms $%s, escalation %.0f ms $%s",
+            self.decision, ", ".join(self.reasons) or "no trigger", self.fast_model, self.fast_ms,
+            self.fast_cost_usd, self.escalation_ms, self.escalation_cost_usd,
+        )
+        if not log_path:
+            return
+        entry = dict(
+            self.as_dict(),
+            at=datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            scenario_sha256=hashlib.sha256(scenario_text.encode("utf-8")).hexdigest()[:16],
+            fast_codes=fast_result.get("cpt_code"),
+            codes=result.get("cpt_code"),
+        )
+        try:
+            with _log_lock, open(log_path, "a", encoding="utf-8") as handle:
+                handle.write(json.dumps(entry) + "\n")
+        except OSError:
+            logger.exception("Could not append the tiering decision to %s", log_path)
+
+
+async def aanalyze_tiered(catalog, scenario_text, examples=(), guidance=()):
+    """
+    Analyze a scenario on the fast tier, escalating to the full analyzer model when needed
+
+    Returns:
+        tuple: (analyzer result, TierDecision or None when tiering is disabled). An
+        escalated result carries the fast answer and its usage under 'escalated_from'.
+    """
+    config = tiering_settings()
+    if not config["ENABLED"]:
+        agent = CPTAnalyzerAgent(catalog)
+        return await agent.aanalyze_scenario(scenario_text, examples=examples, guidance=guidance), None
+
+    decision = TierDecision(stage_options(FAST_ANALYZER_STAGE)["model"], stage_options("analyzer")["model"])
+    started = time.monotonic()
+    fast_result = await CPTAnalyzerAgent(catalog, stage=FAST_ANALYZER_STAGE).aanalyze_scenario(
+        scenario_text, examples=examples, guidance=guidance)
+    decision.fast_ms = round((time.monotonic() - started) * 1000, 1)
+
+    if "error" in fast_result:
+        decision.reasons = ["error"]
+    else:
+        decision.fast_cost_usd = usage_cost(decision.fast_model, fast_result.get("usage"))
+        with timed("tiering.checks"):
+            check = check_analyzer_result(catalog, scenario_text, fast_result)
+            confidence = local_validation(fast_result, check, catalog)["confidence"]
+        decision.reasons = escalation_reasons(scenario_text, check, confidence, config)
+
+    result = fast_result
+    if decision.reasons:
+        decision.escalated = True
+        started = time.monotonic()
+        result = await CPTAnalyzerAgent(catalog).aanalyze_scenario(scenario_text, examples=examples, guidance=guidance)
+        decision.escalation_ms = round((time.monotonic() - started) * 1000, 1)
+        if "error" not in result:
+            decision.escalation_cost_usd = usage_cost(decision.model, result.get("usage"))
+            if "error" not in fast_result:
+                result["escalated_from"] = {
+                    "model": decision.fast_model,
+                    "cpt_code": fast_result["cpt_code"],
+                    "usage": fast_result.get("usage") or {},
+                }
+
+    if config["LOG_PATH"]:
+        # Keep the file append off the event loop
+        await sync_to_async(decision.record)(scenario_text, fast_result, result, config["LOG_PATH"])
+    else:
+        decision.record(scenario_text, fast_result, result)
+    return result, decision
@@ -4,4 +4,13 @@ from . import views
 urlpatterns = [
     path('', views.index, name='index'),
     path('analyze/', views.analyze_cpt, name='analyze_cpt'),
+    path('analyze/batch/', views.analyze_batch, name='analyze_batch'),
+    path('jobs/', views.jobs, name='jobs'),
+    path('jobs/<uuid:job_id>/', views.job_detail, name='job_detail'),
+    path('analyses/', views.analyses, name='analyses'),
+    path('analyses/<int:pk>/', views.analysis_detail, name='analysis_detail'),
+    path('codes/', views.codes, name='codes'),
+    path('codes/verify/', views.code_verify, name='code_verify'),
+    path('codes/<str:code>/', views.code_detail, name='code_detail'),
+    path('metrics', views.metrics, name='metrics'),
 ] 
\ No newline at end of file
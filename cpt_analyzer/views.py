@@ -1,18 +1,41 @@
 from django.shortcuts import render
-from django.http import JsonResponse
-from .agents import CPTAnalyzerAgent, CPTValidatorAgent
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.conf import settings
+from django.urls import reverse
+from asgiref.sync import sync_to_async
+from .admission import acharge, scenario_admission
+from .audit import arecord_analysis, query_analyses
+from .batch import BatchRunner, normalize_record, detect_format, read_scenarios
+from .catalog import get_catalog
+from .checks import parse_code
+from .jobs import ensure_workers, submit_job
+from .lookup import MAX_LIMIT, get_code_index, timed_lookup
+from .metrics import Trace, registry
+from .models import Analysis, Job
+from .pipeline import (ERROR_TOKEN_BUDGET, EVENT_ERROR, EVENT_RESULT, arun_pipeline, astream_pipeline, preview_pipeline,
+                       resolve_mode, result_usage)
 import json
 
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
 def index(request):
     """Render the main page of the application"""
     return render(request, 'index.html')
 
-def analyze_cpt(request):
+async def analyze_cpt(request):
     """
     Analyze a medical scenario and return the appropriate CPT code(s)
     
     This view handles the AJAX request from the frontend, processes the
     medical scenario using both agents, and returns the results as JSON.
+    Clients that send `Accept: application/x-ndjson` instead receive one JSON
+    line per pipeline stage, so the analyzer result arrives while the
+    validator is still running. With {"async": true} in the body or a
+    `Prefer: respond-async` header the scenario is queued instead and the
+    response is 202 with the job to poll (see `jobs`). With {"dry_run": true}
+    only the preprocessing runs: the response shows the cleaned scenario and
+    the estimated tokens and cost without calling the models.
     """
     if request.method == 'POST':
         try:
@@ -23,46 +46,278 @@ def analyze_cpt(request):
             if not scenario_text:
                 return JsonResponse({'error': 'No scenario provided'}, status=400)
             
-            # Initialize the agents
-            analyzer_agent = CPTAnalyzerAgent()
-            validator_agent = CPTValidatorAgent()
+            # Clients can send {"cache": false} to force a fresh analysis
+            use_cache = data.get('cache', True) is not False
             
-            # Get the analysis from the first agent
-            analyzer_result = analyzer_agent.analyze_scenario(scenario_text)
+            # Optional pipeline mode: full, adaptive, analyzer_only or speculative
+            try:
+                mode = resolve_mode(data.get('mode'))
+            except ValueError as e:
+                return JsonResponse({'error': str(e)}, status=400)
             
-            # Check if there was an error with the first agent
-            if 'error' in analyzer_result:
-                return JsonResponse({'error': analyzer_result['error']}, status=500)
+            if data.get('dry_run'):
+                return JsonResponse(await sync_to_async(preview_pipeline)(scenario_text, mode))
             
-            # Validate the result with the second agent
-            validator_result = validator_agent.validate_cpt_code(scenario_text, analyzer_result)
+            # Queue instead of waiting; interactive submissions run ahead of batch backfills
+            if data.get('async') or 'respond-async' in request.headers.get('Prefer', ''):
+                try:
+                    job = await sync_to_async(_submit)(request, data, Job.PRIORITY_INTERACTIVE)
+                except ValueError as e:
+                    return JsonResponse({'error': str(e)}, status=400)
+                return _job_accepted(job)
             
-            # Check if there was an error with the second agent
-            if 'error' in validator_result:
-                return JsonResponse({'error': validator_result['error']}, status=500)
+            # Stage timings for this request; an upstream X-Request-ID is reused as the trace id
+            trace = Trace(request.headers.get('X-Request-ID'))
             
-            # Check if there are multiple CPT codes
-            has_multiple_codes = ',' in validator_result['cpt_code']
+            if NDJSON_CONTENT_TYPE in request.headers.get('Accept', ''):
+                response = StreamingHttpResponse(
+                    _ndjson_events(_audited(astream_pipeline(scenario_text, use_cache=use_cache, mode=mode, trace=trace), scenario_text, request)),
+                    content_type=NDJSON_CONTENT_TYPE,
+                )
+                response['Cache-Control'] = 'no-cache'
+                response['X-Accel-Buffering'] = 'no'
+                response['X-Trace-Id'] = trace.trace_id
+                return response
             
-            # Combine the results
-            result = {
-                'analyzer_result': analyzer_result,
-                'validator_result': validator_result,
-                'final_cpt_code': validator_result['cpt_code'],
-                'final_description': validator_result['description'],
-                'final_explanation': validator_result['explanation'],
-                'confidence': validator_result['confidence'],
-                'has_multiple_codes': has_multiple_codes,
-                'cpt_codes': validator_result['cpt_code'].split(', ') if has_multiple_codes else [validator_result['cpt_code']]
-            }
+            result = await arun_pipeline(scenario_text, use_cache=use_cache, mode=mode, trace=trace)
             
-            return JsonResponse(result)
+            # Check if either agent reported an error
+            if 'error' in result:
+                # Over-budget scenarios are the client's to shorten; anything else is a server-side failure
+                status = 413 if result.get('code') == ERROR_TOKEN_BUDGET else 500
+                response = JsonResponse(dict(result, trace=trace.as_dict()), status=status)
+            else:
+                await arecord_analysis(scenario_text, result)
+                # Count the tokens against the client's quota (see cpt_analyzer.admission)
+                await acharge(request, result_usage(result))
+                response = JsonResponse(result)
+            response['X-Trace-Id'] = trace.trace_id
+            if settings.CPT_SERVER_TIMING:
+                response['Server-Timing'] = trace.server_timing()
+            return response
             
         except Exception as e:
             return JsonResponse({'error': str(e)}, status=500)
     
     return JsonResponse({'error': 'Only POST requests are allowed'}, status=405)
 
+async def _audited(events, scenario_text, request):
+    """Pass pipeline events through, storing the final result in the audit log and charging its tokens"""
+    async for event, payload in events:
+        if event == EVENT_RESULT:
+            await arecord_analysis(scenario_text, payload)
+            await acharge(request, result_usage(payload))
+        yield event, payload
+
+async def _ndjson_events(events):
+    """Serialize pipeline events as newline-delimited JSON"""
+    try:
+        async for event, payload in events:
+            yield json.dumps({'event': event, 'data': payload}) + '\n'
+    except Exception as e:
+        yield json.dumps({'event': EVENT_ERROR, 'data': {'error': str(e)}}) + '\n'
+
+async def analyze_batch(request):
+    """
+    Code many scenarios in one request, streaming results as they complete
+    
+    Accepts either a multipart upload (`file`: CSV, JSONL or XLSX with a
+    `scenario` column and optional `id`) or a JSON body of the form
+    {"scenarios": ["...", {"id": "...", "scenario": "..."}]}. The response is
+    newline-delimited JSON: one `result` event per scenario followed by a
+    `summary` event with throughput and token usage.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Only POST requests are allowed'}, status=405)
+    
+    try:
+        upload = request.FILES.get('file')
+        if upload is not None:
+            items = read_scenarios(upload.file, request.POST.get('format') or detect_format(upload.name))
+            use_cache = request.POST.get('cache') != 'false'
+            mode = resolve_mode(request.POST.get('mode'))
+        else:
+            data = json.loads(request.body)
+            items = [normalize_record(row, index) for index, row in enumerate(data.get('scenarios') or [], start=1)]
+            items = [item for item in items if item['scenario']]
+            use_cache = data.get('cache', True) is not False
+            mode = resolve_mode(data.get('mode'))
+    except (ValueError, KeyError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    
+    if not items:
+        return JsonResponse({'error': 'No scenarios provided'}, status=400)
+    if len(items) > settings.CPT_BATCH_MAX_SCENARIOS:
+        return JsonResponse({
+            'error': f'At most {settings.CPT_BATCH_MAX_SCENARIOS} scenarios per request; '
+                     f'use `manage.py code_scenarios` for larger files'
+        }, status=400)
+    
+    # Each scenario is rate limited, quota checked, holds a slot and is charged like a request of its own
+    runner = BatchRunner(use_cache=use_cache, mode=mode, admit=scenario_admission(request))
+    
+    async def events():
+        async for record in runner.run(items):
+            yield EVENT_RESULT, record
+        yield 'summary', runner.stats.summary()
+    
+    response = StreamingHttpResponse(_ndjson_events(events()), content_type=NDJSON_CONTENT_TYPE)
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+def metrics(request):
+    """Expose this worker's counters and stage histograms in the Prometheus text format"""
+    if not settings.CPT_METRICS_ENABLED:
+        raise Http404('Metrics are disabled')
+    return HttpResponse(registry.render(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+def jobs(request):
+    """
+    Queue a scenario for analysis and return at once
+    
+    The JSON body takes `scenario` plus optional `mode`, `cache`, `priority`
+    ('interactive', 'normal', 'batch' or an integer, lower first), `id` and
+    `callback_url`, which receives the finished job as a JSON POST. The 202
+    response points at /jobs/<id>/ for polling.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Only POST requests are allowed'}, status=405)
+    try:
+        job = _submit(request, json.loads(request.body))
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return _job_accepted(job)
+
+def job_detail(request, job_id):
+    """Status of a queued job; includes the result once it is done"""
+    try:
+        job = Job.objects.get(pk=job_id)
+    except Job.DoesNotExist:
+        return JsonResponse({'error': f'Job {job_id} not found'}, status=404)
+    if job.status == Job.QUEUED:
+        # Jobs may have been queued by another process; make sure this one is working too
+        ensure_workers()
+    return JsonResponse(job.as_dict())
+
+def _submit(request, data, default_priority=Job.PRIORITY_NORMAL):
+    """Queue a job and describe it (queue position needs the database, so this runs synchronously)"""
+    # The job charges its tokens to the client admitted for this request (see cpt_analyzer.admission)
+    job = submit_job(data, default_priority, client=getattr(request, 'admission_client', None) or '')
+    return dict(job.as_dict(), status_url=reverse('job_detail', args=[job.pk]))
+
+def _job_accepted(job):
+    response = JsonResponse(job, status=202)
+    response['Location'] = job['status_url']
+    return response
+
+def analyses(request):
+    """
+    List stored analyses, newest first
+    
+    Query parameters: code, confidence, mode, source, specialty, scenario,
+    scenario_hash, since/until (ISO dates) and limit. Pass the `next` value
+    of a page as `before` to get the following page.
+    """
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Only GET requests are allowed'}, status=405)
+    try:
+        return JsonResponse(query_analyses(request.GET))
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+def analysis_detail(request, pk):
+    """One stored analysis with its codes, agent outputs, rule findings and stage timings"""
+    try:
+        analysis = Analysis.objects.prefetch_related('codes').get(pk=pk)
+    except Analysis.DoesNotExist:
+        return JsonResponse({'error': f'Analysis {pk} not found'}, status=404)
+    return JsonResponse(analysis.as_dict(detail=True))
+
+def _code_index(request):
+    """The lookup index of the requested specialty's catalog; raises ValueError for bad parameters"""
+    try:
+        catalog = get_catalog(request.GET.get('specialty') or None)
+    except KeyError:
+        raise ValueError(f"Unknown specialty '{request.GET['specialty']}'")
+    if catalog is None:
+        raise LookupError('CPT catalog is not available')
+    return get_code_index(catalog)
+
+def _lookup_response(data, elapsed_ms, status=200):
+    response = JsonResponse(data, status=status)
+    if settings.CPT_SERVER_TIMING:
+        response['Server-Timing'] = f'lookup;dur={elapsed_ms}'
+    return response
+
+def codes(request):
+    """
+    Autocomplete over the CPT catalog, served from the in-memory index
+    
+    Query parameters: q (a code prefix such as '517', a full code such as
+    '51785-51', or description words, each matched as a prefix), limit
+    (default 10, at most 50) and specialty.
+    """
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Only GET requests are allowed'}, status=405)
+    try:
+        limit = min(max(int(request.GET.get('limit', 10)), 1), MAX_LIMIT)
+        code_index = _code_index(request)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except LookupError as e:
+        return JsonResponse({'error': str(e)}, status=503)
+    query = request.GET.get('q', '').strip()
+    if not query:
+        return JsonResponse({'query': query, 'match': None, 'results': []})
+    (match, results), elapsed_ms = timed_lookup('complete', code_index.complete, query, limit)
+    return _lookup_response({'query': query, 'match': match, 'results': results, 'elapsed_ms': elapsed_ms}, elapsed_ms)
+
+def code_detail(request, code):
+    """
+    One catalog code with the modifiers it may carry and its bundling edits
+    
+    A code with modifiers ('51785-51') also reports whether they are valid.
+    """
+    try:
+        code_index = _code_index(request)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except LookupError as e:
+        return JsonResponse({'error': str(e)}, status=503)
+    parsed = parse_code(code)
+    detail = code_index.detail(parsed.code) if parsed else None
+    if detail is None:
+        return JsonResponse({'error': f'Code {code} is not in the CPT catalog'}, status=404)
+    if not parsed.modifiers:
+        return JsonResponse(detail)
+    issues, elapsed_ms = timed_lookup('modifiers', code_index.check_modifiers, parsed.code, parsed.modifiers)
+    return _lookup_response(dict(detail, requested_modifiers=list(parsed.modifiers), valid=not issues,
+                                 issues=issues), elapsed_ms)
+
+def code_verify(request):
+    """
+    Check proposed codes locally, without a model call
+    
+    Query parameters: codes (comma-separated, e.g. '51729,51785-51'),
+    optional scenario (decides bilateral modifiers) and specialty. Returns
+    per-code catalog and modifier checks, the rule engine's bundling and
+    sequencing findings and the corrected code list.
+    """
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Only GET requests are allowed'}, status=405)
+    proposed = [code.strip() for code in request.GET.get('codes', '').split(',') if code.strip()]
+    if not proposed:
+        return JsonResponse({'error': 'Pass the codes to verify as ?codes=51729,51785-51'}, status=400)
+    try:
+        code_index = _code_index(request)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except LookupError as e:
+        return JsonResponse({'error': str(e)}, status=503)
+    result, elapsed_ms = timed_lookup('verify', code_index.verify, proposed, request.GET.get('scenario', ''))
+    return _lookup_response(dict(result, elapsed_ms=elapsed_ms), elapsed_ms)
+
 def format_explanation(explanation):
     """
     Format the explanation to highlight key points from the guidelines
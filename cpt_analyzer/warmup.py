@@ -0,0 +1,76 @@
+"""
+Warm a process up before it serves requests.
+
+Loads the specialty catalogs (from their snapshots when fresh), compiles the
+prompt prefixes, retrievers, rule tables and code lookup indexes, and imports
+the modules the first analysis would otherwise import. Run it in the gunicorn
+master with
+`--preload` (see gunicorn.conf.py) so forked workers share one copy of all of
+this copy-on-write, or with `manage.py warmup` to build the snapshots ahead of
+a deploy.
+
+No network connections are opened: pooled clients and sockets must not be
+created before the fork.
+"""
+import gc
+import importlib
+import logging
+import time
+
+from django.conf import settings
+
+from .catalog import get_registry
+from .lookup import get_code_index
+from .prompts import TEMPLATES
+from .retrieval import get_retriever
+from .rules import get_rule_engine
+
+logger = logging.getLogger(__name__)
+
+# Imported lazily by the request path; loading them up front keeps them in the shared pages
+CLIENT_MODULES = ("httpx", "openai")
+
+
+def warm_up(specialties=None, import_clients=True, freeze=False):
+    """
+    Load and compile everything the first request needs
+
+    Args:
+        specialties (list): Specialty names to load; the default specialty when omitted, every one for 'all'
+        import_clients (bool): Also import openai and httpx
+        freeze (bool): Move everything loaded so far out of the garbage collector's reach
+            (gc.freeze), so collections in forked workers do not touch and copy the shared pages
+
+    Returns:
+        dict: {'specialties': {name: {'codes', 'version', 'seconds'}}, 'seconds'}
+    """
+    started = time.monotonic()
+    registry = get_registry()
+    if specialties == "all":
+        specialties = [shard.name for shard in registry]
+    report = {}
+    for name in specialties or [registry.default]:
+        shard_started = time.monotonic()
+        catalog = registry.get(name)
+        if catalog is None:
+            logger.warning("Warm-up could not load the %s catalog", name)
+            continue
+        for template in TEMPLATES:
+            template.compile(catalog, settings.CPT_PROMPT_TOP_K)
+        get_retriever(catalog)
+        get_rule_engine(catalog)
+        get_code_index(catalog)
+        report[name] = {
+            "codes": len(catalog),
+            "version": catalog.version,
+            "seconds": round(time.monotonic() - shard_started, 3),
+        }
+    if import_clients:
+        for module in CLIENT_MODULES:
+            importlib.import_module(module)
+    if freeze:
+        gc.collect()
+        gc.freeze()
+    seconds = round(time.monotonic() - started, 3)
+    logger.info("Warmed up %s in %.3fs", ", ".join(report) or "nothing", seconds)
+    return {"specialties": report, "seconds": seconds}
@@ -0,0 +1,33 @@
+"""
+gunicorn settings for serving medical_coding with forked workers.
+
+    gunicorn medical_coding.wsgi -c gunicorn.conf.py
+    gunicorn medical_coding.asgi -k uvicorn.workers.UvicornWorker -c gunicorn.conf.py
+
+The application is loaded once in the master (preload_app) and warmed up
+before the first fork, so every worker shares the catalogs, compiled prompts
+and imported modules copy-on-write instead of loading its own copy.
+"""
+import os
+
+bind = os.getenv("GUNICORN_BIND", "127.0.0.1:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", 2))
+preload_app = True
+# Comma-separated specialties to load before forking ('all' for every one; default: the default specialty)
+WARMUP_SPECIALTIES = os.getenv("CPT_WARMUP_SPECIALTIES", "")
+
+
+def when_ready(server):
+    # Runs in the master after the app is loaded and before any worker is forked
+    from cpt_analyzer.warmup import warm_up
+
+    names = [name.strip() for name in WARMUP_SPECIALTIES.split(",") if name.strip()]
+    report = warm_up("all" if names == ["all"] else names or None, freeze=True)
+    server.log.info("Warmed up %s in %.3fs", ", ".join(report["specialties"]), report["seconds"])
+
+
+def post_fork(server, worker):
+    # Database connections must not be shared with the master
+    from django.db import connections
+
+    connections.close_all()
@@ -47,6 +47,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
+    # Rate limits, quotas and the concurrency cap for the analysis endpoints; runs early so rejections are cheap
+    "cpt_analyzer.admission.AdmissionMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -131,3 +133,250 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 # OpenAI API Key
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+
+# CPT code catalog
+CPT_DATA_PATH = os.getenv('CPT_DATA_PATH', os.path.join(BASE_DIR, 'data', 'Urinery.xlsx'))
+# Precompiled snapshot, used when fresh. Written after the workbook is parsed (or by `manage.py build_cpt_snapshot`)
+# so workers do not import pandas/openpyxl; set it to '' to always parse the workbook.
+CPT_CATALOG_SNAPSHOT = os.getenv('CPT_CATALOG_SNAPSHOT', os.path.join(BASE_DIR, 'data', 'Urinery.catalog.pickle'))
+# Specialty shards. Each has its own workbook (PATH) and optional SNAPSHOT, loaded on first use;
+# scenarios are routed to shards by KEYWORDS and by explicit codes within CODE_RANGES (see cpt_analyzer.routing).
+# The default specialty uses CPT_DATA_PATH/CPT_CATALOG_SNAPSHOT unless PATH/SNAPSHOT are given.
+# PROMPT_EXAMPLES is an optional text file of worked examples, added to the shard's prompt prefix only
+# while it is shorter than the 1024 tokens providers need for prompt caching (read when the shard loads).
+CPT_DEFAULT_SPECIALTY = 'urinary'
+CPT_SPECIALTIES = {
+    'urinary': {
+        'LABEL': 'urinary system',
+        'CODE_RANGES': ['50010-53899'],
+        'PROMPT_EXAMPLES': os.path.join(BASE_DIR, 'data', 'urinary.prompt_examples.txt'),
+        'KEYWORDS': [
+            'kidney', 'renal', 'nephrectomy', 'nephrostomy', 'nephrolithotomy', 'pyeloplasty', 'ureter',
+            'ureteral', 'ureteroscopy', 'stent', 'bladder', 'cystoscopy', 'cystourethroscopy', 'cystometrogram',
+            'urodynamic', 'uroflowmetry', 'catheter', 'urethra', 'urethral', 'urethroplasty', 'prostate',
+            'lithotripsy', 'calculus', 'stone', 'urinary', 'incontinence', 'sling', 'voiding', 'cystostomy',
+        ],
+    },
+    # 'integumentary': {
+    #     'LABEL': 'integumentary system',
+    #     'PATH': os.path.join(BASE_DIR, 'data', 'Integumentary.xlsx'),
+    #     'SNAPSHOT': os.path.join(BASE_DIR, 'data', 'Integumentary.catalog.pickle'),
+    #     'CODE_RANGES': ['10030-19499'],
+    #     'KEYWORDS': ['skin', 'laceration', 'wound', 'debridement', 'lesion', 'graft', 'breast', 'nail'],
+    # },
+}
+# Most shards a single scenario's prompt may draw codes from
+CPT_MAX_SPECIALTIES = int(os.getenv('CPT_MAX_SPECIALTIES', '2'))
+# Number of retrieved candidate codes placed in each prompt (0 = whole catalog)
+CPT_PROMPT_TOP_K = int(os.getenv('CPT_PROMPT_TOP_K', '25'))
+# Labeled scenario corpus used for retrieval recall and benchmarks
+CPT_LABELED_SCENARIOS = os.path.join(BASE_DIR, 'data', 'labeled_scenarios.jsonl')
+# Recording used by `manage.py bench_cpt --backend record/replay`
+CPT_BENCH_RECORDING = os.path.join(BASE_DIR, 'data', 'bench_recording.jsonl')
+
+# Cache of final /analyze/ results keyed on normalized scenario, catalog, models and prompt version.
+# BACKEND is one of cpt_analyzer.cache.LocalLRUBackend, DjangoCacheBackend or SQLiteBackend
+# (set it to None to disable). TTL is in seconds.
+CPT_RESULT_CACHE = {
+    'BACKEND': os.getenv('CPT_RESULT_CACHE_BACKEND', 'cpt_analyzer.cache.LocalLRUBackend'),
+    'TTL': int(os.getenv('CPT_RESULT_CACHE_TTL', 60 * 60 * 24)),
+    'MAX_ENTRIES': int(os.getenv('CPT_RESULT_CACHE_MAX_ENTRIES', 512)),
+}
+
+# Identical scenarios submitted while one is being analyzed wait for it instead of calling the models
+# again (see cpt_analyzer.coalesce). LOCK_BACKEND extends this across worker processes on a host:
+# cpt_analyzer.coalesce.FileLockBackend or SQLiteLockBackend (None = per process only); the waiting
+# worker then reads the answer from the result cache, so pair it with a shared CPT_RESULT_CACHE.
+# WAIT_TIMEOUT (seconds) bounds the wait before a request analyzes on its own.
+CPT_COALESCE = {
+    'ENABLED': os.getenv('CPT_COALESCE_ENABLED', '1') == '1',
+    'LOCK_BACKEND': os.getenv('CPT_COALESCE_LOCK_BACKEND') or None,
+    'LOCK_OPTIONS': {},
+    'WAIT_TIMEOUT': float(os.getenv('CPT_COALESCE_WAIT_TIMEOUT', 120)),
+    'POLL_INTERVAL': 0.1,
+}
+
+# Admission control for POSTs to the analysis endpoints (see cpt_analyzer.admission): a token bucket per
+# client (CLIENT_HEADER, else the client address) of RATE requests/second with bursts of BURST, at most
+# MAX_CONCURRENT analyses per worker with MAX_QUEUE more waiting up to QUEUE_TIMEOUT seconds, and a token
+# quota per client per QUOTA_WINDOW seconds (QUOTAS per client, else QUOTA_TOKENS; 0 = unlimited).
+# Rejections are 429 (rate, quota) or 503 (saturated) with Retry-After. Use
+# cpt_analyzer.admission.SQLiteQuotaStore to share quota spend between worker processes.
+CPT_ADMISSION = {
+    'ENABLED': os.getenv('CPT_ADMISSION_ENABLED', '1') == '1',
+    'PATHS': ['/analyze/', '/jobs/'],
+    'CLIENT_HEADER': os.getenv('CPT_ADMISSION_CLIENT_HEADER', 'X-Client-ID'),
+    # Only behind a proxy that sets CLIENT_HEADER itself; otherwise clients are keyed by address
+    'TRUST_CLIENT_HEADER': os.getenv('CPT_ADMISSION_TRUST_CLIENT_HEADER', '0') == '1',
+    'RATE': float(os.getenv('CPT_ADMISSION_RATE', 2.0)),
+    'BURST': int(os.getenv('CPT_ADMISSION_BURST', 20)),
+    'MAX_CONCURRENT': int(os.getenv('CPT_ADMISSION_MAX_CONCURRENT', 32)),
+    'MAX_QUEUE': int(os.getenv('CPT_ADMISSION_MAX_QUEUE', 64)),
+    'QUEUE_TIMEOUT': float(os.getenv('CPT_ADMISSION_QUEUE_TIMEOUT', 10)),
+    'RETRY_AFTER': 2,
+    'QUOTA_TOKENS': int(os.getenv('CPT_ADMISSION_QUOTA_TOKENS', 0)),
+    'QUOTAS': {},
+    'QUOTA_WINDOW': int(os.getenv('CPT_ADMISSION_QUOTA_WINDOW', 86400)),
+    'QUOTA_BACKEND': os.getenv('CPT_ADMISSION_QUOTA_BACKEND', 'cpt_analyzer.admission.LocalQuotaStore'),
+    'QUOTA_OPTIONS': {},
+}
+
+# Nearest-neighbor index over validated, high-confidence results (see cpt_analyzer.semantic). A new
+# scenario at least REUSE_THRESHOLD cosine-similar to a prior one (same catalog version) gets that answer
+# back flagged `semantic_match` (None = never reuse); matches above FEW_SHOT_THRESHOLD are shown to the
+# analyzer as FEW_SHOT_EXAMPLES examples. Off by default: reused answers skip both model calls.
+CPT_SEMANTIC_CACHE = {
+    'ENABLED': os.getenv('CPT_SEMANTIC_CACHE_ENABLED', '0') == '1',
+    'PATH': os.getenv('CPT_SEMANTIC_CACHE_PATH', os.path.join(BASE_DIR, 'data', 'semantic_index')),
+    'DIMENSIONS': 1024,
+    'REUSE_THRESHOLD': 0.97,
+    'FEW_SHOT_THRESHOLD': 0.6,
+    'FEW_SHOT_EXAMPLES': 2,
+}
+
+# Guideline passages (see cpt_analyzer.guidelines). `manage.py ingest_guidelines` indexes SOURCE into INDEX_PATH;
+# each request then gets up to MAX_PASSAGES passages (MAX_TOKENS in total, BM25 score >= MIN_SCORE) in both
+# agents' prompts and as `guideline_citations` in the result. Nothing is added until the index exists.
+CPT_GUIDELINES = {
+    'ENABLED': os.getenv('CPT_GUIDELINES_ENABLED', '1') == '1',
+    'SOURCE': os.getenv('CPT_GUIDELINES_SOURCE', os.path.join(BASE_DIR, 'data', 'urinary system.pdf')),
+    'INDEX_PATH': os.getenv('CPT_GUIDELINES_INDEX', os.path.join(BASE_DIR, 'data', 'guideline_index')),
+    'MAX_PASSAGES': 3,
+    'MAX_TOKENS': 450,
+    'MIN_SCORE': 1.0,
+}
+
+# Batch coding (/analyze/batch/ and `manage.py code_scenarios`)
+CPT_BATCH_CONCURRENCY = int(os.getenv('CPT_BATCH_CONCURRENCY', 4))
+CPT_BATCH_MAX_RETRIES = int(os.getenv('CPT_BATCH_MAX_RETRIES', 3))
+CPT_BATCH_BACKOFF_SECONDS = float(os.getenv('CPT_BATCH_BACKOFF_SECONDS', 2.0))
+# Largest number of scenarios accepted by a single /analyze/batch/ request
+CPT_BATCH_MAX_SCENARIOS = int(os.getenv('CPT_BATCH_MAX_SCENARIOS', 500))
+
+# Optional override of the OpenAI API endpoint (e.g. a local stub server)
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL')
+
+# Shared OpenAI client pool, timeouts (seconds) and retry policy (see cpt_analyzer.clients)
+OPENAI_CLIENT = {
+    'CONNECT_TIMEOUT': float(os.getenv('OPENAI_CONNECT_TIMEOUT', 5)),
+    'READ_TIMEOUT': float(os.getenv('OPENAI_READ_TIMEOUT', 60)),
+    'MAX_CONNECTIONS': 20,
+    'MAX_KEEPALIVE_CONNECTIONS': 10,
+    'MAX_RETRIES': int(os.getenv('OPENAI_MAX_RETRIES', 3)),
+    'BACKOFF_BASE': 0.5,
+    'BACKOFF_MAX': 8.0,
+    # Model calls a single worker process may have in flight at once
+    'MAX_CONCURRENCY': int(os.getenv('OPENAI_MAX_CONCURRENCY', 8)),
+}
+
+# Default pipeline mode: 'full' (always validate), 'adaptive' (skip the validator when local
+# catalog checks pass), 'analyzer_only' or 'speculative' (run a second opinion alongside the analyzer
+# and validate only when they disagree). Requests may override it with {"mode": ...}.
+CPT_PIPELINE_MODE = os.getenv('CPT_PIPELINE_MODE', 'full')
+
+# Ask the models for schema-constrained JSON (disable for providers without json_schema support),
+# and re-prompt once for just the fields a response left out (see cpt_analyzer.parsing)
+CPT_STRUCTURED_OUTPUT = os.getenv('CPT_STRUCTURED_OUTPUT', '1') == '1'
+CPT_REPAIR_MISSING_FIELDS = os.getenv('CPT_REPAIR_MISSING_FIELDS', '1') == '1'
+
+# Deterministic modifier/bundling rules applied to the final codes (see cpt_analyzer.rules)
+CPT_RULES_ENABLED = os.getenv('CPT_RULES_ENABLED', '1') == '1'
+# NCCI-style procedure-to-procedure edits: column1,column2,modifier_indicator,rationale
+CPT_NCCI_EDITS_PATH = os.getenv('CPT_NCCI_EDITS_PATH', os.path.join(BASE_DIR, 'data', 'ncci_edits.csv'))
+# Remove codes bundled by an edit instead of only warning. The shipped table is a small sample:
+# enable this only once the real CMS PTP file has been converted into CPT_NCCI_EDITS_PATH.
+CPT_NCCI_EDITS_ENFORCE = os.getenv('CPT_NCCI_EDITS_ENFORCE', '0') == '1'
+# Add -51 to secondary procedures instead of only warning. Off by default: many payers apply the
+# multiple procedure reduction themselves and reject claims that carry -51.
+CPT_RULES_ADD_MODIFIER_51 = os.getenv('CPT_RULES_ADD_MODIFIER_51', '0') == '1'
+# Optional code,weight CSV (e.g. work RVUs) used to put the most resource-intensive code first
+CPT_CODE_WEIGHTS_PATH = os.getenv('CPT_CODE_WEIGHTS_PATH', os.path.join(BASE_DIR, 'data', 'cpt_weights.csv'))
+# Fallback sequencing weight by catalog category when a code has no explicit weight
+CPT_CATEGORY_WEIGHTS = {
+    'Renal Transplantation': 10,
+    'Excision': 8,
+    'Repair': 7,
+    'Laparoscopy': 7,
+    'Incision': 6,
+    'Endoscopy': 5,
+    'Removal': 3,
+    'Introduction': 3,
+    'Urodynamics': 2,
+}
+
+# Preprocessing before the agents (see cpt_analyzer.preprocess): boilerplate sections (history,
+# medications, vitals, ... plus STRIP_SECTIONS headings) and repeated sentences are removed, then the
+# scenario must fit MAX_SCENARIO_TOKENS and, together with prompts, catalog context and completions of
+# every agent call, MAX_REQUEST_TOKENS. ON_OVERFLOW is 'truncate' or 'reject' (HTTP 413).
+CPT_TOKEN_BUDGET = {
+    'ENABLED': os.getenv('CPT_TOKEN_BUDGET_ENABLED', '1') == '1',
+    'MAX_SCENARIO_TOKENS': int(os.getenv('CPT_MAX_SCENARIO_TOKENS', 2000)),
+    'MAX_REQUEST_TOKENS': int(os.getenv('CPT_MAX_REQUEST_TOKENS', 32000)),
+    'ON_OVERFLOW': os.getenv('CPT_TOKEN_BUDGET_OVERFLOW', 'truncate'),
+    'MIN_SCENARIO_TOKENS': 50,
+    'STRIP_SECTIONS': [],
+}
+# USD per million tokens, for the up-front cost estimate
+CPT_MODEL_PRICES = {
+    'gpt-4o': {'input': 2.50, 'cached_input': 1.25, 'output': 10.00},
+    'gpt-4o-mini': {'input': 0.15, 'cached_input': 0.075, 'output': 0.60},
+}
+
+# Model, temperature and max_tokens of each agent stage. 'analyzer_fast' is the cheaper first tier used
+# when CPT_MODEL_TIERING is enabled; 'second_opinion' only runs in the speculative pipeline mode.
+CPT_AGENT_MODELS = {
+    'analyzer': {
+        'MODEL': os.getenv('CPT_ANALYZER_MODEL', 'gpt-4o'),
+        'TEMPERATURE': float(os.getenv('CPT_ANALYZER_TEMPERATURE', 0.1)),
+        'MAX_TOKENS': int(os.getenv('CPT_ANALYZER_MAX_TOKENS', 800)),
+    },
+    'analyzer_fast': {
+        'MODEL': os.getenv('CPT_ANALYZER_FAST_MODEL', 'gpt-4o-mini'),
+        'TEMPERATURE': float(os.getenv('CPT_ANALYZER_FAST_TEMPERATURE', 0.1)),
+        'MAX_TOKENS': int(os.getenv('CPT_ANALYZER_FAST_MAX_TOKENS', 800)),
+    },
+    'validator': {
+        'MODEL': os.getenv('CPT_VALIDATOR_MODEL', 'gpt-4o'),
+        'TEMPERATURE': float(os.getenv('CPT_VALIDATOR_TEMPERATURE', 0.1)),
+        'MAX_TOKENS': int(os.getenv('CPT_VALIDATOR_MAX_TOKENS', 1000)),
+    },
+    'second_opinion': {
+        'MODEL': os.getenv('CPT_SECOND_OPINION_MODEL', 'gpt-4o'),
+        'TEMPERATURE': float(os.getenv('CPT_SECOND_OPINION_TEMPERATURE', 0.1)),
+        'MAX_TOKENS': int(os.getenv('CPT_SECOND_OPINION_MAX_TOKENS', 600)),
+    },
+}
+
+# Model tiering (see cpt_analyzer.tiering): the analyzer answers on 'analyzer_fast' first and is re-run on
+# 'analyzer' only when an ESCALATE_ON trigger fires: 'check_failed' (local catalog checks reject the answer),
+# 'low_confidence' (local confidence below MIN_CONFIDENCE) or 'multi_procedure'. Decisions are logged and,
+# with LOG_PATH set, appended there as JSON lines for tuning against the benchmark corpus.
+CPT_MODEL_TIERING = {
+    'ENABLED': os.getenv('CPT_MODEL_TIERING_ENABLED', '0') == '1',
+    'ESCALATE_ON': ['check_failed', 'low_confidence', 'multi_procedure'],
+    'MIN_CONFIDENCE': os.getenv('CPT_MODEL_TIERING_MIN_CONFIDENCE', 'High'),
+    'LOG_PATH': os.getenv('CPT_MODEL_TIERING_LOG', ''),
+}
+
+# Queued analyses (/analyze/ with {"async": true}, /jobs/; see cpt_analyzer.jobs). WORKERS is the number of
+# worker threads each web process starts on first use (0 = leave jobs to `manage.py run_jobs`). A job
+# running longer than STALE_AFTER seconds is assumed lost and requeued, up to MAX_ATTEMPTS times.
+# CALLBACK_ALLOWED_HOSTS limits where results may be POSTed: empty turns callbacks off, '*' allows any
+# host. Hosts resolving to loopback, private or link-local addresses are always refused.
+CPT_JOBS = {
+    'WORKERS': int(os.getenv('CPT_JOB_WORKERS', 2)),
+    'POLL_INTERVAL': 1.0,
+    'STALE_AFTER': int(os.getenv('CPT_JOB_STALE_AFTER', 600)),
+    'MAX_ATTEMPTS': 3,
+    'CALLBACK_TIMEOUT': 10,
+    'CALLBACK_RETRIES': 3,
+    'CALLBACK_ALLOWED_HOSTS': [host for host in os.getenv('CPT_JOB_CALLBACK_HOSTS', '').split(',') if host],
+}
+
+# Store every analysis (see cpt_analyzer.audit); batch runs bulk-insert CPT_AUDIT_BATCH_SIZE rows at a time
+CPT_AUDIT_ENABLED = os.getenv('CPT_AUDIT_ENABLED', '1') == '1'
+CPT_AUDIT_BATCH_SIZE = int(os.getenv('CPT_AUDIT_BATCH_SIZE', '200'))
+
+# Instrumentation: Prometheus text metrics at /metrics and Server-Timing headers on /analyze/ (see cpt_analyzer.metrics)
+CPT_METRICS_ENABLED = os.getenv('CPT_METRICS_ENABLED', '1') == '1'
+CPT_SERVER_TIMING = os.getenv('CPT_SERVER_TIMING', '1') == '1'